@@ -572,6 +572,64 @@
 allow_template_database_functions_in_composites = False
 
 
+#: Use compact in-memory tables for very large libraries
+# calibre keeps the metadata for every book in the library in memory. By
+# default it uses data structures optimized for speed. For libraries with
+# hundreds of thousands of books these can use a lot of memory. Setting this
+# to True makes calibre store the metadata in compact arrays instead, using
+# much less memory at the cost of slightly slower sorting and searching.
+# Default: False
+compact_in_memory_tables = False
+
+
+#: Save a snapshot of the in-memory tables to speed up opening large libraries
+# When opening a library, calibre reads the metadata for every book from
+# metadata.db, which can take a long time for very large libraries. Setting
+# this to True makes calibre save a snapshot of this data in the file
+# metadata.db.snapshot next to metadata.db. The next time the library is
+# opened, if metadata.db has not been changed since the snapshot was saved,
+# the data is loaded from the snapshot instead, which is much faster.
+# Default: False
+save_table_snapshot = False
+
+
+#: Save the values of composite columns to speed up opening large libraries
+# Composite columns, columns built from other columns, are computed for every
+# book the first time they are sorted or searched on after calibre starts,
+# which can take a long time for very large libraries. Setting this to True
+# makes calibre save the computed values in the file metadata.db.composites
+# next to metadata.db when the library is closed. The saved value for a book
+# is used until the book is changed. Note that this means that values of
+# templates that depend on anything other than the book itself, such as the
+# current date, other books or the connected device can be out of date after
+# a restart, until the book is changed.
+# Default: False
+save_composite_column_values = False
+
+
+#: Use an index to speed up searching text fields in very large libraries
+# When searching fields such as tags, authors and series, calibre checks every
+# value in the field against the search. For libraries with hundreds of
+# thousands of books, this can be slow. Setting this to True makes calibre
+# maintain an index of the values in these fields, which is used to quickly
+# find the values that could match, at the cost of some extra memory.
+# Default: False
+index_text_fields_for_search = False
+
+
+#: Use write-ahead logging for the library databases
+# Setting this to True makes calibre use SQLite's write-ahead log (WAL) for
+# metadata.db, full-text-search.db and notes.db. Then reading data from the
+# library, for example, by the Content server or by calibredb, is not blocked
+# while the library is being changed, and reads in different threads can
+# happen in parallel. WAL is safe only for libraries on local disks, so it is
+# not used for libraries on FAT filesystems or network shares, as far as
+# calibre can detect them. Do not set this if your library is on a network
+# share.
+# Default: False
+use_wal_for_databases = False
+
+
 #: Change the programs that are run when opening files/URLs
 # By default, calibre passes URLs to the operating system to open using
 # whatever default programs are configured there. Here you can override
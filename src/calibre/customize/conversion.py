@@ -357,6 +357,8 @@ def specialize_css_for_output(self, log, opts, item, stylizer):
                          item. You can get the style for any element by
                          stylizer.style(element).
 
+        This may be called in a worker process, see the max_workers
+        conversion option, so it must only change item and stylizer.
         '''
         pass
 
@@ -15,8 +15,10 @@
 import sys
 import time
 import uuid
+import weakref
 from contextlib import closing, suppress
 from functools import partial
+from threading import local
 
 import apsw
 
@@ -35,6 +37,7 @@
 )
 from calibre.db.errors import NoSuchFormat
 from calibre.db.schema_upgrades import SchemaUpgrade
+from calibre.db.snapshot import db_state_key, encode_snapshot, read_snapshot, write_snapshot
 from calibre.db.tables import (
     AuthorsTable,
     CompositeTable,
@@ -64,6 +67,7 @@
     hardlink_file,
     is_case_sensitive,
     is_fat_filesystem,
+    is_network_filesystem,
     make_long_path_useable,
     remove_dir_if_empty,
     samefile,
@@ -364,17 +368,23 @@ def save_annotations_list_to_cursor(cursor, alist, sync_annots_user, book_id, bo
 class Connection(apsw.Connection):  # {{{
 
     BUSY_TIMEOUT = 10000  # milliseconds
+    WAL_SIZE_LIMIT = 64 * 1024 * 1024  # bytes, the WAL file is truncated to this size after checkpoints
 
-    def __init__(self, path):
+    def __init__(self, path, use_wal=False, read_only=False):
         from calibre.utils.localization import get_lang
         from calibre_extensions.sqlite_extension import set_ui_language
         set_ui_language(get_lang())
-        super().__init__(path)
+        if read_only:
+            super().__init__(path, flags=apsw.SQLITE_OPEN_READONLY)
+        else:
+            super().__init__(path)
         plugins.load_apsw_extension(self, 'sqlite_extension')
         self.fts_dbpath = self.notes_dbpath = None
+        self.use_wal, self.read_only = use_wal, read_only
 
         self.setbusytimeout(self.BUSY_TIMEOUT)
         self.execute('PRAGMA cache_size=-5000; PRAGMA temp_store=2; PRAGMA foreign_keys=ON;')
+        self.set_journal_mode('main')
 
         encoding = next(self.execute('PRAGMA encoding'))[0]
         self.createcollation('PYNOCASE', partial(pynocase,
@@ -402,6 +412,22 @@ def __init__(self, path):
         self.createaggregatefunction('aum_sortconcat',
                 AumSortedConcatenate, 4)
 
+    def set_journal_mode(self, schema):
+        ''' Switch the specified database to or from WAL mode. The journal mode
+        is stored in the database file, so it is only changed when needed. '''
+        if self.read_only:
+            return
+        mode = (self.get(f'PRAGMA {schema}.journal_mode', all=False) or '').lower()
+        if self.use_wal:
+            if mode != 'wal':
+                self.execute(f'PRAGMA {schema}.journal_mode=WAL')
+            self.execute(f'PRAGMA {schema}.journal_size_limit={self.WAL_SIZE_LIMIT}')
+        elif mode == 'wal':
+            # Fails if some other process is using the database, in which
+            # case the switch happens the next time it is opened
+            with suppress(apsw.BusyError):
+                self.execute(f'PRAGMA {schema}.journal_mode=DELETE')
+
     def create_dynamic_filter(self, name):
         f = DynamicFilter(name)
         self.createscalarfunction(name, f, 1)
@@ -466,6 +492,12 @@ def __init__(self, library_path, default_prefs=None, read_only=False,
                  restore_all_prefs=False, progress_callback=lambda x, y:True,
                  load_user_formatter_functions=True, temp_db_path=None):
         self.is_closed = False
+        # The table snapshot is not used for read only libraries as those
+        # work on a temporary copy of metadata.db
+        self.use_table_snapshot = tweaks['save_table_snapshot'] and not read_only
+        self.save_composite_values = tweaks['save_composite_column_values'] and not read_only
+        self.tables_loaded_from_snapshot = False
+        self.snapshot_key = self.snapshot_data_version = None
         if isbytestring(library_path):
             library_path = library_path.decode(filesystem_encoding)
         self.field_metadata = FieldMetadata()
@@ -500,11 +532,21 @@ def __init__(self, library_path, default_prefs=None, read_only=False,
             pt = PersistentTemporaryFile('_metadata_ro.db')
             pt.close()
             shutil.copyfile(self.dbpath, pt.name)
+            if os.path.exists(self.dbpath + '-wal'):
+                # The library is open in WAL mode, changes not yet checkpointed are in the WAL file
+                shutil.copyfile(self.dbpath + '-wal', pt.name + '-wal')
             self.dbpath = pt.name
 
         if not os.path.exists(os.path.dirname(self.dbpath)):
             os.makedirs(os.path.dirname(self.dbpath))
 
+        # WAL mode needs shared memory, which does not work on network
+        # filesystems, so it is used only for libraries on local disks
+        self.use_wal = bool(
+            tweaks['use_wal_for_databases'] and not read_only and temp_db_path is None and
+            not is_fat_filesystem(self.dbpath) and not is_network_filesystem(self.dbpath))
+        self.reader_local = local()
+        self.readers = weakref.WeakSet()
         self._conn = None
         if self.user_version == 0:
             self.initialize_database()
@@ -1009,13 +1051,13 @@ def rename_category_item(self, field_name, table_name, link_table_name, link_col
                      (new_item_id, old_item_id, old_item_id))
 
     def notes_for(self, field_name, item_id):
-        return self.notes.get_note(self.conn, field_name, item_id) or ''
+        return self.notes.get_note(self.reader, field_name, item_id) or ''
 
     def notes_data_for(self, field_name, item_id):
-        return self.notes.get_note_data(self.conn, field_name, item_id)
+        return self.notes.get_note_data(self.reader, field_name, item_id)
 
     def get_all_items_that_have_notes(self, field_name):
-        return self.notes.get_all_items_that_have_notes(self.conn, field_name)
+        return self.notes.get_all_items_that_have_notes(self.reader, field_name)
 
     def set_notes_for(self, field, item_id, doc: str, searchable_text: str, resource_hashes, remove_unused_resources) -> int:
         id_val = self.tables[field].id_map[item_id]
@@ -1032,7 +1074,7 @@ def add_notes_resource(self, path_or_stream, name, mtime=None) -> int:
         return self.notes.add_resource(self.conn, path_or_stream, name, mtime=mtime)
 
     def get_notes_resource(self, resource_hash) -> dict | None:
-        return self.notes.get_resource_data(self.conn, resource_hash)
+        return self.notes.get_resource_data(self.reader, resource_hash)
 
     def notes_resources_used_by(self, field, item_id):
         conn = self.conn
@@ -1047,7 +1089,7 @@ def search_notes(self,
         fts_engine_query, use_stemming, highlight_start, highlight_end, snippet_size, restrict_to_fields, return_text, process_each_result, limit
     ):
         yield from self.notes.search(
-            self.conn, fts_engine_query, use_stemming, highlight_start, highlight_end, snippet_size, restrict_to_fields, return_text,
+            self.reader, fts_engine_query, use_stemming, highlight_start, highlight_end, snippet_size, restrict_to_fields, return_text,
             process_each_result, limit)
 
     def export_notes_data(self, outfile):
@@ -1099,6 +1141,10 @@ def enable_fts(self, dbref=None):
     def fts_enabled(self):
         return getattr(self, 'fts', None) is not None
 
+    @property
+    def fts_bulk_indexing(self):
+        return self.fts_enabled and self.fts.pool.bulk_indexing
+
     @property
     def fts_has_idle_workers(self):
         return self.fts_enabled and self.fts.pool.num_of_idle_workers > 0
@@ -1115,8 +1161,12 @@ def fts_num_of_workers(self, num):
     def get_next_fts_job(self):
         return self.fts.get_next_fts_job()
 
+    def end_fts_bulk_indexing_if_done(self):
+        return self.fts.end_bulk_indexing_if_done()
+
     def reindex_fts(self):
         if self.conn.fts_dbpath:
+            self.close_readers()
             self.conn.execute('DETACH fts_db')
             os.remove(self.conn.fts_dbpath)
             self.conn.fts_dbpath = None
@@ -1131,6 +1181,13 @@ def commit_fts_result(self, book_id, fmt, fmt_size, fmt_hash, text, err_msg):
         if self.fts is not None:
             return self.fts.commit_result(book_id, fmt, fmt_size, fmt_hash, text, err_msg)
 
+    def commit_fts_results(self, results):
+        if self.fts is not None:
+            return self.fts.commit_results(results)
+
+    def start_fts_bulk_indexing(self):
+        self.fts.start_bulk_indexing()
+
     def fts_unindex(self, book_id, fmt=None):
         self.fts.unindex(book_id, fmt=fmt)
 
@@ -1158,14 +1215,60 @@ def get_connection(self):
     @property
     def conn(self):
         if self._conn is None:
-            self._conn = Connection(self.dbpath)
+            self._conn = Connection(self.dbpath, use_wal=self.use_wal)
             self.is_closed = False
             if self._exists and self.user_version == 0:
                 self._conn.close()
                 os.remove(self.dbpath)
-                self._conn = Connection(self.dbpath)
+                self._conn = Connection(self.dbpath, use_wal=self.use_wal)
         return self._conn
 
+    @property
+    def reader(self):
+        ''' A connection to use for only reading data. In WAL mode every thread
+        gets its own read-only connection, so that reads are not blocked by
+        writes or by reads in other threads. Otherwise, or if the main
+        connection is in a transaction, so that uncommitted changes are
+        visible, this is the main connection. '''
+        conn = self.conn
+        if not self.use_wal:
+            return conn
+        try:
+            if not conn.getautocommit():
+                return conn
+        except apsw.ThreadingViolationError:
+            pass  # The main connection is being used by another thread
+        ans = getattr(self.reader_local, 'conn', None)
+        if ans is None:
+            ans = self.reader_local.conn = Connection(self.dbpath, use_wal=True, read_only=True)
+            self.readers.add(ans)
+        # Keep the attached databases the same as those of the main connection
+        for schema, attr in (('fts_db', 'fts_dbpath'), ('notes_db', 'notes_dbpath')):
+            path = getattr(conn, attr)
+            if getattr(ans, attr) != path:
+                if getattr(ans, attr) is not None:
+                    ans.execute(f'DETACH DATABASE {schema}')
+                if path is not None:
+                    ans.execute(f'ATTACH DATABASE ? AS {schema}', (path,))
+                setattr(ans, attr, path)
+        return ans
+
+    def close_readers(self):
+        for conn in tuple(self.readers):
+            conn.close(True)
+        self.readers.clear()
+        self.reader_local = local()
+
+    def checkpoint_wal(self, truncate=False):
+        ''' Copy the changes in the WAL files into the databases, so the WAL
+        files can be re-used from the start. SQLite does this automatically
+        after commits, but cannot if there are readers using the WAL file at
+        that time, so this is also done when the library is closed. '''
+        if self.use_wal and self._conn is not None:
+            mode = apsw.SQLITE_CHECKPOINT_TRUNCATE if truncate else apsw.SQLITE_CHECKPOINT_PASSIVE
+            with suppress(apsw.BusyError):
+                self._conn.wal_checkpoint(mode=mode)
+
     def execute(self, sql, bindings=None):
         try:
             return self.conn.cursor().execute(sql, bindings)
@@ -1212,6 +1315,14 @@ def custom_field_metadata(self, label=None, num=None):
             return self.custom_column_label_map[label]
         return self.custom_column_num_map[num]
 
+    def custom_columns_changed(self):
+        ''' True if custom columns have been created, renamed or marked for
+        deletion in the database since it was opened, for example, by another
+        process. The database has to be opened again for such changes. '''
+        in_db = {r[0]: (r[1], r[2], r[3], bool(r[4]), bool(r[5])) for r in self.conn.get(
+            'SELECT id,label,name,datatype,is_multiple,normalized FROM custom_columns WHERE mark_for_delete=0')}
+        return in_db != {num: (d['label'], d['name'], d['datatype'], d['is_multiple'], d['normalized']) for num, d in self.custom_column_num_map.items()}
+
     def set_custom_column_metadata(self, num, name=None, label=None, is_editable=None, display=None):
         changed = False
         if name is not None:
@@ -1402,6 +1513,9 @@ def close(self, force=True, unload_formatter_functions=True):
                     unload_user_template_functions(self.library_id)
                 except Exception:
                     pass
+            self.save_table_snapshot()
+            self.close_readers()
+            self.checkpoint_wal(truncate=True)
             self._conn.close(force)
             del self._conn
             self.is_closed = True
@@ -1410,6 +1524,9 @@ def reopen(self, force=True):
         self.close(force=force, unload_formatter_functions=False)
         self._conn = None
         self.conn
+        if self.snapshot_data_version is not None:
+            # data_version values are only comparable for the same connection
+            self.snapshot_data_version = self.get('PRAGMA data_version', all=False)
         self.notes.reopen(self)
 
     def dump_and_restore(self, callback=None, sql=None):
@@ -1483,9 +1600,12 @@ def __exit__(self, exc_type, exc_value, tb):
         self.conn.__exit__(exc_type, exc_value, tb)
 
     def clone_for_readonly_access(self, dest_dir: str) -> str:
+        self.checkpoint_wal()
         dbpath = os.path.abspath(self.conn.db_filename('main'))
         clone_db_path = os.path.join(dest_dir, os.path.basename(dbpath))
         shutil.copy2(dbpath, clone_db_path)
+        if os.path.exists(dbpath + '-wal'):
+            shutil.copy2(dbpath + '-wal', clone_db_path + '-wal')
         notes_dir = os.path.join(os.path.dirname(dbpath), NOTES_DIR_NAME)
         if os.path.exists(notes_dir):
             shutil.copytree(notes_dir, os.path.join(dest_dir, NOTES_DIR_NAME))
@@ -1586,22 +1706,84 @@ def library_id(self, val):
 
     def last_modified(self):
         ''' Return last modified time as a UTC datetime object '''
-        return utcfromtimestamp(os.stat(self.dbpath).st_mtime)
+        mtime = os.stat(self.dbpath).st_mtime
+        if self.use_wal:
+            # In WAL mode, changes are written to the WAL file
+            with suppress(OSError):
+                mtime = max(mtime, os.stat(self.dbpath + '-wal').st_mtime)
+        return utcfromtimestamp(mtime)
 
     def read_tables(self):
         '''
         Read all data from the db into the python in-memory tables
         '''
+        state = None
+        if self.use_table_snapshot:
+            try:
+                self.snapshot_key = db_state_key(self.dbpath)
+                state = read_snapshot(self.dbpath, self.snapshot_key, self.tables)
+            except Exception:
+                prints('Failed to read table snapshot, ignoring')
+                import traceback
+                traceback.print_exc()
+                state = None
+        self.tables_loaded_from_snapshot = state is not None
 
         with self.conn:  # Use a single transaction, to ensure nothing modifies the db while we are reading
             for table in itervalues(self.tables):
                 try:
-                    table.read(self)
+                    if state is None:
+                        table.read(self)
+                    else:
+                        table.restore_snapshot(state[table.name])
                 except Exception:
                     prints('Failed to read table:', table.name)
                     import pprint
                     pprint.pprint(table.metadata)
                     raise
+            if self.use_table_snapshot:
+                self.snapshot_data_version = self.get('PRAGMA data_version', all=False)
+        del state
+        if self.use_table_snapshot and not self.tables_loaded_from_snapshot:
+            self.snapshot_key = None
+            self.save_table_snapshot()
+        if tweaks['compact_in_memory_tables']:
+            self.compact_tables()
+
+    def save_table_snapshot(self):
+        '''
+        Save a snapshot of the python in-memory tables, if they have changed
+        since they were read or last saved, see :mod:`calibre.db.snapshot`.
+        Must be called with the tables locked.
+        '''
+        if self.snapshot_data_version is None:
+            return
+        try:
+            # Prevent other processes from changing the db while the snapshot is created
+            self.execute('BEGIN IMMEDIATE')
+            try:
+                if self.get('PRAGMA data_version', all=False) != self.snapshot_data_version:
+                    # Some other process has changed the db so the in-memory
+                    # tables may no longer match it
+                    return
+                key = db_state_key(self.dbpath)
+                if key != self.snapshot_key:
+                    write_snapshot(self.dbpath, key, encode_snapshot(self.tables))
+                    self.snapshot_key = key
+            finally:
+                self.execute('COMMIT')
+        except Exception:
+            prints('Failed to save table snapshot, ignoring')
+            import traceback
+            traceback.print_exc()
+
+    def compact_tables(self):
+        '''
+        Switch the python in-memory tables to the compact, array backed
+        representation, see :mod:`calibre.db.columnar`
+        '''
+        for table in itervalues(self.tables):
+            table.compact()
 
     def find_path_for_book(self, book_id):
         q = BOOK_ID_PATH_TEMPLATE.format(book_id)
@@ -2389,11 +2571,11 @@ def safe_load(val):
         if len(book_ids) == 1:
             bid = next(iter(book_ids))
             ans = {book_id:safe_load(val) for book_id, val in
-                   self.execute('SELECT book, val FROM books_plugin_data WHERE book=? AND name=?', (bid, name))}
+                   self.reader.execute('SELECT book, val FROM books_plugin_data WHERE book=? AND name=?', (bid, name))}
             return ans or {bid:default}
 
         ans = {}
-        for book_id, val in self.execute(
+        for book_id, val in self.reader.execute(
             'SELECT book, val FROM books_plugin_data WHERE name=?', (name,)):
             if not book_ids or book_id in book_ids:
                 val = safe_load(val)
@@ -2417,11 +2599,14 @@ def dirty_books(self, book_ids):
     def mark_book_as_clean(self, book_id):
         self.execute('DELETE FROM metadata_dirtied WHERE book=?', (book_id,))
 
+    def mark_books_as_clean(self, book_ids):
+        self.executemany('DELETE FROM metadata_dirtied WHERE book=?', ((x,) for x in book_ids))
+
     def get_ids_for_custom_book_data(self, name):
-        return frozenset(r[0] for r in self.execute('SELECT book FROM books_plugin_data WHERE name=?', (name,)))
+        return frozenset(r[0] for r in self.reader.execute('SELECT book FROM books_plugin_data WHERE name=?', (name,)))
 
     def annotations_for_book(self, book_id, fmt, user_type, user):
-        yield from annotations_for_book(self.conn, book_id, fmt, user_type, user)
+        yield from annotations_for_book(self.reader, book_id, fmt, user_type, user)
 
     def save_annotations_list(self, book_id, book_fmt, sync_annots_user, alist):
         conn = self.conn
@@ -2457,7 +2642,7 @@ def search_annotations(self,
         query += f' ORDER BY {fts_table}.rank '
         ls = json.loads
         try:
-            for (rowid, book_id, fmt, user_type, user, annot_data, text) in self.execute(query, tuple(data)):
+            for (rowid, book_id, fmt, user_type, user, annot_data, text) in self.reader.execute(query, tuple(data)):
                 if restrict_to_book_ids is not None and book_id not in restrict_to_book_ids:
                     continue
                 try:
@@ -2479,7 +2664,7 @@ def search_annotations(self,
             raise FTSQueryError(fts_engine_query, query, e)
 
     def all_annotations_for_book(self, book_id, ignore_removed=False):
-        for (fmt, user_type, user, data) in self.execute(
+        for (fmt, user_type, user, data) in self.reader.execute(
             'SELECT format, user_type, user, annot_data FROM annotations WHERE book=?', (book_id,)
         ):
             try:
@@ -2543,7 +2728,7 @@ def all_annotations(self, restrict_to_user=None, limit=None, annotation_type=Non
             q += ' WHERE ' + ' AND '.join(restrict_clauses)
         q += ' ORDER BY timestamp DESC '
         count = 0
-        for (rowid, book_id, fmt, user_type, user, annot_data) in self.execute(q, tuple(data)):
+        for (rowid, book_id, fmt, user_type, user, annot_data) in self.reader.execute(q, tuple(data)):
             if restrict_to_book_ids is not None and book_id not in restrict_to_book_ids:
                 continue
             try:
@@ -2572,10 +2757,10 @@ def all_annotations(self, restrict_to_user=None, limit=None, annotation_type=Non
                 break
 
     def all_annotation_users(self):
-        return self.execute('SELECT DISTINCT user_type, user FROM annotations')
+        return self.reader.execute('SELECT DISTINCT user_type, user FROM annotations')
 
     def all_annotation_types(self):
-        for x in self.execute('SELECT DISTINCT annot_type FROM annotations'):
+        for x in self.reader.execute('SELECT DISTINCT annot_type FROM annotations'):
             yield x[0]
 
     def set_annotations_for_book(self, book_id, fmt, annots_list, user_type='local', user='viewer'):
@@ -2600,7 +2785,7 @@ def dirty_books_with_dirtied_annotations(self):
         return changed
 
     def annotation_count_for_book(self, book_id):
-        for (count,) in self.execute('''
+        for (count,) in self.reader.execute('''
                  SELECT count(id) FROM annotations
                  WHERE book=? AND json_extract(annot_data, '$.removed') IS NULL
                  ''', (book_id,)):
@@ -2614,7 +2799,7 @@ def reindex_annotations(self):
         '''.format('annotations_fts', 'annotations_fts_stemmed'))
 
     def conversion_options(self, book_id, fmt):
-        for (data,) in self.conn.get('SELECT data FROM conversion_options WHERE book=? AND format=?', (book_id, fmt.upper())):
+        for (data,) in self.reader.get('SELECT data FROM conversion_options WHERE book=? AND format=?', (book_id, fmt.upper())):
             if data:
                 try:
                     return unpickle_binary_string(bytes(data))
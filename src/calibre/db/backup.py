@@ -8,7 +8,9 @@
 import sys
 import traceback
 import weakref
+from concurrent.futures import ThreadPoolExecutor
 from threading import Event, Thread
+from time import monotonic, thread_time
 
 from calibre.ebooks.metadata.opf2 import metadata_to_opf
 
@@ -27,9 +29,17 @@ class MetadataBackup(Thread):
     Continuously backup changed metadata into OPF files
     in the book directory. This class runs in its own
     thread.
+
+    When many books are dirtied, for example by a bulk edit, they are backed
+    up in batches of batch_size books. The metadata for the books is read one
+    book at a time, pausing between books for longer when the library is busy,
+    which is detected by this thread having to wait for the database lock or
+    for other threads holding the GIL. The OPFs are then rendered and written
+    by a pool of num_workers threads and the books are marked as clean in a
+    single transaction. Set batch_size to one to backup one book at a time.
     '''
 
-    def __init__(self, db, interval=2, scheduling_interval=0.1):
+    def __init__(self, db, interval=2, scheduling_interval=0.1, batch_size=100, num_workers=4):
         Thread.__init__(self)
         self.daemon = True
         self._db = weakref.ref(getattr(db, 'new_api', db))
@@ -37,6 +47,14 @@ def __init__(self, db, interval=2, scheduling_interval=0.1):
         self.interval = interval
         self.scheduling_interval = scheduling_interval
         self.check_dirtied_annotations = 0
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.executor = None
+        # The pause between books in a batch, adapted to how busy the library is
+        self.pause = scheduling_interval
+        # Books that could not be backed up in a batch, mapped to their dirtied
+        # sequence numbers, they are retried by do_one() or once dirtied again
+        self.failed_in_batch = {}
 
     @property
     def db(self):
@@ -57,8 +75,82 @@ def run(self):
             try:
                 self.wait(self.interval)
                 self.do_one()
+                while self.batch_size > 1 and self.do_batch():
+                    pass
             except Abort:
                 break
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+    def adapt_pause(self, wall_time, cpu_time):
+        # If this thread spent more time waiting than working, something else
+        # is using the library, so back off, otherwise speed up
+        if wall_time - cpu_time > max(cpu_time, 0.001):
+            self.pause = min(self.interval, max(2 * self.pause, 0.01))
+        else:
+            self.pause = self.pause / 2 if self.pause > 0.001 else 0
+
+    def render_and_write(self, book_id, mi):
+        raw = metadata_to_opf(mi)
+        self.db.write_backup(book_id, raw)
+
+    def do_batch(self):
+        ''' Backup a batch of dirtied books. Returns True if there may be
+        more dirtied books left. '''
+        try:
+            book_ids = self.db.get_dirtied_books(self.batch_size, exclude=self.failed_in_batch)
+            if not book_ids and not self.db.dirty_queue_length():
+                self.failed_in_batch.clear()
+        except Abort:
+            raise
+        except Exception:
+            # Happens during interpreter shutdown
+            return False
+        if not book_ids:
+            return False
+        for book_id in book_ids:
+            # Dirtied again since it failed
+            self.failed_in_batch.pop(book_id, None)
+
+        done, jobs = {}, []
+        for book_id in book_ids:
+            self.wait(self.pause)
+            st, cst = monotonic(), thread_time()
+            try:
+                mi, sequence = self.db.get_metadata_for_dump(book_id)
+            except Abort:
+                raise
+            except Exception:
+                prints('Failed to get backup metadata for id:', book_id)
+                traceback.print_exc()
+                self.failed_in_batch[book_id] = book_ids[book_id]
+                continue
+            self.adapt_pause(monotonic() - st, thread_time() - cst)
+            if mi is None:
+                done[book_id] = sequence
+            else:
+                jobs.append((book_id, sequence, mi))
+
+        if jobs:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.num_workers, thread_name_prefix='MetadataBackup')
+            futures = [(book_id, sequence, self.executor.submit(self.render_and_write, book_id, mi)) for book_id, sequence, mi in jobs]
+            for book_id, sequence, future in futures:
+                try:
+                    future.result()
+                except Abort:
+                    raise
+                except Exception:
+                    prints('Failed to write backup metadata for id:', book_id)
+                    traceback.print_exc()
+                    self.failed_in_batch[book_id] = book_ids[book_id]
+                else:
+                    done[book_id] = sequence
+        self.wait(0)
+        if done:
+            self.db.clear_dirtied_books(done)
+        return len(book_ids) >= self.batch_size
 
     def do_one(self):
         self.check_dirtied_annotations += 1
@@ -98,6 +190,7 @@ def do_one(self):
 
         if mi is None:
             self.db.clear_dirtied(book_id, sequence)
+            self.failed_in_batch.pop(book_id, None)
             return
 
         # Give the GUI thread a chance to do something. Python threads don't
@@ -111,6 +204,7 @@ def do_one(self):
             prints('Failed to convert to opf for id:', book_id)
             traceback.print_exc()
             self.db.clear_dirtied(book_id, sequence)
+            self.failed_in_batch.pop(book_id, None)
             return
 
         self.wait(self.scheduling_interval)
@@ -129,6 +223,7 @@ def do_one(self):
                 return
 
         self.db.clear_dirtied(book_id, sequence)
+        self.failed_in_batch.pop(book_id, None)
 
     def break_cycles(self):
         # Legacy compatibility
@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+Sets of book ids stored as bitmaps. Book ids are small, dense, positive
+integers, so a set of them is stored as the bits of a python int. This uses
+one bit per book in the library rather than around sixty bytes per member for
+a python set, and/or/andnot between two bitmaps are single operations on
+ints, running in C. Copying is free, as ints are immutable.
+
+Both classes implement the full set API, and compare equal to sets with the
+same members, so they can be used wherever a set of book ids is expected.
+Note that intersecting a python set with a bitmap, as in
+``pyset.intersection(bitmap)``, iterates over the bitmap, use ``pyset &
+bitmap`` or :meth:`BookIdSetBase.frozen` instead.
+'''
+
+from collections import deque
+from collections.abc import MutableSet, Set
+from itertools import repeat
+
+# The positions of the set bits in every byte value
+BIT_POSITIONS = tuple(tuple(i for i in range(8) if b & (1 << i)) for b in range(256))
+# Number of membership tests using the bitmap before a frozenset is built for
+# them, testing a bit needs to shift the whole bitmap
+MAX_BITMAP_LOOKUPS = 16
+
+
+def bits_for(iterable):
+    ' Return the bitmap for the specified book ids '
+    if isinstance(iterable, BookIdSetBase):
+        return iterable.bits
+    ids = iterable if isinstance(iterable, (set, frozenset, list, tuple, range)) else tuple(iterable)
+    if not ids:
+        return 0
+    if min(ids) < 0:
+        raise ValueError('Book ids must not be negative')
+    if len(ids) < 8:
+        bits = 0
+        for i in ids:
+            bits |= 1 << i
+        return bits
+    # Setting one byte per book id in C and parsing the bytes as a binary
+    # number is much faster than setting bits in a python loop
+    buf = bytearray(b'0') * (max(ids) + 1)
+    deque(map(buf.__setitem__, ids, repeat(ord('1'))), maxlen=0)
+    buf.reverse()
+    return int(buf, 2)
+
+
+def as_frozenset(book_ids):
+    ' Return book_ids, which can be a bitmap or any iterable, as a frozenset '
+    return book_ids.frozen() if isinstance(book_ids, BookIdSetBase) else frozenset(book_ids)
+
+
+def iter_bits(bits):
+    ' Yield the positions of the set bits in increasing order '
+    if bits:
+        for offset, b in enumerate(bits.to_bytes((bits.bit_length() + 7) >> 3, 'little')):
+            if b:
+                base = offset << 3
+                for i in BIT_POSITIONS[b]:
+                    yield base + i
+
+
+class BookIdSetBase(Set):
+
+    __slots__ = ('_bits', '_lookups', '_members')
+
+    def __init__(self, iterable=()):
+        self._bits = bits_for(iterable)
+        self._lookups = 0
+        # Members are shared with the bitmap being copied, as they are immutable
+        if isinstance(iterable, BookIdSetBase):
+            self._members = iterable._members
+        else:
+            self._members = iterable if isinstance(iterable, frozenset) else None
+
+    @classmethod
+    def from_bits(cls, bits):
+        ans = cls.__new__(cls)
+        ans._bits, ans._lookups, ans._members = bits, 0, None
+        return ans
+
+    @property
+    def bits(self):
+        ' The bitmap as an int, bit n is set if book id n is a member '
+        return self._bits
+
+    @classmethod
+    def _from_iterable(cls, it):
+        return cls(it)
+
+    def frozen(self):
+        ''' Return the members as a frozenset. It is built only once, so this
+        is the fastest way to pass the book ids to code that needs python sets,
+        for example, to intersect with them. '''
+        ans = self._members
+        if ans is None:
+            ans = self._members = frozenset(iter_bits(self.bits))
+        return ans
+
+    def __iter__(self):
+        return iter_bits(self.bits)
+
+    def __len__(self):
+        return self.bits.bit_count()
+
+    def __bool__(self):
+        return self.bits != 0
+
+    def __contains__(self, book_id):
+        members = self._members
+        if members is None:
+            if self._lookups < MAX_BITMAP_LOOKUPS:
+                self._lookups += 1
+                return isinstance(book_id, int) and book_id >= 0 and (self._bits >> book_id) & 1 == 1
+            members = self.frozen()
+        return book_id in members
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({{{", ".join(map(str, self))}}})'
+
+    def __reduce__(self):
+        return self.__class__.from_bits, (self.bits,)
+
+    def copy(self):
+        return self.__class__(self)
+
+    # Comparisons {{{
+    def __eq__(self, other):
+        if isinstance(other, BookIdSetBase):
+            return self.bits == other.bits
+        if isinstance(other, Set):
+            return len(self) == len(other) and all(x in other for x in self)
+        return NotImplemented
+
+    def __ne__(self, other):
+        ans = self.__eq__(other)
+        return ans if ans is NotImplemented else not ans
+
+    def issubset(self, other):
+        b = bits_for(other)
+        return self.bits & b == self.bits
+
+    def issuperset(self, other):
+        b = bits_for(other)
+        return self.bits & b == b
+
+    def isdisjoint(self, other):
+        return not self.bits & bits_for(other)
+
+    def __le__(self, other):
+        return self.issubset(other) if isinstance(other, Set) else NotImplemented
+
+    def __ge__(self, other):
+        return self.issuperset(other) if isinstance(other, Set) else NotImplemented
+
+    def __lt__(self, other):
+        return (self.bits != bits_for(other) and self.issubset(other)) if isinstance(other, Set) else NotImplemented
+
+    def __gt__(self, other):
+        return (self.bits != bits_for(other) and self.issuperset(other)) if isinstance(other, Set) else NotImplemented
+    # }}}
+
+    # Operations returning new sets {{{
+    def union(self, *others):
+        bits = self.bits
+        for other in others:
+            bits |= bits_for(other)
+        return self.from_bits(bits)
+
+    def intersection(self, *others):
+        bits = self.bits
+        for other in others:
+            bits &= bits_for(other)
+        return self.from_bits(bits)
+
+    def difference(self, *others):
+        bits = self.bits
+        for other in others:
+            bits &= ~bits_for(other)
+        return self.from_bits(bits)
+
+    def symmetric_difference(self, other):
+        return self.from_bits(self.bits ^ bits_for(other))
+
+    def __or__(self, other):
+        return self.union(other) if isinstance(other, Set) else NotImplemented
+    __ror__ = __or__
+
+    def __and__(self, other):
+        return self.intersection(other) if isinstance(other, Set) else NotImplemented
+    __rand__ = __and__
+
+    def __sub__(self, other):
+        return self.difference(other) if isinstance(other, Set) else NotImplemented
+
+    def __rsub__(self, other):
+        return self.from_bits(bits_for(other) & ~self.bits) if isinstance(other, Set) else NotImplemented
+
+    def __xor__(self, other):
+        return self.symmetric_difference(other) if isinstance(other, Set) else NotImplemented
+    __rxor__ = __xor__
+    # }}}
+
+
+class FrozenBookIdSet(BookIdSetBase):
+
+    ''' An immutable set of book ids, hashable, with the same hash as a
+    frozenset with the same members. '''
+
+    __slots__ = ('_hash',)
+
+    def __init__(self, iterable=()):
+        super().__init__(iterable)
+        self._hash = None
+
+    @classmethod
+    def from_bits(cls, bits):
+        ans = super().from_bits(bits)
+        ans._hash = None
+        return ans
+
+    def copy(self):
+        return self
+
+    def __hash__(self):
+        if self._hash is None:
+            self._hash = hash(self.frozen())
+        return self._hash
+
+
+class BookIdSet(BookIdSetBase, MutableSet):
+
+    ''' A mutable set of book ids. Adding or discarding a single book id
+    would have to build a new bitmap, so these are collected in python sets
+    and applied to the bitmap at once, the next time it is needed. '''
+
+    __slots__ = ('_added', '_discarded')
+    __hash__ = None
+
+    def __init__(self, iterable=()):
+        super().__init__(iterable)
+        self._added, self._discarded = set(), set()
+
+    @classmethod
+    def from_bits(cls, bits):
+        ans = super().from_bits(bits)
+        ans._added, ans._discarded = set(), set()
+        return ans
+
+    @property
+    def bits(self):
+        if self._added or self._discarded:
+            self._bits = (self._bits | bits_for(self._added)) & ~bits_for(self._discarded)
+            self._added, self._discarded = set(), set()
+        return self._bits
+
+    def _set_bits(self, bits):
+        if bits != self.bits:
+            self._bits, self._lookups, self._members = bits, 0, None
+
+    def _changed(self):
+        self._lookups, self._members = 0, None
+
+    def __contains__(self, book_id):
+        if book_id in self._added:
+            return True
+        if book_id in self._discarded:
+            return False
+        return super().__contains__(book_id)
+
+    def __bool__(self):
+        return bool(self._added) or self.bits != 0
+
+    def add(self, book_id):
+        if book_id < 0:
+            raise ValueError('Book ids must not be negative')
+        self._discarded.discard(book_id)
+        self._added.add(book_id)
+        self._changed()
+
+    def discard(self, book_id):
+        if isinstance(book_id, int) and book_id >= 0:
+            self._added.discard(book_id)
+            self._discarded.add(book_id)
+            self._changed()
+
+    def remove(self, book_id):
+        if book_id not in self:
+            raise KeyError(book_id)
+        self.discard(book_id)
+
+    def pop(self):
+        bits = self.bits
+        if not bits:
+            raise KeyError('pop from an empty set')
+        book_id = (bits & -bits).bit_length() - 1
+        self.discard(book_id)
+        return book_id
+
+    def clear(self):
+        self._set_bits(0)
+
+    def update(self, *others):
+        self._set_bits(self.union(*others).bits)
+
+    def intersection_update(self, *others):
+        self._set_bits(self.intersection(*others).bits)
+
+    def difference_update(self, *others):
+        self._set_bits(self.difference(*others).bits)
+
+    def symmetric_difference_update(self, other):
+        self._set_bits(self.bits ^ bits_for(other))
+
+    def __ior__(self, other):
+        if not isinstance(other, Set):
+            return NotImplemented
+        self.update(other)
+        return self
+
+    def __iand__(self, other):
+        if not isinstance(other, Set):
+            return NotImplemented
+        self.intersection_update(other)
+        return self
+
+    def __isub__(self, other):
+        if not isinstance(other, Set):
+            return NotImplemented
+        self.difference_update(other)
+        return self
+
+    def __ixor__(self, other):
+        if not isinstance(other, Set):
+            return NotImplemented
+        self.symmetric_difference_update(other)
+        return self
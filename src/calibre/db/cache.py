@@ -6,6 +6,7 @@
 __docformat__ = 'restructuredtext en'
 
 import hashlib
+import heapq
 import operator
 import os
 import random
@@ -28,7 +29,9 @@
 from calibre.customize.ui import run_plugins_on_import, run_plugins_on_postadd, run_plugins_on_postdelete, run_plugins_on_postimport
 from calibre.db import SPOOL_SIZE, _get_next_series_num_for_list
 from calibre.db.annotations import merge_annotations
-from calibre.db.categories import get_categories
+from calibre.db.bitmap import FrozenBookIdSet
+from calibre.db.categories import CategoryCache, get_categories
+from calibre.db.composite_values import context_key, load_composite_values, save_composite_values
 from calibre.db.constants import COVER_FILE_NAME, DATA_DIR_NAME, NOTES_DIR_NAME
 from calibre.db.errors import NoSuchBook, NoSuchFormat
 from calibre.db.fields import IDENTITY, InvalidLinkTable, create_field
@@ -52,7 +55,7 @@
 from calibre.utils.icu import lower as icu_lower
 from calibre.utils.icu import sort_key
 from calibre.utils.localization import canonicalize_lang
-from polyglot.builtins import cmp, iteritems, itervalues, string_or_bytes
+from polyglot.builtins import iteritems, itervalues, string_or_bytes
 
 
 class ExtraFile(NamedTuple):
@@ -165,6 +168,7 @@ def __init__(self, backend, library_database_instance=None):
         self.dirtied_cache = {}
         self.link_maps_cache = {}
         self.extra_files_cache = {}
+        self.category_cache = CategoryCache()
         self.vls_for_books_cache = None
         self.vls_for_books_lib_in_process = None
         self.vls_cache_lock = Lock()
@@ -278,9 +282,12 @@ def clear_composite_caches(self, book_ids=None):
             field.clear_caches(book_ids=book_ids)
 
     @write_api
-    def clear_search_caches(self, book_ids=None):
+    def clear_search_caches(self, book_ids=None, fields=None):
+        ''' Update or clear cached search results for the specified books. If
+        fields is not None, only cached searches that depend on those fields
+        are affected. '''
         self.clear_search_cache_count += 1
-        self._search_api.update_or_clear(self, book_ids)
+        self._search_api.update_or_clear(self, book_ids, fields)
         self.vls_for_books_cache = None
         self.vls_for_books_lib_in_process = None
 
@@ -316,6 +323,13 @@ def clear_caches(self, book_ids=None, template_cache=True, search_cache=True):
         if search_cache:
             self._clear_search_caches(book_ids)
         self._clear_link_map_cache(book_ids)
+        self._clear_category_caches()
+
+    @write_api
+    def clear_category_caches(self, fields=None):
+        ''' Clear the cached items of the Tag browser categories that depend
+        on the specified fields, or all of them if fields is None. '''
+        self.category_cache.clear(fields)
 
     @write_api
     def clear_link_map_cache(self, book_ids=None):
@@ -329,12 +343,33 @@ def clear_link_map_cache(self, book_ids=None):
     def reload_from_db(self, clear_caches=True):
         if clear_caches:
             self._clear_caches()
+            self._clear_extra_files_cache()
         with self.backend.conn:  # Prevent other processes, such as calibredb from interrupting the reload by locking the db
             self.backend.prefs.load_from_db()
             self._search_api.saved_searches.load_from_db()
+            if self.backend.prefs['fts_enabled'] != self.backend.fts_enabled:
+                # Full text searching was enabled or disabled by another process
+                if self.backend.fts_enabled:
+                    self._enable_fts(enabled=False)
+                elif self.backend.initialize_fts(weakref.ref(self)) is not None:
+                    self.start_fts_pool()
+                    self._update_fts_indexing_numbers()
             for field in itervalues(self.fields):
                 if hasattr(field, 'table'):
                     field.table.read(self.backend)  # Reread data from metadata.db
+                    if getattr(field, 'search_index', None) is not None:
+                        field.search_index.invalidate()
+            if tweaks['compact_in_memory_tables']:
+                # Re-reading the tables replaces the compact maps with dicts
+                self.backend.compact_tables()
+        # Search results depend on the data that has just been re-read
+        self._clear_search_caches()
+        self._clear_category_caches()
+
+    @read_api
+    def custom_columns_changed(self):
+        ' True if the custom columns have been changed in the database by another process, reload_from_db() does not re-read them '
+        return self.backend.custom_columns_changed()
 
     @property
     def field_metadata(self):
@@ -459,6 +494,13 @@ def init(self):
                     field.author_sort_field = self.fields['author_sort']
                 elif name == 'title':
                     field.title_sort_field = self.fields['sort']
+            if self.composites and self.backend.save_composite_values:
+                try:
+                    load_composite_values(self.backend.dbpath, self._composite_values_key(), self.composites,
+                                          self.fields['last_modified'].table.book_col_map)
+                except Exception:
+                    print('Failed to load saved composite column values, ignoring', file=sys.stderr)
+                    traceback.print_exc()
         if self.backend.prefs['update_all_last_mod_dates_on_start']:
             self.update_last_modified(self.all_book_ids())
             self.backend.prefs.set('update_all_last_mod_dates_on_start', False)
@@ -470,6 +512,8 @@ def initialize_fts(self):
         self.fts_num_done_since_start = 0
         self.fts_job_queue = Queue()
         self.fts_indexing_left = self.fts_indexing_total = 0
+        self.fts_counters = dict.fromkeys(('indexed', 'failed', 'text_length', 'transactions'), 0)
+        self.fts_counters_start = monotonic()
         fts = self.backend.initialize_fts(weakref.ref(self))
         if self.is_fts_enabled():
             self.start_fts_pool()
@@ -494,7 +538,7 @@ def fts_start_measuring_rate(self, measure=True):
         self.fts_measuring_rate = monotonic() if measure else None
         self.fts_num_done_since_start = 0
 
-    def _update_fts_indexing_numbers(self, job_time=None):
+    def _update_fts_indexing_numbers(self, job_time=None, num_done=1):
         # this is called when new formats are added and when a format is
         # indexed, but NOT when books or formats are deleted, so total may not
         # be up to date.
@@ -503,18 +547,29 @@ def _update_fts_indexing_numbers(self, job_time=None):
         if not nl:
             self._fts_start_measuring_rate(measure=False)
         if job_time is not None and self.fts_measuring_rate is not None:
-            self.fts_num_done_since_start += 1
+            self.fts_num_done_since_start += num_done
         if (self.fts_indexing_left, self.fts_indexing_total) != (nl, nt) or job_time is not None:
             self.fts_indexing_left = nl
             self.fts_indexing_total = nt
             self.event_dispatcher(EventType.indexing_progress_changed, *self._fts_indexing_progress())
 
     @read_api
-    def fts_indexing_progress(self):
+    def fts_indexing_progress(self, with_counters=False):
+        ''' Return the number of formats left to index, the total number of
+        formats and the indexing rate, if it is being measured. If
+        with_counters is True, a dictionary with the number of formats indexed
+        and failed, the length of the text indexed, the number of database
+        transactions used and the formats indexed per minute, since indexing
+        was started, is also returned. '''
         rate = None
         if self.fts_measuring_rate is not None and self.fts_num_done_since_start > 4:
             rate = self.fts_num_done_since_start / (monotonic() - self.fts_measuring_rate)
-        return self.fts_indexing_left, self.fts_indexing_total, rate
+        if not with_counters:
+            return self.fts_indexing_left, self.fts_indexing_total, rate
+        counters = self.fts_counters.copy()
+        counters['elapsed'] = monotonic() - self.fts_counters_start
+        counters['formats_per_minute'] = (counters['indexed'] + counters['failed']) * 60 / max(counters['elapsed'], 0.001)
+        return self.fts_indexing_left, self.fts_indexing_total, rate, counters
 
     @write_api
     def enable_fts(self, enabled=True, start_pool=True):
@@ -546,9 +601,15 @@ def do_one():
                 if not self.backend.fts_enabled:
                     return False
                 book_id, fmt = self.backend.get_next_fts_job()
-                if book_id is None:
-                    return False
-                path = self._format_abspath(book_id, fmt)
+                if book_id is not None:
+                    path = self._format_abspath(book_id, fmt)
+            if book_id is None:
+                if self.backend.fts_bulk_indexing:
+                    # Dirtied formats can also go away by deleting books or formats
+                    with self.write_lock:
+                        if self.backend.fts_bulk_indexing:
+                            self.backend.end_fts_bulk_indexing_if_done()
+                return False
             if not path or not is_fmt_extractable(fmt):
                 with self.write_lock:
                     self.backend.remove_dirty_fts(book_id, fmt)
@@ -597,12 +658,28 @@ def queue_next_fts_job(self):
         self.fts_job_queue.put(True)
         self._update_fts_indexing_numbers()
 
+    def _count_fts_results(self, results):
+        c = self.fts_counters
+        for book_id, fmt, fmt_size, fmt_hash, text, err_msg, start_time in results:
+            c['failed' if err_msg else 'indexed'] += 1
+            c['text_length'] += len(text)
+        c['transactions'] += 1
+
     @write_api
     def commit_fts_result(self, book_id, fmt, fmt_size, fmt_hash, text, err_msg, start_time):
         ans = self.backend.commit_fts_result(book_id, fmt, fmt_size, fmt_hash, text, err_msg)
+        self._count_fts_results(((book_id, fmt, fmt_size, fmt_hash, text, err_msg, start_time),))
         self._update_fts_indexing_numbers(monotonic() - start_time)
         return ans
 
+    @write_api
+    def commit_fts_results(self, results):
+        ' Commit many results, each a tuple of the arguments to commit_fts_result(), in a single transaction '
+        if results:
+            self.backend.commit_fts_results(tuple(r[:-1] for r in results))
+            self._count_fts_results(results)
+            self._update_fts_indexing_numbers(monotonic() - min(r[-1] for r in results), num_done=len(results))
+
     @write_api
     def reindex_fts_book(self, book_id, *fmts):
         if not self.is_fts_enabled():
@@ -613,7 +690,11 @@ def reindex_fts_book(self, book_id, *fmts):
         self._queue_next_fts_job()
 
     @api
-    def reindex_fts(self):
+    def reindex_fts(self, bulk=False):
+        ''' Re-index all formats in the library. If bulk is True, results are
+        committed in large batches and the full text index is built only after
+        all formats have been indexed, which is much faster for large libraries,
+        but searches find nothing until indexing is complete. '''
         if not self.is_fts_enabled():
             return
         with self.write_lock:
@@ -623,6 +704,8 @@ def reindex_fts(self):
             self.backend.reindex_fts()
             fts = self.initialize_fts()
             fts.initialize(self.backend.conn)  # ensure fts is pre-initialized needed for the tests
+            if bulk:
+                self.backend.start_fts_bulk_indexing()
             self._queue_next_fts_job()
         return fts
 
@@ -1477,67 +1560,56 @@ def skf(book_id):
 
         # Sort only once on any given field
         fields = uniq(fields, operator.itemgetter(0))
-
-        if len(fields) == 1:
-            keyfunc = sort_key_func(fields[0][0])
-            reverse = not fields[0][1]
+        composites = [self.fields[name] for name in (fm.get(f[0], f[0]) for f in fields) if name in self.composites]
+        if composites:
+            if not isinstance(ids_to_sort, (Set, list, tuple)):
+                ids_to_sort = tuple(ids_to_sort)
+            for field in composites:
+                field.render_books(ids_to_sort)
+
+        def sort_on(ids, names, keyfunc, reverse):
             try:
-                return sorted(ids_to_sort, key=keyfunc, reverse=reverse)
+                return sorted(ids, key=keyfunc, reverse=reverse)
             except Exception as err:
-                print('Failed to sort database on field:', fields[0][0], 'with error:', err, file=sys.stderr)
+                print('Failed to sort database on field:', names, 'with error:', err, file=sys.stderr)
                 try:
-                    return sorted(ids_to_sort, key=type_safe_sort_key_function(keyfunc), reverse=reverse)
+                    return sorted(ids, key=type_safe_sort_key_function(keyfunc), reverse=reverse)
                 except Exception as err:
-                    print('Failed to type-safe sort database on field:', fields[0][0], 'with error:', err, file=sys.stderr)
-                    return sorted(ids_to_sort, reverse=reverse)
-        sort_key_funcs = tuple(sort_key_func(field) for field, order in fields)
-        orders = tuple(1 if order else -1 for _, order in fields)
-        Lazy = object()  # Lazy load the sort keys for sub-sort fields
-
-        class SortKey:
+                    print('Failed to type-safe sort database on field:', names, 'with error:', err, file=sys.stderr)
+                    return sorted(ids, reverse=reverse)
 
-            __slots__ = 'book_id', 'sort_key'
-
-            def __init__(self, book_id):
-                self.book_id = book_id
-                # Calculate only the first sub-sort key since that will always be used
-                self.sort_key = [key(book_id) if i == 0 else Lazy for i, key in enumerate(sort_key_funcs)]
-
-            def compare_to_other(self, other):
-                for i, (order, self_key, other_key) in enumerate(zip(orders, self.sort_key, other.sort_key)):
-                    if self_key is Lazy:
-                        self_key = self.sort_key[i] = sort_key_funcs[i](self.book_id)
-                    if other_key is Lazy:
-                        other_key = other.sort_key[i] = sort_key_funcs[i](other.book_id)
-                    ans = cmp(self_key, other_key)
-                    if ans != 0:
-                        return ans * order
-                return 0
-
-            def __eq__(self, other):
-                return self.compare_to_other(other) == 0
-
-            def __ne__(self, other):
-                return self.compare_to_other(other) != 0
-
-            def __lt__(self, other):
-                return self.compare_to_other(other) < 0
-
-            def __le__(self, other):
-                return self.compare_to_other(other) <= 0
-
-            def __gt__(self, other):
-                return self.compare_to_other(other) > 0
-
-            def __ge__(self, other):
-                return self.compare_to_other(other) >= 0
+        if len(fields) == 1:
+            return sort_on(ids_to_sort, fields[0][0], sort_key_func(fields[0][0]), not fields[0][1])
+
+        # Group consecutive fields with the same order, the books are sorted
+        # on a tuple of the sort keys of the fields in a group. Then, as
+        # python's sort is stable, sorting on each group starting with the
+        # least significant one gives the multi-field sort, without needing
+        # a comparison function.
+        groups = []
+        for field, order in fields:
+            order = bool(order)
+            if groups and groups[-1][1] == order:
+                groups[-1][0].append(field)
+            else:
+                groups.append(([field], order))
+        ans = ids_to_sort
+        for names, order in reversed(groups):
+            if len(names) == 1:
+                keyfunc = sort_key_func(names[0])
+            else:
+                funcs = tuple(map(sort_key_func, names))
 
-        return sorted(ids_to_sort, key=SortKey)
+                def keyfunc(book_id, funcs=funcs):
+                    return tuple(f(book_id) for f in funcs)
+            ans = sort_on(ans, names, keyfunc, not order)
+        return ans
 
     @read_api
     def search(self, query, restriction='', virtual_fields=None, book_ids=None):
         '''
-        Search the database for the specified query, returning a set of matched book ids.
+        Search the database for the specified query, returning a set of matched
+        book ids, as a :class:`calibre.db.bitmap.BookIdSet`.
 
         :param restriction: A restriction that is ANDed to the specified query. Note that
             restrictions are cached, therefore the search for a AND b will be slower than a with restriction b.
@@ -1555,13 +1627,14 @@ def books_in_virtual_library(self, vl, search_restriction=None, virtual_fields=N
         vl = self._pref('virtual_libraries', {}).get(vl) if vl else None
         if not vl and not search_restriction:
             return self.all_book_ids()
-        # We utilize the search restriction cache to speed this up
+        # We utilize the search restriction cache to speed this up. The
+        # results are bitmaps, so intersecting and freezing them is cheap.
         srch = partial(self._search, virtual_fields=virtual_fields)
         if vl:
             if search_restriction:
-                return frozenset(srch('', vl) & srch('', search_restriction))
-            return frozenset(srch('', vl))
-        return frozenset(srch('', search_restriction))
+                return FrozenBookIdSet(srch('', vl) & srch('', search_restriction))
+            return FrozenBookIdSet(srch('', vl))
+        return FrozenBookIdSet(srch('', search_restriction))
 
     @read_api
     def number_of_books_in_virtual_library(self, vl=None, search_restriction=None):
@@ -1587,7 +1660,10 @@ def get_categories(self, sort='name', book_ids=None, already_fixed=None,
             return self.get_categories(sort=sort, book_ids=book_ids, already_fixed=bad_field)
 
     @write_api
-    def update_last_modified(self, book_ids, now=None):
+    def update_last_modified(self, book_ids, now=None, fields=None):
+        ''' Set the last modified date for the specified books. fields, if
+        not None, is the set of fields that were changed, used to limit the
+        cached searches that are updated. '''
         if book_ids:
             if now is None:
                 now = nowf()
@@ -1595,11 +1671,12 @@ def update_last_modified(self, book_ids, now=None):
             f.writer.set_books({book_id:now for book_id in book_ids}, self.backend)
             if self.composites:
                 self._clear_composite_caches(book_ids)
-            self._clear_search_caches(book_ids)
+            self._clear_search_caches(book_ids, None if fields is None else set(fields) | {'last_modified'})
+            self._clear_category_caches(fields)
 
     @write_api
-    def mark_as_dirty(self, book_ids):
-        self._update_last_modified(book_ids)
+    def mark_as_dirty(self, book_ids, fields=None):
+        self._update_last_modified(book_ids, fields=fields)
         already_dirtied = set(self.dirtied_cache).intersection(book_ids)
         new_dirtied = book_ids - already_dirtied
         already_dirtied = {book_id:self.dirtied_sequence+i for i, book_id in enumerate(already_dirtied)}
@@ -1670,10 +1747,22 @@ def set_field(self, name, book_id_to_val_map, allow_case_change=True, do_path_up
             sf = self.fields[f.name+'_index']
             dirtied |= sf.writer.set_books(simap, self.backend, allow_case_change=False)
 
+        if dirtied and f.search_index is not None:
+            # New items and items whose case was changed are in the dirtied books
+            f.search_index.update_items({item_id for book_id in dirtied for item_id in f.ids_for_book(book_id)})
+
         if dirtied:
             if update_path and do_path_update:
                 self._update_path(dirtied, mark_as_dirtied=False)
-            self._mark_as_dirty(dirtied)
+            # Fields whose values the writer can change along with this one
+            changed_fields = {name}
+            if is_series:
+                changed_fields.add(name + '_index')
+            elif name == 'title':
+                changed_fields.add('sort')
+            elif name == 'authors':
+                changed_fields.add('author_sort')
+            self._mark_as_dirty(dirtied, changed_fields)
             self._clear_link_map_cache(dirtied)
             self.event_dispatcher(EventType.metadata_changed, name, dirtied)
         return dirtied
@@ -1688,9 +1777,9 @@ def update_path(self, book_ids, mark_as_dirtied=True):
                 author = _('Unknown')
             self.backend.update_path(book_id, title, author, self.fields['path'], self.fields['formats'])
             self.format_metadata_cache.pop(book_id, None)
-            if mark_as_dirtied:
-                self._mark_as_dirty(book_ids)
-            self._clear_link_map_cache(book_ids)
+        if mark_as_dirtied:
+            self._mark_as_dirty(book_ids)
+        self._clear_link_map_cache(book_ids)
 
     @read_api
     def get_a_dirtied_book(self):
@@ -1698,6 +1787,16 @@ def get_a_dirtied_book(self):
             return random.choice(tuple(self.dirtied_cache))
         return None
 
+    @read_api
+    def get_dirtied_books(self, limit, exclude=None):
+        ''' Return up to limit dirtied book ids, the ones dirtied earliest
+        first, mapped to their dirtied sequence numbers. Books in exclude, a
+        map of book ids to sequence numbers, are skipped unless they have been
+        dirtied again since. '''
+        dc, exclude = self.dirtied_cache, exclude or {}
+        book_ids = heapq.nsmallest(limit, (book_id for book_id, sequence in dc.items() if exclude.get(book_id) != sequence), key=dc.__getitem__)
+        return {book_id: dc[book_id] for book_id in book_ids}
+
     def _metadata_as_object_for_dump(self, book_id):
         mi = self._get_metadata(book_id)
         # Always set cover to cover.jpg. Even if cover doesn't exist,
@@ -1737,6 +1836,21 @@ def clear_dirtied(self, book_id, sequence):
             self.dirtied_cache.pop(book_id, None)
 
     @write_api
+    def clear_dirtied_books(self, book_id_sequence_map):
+        ' Same as clear_dirtied() for many books, in a single transaction '
+        clean = []
+        for book_id, sequence in iteritems(book_id_sequence_map):
+            dc_sequence = self.dirtied_cache.get(book_id, None)
+            if dc_sequence is None or sequence is None or dc_sequence == sequence:
+                clean.append(book_id)
+        if clean:
+            self.backend.mark_books_as_clean(clean)
+            for book_id in clean:
+                self.dirtied_cache.pop(book_id, None)
+
+    # Only the read lock is needed, as it prevents the book folder from being
+    # renamed, so that backups for many books can be written in parallel
+    @read_api
     def write_backup(self, book_id, raw):
         try:
             path = self._get_book_path(book_id)
@@ -1817,6 +1931,9 @@ def set_cover(self, book_id_data_map):
 
     @write_api
     def add_cover_cache(self, cover_cache):
+        ''' Cover caches have their invalidate() method called with the ids of
+        books whose covers change and, if they have one, their library_closed()
+        method called when the library is closed. '''
         if not callable(cover_cache.invalidate):
             raise ValueError('Cover caches must have an invalidate method')
         self.cover_caches.add(cover_cache)
@@ -1841,107 +1958,152 @@ def set_metadata(self, book_id, mi, ignore_errors=False, force_changes=False,
         provided, but are never deleted. Also note that force_changes has no
         effect on setting title or authors.
         '''
+        return self._set_metadata_for_books(
+            {book_id: mi}, ignore_errors=ignore_errors, force_changes=force_changes,
+            set_title=set_title, set_authors=set_authors, allow_case_change=allow_case_change)
+
+    @write_api
+    def set_metadata_for_books(self, book_id_mi_map, ignore_errors=False, force_changes=False,
+                               set_title=True, set_authors=True, allow_case_change=False):
+        '''
+        Set metadata for many books at once, from a mapping of book ids to
+        `Metadata` objects. The arguments have the same meaning as for
+        :meth:`set_metadata`. This is much faster than calling
+        :meth:`set_metadata` for every book, as the changes are grouped by
+        field, so every field is written once for all books, book folders are
+        renamed in a single pass and a single change event is sent per field.
+        Returns the set of book ids that were changed.
+        '''
         dirtied = set()
+        mi_map = {}
+        for book_id, mi in iteritems(book_id_mi_map):
+            try:
+                # Handle code passing in an OPF object instead of a Metadata object
+                mi = mi.to_book_metadata()
+            except (AttributeError, TypeError):
+                pass
+            mi_map[book_id] = mi
 
-        try:
-            # Handle code passing in an OPF object instead of a Metadata object
-            mi = mi.to_book_metadata()
-        except (AttributeError, TypeError):
-            pass
-
-        def set_field(name, val):
-            dirtied.update(self._set_field(name, {book_id:val}, do_path_update=False, allow_case_change=allow_case_change))
-
-        path_changed = False
-        if set_title and mi.title:
-            path_changed = True
-            set_field('title', mi.title)
-        authors_changed = False
-        if set_authors:
-            path_changed = True
-            if not mi.authors:
-                mi.authors = [_('Unknown')]
-            authors = []
-            for a in mi.authors:
-                authors += string_to_authors(a)
-            set_field('authors', authors)
-            authors_changed = True
+        def set_field(name, val_map):
+            dirtied.update(self._set_field(name, val_map, do_path_update=False, allow_case_change=allow_case_change))
 
+        def protected_set_field(name, val_map):
+            try:
+                set_field(name, val_map)
+            except Exception:
+                if not ignore_errors:
+                    raise
+                if len(val_map) == 1:
+                    traceback.print_exc()
+                    return
+                # Set the values one book at a time, so that only the
+                # bad values are skipped
+                for book_id, val in iteritems(val_map):
+                    protected_set_field(name, {book_id: val})
+
+        titles, authors_map = {}, {}
+        for book_id, mi in iteritems(mi_map):
+            if set_title and mi.title:
+                titles[book_id] = mi.title
+            if set_authors:
+                if not mi.authors:
+                    mi.authors = [_('Unknown')]
+                authors = []
+                for a in mi.authors:
+                    authors += string_to_authors(a)
+                authors_map[book_id] = authors
+        if titles:
+            set_field('title', titles)
+        if authors_map:
+            set_field('authors', authors_map)
+        path_changed = set(titles) | set(authors_map)
         if path_changed:
-            self._update_path({book_id})
+            self._update_path(path_changed)
 
-        def protected_set_field(name, val):
+        # force_changes has no effect on cover manipulation
+        covers = {}
+        for book_id, mi in iteritems(mi_map):
             try:
-                set_field(name, val)
+                cdata = mi.cover_data[1]
+                if cdata is None and isinstance(mi.cover, string_or_bytes) and mi.cover and os.access(mi.cover, os.R_OK):
+                    with open(mi.cover, 'rb') as f:
+                        cdata = f.read() or None
+                if cdata is not None:
+                    covers[book_id] = cdata
+            except Exception:
+                if ignore_errors:
+                    traceback.print_exc()
+                else:
+                    raise
+        if covers:
+            try:
+                self._set_cover(covers)
             except Exception:
                 if ignore_errors:
                     traceback.print_exc()
                 else:
                     raise
 
-        # force_changes has no effect on cover manipulation
-        try:
-            cdata = mi.cover_data[1]
-            if cdata is None and isinstance(mi.cover, string_or_bytes) and mi.cover and os.access(mi.cover, os.R_OK):
-                with open(mi.cover, 'rb') as f:
-                    cdata = f.read() or None
-            if cdata is not None:
-                self._set_cover({book_id: cdata})
-        except Exception:
-            if ignore_errors:
-                traceback.print_exc()
-            else:
-                raise
+        # Collect the values for all books grouped by field. The fields are
+        # set in the same order as for a single book, since, for example,
+        # setting series can change series_index.
+        field_maps = {field: {} for field in (
+            'rating', 'series_index', 'timestamp', 'author_sort', 'publisher', 'series', 'tags', 'comments',
+            'languages', 'pubdate', 'sort', 'identifiers')}
+        fm = self.field_metadata
+        for book_id, mi in iteritems(mi_map):
+            for field in ('rating', 'series_index', 'timestamp'):
+                val = getattr(mi, field)
+                if val is not None:
+                    field_maps[field][book_id] = val
+
+            val = mi.get('author_sort', None)
+            authors_changed = book_id in authors_map
+            if authors_changed and (not val or mi.is_null('author_sort')):
+                val = self._author_sort_from_authors(mi.authors)
+            if authors_changed or (force_changes and val is not None) or not mi.is_null('author_sort'):
+                field_maps['author_sort'][book_id] = val
+
+            for field in ('publisher', 'series', 'tags', 'comments',
+                'languages', 'pubdate'):
+                val = mi.get(field, None)
+                if (force_changes and val is not None) or not mi.is_null(field):
+                    field_maps[field][book_id] = val
+
+            val = mi.get('title_sort', None)
+            if (force_changes and val is not None) or not mi.is_null('title_sort'):
+                field_maps['sort'][book_id] = val
+
+            # identifiers will always be replaced if force_changes is True
+            mi_idents = mi.get_identifiers()
+            if force_changes:
+                field_maps['identifiers'][book_id] = mi_idents
+            elif mi_idents:
+                identifiers = self._field_for('identifiers', book_id, default_value={})
+                for key, val in iteritems(mi_idents):
+                    if val and val.strip():  # Don't delete an existing identifier
+                        identifiers[icu_lower(key)] = val
+                field_maps['identifiers'][book_id] = identifiers
+
+            user_mi = mi.get_all_user_metadata(make_copy=False)
+            for key in user_mi:
+                if (key in fm and user_mi[key]['datatype'] == fm[key]['datatype'] and (
+                    user_mi[key]['datatype'] != 'text' or (
+                        user_mi[key]['is_multiple'] == fm[key]['is_multiple']))):
+                    val = mi.get(key, None)
+                    if force_changes or val is not None:
+                        field_maps.setdefault(key, {})[book_id] = val
+                        idx = key + '_index'
+                        if idx in self.fields:
+                            extra = mi.get_extra(key)
+                            if extra is not None or force_changes:
+                                field_maps.setdefault(idx, {})[book_id] = extra
 
         try:
             with self.backend.conn:  # Speed up set_metadata by not operating in autocommit mode
-                for field in ('rating', 'series_index', 'timestamp'):
-                    val = getattr(mi, field)
-                    if val is not None:
-                        protected_set_field(field, val)
-
-                val = mi.get('author_sort', None)
-                if authors_changed and (not val or mi.is_null('author_sort')):
-                    val = self._author_sort_from_authors(mi.authors)
-                if authors_changed or (force_changes and val is not None) or not mi.is_null('author_sort'):
-                    protected_set_field('author_sort', val)
-
-                for field in ('publisher', 'series', 'tags', 'comments',
-                    'languages', 'pubdate'):
-                    val = mi.get(field, None)
-                    if (force_changes and val is not None) or not mi.is_null(field):
-                        protected_set_field(field, val)
-
-                val = mi.get('title_sort', None)
-                if (force_changes and val is not None) or not mi.is_null('title_sort'):
-
-                    protected_set_field('sort', val)
-
-                # identifiers will always be replaced if force_changes is True
-                mi_idents = mi.get_identifiers()
-                if force_changes:
-                    protected_set_field('identifiers', mi_idents)
-                elif mi_idents:
-                    identifiers = self._field_for('identifiers', book_id, default_value={})
-                    for key, val in iteritems(mi_idents):
-                        if val and val.strip():  # Don't delete an existing identifier
-                            identifiers[icu_lower(key)] = val
-                    protected_set_field('identifiers', identifiers)
-
-                user_mi = mi.get_all_user_metadata(make_copy=False)
-                fm = self.field_metadata
-                for key in user_mi:
-                    if (key in fm and user_mi[key]['datatype'] == fm[key]['datatype'] and (
-                        user_mi[key]['datatype'] != 'text' or (
-                            user_mi[key]['is_multiple'] == fm[key]['is_multiple']))):
-                        val = mi.get(key, None)
-                        if force_changes or val is not None:
-                            protected_set_field(key, val)
-                            idx = key + '_index'
-                            if idx in self.fields:
-                                extra = mi.get_extra(key)
-                                if extra is not None or force_changes:
-                                    protected_set_field(idx, extra)
+                for field, val_map in iteritems(field_maps):
+                    if val_map:
+                        protected_set_field(field, val_map)
         except Exception:
             # sqlite will rollback the entire transaction, thanks to the with
             # statement, so we have to re-read everything form the db to ensure
@@ -2257,7 +2419,9 @@ def remove_books(self, book_ids, permanent=False):
             except AttributeError:
                 continue  # Some fields like ondevice do not have tables
             else:
-                table.remove_books(book_ids, self.backend)
+                removed_items = table.remove_books(book_ids, self.backend)
+                if removed_items and getattr(field, 'search_index', None) is not None:
+                    field.search_index.update_items(removed_items)
         self._search_api.discard_books(book_ids)
         self._clear_caches(book_ids=book_ids, template_cache=False, search_cache=False)
         for cc in self.cover_caches:
@@ -2353,6 +2517,8 @@ def rename_items(self, field, item_id_to_new_name_map, change_index=True, restri
         for item_id, new_name in item_id_to_new_name_map.items():
             new_names = tuple(x.strip() for x in new_name.split(sv)) if sv else (new_name,)
             books, new_id = func(item_id, new_names[0], self.backend)
+            if f.search_index is not None:
+                f.search_index.update_items((item_id, new_id))
             affected_books.update(books)
             id_map[item_id] = new_id
             if new_id != item_id:
@@ -2386,6 +2552,8 @@ def remove_items(self, field, item_ids, restrict_to_book_ids=None):
             restrict_to_book_ids = frozenset(restrict_to_book_ids)
         affected_books = field.table.remove_items(item_ids, self.backend,
                                                   restrict_to_book_ids=restrict_to_book_ids)
+        if field.search_index is not None:
+            field.search_index.update_items(item_ids)
         if affected_books:
             if hasattr(field, 'index_field'):
                 self._set_field(field.index_field.name, {bid:1.0 for bid in affected_books})
@@ -2511,6 +2679,7 @@ def tags_older_than(self, tag, delta=None, must_have_tag=None, must_have_authors
     @write_api
     def set_sort_for_authors(self, author_id_to_sort_map, update_books=True):
         sort_map = self.fields['authors'].table.set_sort_names(author_id_to_sort_map, self.backend)
+        self._clear_category_caches(('authors',))
         changed_books = set()
         if update_books:
             val_map = {}
@@ -2812,15 +2981,26 @@ def saved_search_rename(self, old_name, new_name):
     @write_api
     def change_search_locations(self, newlocs):
         self._search_api.change_locations(newlocs)
+        self._clear_category_caches()
 
     @write_api
     def refresh_search_locations(self):
         self._search_api.change_locations(self.field_metadata.get_search_terms())
+        self._clear_category_caches()
 
     @write_api
     def dump_and_restore(self, callback=None, sql=None):
         return self.backend.dump_and_restore(callback=callback, sql=sql)
 
+    @write_api
+    def compact_tables(self):
+        ''' Switch the in-memory tables to the compact, array backed
+        representation, which uses much less memory for large libraries at the
+        cost of slightly slower access. If the tables are already compact, any
+        changes made since they were compacted are folded back in. See also the
+        compact_in_memory_tables tweak. '''
+        self.backend.compact_tables()
+
     @write_api
     def vacuum(self, include_fts_db=False, include_notes_db=True):
         self.is_doing_rebuild_or_vacuum = True
@@ -2855,6 +3035,9 @@ def close(self):
             self.close_called = True
             self.shutting_down = True
             self.event_dispatcher.close()
+            for cc in self.cover_caches:
+                getattr(cc, 'library_closed', lambda: None)()
+            self.cover_caches.clear()
             self._shutdown_fts()
             try:
                 from calibre.customize.ui import available_library_closed_plugins
@@ -2868,8 +3051,18 @@ def close(self):
                         traceback.print_exc()
         self._shutdown_fts(stage=2)
         with self.write_lock:
+            if self.composites and self.backend.save_composite_values:
+                try:
+                    save_composite_values(self.backend.dbpath, self._composite_values_key(), self.composites,
+                                          self.fields['last_modified'].table.book_col_map)
+                except Exception:
+                    print('Failed to save composite column values, ignoring', file=sys.stderr)
+                    traceback.print_exc()
             self.backend.close()
 
+    def _composite_values_key(self):
+        return context_key(self.backend.prefs.get('user_template_functions', []), tweaks, self.field_metadata.custom_field_metadata())
+
     @property
     def is_closed(self):
         return self.backend.is_closed
@@ -8,7 +8,9 @@
 import copy
 from collections import OrderedDict
 from functools import partial
+from threading import Lock
 
+from calibre.db.bitmap import as_frozenset
 from calibre.ebooks.metadata import author_to_author_sort
 from calibre.utils.config_base import prefs, tweaks
 from calibre.utils.icu import collation_order, sort_key
@@ -73,6 +75,12 @@ def __repr__(self):
     def as_dict(self):
         return {k: getattr(self, k) for k in self.__slots__}
 
+    def copy(self):
+        ans = Tag.__new__(Tag)
+        for k in self.__slots__:
+            setattr(ans, k, getattr(self, k))
+        return ans
+
     @classmethod
     def from_dict(cls, d):
         ans = cls('')
@@ -168,6 +176,51 @@ def category_display_order(ordered_cats, all_cats):
     return cat_ord
 
 
+class CategoryCache:
+
+    ''' Cache of the items in the categories of the Tag browser, so that only
+    the categories whose fields have changed are re-built. Items are cached
+    per set of books, so restricting to a few Virtual libraries stays cheap.
+    The cache is cleared by the write paths in Cache, under the write lock. '''
+
+    # Number of different sets of books for which items are cached, per category
+    LIMIT = 4
+    # Fields that change the items of every category, via average ratings and
+    # sort values
+    GLOBAL_FIELDS = frozenset({'rating', 'languages'})
+
+    def __init__(self):
+        self.item_map = {}
+        # get() is called by several reading threads at once, holding only the
+        # read lock, so the map is protected by its own lock. Items are created
+        # without it.
+        self.lock = Lock()
+
+    def get(self, category, book_ids, create):
+        key = None if book_ids is None else frozenset(book_ids)
+        with self.lock:
+            ans = self.item_map.get(category, {}).get(key)
+        if ans is None:
+            ans = create()
+            with self.lock:
+                cmap = self.item_map.setdefault(category, {})
+                if len(cmap) >= self.LIMIT and key not in cmap:
+                    cmap.pop(next(iter(cmap)), None)
+                cmap[key] = ans
+        # Callers modify the returned items, so give them copies
+        return [t.copy() for t in ans]
+
+    def clear(self, fields=None):
+        with self.lock:
+            if fields is None or not self.GLOBAL_FIELDS.isdisjoint(fields):
+                self.item_map.clear()
+                return
+            for field in fields:
+                self.item_map.pop(field, None)
+                if field == 'tags':
+                    self.item_map.pop('news', None)
+
+
 numeric_collation = prefs['numeric_collation']
 
 
@@ -220,11 +273,28 @@ def get_categories(dbcache, sort='name', book_ids=None, first_letter_sort=False,
 
     hierarchical_categories = frozenset(dbcache.pref('categories_using_hierarchy', ()))
     fm = dbcache.field_metadata
-    book_rating_map = dbcache.fields['rating'].book_value_map
-    lang_map = dbcache.fields['languages'].book_value_map
+    category_cache = dbcache.category_cache
+    value_maps = {}
+
+    def book_value_map(field):
+        # Only built when needed, as most categories are usually cached
+        ans = value_maps.get(field)
+        if ans is None:
+            ans = value_maps[field] = dbcache.fields[field].book_value_map
+        return ans
+
+    def field_categories(category, cat, tag_class, book_ids):
+        brm = book_value_map(category if cat['datatype'] == 'rating' else 'rating')
+        cats = dbcache.fields[category].get_categories(
+            tag_class, brm, book_value_map('languages'), book_ids)
+        if (category != 'authors' and cat['datatype'] == 'text' and
+            cat['is_multiple'] and cat['display'].get('is_names', False)):
+            for item in cats:
+                item.sort = author_to_author_sort(item.sort)
+        return cats
 
     categories = OrderedDict()
-    book_ids = frozenset(book_ids) if book_ids else book_ids
+    book_ids = as_frozenset(book_ids) if book_ids else book_ids
     pm_cache = {}
 
     def get_metadata(book_id):
@@ -244,24 +314,17 @@ def get_metadata(book_id):
             if bids is None:
                 bids = dbcache._all_book_ids() if book_ids is None else book_ids
             cats = dbcache.fields[category].get_composite_categories(
-                tag_class, book_rating_map, bids, is_multiple, get_metadata)
+                tag_class, book_value_map('rating'), bids, is_multiple, get_metadata)
         elif category == 'news':
-            cats = dbcache.fields['tags'].get_news_category(tag_class, book_ids)
+            cats = category_cache.get(category, book_ids, partial(
+                dbcache.fields['tags'].get_news_category, tag_class, book_ids))
         else:
             cat = fm[category]
-            brm = book_rating_map
             dt = cat['datatype']
-            if dt == 'rating':
-                if category != 'rating':
-                    brm = dbcache.fields[category].book_value_map
-                if sort_on == 'name':
-                    sort_on, reverse = 'rating', True
-            cats = dbcache.fields[category].get_categories(
-                tag_class, brm, lang_map, book_ids)
-            if (category != 'authors' and dt == 'text' and
-                cat['is_multiple'] and cat['display'].get('is_names', False)):
-                for item in cats:
-                    item.sort = author_to_author_sort(item.sort)
+            if dt == 'rating' and sort_on == 'name':
+                sort_on, reverse = 'rating', True
+            cats = category_cache.get(category, book_ids, partial(
+                field_categories, category, cat, tag_class, book_ids))
         cats.sort(key=partial(category_sort_keys[fl_sort][sort_on],
                               hierarchical_categories=hierarchical_categories),
                   reverse=reverse)
@@ -272,7 +335,7 @@ def get_metadata(book_id):
     for r in categories['rating']:
         for x in tuple(categories['rating']):
             if r.name == x.name and r.id != x.id:
-                r.id_set |= x.id_set
+                r.id_set = r.id_set | x.id_set
                 r.count = len(r.id_set)
                 categories['rating'].remove(x)
                 break
@@ -326,7 +389,7 @@ def get_metadata(book_id):
                             total_rating = 0
                             count = 0
                             for id_ in t.id_set:
-                                rating = book_rating_map.get(id_, 0)
+                                rating = book_value_map('rating').get(id_, 0)
                                 if rating:
                                     total_rating += rating/2
                                     count += 1
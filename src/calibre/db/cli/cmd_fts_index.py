@@ -36,7 +36,7 @@ def implementation(db, notify_changes, action, adata=None):
             for item in items:
                 db.reindex_fts_book(*item)
         else:
-            db.reindex_fts()
+            db.reindex_fts(bulk=True)
         l, t, r = db.fts_indexing_progress()
         return {'enabled': True, 'left': l, 'total': t, 'rate': r}
 
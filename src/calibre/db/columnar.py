@@ -0,0 +1,566 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+Compact, array backed replacements for the dicts used by the in-memory tables
+in :mod:`calibre.db.tables`.
+
+Book and item ids are small, mostly dense integers, so instead of dicts of
+boxed ints and strings we store values in typed arrays indexed directly by id.
+Strings are stored UTF-8 encoded in a single shared buffer, with identical
+values interned at load time. Many-many links are stored in CSR form, a single
+array of offsets indexed by id pointing into a single array of values.
+
+All the classes here implement the full mapping API, so code written against
+the dicts keeps working unchanged. Values that cannot be packed (for example,
+a datetime in a non UTC timezone or a key that is far outside the dense id
+range) are transparently stored in a normal dict on the side. The CSR maps are
+frozen at load time, modifications are stored in an overlay dict and folded
+back in by calling :meth:`compacted`.
+'''
+
+from array import array
+from collections import Counter
+from collections.abc import ItemsView, MutableMapping, ValuesView
+from datetime import datetime, timedelta
+from itertools import accumulate, compress, islice
+from threading import Lock
+
+from calibre.utils.date import EPOCH, utc_tz
+
+ABSENT, PACKED, BOXED = 0, 1, 2
+INT64_MIN, INT64_MAX = -(1 << 63), (1 << 63) - 1
+# Dense storage costs at least 1 byte per possible key, so only use it if the
+# keys are not too sparse
+SPARSITY_FACTOR = 4
+SPARSITY_SLACK = 4096
+missing = object()
+
+
+def is_dense_enough(num_keys, max_key):
+    return max_key < SPARSITY_FACTOR * num_keys + SPARSITY_SLACK
+
+
+def zeroed(typecode, n):
+    ans = array(typecode)
+    ans.frombytes(bytes(n * ans.itemsize))
+    return ans
+
+
+def dense_int_keys(keys):
+    ' Return the maximum key if all keys are non-negative ints dense enough to be stored in arrays, otherwise -1 '
+    mx, n = -1, 0
+    for k in keys:
+        if type(k) is not int or k < 0:
+            return -1
+        n += 1
+        mx = max(mx, k)
+    return mx if is_dense_enough(n, mx) else -1
+
+
+# Value stores {{{
+
+class ArrayStore:
+
+    typecode = 'q'
+    packable_type = int
+
+    def __init__(self):
+        self.data = array(self.typecode)
+
+    def resize(self, n):
+        extra = n - len(self.data)
+        if extra > 0:
+            self.data.frombytes(bytes(extra * self.data.itemsize))
+
+    def put(self, idx, val):
+        if type(val) is not self.packable_type:
+            return False
+        self.data[idx] = val
+        return True
+
+    def get(self, idx):
+        return self.data[idx]
+
+    def discard(self, idx):
+        pass
+
+    def nbytes(self):
+        return len(self.data) * self.data.itemsize
+
+
+class IntStore(ArrayStore):
+
+    def put(self, idx, val):
+        if type(val) is not int or val < INT64_MIN or val > INT64_MAX:
+            return False
+        self.data[idx] = val
+        return True
+
+
+class FloatStore(ArrayStore):
+
+    typecode = 'd'
+    packable_type = float
+
+
+class BoolStore(ArrayStore):
+
+    typecode = 'b'
+    packable_type = bool
+
+    def get(self, idx):
+        return bool(self.data[idx])
+
+
+class DatetimeStore(ArrayStore):
+
+    ' Stores UTC datetimes as microseconds since the epoch '
+
+    packable_type = datetime
+
+    def put(self, idx, val):
+        if type(val) is not datetime or val.tzinfo is not utc_tz:
+            return False
+        td = val - EPOCH
+        self.data[idx] = (td.days * 86400 + td.seconds) * 1000000 + td.microseconds
+        return True
+
+    def get(self, idx):
+        return EPOCH + timedelta(microseconds=self.data[idx])
+
+
+class StringStore:
+
+    ''' Stores strings UTF-8 encoded in a single buffer. Replaced values leave
+    holes in the buffer that are reclaimed by :meth:`compact` once they
+    dominate it. '''
+
+    packable_type = str
+    MIN_WASTE_FOR_COMPACTION = 1024 * 1024
+
+    def __init__(self):
+        self.blob = bytearray()
+        self.offsets = array('q')
+        self.lengths = array('l')
+        self.waste = 0
+        self.interned = None
+
+    def resize(self, n):
+        extra = n - len(self.offsets)
+        if extra > 0:
+            self.offsets.frombytes(bytes(extra * self.offsets.itemsize))
+            self.lengths.frombytes(bytes(extra * self.lengths.itemsize))
+
+    def start_interning(self):
+        self.interned = {}
+
+    def stop_interning(self):
+        self.interned = None
+
+    def put(self, idx, val):
+        if type(val) is not str:
+            return False
+        try:
+            b = val.encode('utf-8')
+        except UnicodeEncodeError:  # lone surrogates
+            return False
+        n = len(b)
+        if self.interned is None:
+            offset = len(self.blob)
+            self.blob += b
+        else:
+            offset = self.interned.get(b)
+            if offset is None:
+                offset = self.interned[b] = len(self.blob)
+                self.blob += b
+        self.offsets[idx] = offset
+        self.lengths[idx] = n
+        return True
+
+    def get(self, idx):
+        o = self.offsets[idx]
+        return self.blob[o:o + self.lengths[idx]].decode('utf-8')
+
+    def discard(self, idx):
+        self.waste += self.lengths[idx]
+
+    @property
+    def needs_compaction(self):
+        return self.waste > self.MIN_WASTE_FOR_COMPACTION and self.waste > len(self.blob) // 2
+
+    def compact(self, indices):
+        old, offsets, lengths = self.blob, self.offsets, self.lengths
+        self.blob, self.waste = bytearray(), 0
+        interned = {}
+        for idx in indices:
+            o = offsets[idx]
+            b = bytes(old[o:o + lengths[idx]])
+            offset = interned.get(b)
+            if offset is None:
+                offset = interned[b] = len(self.blob)
+                self.blob += b
+            offsets[idx] = offset
+
+    def nbytes(self):
+        return len(self.blob) + len(self.offsets) * self.offsets.itemsize + len(self.lengths) * self.lengths.itemsize
+
+
+STORE_TYPES = {int: IntStore, float: FloatStore, bool: BoolStore, str: StringStore, datetime: DatetimeStore}
+
+
+def store_for_values(values, sample_size=1024):
+    ' Return the store for the most common packable type among values or None if there is no such type '
+    c = Counter(t for t in map(type, islice(values, sample_size)) if t in STORE_TYPES)
+    if c:
+        return STORE_TYPES[c.most_common(1)[0][0]]()
+# }}}
+
+
+class _ItemsView(ItemsView):
+
+    __slots__ = ()
+
+    def __iter__(self):
+        return self._mapping._iteritems()
+
+
+class _ValuesView(ValuesView):
+
+    __slots__ = ()
+
+    def __iter__(self):
+        return (v for k, v in self._mapping._iteritems())
+
+
+class CompactMapBase(MutableMapping):
+
+    def items(self):
+        return _ItemsView(self)
+
+    def values(self):
+        return _ValuesView(self)
+
+    def copy(self):
+        return dict(self._iteritems())
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.copy()!r})'
+
+
+class DenseMap(CompactMapBase):
+
+    ''' A map of non-negative integer keys (usually book or item ids) to
+    scalar values, all of which are mostly of the same type. Values are stored
+    in a :class:`ArrayStore` or :class:`StringStore` indexed by key. '''
+
+    def __init__(self, store, src=None, max_key=-1):
+        self.store = store
+        self.state = bytearray()
+        self.boxed = {}
+        self.num_packed = 0
+        if src:
+            if max_key < 0:
+                max_key = max(k for k in src if type(k) is int)
+            self._resize(max_key + 1)
+            interning = hasattr(store, 'start_interning')
+            if interning:
+                store.start_interning()
+            try:
+                for k, v in src.items():
+                    self[k] = v
+            finally:
+                if interning:
+                    store.stop_interning()
+
+    def _resize(self, n):
+        old = len(self.state)
+        extra = n - old
+        if extra > 0:
+            self.state.extend(bytes(extra))
+            self.store.resize(n)
+            # Keys that were out of range are now in range, store them in the array
+            moved = [k for k in self.boxed if type(k) is int and old <= k < n]
+            for k in moved:
+                val = self.boxed.pop(k)
+                if self.store.put(k, val):
+                    self.state[k] = PACKED
+                    self.num_packed += 1
+                else:
+                    self.state[k] = BOXED
+                    self.boxed[k] = val
+
+    def __len__(self):
+        return self.num_packed + len(self.boxed)
+
+    def __contains__(self, key):
+        if type(key) is int and 0 <= key < len(self.state):
+            return self.state[key] != ABSENT
+        return key in self.boxed
+
+    def get(self, key, default=None):
+        if type(key) is int and 0 <= key < len(self.state):
+            s = self.state[key]
+            if s == PACKED:
+                return self.store.get(key)
+            if s == ABSENT:
+                return default
+        return self.boxed.get(key, default)
+
+    def __getitem__(self, key):
+        ans = self.get(key, missing)
+        if ans is missing:
+            raise KeyError(key)
+        return ans
+
+    def __setitem__(self, key, val):
+        if type(key) is int and key >= 0:
+            n = len(self.state)
+            if key >= n and is_dense_enough(len(self) + 1, key):
+                self._resize(max(key + 1, n + (n >> 2) + 16))
+                n = len(self.state)
+            if key < n:
+                s = self.state[key]
+                if s == PACKED:
+                    self.store.discard(key)
+                    self.num_packed -= 1
+                elif s == BOXED:
+                    del self.boxed[key]
+                if self.store.put(key, val):
+                    self.state[key] = PACKED
+                    self.num_packed += 1
+                    if s == PACKED and getattr(self.store, 'needs_compaction', False):
+                        self.store.compact(self._packed_keys())
+                else:
+                    self.state[key] = BOXED
+                    self.boxed[key] = val
+                return
+        self.boxed[key] = val
+
+    def __delitem__(self, key):
+        if type(key) is int and 0 <= key < len(self.state):
+            s = self.state[key]
+            if s == ABSENT:
+                raise KeyError(key)
+            self.state[key] = ABSENT
+            if s == PACKED:
+                self.store.discard(key)
+                self.num_packed -= 1
+                return
+        del self.boxed[key]
+
+    def pop(self, key, default=missing):
+        ans = self.get(key, missing)
+        if ans is missing:
+            if default is missing:
+                raise KeyError(key)
+            return default
+        del self[key]
+        return ans
+
+    def clear(self):
+        self.state = bytearray()
+        self.boxed = {}
+        self.num_packed = 0
+        self.store = self.store.__class__()
+
+    def _packed_keys(self):
+        return compress(range(len(self.state)), map(PACKED.__eq__, self.state))
+
+    def __iter__(self):
+        n = len(self.state)
+        yield from compress(range(n), self.state)
+        for k in self.boxed:
+            if not (type(k) is int and 0 <= k < n):
+                yield k
+
+    def _iteritems(self):
+        n, state, get, boxed = len(self.state), self.state, self.store.get, self.boxed
+        for k in compress(range(n), state):
+            yield k, (get(k) if state[k] == PACKED else boxed[k])
+        for k, v in boxed.items():
+            if not (type(k) is int and 0 <= k < n):
+                yield k, v
+
+    def compacted(self):
+        return compact_scalar_map(self)
+
+    def nbytes(self):
+        return len(self.state) + self.store.nbytes()
+
+
+class CSRMap(CompactMapBase):
+
+    ''' A map of non-negative integer keys to collections of integers, stored
+    in CSR form. Modified entries are stored in an overlay dict and shadow the
+    packed entries. Base class for :class:`TupleMap` and :class:`SetMap`. '''
+
+    def __init__(self, src, max_key):
+        n = max_key + 1
+        self.overlay = {}
+        self.present = present = bytearray(n)
+        counts = zeroed('q', n)
+        for k, v in src.items():
+            present[k] = 1
+            counts[k] = len(v)
+        self.base_count = len(src)
+        self.offsets = offsets = array('q', (0,))
+        offsets.extend(accumulate(counts))
+        self.flat = flat = zeroed('q', offsets[-1])
+        for k, v in src.items():
+            o = offsets[k]
+            flat[o:o + len(v)] = array('q', self.ordered(v))
+
+    def ordered(self, v):
+        return v
+
+    def _base(self, key):
+        o = self.offsets
+        return self.flat[o[key]:o[key+1]]
+
+    def _in_base(self, key):
+        return type(key) is int and 0 <= key < len(self.present) and self.present[key]
+
+    def __len__(self):
+        return self.base_count + len(self.overlay)
+
+    def __contains__(self, key):
+        return self._in_base(key) or key in self.overlay
+
+    def __iter__(self):
+        yield from compress(range(len(self.present)), self.present)
+        yield from self.overlay
+
+    def _iteritems(self):
+        wrap = self.wrap
+        for k in compress(range(len(self.present)), self.present):
+            yield k, wrap(self._base(k))
+        yield from self.overlay.items()
+
+    def _unpack(self, key):
+        ' Remove key from the packed entries, returning True if it was present '
+        if self._in_base(key):
+            self.present[key] = 0
+            self.base_count -= 1
+            return True
+        return False
+
+    def __setitem__(self, key, val):
+        self._unpack(key)
+        self.overlay[key] = val
+
+    def __delitem__(self, key):
+        if not self._unpack(key):
+            del self.overlay[key]
+
+    def pop(self, key, default=missing):
+        if self._in_base(key):
+            ans = self.wrap(self._base(key))
+            self._unpack(key)
+            return ans
+        if default is missing:
+            return self.overlay.pop(key)
+        return self.overlay.pop(key, default)
+
+    def clear(self):
+        self.present = bytearray()
+        self.offsets = array('q', (0,))
+        self.flat = array('q')
+        self.base_count = 0
+        self.overlay = {}
+
+    def compacted(self):
+        return self.__class__.from_map(self)
+
+    @classmethod
+    def from_map(cls, src):
+        mx = dense_int_keys(src)
+        if mx < 0:
+            return src
+        for v in src.values():
+            for x in v:
+                if type(x) is not int or x < INT64_MIN or x > INT64_MAX:
+                    return src
+        return cls(src, mx)
+
+    def nbytes(self):
+        return len(self.present) + (len(self.offsets) + len(self.flat)) * self.flat.itemsize
+
+
+class TupleMap(CSRMap):
+
+    ' Map of keys to tuples of ints, for example: book_id -> tuple of tag ids '
+
+    wrap = tuple
+
+    def get(self, key, default=None):
+        if type(key) is int and 0 <= key < len(self.present) and self.present[key]:
+            o = self.offsets
+            return tuple(self.flat[o[key]:o[key+1]])
+        return self.overlay.get(key, default)
+
+    def __getitem__(self, key):
+        ans = self.get(key, missing)
+        if ans is missing:
+            raise KeyError(key)
+        return ans
+
+
+class SetMap(CSRMap):
+
+    ''' Map of keys to sets of ints, for example: tag_id -> set of book ids.
+    Behaves like a ``defaultdict(set)``. Note that indexing returns a set that
+    is owned by the map and can be modified in place, while :meth:`get` and
+    iteration return copies for entries that have not been modified. '''
+
+    wrap = set
+    default_factory = set
+
+    def __init__(self, src, max_key):
+        CSRMap.__init__(self, src, max_key)
+        self.lock = Lock()
+
+    def ordered(self, v):
+        return sorted(v)
+
+    def get(self, key, default=None):
+        if type(key) is int and 0 <= key < len(self.present) and self.present[key]:
+            o = self.offsets
+            return set(self.flat[o[key]:o[key+1]])
+        return self.overlay.get(key, default)
+
+    def __getitem__(self, key):
+        if self._in_base(key):
+            # Move the entry into the overlay so that in-place modifications
+            # to the returned set are preserved. Readers can call this
+            # concurrently, hence the lock.
+            with self.lock:
+                if self._in_base(key):
+                    ans = self.overlay[key] = set(self._base(key))
+                    self._unpack(key)
+                    return ans
+        try:
+            return self.overlay[key]
+        except KeyError:
+            with self.lock:
+                return self.overlay.setdefault(key, set())
+
+
+def compact_scalar_map(src):
+    ''' Return an array backed equivalent of the dict of scalar values src or
+    src itself if it cannot usefully be compacted. '''
+    mx = dense_int_keys(src)
+    if mx < 0:
+        return src
+    store = store_for_values(src.values())
+    if store is None:
+        return src
+    return DenseMap(store, src, mx)
+
+
+def compact_tuple_map(src):
+    return TupleMap.from_map(src)
+
+
+def compact_set_map(src):
+    return SetMap.from_map(src)
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+Rendered values of composite columns, saved when a library is closed and
+restored when it is next opened, to avoid rendering the templates of
+composite columns for every book after a restart.
+
+The values are stored in metadata.db.composites next to metadata.db, together
+with the last modified date of each book when its values were saved. A value
+is restored only if the book has not been modified since. All values for a
+column are discarded if its template, the template functions, the tweaks, the
+custom column definitions or the calibre version have changed.
+'''
+
+import hashlib
+from datetime import timedelta
+
+from calibre.constants import numeric_version
+from calibre.utils.date import EPOCH
+from calibre.utils.filenames import atomic_rename
+from calibre.utils.serialize import msgpack_dumps, msgpack_loads
+
+VERSION = 1
+ONE_MICROSECOND = timedelta(microseconds=1)
+
+
+def values_path(dbpath):
+    return dbpath + '.composites'
+
+
+def context_key(user_template_functions, tweaks, custom_field_metadata):
+    ' A key that changes when anything, other than the books, that can change the output of templates changes '
+    data = repr((VERSION, tuple(numeric_version), user_template_functions, sorted(tweaks.items()), custom_field_metadata))
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+def timestamp(dt):
+    return None if dt is None else (dt - EPOCH) // ONE_MICROSECOND
+
+
+def save_composite_values(dbpath, key, composites, last_modified_map):
+    ''' Save the values in the render caches of composites, a mapping of field
+    names to :class:`calibre.db.fields.CompositeField`. Must be called with the
+    tables locked. '''
+    columns = {}
+    for name, field in composites.items():
+        values = field.rendered_values()
+        book_ids = tuple(values)
+        columns[name] = (
+            field.metadata['display'].get('composite_template', ''), book_ids,
+            tuple(timestamp(last_modified_map.get(book_id)) for book_id in book_ids), tuple(values.values()))
+    path = values_path(dbpath)
+    tpath = path + '.tmp'
+    with open(tpath, 'wb') as f:
+        f.write(msgpack_dumps({'key': key, 'columns': columns}))
+    atomic_rename(tpath, path)
+
+
+def load_composite_values(dbpath, key, composites, last_modified_map):
+    ''' Restore the saved values of the books that have not been modified since
+    they were saved into the render caches of composites. Returns the number of
+    values restored. '''
+    try:
+        with open(values_path(dbpath), 'rb') as f:
+            data = msgpack_loads(f.read(), use_list=False)
+    except FileNotFoundError:
+        return 0
+    if data.get('key') != key:
+        return 0
+    count = 0
+    for name, (template, book_ids, modified, values) in data['columns'].items():
+        field = composites.get(name)
+        if field is None or field.metadata['display'].get('composite_template', '') != template:
+            continue
+        valid = {book_id: val for book_id, lm, val in zip(book_ids, modified, values) if lm is not None and timestamp(
+            last_modified_map.get(book_id)) == lm}
+        field.restore_rendered_values(valid)
+        count += len(valid)
+    return count
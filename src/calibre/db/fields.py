@@ -11,6 +11,7 @@
 from functools import partial
 from threading import Lock
 
+from calibre.db.search_index import TextSearchIndex
 from calibre.db.tables import MANY_MANY, MANY_ONE, ONE_ONE, null
 from calibre.db.utils import atof, force_to_bool
 from calibre.db.write import Writer
@@ -51,6 +52,35 @@ def IDENTITY(x):
     return x
 
 
+class SortKeyCache:
+
+    ''' A cache of sort keys that persists across sorts, keyed by item or book
+    id. Each entry remembers the value its sort key was computed from and is
+    recomputed when that value changes, so edits and renames update it
+    incrementally, without needing explicit invalidation. '''
+
+    __slots__ = ('cache', 'sort_key_func')
+
+    def __init__(self, sort_key_func):
+        self.sort_key_func = sort_key_func
+        self.cache = {}
+
+    def __call__(self, key, val, *args):
+        try:
+            cval, ans = self.cache[key]
+        except KeyError:
+            pass
+        else:
+            if cval == val:
+                return ans
+        ans = self.sort_key_func(val, *args)
+        self.cache[key] = val, ans
+        return ans
+
+    def clear(self):
+        self.cache.clear()
+
+
 class InvalidLinkTable(Exception):
 
     def __init__(self, name):
@@ -116,6 +146,13 @@ def __init__(self, name, table, bools_are_tristate, get_template_functions, db_w
         self.writer = Writer(self)
         self.series_field = None
         self.get_template_functions = get_template_functions
+        # Sort keys that are expensive to calculate are cached
+        self.cache_sort_keys = self._sort_key is not IDENTITY and dt not in {'int', 'float', 'rating', 'bool'}
+        self.sort_key_cache = SortKeyCache(self._sort_key)
+        self.search_index = None
+        if (tweaks['index_text_fields_for_search'] and self.is_many and dt in {'text', 'series', 'enumeration'} and
+                name not in {'languages', 'formats', 'identifiers'}):
+            self.search_index = TextSearchIndex(table)
 
     @property
     def metadata(self):
@@ -225,6 +262,9 @@ def none_safe_key(book_id):
                     return ans
                 return none_safe_key
             return lambda book_id: bcmg(book_id, dk)
+        if self.cache_sort_keys:
+            skc = self.sort_key_cache
+            return lambda book_id: skc(book_id, bcmg(book_id, dk))
         return lambda book_id: sk(bcmg(book_id, dk))
 
     def iter_searchable_values(self, get_metadata, candidates, default_value=None):
@@ -327,6 +367,29 @@ def clear_caches(self, book_ids=None):
                 for book_id in book_ids:
                     self._render_cache.pop(book_id, None)
 
+    def rendered_values(self):
+        with self._lock:
+            return self._render_cache.copy()
+
+    def restore_rendered_values(self, values):
+        with self._lock:
+            self._render_cache.update(values)
+
+    def render_books(self, book_ids):
+        ''' Render the composite for all the specified books that are not in
+        the render cache. Much faster than rendering one book at a time, as a
+        single formatter is used for all books. '''
+        with self._lock:
+            rc = self._render_cache
+            book_ids = [book_id for book_id in book_ids if book_id not in rc]
+        if book_ids:
+            from calibre.db.lazy import ProxyMetadata
+            from calibre.ebooks.metadata.book.formatter import SafeFormat
+            db = self.db_weakref()
+            formatter, template_cache = SafeFormat(), db.formatter_template_cache
+            for book_id in book_ids:
+                self.__render_composite(book_id, ProxyMetadata(db, book_id, formatter), formatter, template_cache)
+
     def get_value_with_cache(self, book_id, get_metadata):
         with self._lock:
             ans = self._render_cache.get(book_id, None)
@@ -345,6 +408,7 @@ def sort_keys_for_books(self, get_metadata, lang_map):
     def iter_searchable_values(self, get_metadata, candidates, default_value=None):
         val_map = defaultdict(set)
         splitter = self.splitter
+        self.render_books(candidates)
         for book_id in candidates:
             vals = self.get_value_with_cache(book_id, get_metadata)
             vals = (vv.strip() for vv in vals.split(splitter)) if splitter else (vals,)
@@ -363,6 +427,7 @@ def iter_searchable_values(self, get_metadata, candidates, default_value=None):
     def iter_counts(self, candidates, get_metadata=None):
         val_map = defaultdict(set)
         splitter = self.splitter
+        self.render_books(candidates)
         for book_id in candidates:
             vals = self.get_value_with_cache(book_id, get_metadata)
             if splitter:
@@ -378,6 +443,7 @@ def get_composite_categories(self, tag_class, book_rating_map, book_ids,
                                  is_multiple, get_metadata):
         ans = []
         id_map = defaultdict(set)
+        self.render_books(book_ids)
         for book_id in book_ids:
             val = self.get_value_with_cache(book_id, get_metadata)
             vals = [x.strip() for x in val.split(is_multiple)] if is_multiple else [val]
@@ -396,6 +462,7 @@ def get_composite_categories(self, tag_class, book_rating_map, book_ids,
     def get_books_for_val(self, value, get_metadata, book_ids):
         is_multiple = self.table.metadata['is_multiple'].get('cache_to_list', None)
         ans = set()
+        self.render_books(book_ids)
         for book_id in book_ids:
             val = self.get_value_with_cache(book_id, get_metadata)
             vals = {x.strip() for x in val.split(is_multiple)} if is_multiple else [val]
@@ -471,11 +538,14 @@ def iter_searchable_values(self, get_metadata, candidates, default_value=None):
 
 class LazySortMap:
 
-    __slots__ = ('cache', 'default_sort_key', 'id_map', 'sort_key_func')
+    ''' Sort keys for items, for the duration of a single sort. Keys are
+    fetched from the persistent :class:`SortKeyCache` of the field. '''
+
+    __slots__ = ('cache', 'default_sort_key', 'id_map', 'sort_key_cache')
 
-    def __init__(self, default_sort_key, sort_key_func, id_map):
+    def __init__(self, default_sort_key, sort_key_cache, id_map):
         self.default_sort_key = default_sort_key
-        self.sort_key_func = sort_key_func
+        self.sort_key_cache = sort_key_cache
         self.id_map = id_map
         self.cache = {None:default_sort_key}
 
@@ -484,7 +554,7 @@ def __call__(self, item_id):
             return self.cache[item_id]
         except KeyError:
             try:
-                val = self.cache[item_id] = self.sort_key_func(self.id_map[item_id])
+                val = self.cache[item_id] = self.sort_key_cache(item_id, self.id_map[item_id])
             except KeyError:
                 val = self.cache[item_id] = self.default_sort_key
             return val
@@ -515,14 +585,19 @@ def __iter__(self):
         return iter(self.table.id_map)
 
     def sort_keys_for_books(self, get_metadata, lang_map):
-        sk_map = LazySortMap(self._default_sort_key, self._sort_key, self.table.id_map)
+        sk_map = LazySortMap(self._default_sort_key, self.sort_key_cache, self.table.id_map)
         bcmg = self.table.book_col_map.get
         return lambda book_id: sk_map(bcmg(book_id, None))
 
-    def iter_searchable_values(self, get_metadata, candidates, default_value=None):
+    def iter_searchable_values(self, get_metadata, candidates, default_value=None, item_ids=None):
         cbm = self.table.col_book_map
         empty = set()
-        for item_id, val in iteritems(self.table.id_map):
+        id_map = self.table.id_map
+        if item_ids is None:
+            items = iteritems(id_map)
+        else:
+            items = ((item_id, id_map[item_id]) for item_id in item_ids if item_id in id_map)
+        for item_id, val in items:
             book_ids = cbm.get(item_id, empty).intersection(candidates)
             if book_ids:
                 yield val, book_ids
@@ -572,7 +647,7 @@ def __iter__(self):
         return iter(self.table.id_map)
 
     def sort_keys_for_books(self, get_metadata, lang_map):
-        sk_map = LazySortMap(self._default_sort_key, self._sort_key, self.table.id_map)
+        sk_map = LazySortMap(self._default_sort_key, self.sort_key_cache, self.table.id_map)
         bcmg = self.table.book_col_map.get
         dsk = (self._default_sort_key,)
         if self.sort_sort_key:
@@ -583,10 +658,15 @@ def sk(book_id):
                 return tuple(sk_map(x) for x in bcmg(book_id, ())) or dsk
         return sk
 
-    def iter_searchable_values(self, get_metadata, candidates, default_value=None):
+    def iter_searchable_values(self, get_metadata, candidates, default_value=None, item_ids=None):
         cbm = self.table.col_book_map
         empty = set()
-        for item_id, val in iteritems(self.table.id_map):
+        id_map = self.table.id_map
+        if item_ids is None:
+            items = iteritems(id_map)
+        else:
+            items = ((item_id, id_map[item_id]) for item_id in item_ids if item_id in id_map)
+        for item_id, val in items:
             book_ids = cbm.get(item_id, empty).intersection(candidates)
             if book_ids:
                 yield val, book_ids
@@ -701,35 +781,38 @@ def get_categories(self, tag_class, book_rating_map, lang_map, book_ids=None):
 
 class LazySeriesSortMap:
 
-    __slots__ = ('cache', 'default_sort_key', 'id_map', 'sort_key_func')
+    __slots__ = ('cache', 'default_sort_key', 'id_map', 'sort_key_cache')
 
-    def __init__(self, default_sort_key, sort_key_func, id_map):
+    def __init__(self, default_sort_key, sort_key_cache, id_map):
         self.default_sort_key = default_sort_key
-        self.sort_key_func = sort_key_func
+        self.sort_key_cache = sort_key_cache
         self.id_map = id_map
         self.cache = {}
 
     def __call__(self, item_id, lang):
+        key = item_id, lang
         try:
-            return self.cache[(item_id, lang)]
+            return self.cache[key]
         except KeyError:
             try:
-                val = self.cache[(item_id, lang)] = self.sort_key_func(self.id_map[item_id], lang)
+                val = self.cache[key] = self.sort_key_cache(key, self.id_map[item_id], lang)
             except KeyError:
-                val = self.cache[(item_id, lang)] = self.default_sort_key
+                val = self.cache[key] = self.default_sort_key
             return val
 
 
 class SeriesField(ManyToOneField):
 
-    def sort_keys_for_books(self, get_metadata, lang_map):
-        sso = tweaks['title_series_sorting']
-        ssk = self._sort_key
-        ts = title_sort
+    def __init__(self, *args, **kwargs):
+        ManyToOneField.__init__(self, *args, **kwargs)
+        # The sort keys of series depend on the language of the book
+        self.sort_key_cache = SortKeyCache(self.series_sort_key)
 
-        def sk(val, lang):
-            return ssk(ts(val, order=sso, lang=lang))
-        sk_map = LazySeriesSortMap(self._default_sort_key, sk, self.table.id_map)
+    def series_sort_key(self, val, lang):
+        return self._sort_key(title_sort(val, order=tweaks['title_series_sorting'], lang=lang))
+
+    def sort_keys_for_books(self, get_metadata, lang_map):
+        sk_map = LazySeriesSortMap(self._default_sort_key, self.sort_key_cache, self.table.id_map)
         bcmg = self.table.book_col_map.get
         lang_map = {k:v[0] if v else None for k, v in iteritems(lang_map)}
 
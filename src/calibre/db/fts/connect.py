@@ -17,7 +17,21 @@
 from calibre.utils.date import EPOCH, utcnow
 
 from .pool import Pool
-from .schema_upgrade import SchemaUpgrade
+from .schema_upgrade import SchemaUpgrade, index_triggers
+
+INDEX_TRIGGERS = ('books_fts_insert_trg', 'books_fts_delete_trg', 'books_fts_update_trg')
+# Used instead of the index triggers while bulk indexing, see start_bulk_indexing()
+BULK_TRIGGERS = '''
+CREATE TRIGGER fts_db.books_fts_bulk_insert_trg AFTER INSERT ON fts_db.books_text
+BEGIN
+    DELETE FROM dirtied_formats WHERE book=NEW.book AND format=NEW.format;
+END;
+
+CREATE TRIGGER fts_db.books_fts_bulk_update_trg AFTER UPDATE ON fts_db.books_text
+BEGIN
+    DELETE FROM dirtied_formats WHERE book=NEW.book AND format=NEW.format;
+END;
+'''
 
 
 def print(*args, **kwargs):
@@ -40,6 +54,7 @@ def initialize(self, conn):
                 main_db_path = os.path.abspath(conn.db_filename('main'))
                 dbpath = os.path.join(os.path.dirname(main_db_path), 'full-text-search.db')
                 conn.execute('ATTACH DATABASE ? AS fts_db', (dbpath,))
+                conn.set_journal_mode('fts_db')
                 SchemaUpgrade(conn)
                 conn.execute('UPDATE fts_db.dirtied_formats SET in_progress=FALSE WHERE in_progress=TRUE')
                 num_dirty = conn.get('''SELECT COUNT(*) from fts_db.dirtied_formats''')[0][0]
@@ -47,6 +62,11 @@ def initialize(self, conn):
                     num_indexed = conn.get('''SELECT COUNT(*) from fts_db.books_text''')[0][0]
                     if not num_indexed:
                         needs_dirty = True
+                # Continue bulk indexing that was interrupted, for example, by calibre being closed
+                self.pool.bulk_indexing = bool(conn.get(
+                    "SELECT name FROM fts_db.sqlite_master WHERE type='trigger' AND name='books_fts_bulk_insert_trg'"))
+                if self.pool.bulk_indexing and not num_dirty:
+                    self._end_bulk_indexing(conn)
                 conn.fts_dbpath = dbpath
         if needs_dirty:
             self.dirty_existing()
@@ -59,6 +79,11 @@ def get_connection(self):
         self.initialize(ans)
         return ans
 
+    def get_reader(self):
+        ' A connection for only reading, see DB.reader '
+        self.get_connection()  # ensure the FTS database is attached
+        return self.dbref().backend.reader
+
     def dirty_existing(self):
         conn = self.get_connection()
         conn.execute('''
@@ -85,6 +110,7 @@ def vacuum(self):
     def remove_dirty(self, book_id, fmt):
         conn = self.get_connection()
         conn.execute('DELETE FROM fts_db.dirtied_formats WHERE book=? AND format=?', (book_id, fmt.upper()))
+        self.end_bulk_indexing_if_done()
 
     def dirty_book(self, book_id, *fmts):
         conn = self.get_connection()
@@ -123,16 +149,61 @@ def get_next_fts_job(self):
             return book_id, fmt
         return None, None
 
-    def commit_result(self, book_id, fmt, fmt_size, fmt_hash, text, err_msg=''):
+    def commit_result(self, book_id, fmt, fmt_size, fmt_hash, text, err_msg='', check_unchanged=True):
         conn = self.get_connection()
         text_hash = ''
         if text:
             text_hash = hashlib.sha1(text.encode('utf-8')).hexdigest()
-            for x in conn.get('SELECT id FROM fts_db.books_text WHERE book=? AND format=? AND text_hash=?', (book_id, fmt, text_hash)):
-                text = ''
-                break
+            if check_unchanged:
+                for x in conn.get('SELECT id FROM fts_db.books_text WHERE book=? AND format=? AND text_hash=?', (book_id, fmt, text_hash)):
+                    text = ''
+                    break
         self.add_text(book_id, fmt, text, text_hash, fmt_size, fmt_hash, err_msg)
 
+    def commit_results(self, results):
+        ''' Commit many results, each a tuple of the arguments to
+        commit_result(), in a single transaction. When bulk indexing, the
+        full text index is rebuilt after the last result is committed. '''
+        conn = self.get_connection()
+        with conn:
+            for r in results:
+                # A full reindex starts with an empty table, so there is no
+                # previous text to compare with
+                self.commit_result(*r, check_unchanged=not self.pool.bulk_indexing)
+        self.end_bulk_indexing_if_done()
+
+    def start_bulk_indexing(self):
+        ''' Defer updating the full text index until all dirtied formats have
+        been indexed, which is much faster than updating it for every book when
+        indexing a whole library. The triggers that update the index are
+        replaced by ones that only remove formats from the dirtied list. The
+        index is rebuilt from the books_text table at the end, so searches
+        do not find anything until then. '''
+        conn = self.get_connection()
+        with conn:
+            for name in INDEX_TRIGGERS:
+                conn.execute(f'DROP TRIGGER IF EXISTS fts_db.{name}')
+            conn.execute(BULK_TRIGGERS)
+        self.pool.bulk_indexing = True
+
+    def end_bulk_indexing_if_done(self):
+        ''' Rebuild the full text index once no dirtied formats are left, which
+        can also happen without committing a result, for instance when the last
+        dirtied format is missing or cannot be indexed. '''
+        if self.pool.bulk_indexing and not self.number_dirtied():
+            self._end_bulk_indexing(self.get_connection())
+
+    def _end_bulk_indexing(self, conn):
+        with conn:
+            conn.execute('DROP TRIGGER IF EXISTS fts_db.books_fts_bulk_insert_trg')
+            conn.execute('DROP TRIGGER IF EXISTS fts_db.books_fts_bulk_update_trg')
+            conn.execute(index_triggers())
+            for table in ('books_fts', 'books_fts_stemmed'):
+                conn.execute(f"INSERT INTO fts_db.{table}({table}) VALUES('rebuild')")
+        for table in ('books_fts', 'books_fts_stemmed'):
+            conn.execute(f"INSERT INTO fts_db.{table}({table}) VALUES('optimize')")
+        self.pool.bulk_indexing = False
+
     def queue_job(self, book_id, fmt, path, fmt_size, fmt_hash, start_time):
         conn = self.get_connection()
         fmt = fmt.upper()
@@ -172,7 +243,7 @@ def search(self,
         query = 'SELECT {0}.id, {0}.book, {0}.format {1} FROM {0} '.format('books_text', text)
         query += f' JOIN {fts_table} ON fts_db.books_text.id = {fts_table}.rowid'
         query += ' WHERE '
-        conn = self.get_connection()
+        conn = self.get_reader()
         temp_table_name = ''
         if restrict_to_book_ids:
             if len(restrict_to_book_ids) == 1:
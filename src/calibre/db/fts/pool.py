@@ -2,12 +2,13 @@
 # License: GPL v3 Copyright: 2022, Kovid Goyal <kovid at kovidgoyal.net>
 
 
+import json
 import os
 import subprocess
 import sys
 import traceback
 from contextlib import suppress
-from queue import Queue
+from queue import Empty, Queue
 from threading import Event, Thread
 from time import monotonic
 
@@ -49,11 +50,25 @@ def __init__(self, job, err_msg=''):
             self.text = err_msg
 
 
+def read_replies(stream, replies):
+    try:
+        for line in stream:
+            replies.put(line)
+    except Exception:
+        pass
+    replies.put(b'')
+
+
 class Worker(Thread):
 
-    code_to_exec = 'from calibre.db.fts.text import main; main({!r})'
+    code_to_exec = 'from calibre.db.fts.text import serve; serve()'
     max_duration = 30  # minutes
     poll_interval = 0.1  # seconds
+    # The worker process is restarted after this many jobs or when it uses
+    # more than max_memory, to limit the effects of memory leaks in the
+    # conversion code
+    max_jobs_per_process = 100
+    max_memory = 1024  # MB
 
     def __init__(self, jobs_queue, supervise_queue):
         super().__init__(name='FTSWorker', daemon=True)
@@ -62,50 +77,99 @@ def __init__(self, jobs_queue, supervise_queue):
         self.supervise_queue = supervise_queue
         self.keep_going = True
         self.working = False
+        self.process = None
 
     def run(self):
-        while self.keep_going:
-            x = self.jobs_queue.get()
-            if x is quit:
-                break
-            self.working = True
+        try:
+            while self.keep_going:
+                x = self.jobs_queue.get()
+                if x is quit:
+                    break
+                self.working = True
+                try:
+                    res = self.run_job(x)
+                    if res is not None and self.keep_going:
+                        self.supervise_queue.put(res)
+                except Exception:
+                    tb = traceback.format_exc()
+                    traceback.print_exc()
+                    if self.keep_going:
+                        self.supervise_queue.put(Result(x, tb))
+                finally:
+                    self.working = False
+        finally:
+            self.stop_process(kill=not self.keep_going)
+
+    def start_process(self):
+        p = start_pipe_worker(self.code_to_exec, stderr=subprocess.DEVNULL, priority='low')
+        self.replies = Queue()
+        Thread(name='FTSWorkerReplies', daemon=True, target=read_replies, args=(p.stdout, self.replies)).start()
+        self.process, self.jobs_done = p, 0
+
+    def stop_process(self, kill=False):
+        p, self.process = self.process, None
+        if p is None:
+            return
+        if not kill:
+            # The process exits when there are no more jobs
+            with suppress(OSError):
+                p.stdin.close()
+            with suppress(subprocess.TimeoutExpired):
+                p.wait(1)
+        if p.returncode is None:
+            p.kill()
+            p.wait()
+        for f in (p.stdin, p.stdout):
+            with suppress(OSError):
+                f.close()
+
+    def send_job(self, job):
+        data = json.dumps(job.path).encode('utf-8') + b'\n'
+        if self.process is not None:
             try:
-                res = self.run_job(x)
-                if res is not None and self.keep_going:
-                    self.supervise_queue.put(res)
-            except Exception:
-                tb = traceback.format_exc()
-                traceback.print_exc()
-                if self.keep_going:
-                    self.supervise_queue.put(Result(x, tb))
-            finally:
-                self.working = False
+                self.process.stdin.write(data)
+                self.process.stdin.flush()
+                return
+            except OSError:
+                # The process has died
+                self.stop_process(kill=True)
+        self.start_process()
+        self.process.stdin.write(data)
+        self.process.stdin.flush()
 
     def run_job(self, job):
         time_limit = monotonic() + (self.max_duration * 60)
         txtpath = job.path + '.txt'
         errpath = job.path + '.error'
         try:
-            with open(errpath, 'wb') as error:
-                p = start_pipe_worker(
-                    self.code_to_exec.format(job.path),
-                    stdout=subprocess.DEVNULL, stderr=error, stdin=subprocess.DEVNULL, priority='low',
-                )
-                while self.keep_going and monotonic() <= time_limit:
-                    with suppress(subprocess.TimeoutExpired):
-                        p.wait(self.poll_interval)
-                        break
-                if p.returncode is None:
-                    p.kill()
-                    if not self.keep_going:
-                        return
-                    return Result(job, _('Extracting text from the {0} file of size {1} took too long').format(
-                        job.fmt, human_readable(job.fmt_size)))
-                if os.path.exists(txtpath):
-                    return Result(job)
-            with open(errpath, 'rb') as f:
-                err = f.read().decode('utf-8', 'replace')
-                return Result(job, err)
+            self.send_job(job)
+            reply = None
+            while self.keep_going and monotonic() <= time_limit:
+                with suppress(Empty):
+                    reply = self.replies.get(timeout=self.poll_interval)
+                    break
+            if reply is None:
+                self.stop_process(kill=True)
+                if not self.keep_going:
+                    return
+                return Result(job, _('Extracting text from the {0} file of size {1} took too long').format(
+                    job.fmt, human_readable(job.fmt_size)))
+            if not reply:
+                p = self.process
+                self.stop_process(kill=True)
+                return Result(job, _('The worker process extracting text from the {0} file of size {1} crashed with code: {2}').format(
+                    job.fmt, human_readable(job.fmt_size), p.returncode))
+            self.jobs_done += 1
+            if self.jobs_done >= self.max_jobs_per_process or float(reply) >= self.max_memory:
+                self.stop_process()
+            if os.path.exists(txtpath):
+                return Result(job)
+            try:
+                with open(errpath, 'rb') as f:
+                    err = f.read().decode('utf-8', 'replace')
+            except FileNotFoundError:
+                err = ''
+            return Result(job, err or _('Failed to extract text from the {} file').format(job.fmt))
         finally:
             with suppress(OSError):
                 os.remove(job.path)
@@ -117,7 +181,14 @@ def run_job(self, job):
 
 class Pool:
 
+    # When bulk indexing, results are committed in batches of this size, or
+    # when no new result has arrived for bulk_commit_interval seconds
+    bulk_commit_size = 250
+    bulk_commit_interval = 1
+
     def __init__(self, dbref):
+        self.bulk_indexing = False
+        self.pending_results = []
         self.max_workers = 1
         self.jobs_queue = Queue()
         self.supervise_queue = Queue()
@@ -183,7 +254,7 @@ def add_job(self, book_id, fmt, path, fmt_size, fmt_hash, start_time):
         job = Job(book_id, fmt, path, fmt_size, fmt_hash, start_time)
         self.jobs_queue.put(job)
 
-    def commit_result(self, result):
+    def result_args(self, result):
         text = result.text
         err_msg = ''
         if not result.ok:
@@ -191,9 +262,21 @@ def commit_result(self, result):
             print(text, file=sys.stderr)
             err_msg = text
             text = ''
+        return result.book_id, result.fmt, result.fmt_size, result.fmt_hash, text, err_msg, result.start_time
+
+    def commit_result(self, result):
+        args = self.result_args(result)
         db = self.dbref()
         if db is not None:
-            db.commit_fts_result(result.book_id, result.fmt, result.fmt_size, result.fmt_hash, text, err_msg, result.start_time)
+            db.commit_fts_result(*args)
+
+    def commit_pending_results(self):
+        results, self.pending_results = self.pending_results, []
+        if results:
+            args = tuple(map(self.result_args, results))
+            db = self.dbref()
+            if db is not None:
+                db.commit_fts_results(args)
 
     def shutdown(self):
         if self.initialized.is_set():
@@ -221,14 +304,29 @@ def do_check_for_work(self):
 
     def supervise(self):
         while self.keep_going:
-            x = self.supervise_queue.get()
             try:
-                if x is check_for_work:
+                x = self.supervise_queue.get(timeout=self.bulk_commit_interval if self.pending_results else None)
+            except Empty:
+                x = None
+            try:
+                if x is None:
+                    self.commit_pending_results()
+                elif x is check_for_work:
                     self.do_check_for_work()
                 elif x is quit:
                     break
                 elif isinstance(x, Result):
-                    self.commit_result(x)
+                    if self.bulk_indexing:
+                        self.pending_results.append(x)
+                        if len(self.pending_results) >= self.bulk_commit_size:
+                            self.commit_pending_results()
+                    else:
+                        self.commit_result(x)
                     self.do_check_for_work()
             except Exception:
                 traceback.print_exc()
+        # Commit any results buffered for bulk indexing, so they are not lost
+        try:
+            self.commit_pending_results()
+        except Exception:
+            traceback.print_exc()
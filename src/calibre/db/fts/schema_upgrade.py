@@ -4,6 +4,11 @@
 from calibre.utils.resources import get_path as P
 
 
+def index_triggers():
+    ' The triggers that keep the full text index in sync with the books_text table '
+    return P('fts_index_triggers.sql', data=True, allow_user_override=False).decode('utf-8')
+
+
 class SchemaUpgrade:
 
     def __init__(self, conn):
@@ -13,6 +18,7 @@ def __init__(self, conn):
             if self.user_version == 0:
                 fts_sqlite = P('fts_sqlite.sql', data=True, allow_user_override=False).decode('utf-8')
                 conn.execute(fts_sqlite)
+                conn.execute(index_triggers())
             while True:
                 uv = self.user_version
                 meth = getattr(self, f'upgrade_version_{uv}', None)
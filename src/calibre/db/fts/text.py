@@ -3,8 +3,11 @@
 
 
 import contextlib
+import json
 import os
 import re
+import sys
+import traceback
 import unicodedata
 
 from calibre.customize.ui import plugin_for_input_format
@@ -132,3 +135,23 @@ def main(pathtoebook):
     text = extract_text(pathtoebook)
     with open(pathtoebook + '.txt', 'wb') as f:
         f.write(text.encode('utf-8'))
+
+
+def serve():
+    ''' Extract text from the books whose paths are read from stdin, as one
+    JSON encoded path per line, until stdin is closed. Writes a line with the
+    memory used by this process (in MB) to stdout after each book. '''
+    from calibre.utils.mem import memory
+    replies = os.fdopen(os.dup(sys.stdout.fileno()), 'wb')
+    # Output from the conversion code must not be mixed with the replies
+    with open(os.devnull, 'wb') as devnull:
+        os.dup2(devnull.fileno(), sys.stdout.fileno())
+    for line in sys.stdin.buffer:
+        pathtoebook = json.loads(line)
+        try:
+            main(pathtoebook)
+        except Exception:
+            with open(pathtoebook + '.error', 'wb') as f:
+                f.write(traceback.format_exc().encode('utf-8'))
+        replies.write(f'{memory()}\n'.encode('ascii'))
+        replies.flush()
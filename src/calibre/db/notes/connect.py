@@ -84,6 +84,7 @@ def reopen(self, backend):
         conn = backend.get_connection()
         conn.notes_dbpath = os.path.join(self.notes_dir, NOTES_DB_NAME)
         conn.execute('ATTACH DATABASE ? AS notes_db', (conn.notes_dbpath,))
+        conn.set_journal_mode('notes_db')
         self.allowed_fields = set()
         triggers = []
         for table in backend.tables.values():
@@ -8,19 +8,23 @@
 import operator
 import weakref
 from collections import OrderedDict, deque
-from datetime import timedelta
+from datetime import datetime, time, timedelta
 from functools import partial
+from operator import itemgetter
+from threading import Lock
 
 import regex
 
 from calibre.constants import DEBUG, preferred_encoding
+from calibre.db.bitmap import BookIdSet, BookIdSetBase, as_frozenset
 from calibre.db.utils import force_to_bool
 from calibre.utils.config_base import prefs
 from calibre.utils.date import UNDEFINED_DATE, dt_as_local, now, parse_date
 from calibre.utils.icu import lower as icu_lower
 from calibre.utils.icu import primary_contains, primary_no_punc_contains, sort_key
 from calibre.utils.localization import canonicalize_lang, lang_map
-from calibre.utils.search_query_parser import ParseException, SearchQueryParser
+from calibre.utils.search_query_parser import ParseException
+from calibre.utils.search_query_parser import Parser as TreeParser
 from polyglot.builtins import iteritems, string_or_bytes
 
 CONTAINS_MATCH = 0
@@ -409,6 +413,9 @@ class SavedSearchQueries:  # {{{
 
     def __init__(self, db, _opt_name):
         self.opt_name = _opt_name
+        # Incremented whenever the saved searches change, used to invalidate
+        # compiled query plans, which have saved searches expanded
+        self.version = 0
         try:
             self._db = weakref.ref(db)
         except TypeError:
@@ -422,6 +429,7 @@ def load_from_db(self):
             self.queries = db._pref(self.opt_name, default={})
         else:
             self.queries = {}
+        self.version += 1
 
     @property
     def db(self):
@@ -436,6 +444,7 @@ def add(self, name, value):
         db = self.db
         if db is not None:
             self.queries[self.force_unicode(name)] = self.force_unicode(value).strip()
+            self.version += 1
             db._set_pref(self.opt_name, self.queries)
 
     def lookup(self, name):
@@ -449,6 +458,7 @@ def delete(self, name):
         db = self.db
         if db is not None:
             self.queries.pop(self.force_unicode(name), False)
+            self.version += 1
             db._set_pref(self.opt_name, self.queries)
 
     def rename(self, old_name, new_name):
@@ -456,12 +466,14 @@ def rename(self, old_name, new_name):
         if db is not None:
             self.queries[self.force_unicode(new_name)] = self.queries.get(self.force_unicode(old_name), None)
             self.queries.pop(self.force_unicode(old_name), False)
+            self.version += 1
             db._set_pref(self.opt_name, self.queries)
 
     def set_all(self, smap):
         db = self.db
         if db is not None:
             self.queries = smap
+            self.version += 1
             db._set_pref(self.opt_name, smap)
 
     def names(self):
@@ -469,11 +481,187 @@ def names(self):
 # }}}
 
 
-class Parser(SearchQueryParser):  # {{{
+# Compiled query plans {{{
+
+class QueryPlan:
+
+    ''' A compiled search query. The parse tree is converted into nested
+    tuples with saved searches expanded and chains of and expressions
+    flattened and ordered so that the cheapest and most selective terms are
+    evaluated first, as later terms only check the books matched by earlier
+    ones. Plans are immutable, so they can be cached and evaluated by any number
+    of threads at the same time. '''
+
+    __slots__ = ('queried_fields', 'query', 'root')
+
+    def __init__(self, query, root, queried_fields):
+        self.query, self.root, self.queried_fields = query, root, queried_fields
+
+    def evaluate(self, matcher, candidates):
+        ''' Return the subset of candidates that match this plan, using
+        matcher.get_matches() to match individual terms. '''
+        return evaluate_plan_node(self.root, matcher, candidates)
+
+    def __repr__(self):
+        return f'QueryPlan({self.root!r})'
+
+
+def evaluate_plan_node(node, matcher, candidates):
+    op = node[0]
+    if op == 'token':
+        return matcher.get_matches(node[1], node[2], candidates=candidates)
+    if op == 'and':
+        # Each term checks only the books matched by the previous terms. Once
+        # nothing is left, the remaining terms cannot match anything, but are
+        # still checked for errors, as the order of the terms is not the one
+        # in the query.
+        children = node[1]
+        for i, child in enumerate(children):
+            candidates = candidates.intersection(evaluate_plan_node(child, matcher, candidates))
+            if not candidates:
+                validate_plan_nodes(children[i+1:], matcher)
+                break
+        return candidates
+    if op == 'or':
+        # RHS checks only those books not matched by LHS
+        l = evaluate_plan_node(node[1], matcher, candidates)
+        return l.union(evaluate_plan_node(node[2], matcher, candidates.difference(l)))
+    return candidates.difference(evaluate_plan_node(node[1], matcher, candidates))
+
+
+def validate_plan_nodes(nodes, matcher):
+    ''' Match every term in nodes against a single book, so that invalid
+    terms, such as ones with invalid dates or numbers, raise the same errors
+    regardless of the books matched by other terms. '''
+    book_id = next(iter(matcher.all_book_ids), None) if nodes else None
+    if book_id is None:
+        return
+    probe = frozenset((book_id,))
+    stack = list(nodes)
+    while stack:
+        node = stack.pop()
+        op = node[0]
+        if op == 'token':
+            matcher.get_matches(node[1], node[2], candidates=probe)
+        elif op == 'and':
+            stack.extend(node[1])
+        else:
+            stack.extend(node[1:])
+
+
+def term_cost(dbcache, location, query):
+    ''' Estimate the relative cost of matching a search term, lower is
+    cheaper and more selective. Returns None for terms whose result depends on
+    the set of books they are asked to check, such terms must not be moved
+    relative to other terms. '''
+    if location == 'template':
+        # Templates can use the candidates via the _candidates global
+        return None
+    if location in ('id', 'vl', 'marked', 'in_tag_browser'):
+        return 0
+    if location.startswith('@'):
+        return 6
+    key = dbcache.field_metadata.search_term_to_field_key(location)
+    if isinstance(key, list) or key == 'all' or key not in dbcache.field_metadata:
+        # grouped search terms and searches of all fields check many fields
+        return 6
+    fm = dbcache.field_metadata[key]
+    dt = fm['datatype']
+    if dt == 'composite':
+        return 7
+    if dt in ('bool', 'rating', 'int', 'float', 'datetime'):
+        return 1
+    if fm.get('is_csp', False):
+        return 2
+    field = dbcache.fields.get(key)
+    regexp = query.startswith('~')
+    if field is not None and field.is_many:
+        # Matched once per distinct value rather than once per book
+        return (2 if query.startswith('=') else 3) + regexp
+    return (5 if dt == 'comments' else 4) + regexp
+
+
+def compile_query(query, locations, lookup_saved_search, cost):
+    ''' Compile query into a :class:`QueryPlan`. cost(location, query) must
+    return the estimated cost of a term, see :func:`term_cost`. '''
+    queried_fields = []
+
+    def parse(query):
+        try:
+            return TreeParser().parse(query, locations)
+        except RuntimeError:
+            raise ParseException(_('Failed to parse query, recursion limit reached: %s')%repr(query))
+
+    def saved_search_text(name):
+        try:
+            ans = lookup_saved_search(name)
+        except Exception:  # convert all exceptions (e.g., missing key) to a parse error
+            import traceback
+            traceback.print_exc()
+            raise ParseException(_('Unknown error in saved search: {0}').format(name))
+        if ans is None:
+            raise ParseException(_('Unknown saved search: {}').format(name))
+        return ans
+
+    def saved_search(tree, searches_seen):
+        ' Return the parse tree of a saved search term '
+        name = tree[2].removeprefix('=')
+        if name.lower() in searches_seen:
+            raise ParseException(_('Recursive saved search: {0}').format(name))
+        return parse(saved_search_text(name)), searches_seen | {name.lower()}
+
+    def is_saved_search(tree):
+        return tree[0] == 'token' and tree[1].lower() == 'search'
+
+    def and_terms(tree, searches_seen):
+        if tree[0] == 'and':
+            return and_terms(tree[1], searches_seen) + and_terms(tree[2], searches_seen)
+        if is_saved_search(tree):
+            return and_terms(*saved_search(tree, searches_seen))
+        return [compile_tree(tree, searches_seen)]
+
+    def compile_tree(tree, searches_seen):
+        ''' Return the plan node for tree and its cost '''
+        op = tree[0]
+        if op == 'and':
+            terms, ordered, run = and_terms(tree, searches_seen), [], []
+            # Terms are only reordered between terms that must not be moved,
+            # so that those terms see the same candidates as before
+            for term in terms:
+                if term[1] is None:
+                    ordered.extend(sorted(run, key=itemgetter(1)))
+                    ordered.append(term)
+                    run = []
+                else:
+                    run.append(term)
+            ordered.extend(sorted(run, key=itemgetter(1)))
+            c = None if any(t[1] is None for t in terms) else sum(t[1] for t in terms)
+            return ('and', tuple(t[0] for t in ordered)), c
+        if op == 'or':
+            (l, lc), (r, rc) = compile_tree(tree[1], searches_seen), compile_tree(tree[2], searches_seen)
+            return ('or', l, r), (None if lc is None or rc is None else lc + rc)
+        if op == 'not':
+            node, c = compile_tree(tree[1], searches_seen)
+            return ('not', node), c
+        if is_saved_search(tree):
+            return compile_tree(*saved_search(tree, searches_seen))
+        queried_fields.append((tree[1], tree[2]))
+        return ('token', tree[1], tree[2]), cost(tree[1], tree[2])
+
+    root = compile_tree(parse(query), frozenset())[0]
+    return QueryPlan(query, root, tuple(queried_fields))
+# }}}
+
+
+class Parser:  # {{{
+
+    ''' Matches the terms of compiled query plans against the books in
+    dbcache. Holds the state of a single search, so a new instance is used
+    for every search, plans are shared. '''
 
     def __init__(self, dbcache, all_book_ids, gst, date_search, num_search,
                  bool_search, keypair_search, limit_search_columns, limit_search_columns_to,
-                 locations, virtual_fields, lookup_saved_search, parse_cache):
+                 locations, virtual_fields, plan_for):
         self.dbcache, self.all_book_ids = dbcache, all_book_ids
         self.all_search_locations = frozenset(locations)
         self.grouped_search_terms = gst
@@ -486,31 +674,52 @@ def __init__(self, dbcache, all_book_ids, gst, date_search, num_search,
             self.virtual_fields['marked'] = self
         if 'in_tag_browser' not in self.virtual_fields:
             self.virtual_fields['in_tag_browser'] = self
-        SearchQueryParser.__init__(self, locations, optimize=True, lookup_saved_search=lookup_saved_search, parse_cache=parse_cache)
+        self.plan_for = plan_for
+        self.virtual_field_used = False
 
     @property
     def field_metadata(self):
         return self.dbcache.field_metadata
 
-    def universal_set(self):
-        return self.all_book_ids
-
-    def field_iter(self, name, candidates):
+    def field_iter(self, name, candidates, item_ids=None):
         get_metadata = self.dbcache._get_proxy_metadata
         try:
             field = self.dbcache.fields[name]
         except KeyError:
             field = self.virtual_fields[name]
             self.virtual_field_used = True
+        if item_ids is not None:
+            return field.iter_searchable_values(get_metadata, candidates, item_ids=item_ids)
         return field.iter_searchable_values(get_metadata, candidates)
 
+    def indexed_item_ids(self, location, query, matchkind):
+        ''' Return the ids of the items in the field that could match query,
+        found using the search index of the field, or None if the field has no
+        index or it cannot be used for this query. '''
+        index = getattr(self.dbcache.fields.get(location), 'search_index', None)
+        if index is None:
+            return None
+        if matchkind == EQUALS_MATCH:
+            if query.startswith('..'):
+                return None
+            if query.startswith('.'):
+                # Hierarchical match, a prefix that is also contained in the value
+                return index.items_containing(query[1:])
+            return index.items_equal_to(query)
+        if matchkind in (CONTAINS_MATCH, ACCENT_MATCH):
+            return index.items_containing(query)
+
     def iter_searchable_values(self, *args, **kwargs):
         for x in ():
             yield x, set()
 
-    def parse(self, *args, **kwargs):
+    def get_queried_fields(self, query):
+        return self.plan_for(self.dbcache, query).queried_fields
+
+    def parse(self, query):
+        ' Return the ids of the books in all_book_ids that match query '
         self.virtual_field_used = False
-        return SearchQueryParser.parse(self, *args, **kwargs)
+        return self.plan_for(self.dbcache, query).evaluate(self, self.all_book_ids)
 
     def get_matches(self, location, query, candidates=None,
                     allow_recursion=True):
@@ -530,8 +739,8 @@ def get_matches(self, location, query, candidates=None,
             if not vl:
                 raise ParseException(_('No such Virtual library: {}').format(query))
             try:
-                return candidates & self.dbcache.books_in_virtual_library(
-                            query, virtual_fields=self.virtual_fields)
+                return candidates.intersection(as_frozenset(self.dbcache.books_in_virtual_library(
+                            query, virtual_fields=self.virtual_fields)))
             except RuntimeError:
                 raise ParseException(_('Virtual library search is recursive: {}').format(query))
 
@@ -771,7 +980,8 @@ def fi(default_value=None):
                 continue
 
             if location in text_fields:
-                for val, book_ids in self.field_iter(location, current_candidates):
+                item_ids = self.indexed_item_ids(location, q, matchkind)
+                for val, book_ids in self.field_iter(location, current_candidates, item_ids):
                     if val is not None:
                         if isinstance(val, string_or_bytes):
                             val = (val,)
@@ -882,42 +1092,89 @@ def __init__(self, db, opt_name, all_search_locations=()):
         self.keypair_search = KeyPairSearch()
         self.saved_searches = SavedSearchQueries(db, opt_name)
         self.cache = LRUCache()
-        self.parse_cache = LRUCache(limit=100)
+        # Expiry times of cached results of searches on dates
+        self.cache_expiry = {}
+        # Compiled query plans, shared by all threads, keyed by the query, the
+        # version of the field metadata and the version of the saved searches
+        self.plan_cache = LRUCache(limit=100)
+        self.plan_lock = Lock()
+        self.field_metadata_version = 0
 
     def get_saved_searches(self):
         return self.saved_searches
 
     def change_locations(self, newlocs):
+        # Called whenever the field metadata changes
         if frozenset(newlocs) != frozenset(self.all_search_locations):
             self.clear_caches()
-            self.parse_cache.clear()
-        self.all_search_locations = newlocs
-
-    def update_or_clear(self, dbcache, book_ids=None):
-        if book_ids and (len(book_ids) * len(self.cache)) <= self.MAX_CACHE_UPDATE:
-            self.update_caches(dbcache, book_ids)
-        else:
+        with self.plan_lock:
+            self.plan_cache.clear()
+            self.field_metadata_version += 1
+            self.all_search_locations = newlocs
+
+    def plan_for(self, dbcache, query):
+        ''' Return the compiled :class:`QueryPlan` for query. Safe to call
+        from multiple threads. '''
+        with self.plan_lock:
+            key = query, self.field_metadata_version, self.saved_searches.version
+            locations = self.all_search_locations
+            plan = self.plan_cache.get(key)
+        if plan is None:
+            plan = compile_query(query, frozenset(locations), self.saved_searches.lookup, partial(term_cost, dbcache))
+            with self.plan_lock:
+                self.plan_cache.add(key, plan)
+        return plan
+
+    def update_or_clear(self, dbcache, book_ids=None, fields=None):
+        ''' Update the cached results for the specified books. If fields is
+        not None, only cached queries that depend on the specified fields are
+        updated, the rest are left untouched. Queries that would be too
+        expensive to update are dropped from the cache. '''
+        if not book_ids:
             self.clear_caches()
+            return
+        sqp = self.create_parser(dbcache)
+        try:
+            if fields is None:
+                affected = tuple(query for query, result in self.cache)
+            else:
+                affected = self.queries_depending_on(sqp, dbcache, fields)
+            if not affected:
+                return
+            if len(book_ids) * len(affected) <= self.MAX_CACHE_UPDATE:
+                self._update_caches(sqp, book_ids, affected)
+            elif len(affected) == len(self.cache):
+                self.clear_caches()
+            else:
+                for query in affected:
+                    self.cache.pop(query)
+                    self.cache_expiry.pop(query, None)
+        finally:
+            sqp.dbcache = sqp.plan_for = None
 
     def clear_caches(self):
         self.cache.clear()
+        self.cache_expiry.clear()
 
     def update_caches(self, dbcache, book_ids):
         sqp = self.create_parser(dbcache)
         try:
             return self._update_caches(sqp, book_ids)
         finally:
-            sqp.dbcache = sqp.lookup_saved_search = None
+            sqp.dbcache = sqp.plan_for = None
 
     def discard_books(self, book_ids):
         book_ids = set(book_ids)
         for query, result in self.cache:
             result.difference_update(book_ids)
 
-    def _update_caches(self, sqp, book_ids):
+    def _update_caches(self, sqp, book_ids, queries=None):
         book_ids = sqp.all_book_ids = set(book_ids)
         remove = set()
-        for query, result in tuple(self.cache):
+        for query in (tuple(q for q, r in self.cache) if queries is None else queries):
+            result = self.cache.item_map.get(query)
+            if result is None:
+                continue
             try:
                 matches = sqp.parse(query)
             except ParseException:
@@ -929,6 +1186,77 @@ def _update_caches(self, sqp, book_ids):
                 result.update(matches)
         for query in remove:
             self.cache.pop(query)
+            self.cache_expiry.pop(query, None)
+
+    def fields_for_query(self, sqp, dbcache, query):
+        ''' Return the set of fields whose values determine the result of
+        query or None if the result could depend on any field, for example,
+        for searches on all fields, grouped search terms, Virtual libraries or
+        composite columns. '''
+        ans = set()
+        fm = dbcache.field_metadata
+        try:
+            queried_fields = sqp.get_queried_fields(query)
+        except ParseException:
+            return None
+        for location, value in queried_fields:
+            key = fm.search_term_to_field_key(icu_lower(location.strip()))
+            if key == 'date':
+                key = 'timestamp'
+            if not isinstance(key, str) or key not in dbcache.fields or key not in fm:
+                return None
+            if fm[key]['datatype'] == 'composite':
+                return None
+            ans.add(key)
+        return ans
+
+    def queries_depending_on(self, sqp, dbcache, fields):
+        ''' Return the cached queries whose results could change when the
+        specified fields change '''
+        fields = frozenset(fields)
+        ans = []
+        for query, result in self.cache:
+            qf = self.fields_for_query(sqp, dbcache, query)
+            if qf is None or not qf.isdisjoint(fields):
+                ans.append(query)
+        return tuple(ans)
+
+    def expiry_for_query(self, sqp, dbcache, query):
+        ''' Results of searches on dates can use relative dates such as today
+        or 3daysago which change at midnight, so they expire then. Returns the
+        expiry time as a timestamp or None if the results never expire. '''
+        fm = dbcache.field_metadata
+        for name, value in sqp.get_queried_fields(query):
+            key = fm.search_term_to_field_key(icu_lower(name.strip()))
+            if key == 'date':
+                key = 'timestamp'
+            if isinstance(key, str) and key in fm:
+                m = fm[key]
+                if m['datatype'] == 'datetime' or (
+                        m['datatype'] == 'composite' and m.get('display', {}).get('composite_sort', '') == 'date'):
+                    tomorrow = datetime.now().date() + timedelta(days=1)
+                    return datetime.combine(tomorrow, time()).timestamp()
+
+    def get_cached(self, query):
+        expires = self.cache_expiry.get(query)
+        if expires is not None and datetime.now().timestamp() >= expires:
+            self.cache.pop(query)
+            self.cache_expiry.pop(query, None)
+        return self.cache.get(query)
+
+    def add_to_cache(self, sqp, dbcache, query, result):
+        if not isinstance(result, BookIdSet):
+            result = BookIdSet(result)
+        self.cache.add(query, result)
+        expires = self.expiry_for_query(sqp, dbcache, query)
+        if expires is None:
+            self.cache_expiry.pop(query, None)
+        else:
+            self.cache_expiry[query] = expires
+            if len(self.cache_expiry) > self.cache.limit:
+                for q in tuple(self.cache_expiry):
+                    if q not in self.cache:
+                        self.cache_expiry.pop(q, None)
 
     def create_parser(self, dbcache, virtual_fields=None):
         return Parser(
@@ -937,38 +1265,33 @@ def create_parser(self, dbcache, virtual_fields=None):
             self.keypair_search,
             prefs['limit_search_columns'],
             prefs['limit_search_columns_to'], self.all_search_locations,
-            virtual_fields, self.saved_searches.lookup, self.parse_cache)
+            virtual_fields, self.plan_for)
 
     def __call__(self, dbcache, query, search_restriction, virtual_fields=None, book_ids=None):
         '''
         Return the set of ids of all records that match the specified
         query and restriction
         '''
-        # We construct a new parser instance per search as the parse is not
-        # thread safe.
+        # The compiled query plans are shared, but the state of a search is
+        # not, so we use a new matcher instance per search.
         sqp = self.create_parser(dbcache, virtual_fields)
         try:
             return self._do_search(sqp, query, search_restriction, dbcache, book_ids=book_ids)
         finally:
-            sqp.dbcache = sqp.lookup_saved_search = None
+            sqp.dbcache = sqp.plan_for = None
 
     def query_is_cacheable(self, sqp, dbcache, query):
         if query:
             for name, value in sqp.get_queried_fields(query):
                 if name == 'template':
                     return False
-                elif name in dbcache.field_metadata.all_field_keys():
-                    fm = dbcache.field_metadata[name]
-                    if fm['datatype'] == 'datetime':
-                        return False
-                    if fm['datatype'] == 'composite':
-                        if fm.get('display', {}).get('composite_sort', '') == 'date':
-                            return False
         return True
 
     def _do_search(self, sqp, query, search_restriction, dbcache, book_ids=None):
         ''' Do the search, caching the results. Results are cached only if the
-        search is on the full library and no virtual field is searched on '''
+        search is on the full library and no virtual field is searched on.
+        Results are cached and returned as :class:`BookIdSet` bitmaps, while
+        the matching itself works on python sets. '''
         if isinstance(search_restriction, bytes):
             search_restriction = search_restriction.decode('utf-8')
         if isinstance(query, bytes):
@@ -976,43 +1299,48 @@ def _do_search(self, sqp, query, search_restriction, dbcache, book_ids=None):
 
         query = query.strip()
         use_cache = self.query_is_cacheable(sqp, dbcache, query)
+        if isinstance(book_ids, BookIdSetBase):
+            # Matching intersects candidates with the books for every item
+            book_ids = book_ids.frozen()
 
         if use_cache and book_ids is None and query and not search_restriction:
-            cached = self.cache.get(query)
+            cached = self.get_cached(query)
             if cached is not None:
-                return cached
+                return BookIdSet(cached)
 
         restricted_ids = all_book_ids = dbcache._all_book_ids(type=set)
         if search_restriction and search_restriction.strip():
             sr = search_restriction.strip()
             sqp.all_book_ids = all_book_ids if book_ids is None else book_ids
             if self.query_is_cacheable(sqp, dbcache, sr):
-                cached = self.cache.get(sr)
+                cached = self.get_cached(sr)
                 if cached is None:
                     restricted_ids = sqp.parse(sr)
                     if not sqp.virtual_field_used and sqp.all_book_ids is all_book_ids:
-                        self.cache.add(sr, restricted_ids)
+                        self.add_to_cache(sqp, dbcache, sr, restricted_ids)
+                elif book_ids is None:
+                    if not query:
+                        return BookIdSet(cached)
+                    restricted_ids = cached.frozen()
                 else:
-                    restricted_ids = cached
-                    if book_ids is not None:
-                        restricted_ids = book_ids.intersection(restricted_ids)
+                    restricted_ids = book_ids.intersection(cached.frozen())
             else:
                 restricted_ids = sqp.parse(sr)
         elif book_ids is not None:
             restricted_ids = book_ids
 
         if not query:
-            return restricted_ids
+            return BookIdSet(restricted_ids)
 
         if use_cache and restricted_ids is all_book_ids:
-            cached = self.cache.get(query)
+            cached = self.get_cached(query)
             if cached is not None:
-                return cached
+                return BookIdSet(cached)
 
         sqp.all_book_ids = restricted_ids
-        result = sqp.parse(query)
+        result = BookIdSet(sqp.parse(query))
 
         if not sqp.virtual_field_used and sqp.all_book_ids is all_book_ids:
-            self.cache.add(query, result)
+            self.add_to_cache(sqp, dbcache, query, result.copy())
 
         return result
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+An inverted index of the values of text fields such as tags, authors and
+series, used to speed up searching. Rather than matching the query against
+every value of a field, the index is used to find a small set of candidate
+values, which are then matched against the query as usual. The index must
+therefore never miss a value that could match.
+
+Contains matches use trigrams of the lower cased, alphanumeric characters of
+values. This is only done for values that are pure ASCII since ICU primary
+strength matching can treat non-ASCII characters as equal to other
+characters in locale specific ways, for example, in Danish, "aa" is the same
+letter as "å". Values that are not ASCII are always candidates.
+'''
+
+import re
+from collections import defaultdict
+from itertools import product
+from string import ascii_lowercase, digits
+from threading import Lock
+
+from calibre.utils.icu import lower as icu_lower
+from calibre.utils.icu import primary_contains, primary_no_punc_contains
+
+NGRAM = 3
+NON_ALNUM = re.compile(r'[^a-z0-9]+')
+null = object()
+_ascii_is_distinct = None
+
+
+def ascii_is_distinct():
+    ''' Check that the collation used for searching treats all ASCII letters
+    and digits as distinct characters, as some old style tailorings, for
+    example, do not distinguish between v and w. '''
+    global _ascii_is_distinct
+    if _ascii_is_distinct is None:
+        chars = ascii_lowercase + digits
+        _ascii_is_distinct = all(
+            bool(primary_no_punc_contains(a, b)) == bool(primary_contains(a, b)) == (a == b) for a, b in product(chars, chars))
+    return _ascii_is_distinct
+
+
+def fold(text):
+    ' Return the lower cased alphanumeric characters of text, or None if text is not ASCII '
+    if text.isascii():
+        return NON_ALNUM.sub('', text.lower())
+
+
+def ngrams(text):
+    return {text[i:i+NGRAM] for i in range(len(text) - NGRAM + 1)}
+
+
+class TextSearchIndex:
+
+    ''' An inverted index of the values in the id_map of a table. It is built
+    the first time it is used and must be told about changed items, via
+    :meth:`update_items`, after that. '''
+
+    def __init__(self, table):
+        self.table = table
+        self.built = False
+        self.build_lock = Lock()
+
+    def ensure_built(self):
+        if not self.built:
+            with self.build_lock:
+                if not self.built:
+                    self.values = {}
+                    self.postings = defaultdict(set)
+                    self.exact = defaultdict(set)
+                    # Items whose values are not in the trigram postings or
+                    # are not text, these are always candidates
+                    self.unindexed, self.non_text = set(), set()
+                    for item_id, val in self.table.id_map.items():
+                        self.add(item_id, val)
+                    self.built = True
+
+    def invalidate(self):
+        ' Rebuild the index the next time it is used, for example, after the table is re-read '
+        with self.build_lock:
+            self.built = False
+
+    def add(self, item_id, val):
+        self.values[item_id] = val
+        if isinstance(val, str):
+            self.exact[icu_lower(val)].add(item_id)
+            f = fold(val)
+            if f is not None:
+                for g in ngrams(f):
+                    self.postings[g].add(item_id)
+                return
+        else:
+            self.non_text.add(item_id)
+        self.unindexed.add(item_id)
+
+    def remove(self, item_id):
+        val = self.values.pop(item_id)
+        self.unindexed.discard(item_id)
+        self.non_text.discard(item_id)
+        if isinstance(val, str):
+            self.discard_from(self.exact, icu_lower(val), item_id)
+            f = fold(val)
+            if f is not None:
+                for g in ngrams(f):
+                    self.discard_from(self.postings, g, item_id)
+
+    def discard_from(self, m, key, item_id):
+        s = m.get(key)
+        if s is not None:
+            s.discard(item_id)
+            if not s:
+                del m[key]
+
+    def update_items(self, item_ids):
+        ' Update the index for items that have been added, renamed or removed. Must be called with the write lock held. '
+        if not self.built:
+            return
+        id_map = self.table.id_map
+        for item_id in item_ids:
+            val = id_map.get(item_id, null)
+            old = self.values.get(item_id, null)
+            if val != old:
+                if old is not null:
+                    self.remove(item_id)
+                if val is not null:
+                    self.add(item_id, val)
+
+    def items_equal_to(self, query):
+        ''' Return the ids of items that could be equal to query, ignoring
+        case. Can contain ids of items that no longer exist. '''
+        self.ensure_built()
+        return self.exact.get(icu_lower(query), set()) | self.non_text
+
+    def items_containing(self, query):
+        ''' Return the ids of items that could contain query, ignoring case,
+        accents and punctuation, or None if the index cannot be used for this
+        query. Can contain ids of items that no longer exist. '''
+        f = fold(query)
+        if f is None or len(f) < NGRAM or not ascii_is_distinct():
+            return None
+        self.ensure_built()
+        postings = sorted((self.postings.get(g, ()) for g in ngrams(f)), key=len)
+        return set(postings[0]).intersection(*postings[1:]) | self.unindexed
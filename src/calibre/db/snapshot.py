@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+An on-disk snapshot of the in-memory tables, used to avoid reading every
+table from metadata.db when opening large libraries.
+
+The snapshot is stored next to metadata.db. It consists of a small header,
+used to check if the snapshot is still valid, followed by the msgpack encoded
+table data, which is unpacked directly from a memory map of the file. The
+snapshot is valid only if metadata.db (and its WAL file, if any) has not
+changed since the snapshot was created, which is checked using the file
+change counter from the SQLite database header and the size and modification
+times of the files.
+'''
+
+import mmap
+import os
+import struct
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from calibre.constants import numeric_version
+from calibre.utils.date import EPOCH
+from calibre.utils.filenames import atomic_rename
+from calibre.utils.serialize import msgpack_dumps, msgpack_loads
+
+MAGIC = b'calibre-table-snapshot\n'
+SNAPSHOT_VERSION = 1
+HEADER_LENGTH = struct.Struct('<Q')
+ONE_MICROSECOND = timedelta(microseconds=1)
+FACTORIES = {'set': set, 'dict': dict, 'list': list}
+
+
+def snapshot_path(dbpath):
+    return dbpath + '.snapshot'
+
+
+def db_state_key(dbpath):
+    ''' A key that changes whenever the database at dbpath is changed. In
+    rollback journal mode SQLite increments the file change counter on every
+    commit. In WAL mode it does not, but commits change the WAL file instead. '''
+    with open(dbpath, 'rb') as f:
+        f.seek(24)
+        change_counter = int.from_bytes(f.read(4), 'big')
+        st = os.fstat(f.fileno())
+    try:
+        wst = os.stat(dbpath + '-wal')
+    except OSError:
+        wal = [-1, -1]
+    else:
+        wal = [wst.st_size, wst.st_mtime_ns]
+    return [SNAPSHOT_VERSION, list(numeric_version), change_counter, st.st_size, st.st_mtime_ns] + wal
+
+
+# Encoding of maps {{{
+
+def encode_map(m):
+    ' Encode a dict like object as [kind, default_factory, keys, values] '
+    factory = getattr(m, 'default_factory', None)
+    factory = {set: 'set', dict: 'dict', list: 'list'}.get(factory)
+    keys, values = list(m.keys()), list(m.values())
+    types = {type(v) for v in values}
+    types.discard(type(None))
+    kind = 'raw'
+    if types == {datetime}:
+        kind = 'datetime'
+        values = [None if v is None else (v - EPOCH) // ONE_MICROSECOND for v in values]
+    elif types and types <= {set, frozenset}:
+        kind = 'set'
+        values = [None if v is None else tuple(v) for v in values]
+    return [kind, factory, keys, values]
+
+
+def decode_map(x):
+    kind, factory, keys, values = x
+    if kind == 'datetime':
+        values = (None if v is None else EPOCH + timedelta(microseconds=v) for v in values)
+    elif kind == 'set':
+        values = (None if v is None else set(v) for v in values)
+    pairs = zip(keys, values)
+    return dict(pairs) if factory is None else defaultdict(FACTORIES[factory], pairs)
+# }}}
+
+
+def encode_snapshot(tables):
+    ''' Encode the state of tables, a mapping of table names to
+    :class:`calibre.db.tables.Table` objects. Must be called with the tables
+    locked. Returns the encoded data as bytes. '''
+    return msgpack_dumps({
+        name: {attr: encode_map(val) for attr, val in table.snapshot().items()} for name, table in tables.items()})
+
+
+def write_snapshot(dbpath, key, data):
+    ' Write the encoded snapshot data atomically, marking it as valid for the database state key '
+    header = msgpack_dumps({'key': key})
+    path = snapshot_path(dbpath)
+    tpath = path + '.tmp'
+    with open(tpath, 'wb') as f:
+        f.write(MAGIC)
+        f.write(HEADER_LENGTH.pack(len(header)))
+        f.write(header)
+        f.write(data)
+    atomic_rename(tpath, path)
+
+
+def read_snapshot(dbpath, key, table_names):
+    ''' Return a mapping of table names to table state if a valid snapshot
+    exists for the database state key, containing exactly the specified
+    tables. Otherwise returns None. '''
+    try:
+        f = open(snapshot_path(dbpath), 'rb')
+    except OSError:
+        return
+    with f:
+        if f.read(len(MAGIC)) != MAGIC:
+            return
+        hlen = HEADER_LENGTH.unpack(f.read(HEADER_LENGTH.size))[0]
+        header = msgpack_loads(f.read(hlen))
+        if header.get('key') != key:
+            return
+        offset = len(MAGIC) + HEADER_LENGTH.size + hlen
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m, memoryview(m) as mv:
+            body = mv[offset:]
+            try:
+                data = msgpack_loads(body, use_list=False)
+            finally:
+                body.release()
+    if set(data) != set(table_names):
+        return
+    return {name: {attr: decode_map(val) for attr, val in state.items()} for name, state in data.items()}
+
+
+def remove_snapshot(dbpath):
+    try:
+        os.remove(snapshot_path(dbpath))
+    except FileNotFoundError:
+        pass
@@ -10,6 +10,7 @@
 from collections.abc import Iterable
 from datetime import datetime, timedelta
 
+from calibre.db.columnar import compact_scalar_map, compact_set_map, compact_tuple_map
 from calibre.ebooks.metadata import author_to_author_sort
 from calibre.utils.date import UNDEFINED_DATE, parse_date, utc_tz
 from calibre.utils.icu import lower as icu_lower
@@ -55,6 +56,9 @@ def c_parse(val):
 class Table:
 
     supports_notes = False
+    # The attributes holding the in-memory maps of this table, that are
+    # saved in the startup snapshot, see :mod:`calibre.db.snapshot`
+    snapshot_attrs = ()
 
     def __init__(self, name, metadata, link_table=None):
         self.name, self.metadata = name, metadata
@@ -79,6 +83,24 @@ def __init__(self, name, metadata, link_table=None):
     def remove_books(self, book_ids, db):
         return set()
 
+    def compact(self):
+        ''' Switch the in-memory maps of this table to the compact, array
+        backed representation from :mod:`calibre.db.columnar`. Calling it
+        again folds any changes made since the last call back into the
+        arrays. '''
+        pass
+
+    def snapshot(self):
+        ''' Return the in-memory state of this table as a mapping of
+        attribute names to maps '''
+        return {attr: getattr(self, attr) for attr in self.snapshot_attrs}
+
+    def restore_snapshot(self, state):
+        ''' Restore the in-memory state of this table from a snapshot
+        instead of reading it from the database '''
+        for attr in self.snapshot_attrs:
+            setattr(self, attr, state[attr])
+
     def fix_link_table(self, db):
         pass
 
@@ -109,6 +131,7 @@ class OneToOneTable(Table):
     '''
 
     table_type = ONE_ONE
+    snapshot_attrs = ('book_col_map',)
 
     def read(self, db):
         idcol = 'id' if self.metadata['table'] == 'books' else 'book'
@@ -127,6 +150,9 @@ def read(self, db):
             us = self.unserialize
             self.book_col_map = {book_id:us(val) for book_id, val in query}
 
+    def compact(self):
+        self.book_col_map = compact_scalar_map(self.book_col_map)
+
     def remove_books(self, book_ids, db):
         clean = set()
         for book_id in book_ids:
@@ -162,6 +188,10 @@ def read(self, db):
         OneToOneTable.read(self, db)
         self.uuid_to_id_map = {v:k for k, v in iteritems(self.book_col_map)}
 
+    def restore_snapshot(self, state):
+        OneToOneTable.restore_snapshot(self, state)
+        self.uuid_to_id_map = {v:k for k, v in iteritems(self.book_col_map)}
+
     def update_uuid_cache(self, book_id_val_map):
         for book_id, uuid in iteritems(book_id_val_map):
             self.uuid_to_id_map.pop(self.book_col_map.get(book_id, None), None)  # discard old uuid
@@ -191,6 +221,16 @@ def read(self, db):
         self.composite_sort = d.get('composite_sort', False)
         self.use_decorations = d.get('use_decorations', False)
 
+    def compact(self):
+        pass
+
+    def snapshot(self):
+        return {}
+
+    def restore_snapshot(self, state):
+        # Composite columns have no data in the database
+        self.read(None)
+
     def remove_books(self, book_ids, db):
         return set()
 
@@ -205,6 +245,7 @@ class ManyToOneTable(Table):
 
     table_type = MANY_ONE
     supports_notes = True
+    snapshot_attrs = ('id_map', 'link_map', 'book_col_map', 'col_book_map')
 
     def read(self, db):
         self.id_map = {}
@@ -231,6 +272,12 @@ def read_maps(self, db):
             cbm[item_id].add(book)
             bcm[book] = item_id
 
+    def compact(self):
+        self.id_map = compact_scalar_map(self.id_map)
+        self.link_map = compact_scalar_map(self.link_map)
+        self.book_col_map = compact_scalar_map(self.book_col_map)
+        self.col_book_map = compact_set_map(self.col_book_map)
+
     def fix_link_table(self, db):
         linked_item_ids = set(itervalues(self.book_col_map))
         extra_item_ids = linked_item_ids - set(self.id_map)
@@ -427,6 +474,12 @@ def read_maps(self, db):
 
         self.book_col_map = {k:tuple(v) for k, v in iteritems(bcm)}
 
+    def compact(self):
+        self.id_map = compact_scalar_map(self.id_map)
+        self.link_map = compact_scalar_map(self.link_map)
+        self.book_col_map = compact_tuple_map(self.book_col_map)
+        self.col_book_map = compact_set_map(self.col_book_map)
+
     def fix_link_table(self, db):
         linked_item_ids = {item_id for item_ids in itervalues(self.book_col_map) for item_id in item_ids}
         extra_item_ids = linked_item_ids - set(self.id_map)
@@ -577,6 +630,8 @@ def fix_case_duplicates(self, db):
 
 class AuthorsTable(ManyToManyTable):
 
+    snapshot_attrs = ManyToManyTable.snapshot_attrs + ('asort_map',)
+
     def read_id_maps(self, db):
         self.link_map = lm = {}
         self.asort_map = sm = {}
@@ -589,6 +644,10 @@ def read_id_maps(self, db):
             sm[aid] = (sort or author_to_author_sort(name))
             lm[aid] = link
 
+    def compact(self):
+        ManyToManyTable.compact(self)
+        self.asort_map = compact_scalar_map(self.asort_map)
+
     def set_sort_names(self, aus_map, db):
         aus_map = {aid:(a or '').strip() for aid, a in iteritems(aus_map)}
         aus_map = {aid:a for aid, a in iteritems(aus_map) if a != self.asort_map.get(aid, None)}
@@ -630,6 +689,7 @@ class FormatsTable(ManyToManyTable):
 
     do_clean_on_remove = False
     supports_notes = False
+    snapshot_attrs = ('book_col_map', 'col_book_map', 'fname_map', 'size_map')
 
     def read_id_maps(self, db):
         pass
@@ -637,6 +697,10 @@ def read_id_maps(self, db):
     def fix_case_duplicates(self, db):
         pass
 
+    def compact(self):
+        # Formats are keyed by name not id and the maps are small
+        pass
+
     def read_maps(self, db):
         self.fname_map = fnm = defaultdict(dict)
         self.size_map = sm = defaultdict(dict)
@@ -716,6 +780,7 @@ def update_fmt(self, book_id, fmt, fname, size, db):
 class IdentifiersTable(ManyToManyTable):
 
     supports_notes = False
+    snapshot_attrs = ('book_col_map', 'col_book_map')
 
     def read_id_maps(self, db):
         pass
@@ -723,6 +788,10 @@ def read_id_maps(self, db):
     def fix_case_duplicates(self, db):
         pass
 
+    def compact(self):
+        # The per book values are dicts keyed by identifier type
+        pass
+
     def read_maps(self, db):
         self.book_col_map = defaultdict(dict)
         self.col_book_map = defaultdict(set)
@@ -0,0 +1,536 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+Benchmarks for the database layer, run on a synthetic library created by
+scaling up the test library in metadata.db. Run as:
+
+    calibre-debug src/calibre/db/tests/benchmark.py -- tables --books 100000
+
+Use --library to re-use a previously created synthetic library.
+'''
+
+import gc
+import os
+import random
+import shutil
+import sys
+import tempfile
+from functools import partial
+from time import monotonic
+
+# Synthetic library {{{
+
+SYLLABLES = (
+    'al', 'an', 'ar', 'be', 'bo', 'ca', 'da', 'de', 'el', 'en', 'fa', 'ga', 'ha', 'in', 'ka', 'la', 'le', 'li',
+    'ma', 'mo', 'na', 'ne', 'or', 'pa', 'ra', 're', 'ri', 'sa', 'se', 'ta', 'te', 'ti', 'to', 'ul', 'va', 'yo', 'za',
+)
+LANGUAGES = ('eng', 'deu', 'fra', 'spa', 'ita', 'jpn', 'rus', 'zho')
+
+
+def word(rng, mn=1, mx=4):
+    return ''.join(rng.choice(SYLLABLES) for i in range(rng.randint(mn, mx)))
+
+
+def phrase(rng, mn=1, mx=4):
+    return ' '.join(word(rng).capitalize() for i in range(rng.randint(mn, mx)))
+
+
+def unique_names(rng, num, make):
+    ans, seen = [], set()
+    while len(ans) < num:
+        x = make(rng)
+        if x.lower() not in seen:
+            seen.add(x.lower())
+            ans.append(x)
+    return ans
+
+
+def create_synthetic_library(library_path, num_books=100000, seed=1234, report=print):
+    ''' Create a library at library_path starting from the test library in
+    metadata.db and add num_books synthetic books to it. Item counts and the
+    number of items per book follow roughly the distributions found in large
+    real world libraries. Data is inserted directly with SQL, so this is much
+    faster than using the add books API. '''
+    from calibre.db.backend import DB
+    from calibre.ebooks.metadata import author_to_author_sort
+    os.makedirs(library_path, exist_ok=True)
+    shutil.copyfile(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'metadata.db'), os.path.join(library_path, 'metadata.db'))
+    rng = random.Random(seed)
+    st = monotonic()
+    num_authors, num_tags = max(10, num_books // 3), max(10, num_books // 8)
+    num_series, num_publishers = max(10, num_books // 10), max(10, num_books // 200)
+    authors = unique_names(rng, num_authors, lambda rng: phrase(rng, 2, 3))
+    tags = unique_names(rng, num_tags, lambda rng: phrase(rng, 1, 3))
+    series = unique_names(rng, num_series, lambda rng: phrase(rng, 1, 4))
+    publishers = unique_names(rng, num_publishers, lambda rng: phrase(rng, 1, 2))
+
+    db = DB(library_path)
+    try:
+        with db.conn:
+            def insert_items(table, col, vals):
+                start = (db.get(f'SELECT MAX(id) FROM {table}', all=False) or 0) + 1
+                db.executemany(f'INSERT INTO {table} (id, {col}) VALUES (?, ?)', enumerate(vals, start=start))
+                return range(start, start + len(vals))
+
+            start = (db.get('SELECT MAX(id) FROM authors', all=False) or 0) + 1
+            db.executemany('INSERT INTO authors (id, name, sort) VALUES (?, ?, ?)', (
+                (i, a, author_to_author_sort(a)) for i, a in enumerate(authors, start=start)))
+            author_ids = range(start, start + len(authors))
+            tag_ids = insert_items('tags', 'name', tags)
+            series_ids = insert_items('series', 'name', series)
+            publisher_ids = insert_items('publishers', 'name', publishers)
+            db.executemany('INSERT OR IGNORE INTO ratings (rating) VALUES (?)', ((r,) for r in range(1, 11)))
+            rating_ids = [x[0] for x in db.get('SELECT id FROM ratings WHERE rating > 0')]
+            db.executemany('INSERT OR IGNORE INTO languages (lang_code) VALUES (?)', ((l,) for l in LANGUAGES))
+            lang_ids = [x[0] for x in db.get('SELECT id FROM languages')]
+
+            first_book = (db.get('SELECT MAX(id) FROM books', all=False) or 0) + 1
+            book_ids = range(first_book, first_book + num_books)
+            books, alinks, tlinks, slinks, plinks, rlinks, llinks, idents, comments = [], [], [], [], [], [], [], [], []
+            # Zipf like popularity so that some items have many books
+            def pick(ids, skew=1.2):
+                return ids[min(len(ids) - 1, int(len(ids) * rng.random() ** (skew * 2)))]
+
+            for book_id in book_ids:
+                ts = f'20{rng.randint(0, 25):02d}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d} 12:00:00+00:00'
+                title = phrase(rng, 1, 6)
+                baus = {pick(author_ids) for i in range(1 if rng.random() < 0.85 else rng.randint(2, 4))}
+                books.append((book_id, title, ts, ts, float(rng.randint(1, 20)), f'Synthetic/{title} ({book_id})', ts))
+                alinks.extend((book_id, a) for a in baus)
+                tlinks.extend((book_id, t) for t in {pick(tag_ids) for i in range(rng.randint(0, 8))})
+                if rng.random() < 0.4:
+                    slinks.append((book_id, pick(series_ids)))
+                if rng.random() < 0.8:
+                    plinks.append((book_id, pick(publisher_ids)))
+                if rng.random() < 0.5:
+                    rlinks.append((book_id, rng.choice(rating_ids)))
+                llinks.append((book_id, pick(lang_ids, 3)))
+                idents.append((book_id, 'isbn', str(rng.randint(10**12, 10**13 - 1))))
+                if rng.random() < 0.3:
+                    comments.append((book_id, ' '.join(word(rng) for i in range(rng.randint(10, 100)))))
+            db.executemany(
+                'INSERT INTO books (id, title, timestamp, pubdate, series_index, path, last_modified) VALUES (?,?,?,?,?,?,?)', books)
+            db.executemany('INSERT INTO books_authors_link (book, author) VALUES (?,?)', alinks)
+            db.executemany('INSERT INTO books_tags_link (book, tag) VALUES (?,?)', tlinks)
+            db.executemany('INSERT INTO books_series_link (book, series) VALUES (?,?)', slinks)
+            db.executemany('INSERT INTO books_publishers_link (book, publisher) VALUES (?,?)', plinks)
+            db.executemany('INSERT INTO books_ratings_link (book, rating) VALUES (?,?)', rlinks)
+            db.executemany('INSERT INTO books_languages_link (book, lang_code) VALUES (?,?)', llinks)
+            db.executemany('INSERT INTO identifiers (book, type, val) VALUES (?,?,?)', idents)
+            db.executemany('INSERT INTO comments (book, text) VALUES (?,?)', comments)
+            db.execute("UPDATE books SET author_sort=(SELECT GROUP_CONCAT(sort, ' & ') FROM authors WHERE id IN"
+                       " (SELECT author FROM books_authors_link WHERE book=books.id)) WHERE id >= ?", (first_book,))
+    finally:
+        db.close()
+    report(f'Created synthetic library with {num_books} extra books at {library_path} in {monotonic() - st:.1f} seconds')
+    return library_path
+# }}}
+
+
+# Utilities {{{
+
+def timed(func, repeat=3):
+    ' Return the best time in seconds over repeat calls of func '
+    best = float('inf')
+    for i in range(repeat):
+        gc.collect()
+        st = monotonic()
+        func()
+        best = min(best, monotonic() - st)
+    return best
+
+
+def traced_memory(func):
+    ' Return the result of func and the memory it allocated that is still alive when it returns '
+    import tracemalloc
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        ans = func()
+        gc.collect()
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    return ans, after - before
+
+
+def open_cache(library_path, **tweak_overrides):
+    from calibre.db.backend import DB
+    from calibre.db.cache import Cache
+    from calibre.utils.config_base import tweaks
+    orig = {k: tweaks[k] for k in tweak_overrides}
+    tweaks.update(tweak_overrides)
+    try:
+        cache = Cache(DB(library_path))
+        cache.init()
+    finally:
+        tweaks.update(orig)
+    return cache
+
+
+def print_table(rows, headers):
+    widths = [max(len(str(r[i])) for r in rows + [headers]) for i in range(len(headers))]
+    fmt = '  '.join(f'{{:<{w}}}' if i == 0 else f'{{:>{w}}}' for i, w in enumerate(widths))
+    print(fmt.format(*headers))
+    for r in rows:
+        print(fmt.format(*r))
+
+
+def ms(secs):
+    return f'{secs * 1000:.1f} ms'
+
+
+def mb(num_bytes):
+    return f'{num_bytes / 1024 ** 2:.1f} MB'
+# }}}
+
+
+def benchmark_tables(library_path):  # {{{
+    ' Compare memory usage and access latency of the dict and compact array backed in-memory tables '
+    results = {}
+    for compact in (False, True):
+        cache, mem = traced_memory(lambda: open_cache(library_path, compact_in_memory_tables=compact))
+        load = timed(lambda: open_cache(library_path, compact_in_memory_tables=compact).close(), repeat=1)
+        book_ids = tuple(cache.all_book_ids())
+        tag_ids = tuple(cache.get_id_map('tags'))
+        popular_tag = cache.get_item_name('tags', max(tag_ids, key=lambda t: len(cache.books_for_field('tags', t))))
+        r = results[compact] = {
+            'memory': mb(mem), 'load': ms(load),
+        }
+        for field in ('title', 'timestamp', 'authors', 'tags', 'series'):
+            r[f'for_book({field})'] = ms(timed(lambda: cache.all_field_for(field, book_ids)))
+        r['books_for(tags)'] = ms(timed(lambda: [cache.books_for_field('tags', t) for t in tag_ids]))
+
+        def search(q):
+            cache.clear_search_caches()
+            cache.search(q)
+        r['search tags:=popular'] = ms(timed(lambda: search(f'tags:"={popular_tag}"')))
+        r['search title:~ba'] = ms(timed(lambda: search('title:~ba')))
+        r['sort(title)'] = ms(timed(lambda: cache.multisort([('title', True)])))
+        r['sort(authors, series)'] = ms(timed(lambda: cache.multisort([('authors', True), ('series', True)])))
+        r['get_categories'] = ms(timed(cache.get_categories, repeat=1))
+        cache.close()
+    print(f'\nIn-memory tables for {len(book_ids)} books\n')
+    print_table([(k, results[False][k], results[True][k]) for k in results[False]], ('', 'dict', 'compact'))
+# }}}
+
+
+def benchmark_startup(library_path):  # {{{
+    ' Compare the time taken to open the library with and without the table snapshot '
+    from calibre.db.snapshot import remove_snapshot
+    cache = open_cache(library_path)
+    num_books = len(cache.all_book_ids())
+    dbpath = cache.backend.dbpath
+    cache.close()
+    remove_snapshot(dbpath)
+    rows = [
+        ('read tables from metadata.db', ms(timed(lambda: open_cache(library_path).close()))),
+        ('read tables and save snapshot', ms(timed(lambda: (remove_snapshot(dbpath), open_cache(library_path, save_table_snapshot=True).close())))),
+        ('load tables from snapshot', ms(timed(lambda: open_cache(library_path, save_table_snapshot=True).close()))),
+    ]
+    print(f'\nOpening a library with {num_books} books\n')
+    print_table(rows, ('', 'time'))
+    remove_snapshot(dbpath)
+# }}}
+
+
+def benchmark_sort(library_path):  # {{{
+    ' Time sorting on one and more fields, the first sort after opening the library and repeated sorts '
+    cache = open_cache(library_path)
+    num_books = len(cache.all_book_ids())
+    rows = []
+    for fields in (
+        [('title', True)], [('authors', True)], [('series', True)], [('tags', False)],
+        [('authors', True), ('series', True)], [('authors', True), ('title', True)],
+        [('series', True), ('timestamp', False), ('title', True)], [('tags', True), ('rating', False), ('authors', True)],
+    ):
+        for field, order in fields:
+            f = cache.fields.get({'title': 'sort', 'authors': 'author_sort'}.get(field, field))
+            if f is not None:
+                f.sort_key_cache.clear()
+        first = timed(lambda: cache.multisort(fields), repeat=1)
+        rows.append((', '.join(f'{f} {"asc" if o else "desc"}' for f, o in fields), ms(first), ms(timed(lambda: cache.multisort(fields)))))
+    cache.close()
+    print(f'\nSorting {num_books} books\n')
+    print_table(rows, ('', 'first', 'repeat'))
+# }}}
+
+
+def benchmark_search(library_path):  # {{{
+    ''' Compare the latency of text searches with and without the search index,
+    with the search cache cleared before every search. Run with --books 500000
+    for a large library. '''
+    plain = open_cache(library_path)
+    indexed = open_cache(library_path, index_text_fields_for_search=True)
+    num_books = len(plain.all_book_ids())
+    tags = plain.get_id_map('tags')
+    popular_tag = plain.get_item_name('tags', max(tags, key=lambda t: len(plain.books_for_field('tags', t))))
+    rare_author = plain.get_item_name('authors', max(plain.get_id_map('authors')))
+    build = timed(lambda: [f.search_index.ensure_built() for f in indexed.fields.values() if getattr(f, 'search_index', None)], repeat=1)
+    rows = [('build index', '', ms(build))]
+    for q in (
+        f'tags:"={popular_tag}"', f'tags:"{popular_tag[:5]}"', f'authors:"={rare_author}"', f'authors:"{rare_author[-6:]}"',
+        'series:"=.bala"', 'tags:leyo and authors:mabe', 'publisher:sara', f'"{rare_author}"', 'tags:a',
+    ):
+        def search(cache):
+            cache.clear_search_caches()
+            cache.search(q)
+        rows.append((q, ms(timed(lambda: search(plain))), ms(timed(lambda: search(indexed)))))
+    plain.close(), indexed.close()
+    print(f'\nSearching {num_books} books\n')
+    print_table(rows, ('', 'scan', 'indexed'))
+# }}}
+
+
+def benchmark_fts(library_path, num_books=200):  # {{{
+    ''' Measure the throughput of full text indexing, in books per minute, with
+    one worker process and with one worker process per CPU core. The first
+    num_books books in the library are given a copy of the quick start guide as
+    an EPUB. '''
+    from io import BytesIO
+    from time import sleep
+
+    from calibre import detect_ncpus
+    from calibre.db.cache import Cache
+    from calibre.utils.resources import get_path as P
+    cache = open_cache(library_path)
+    book_ids = sorted(cache.all_book_ids())[:num_books]
+    data = P('quick_start/eng.epub', data=True)
+    for book_id in book_ids:
+        cache.add_format(book_id, 'EPUB', BytesIO(data), run_hooks=False)
+    cache.enable_fts(start_pool=False)
+    cache.close()
+    orig_sleep_time, Cache.fts_indexing_sleep_time = Cache.fts_indexing_sleep_time, 0
+    rows = []
+    try:
+        for num_workers in sorted({1, detect_ncpus()}):
+            cache = open_cache(library_path)
+            st = monotonic()
+            cache.reindex_fts(bulk=True)
+            cache.set_fts_num_of_workers(num_workers)
+            while cache.fts_indexing_progress()[0]:
+                sleep(0.1)
+            rows.append((f'{num_workers} worker processes', f'{len(book_ids) * 60 / (monotonic() - st):.0f}'))
+            cache.close()
+    finally:
+        Cache.fts_indexing_sleep_time = orig_sleep_time
+    print(f'\nFull text indexing of {len(book_ids)} books\n')
+    print_table(rows, ('', 'books per minute'))
+# }}}
+
+
+def benchmark_set_metadata(library_path, num_books=10000):  # {{{
+    ''' Compare setting the tags and series of num_books books by calling
+    set_metadata() for every book and by calling set_metadata_for_books() once '''
+    from calibre.ebooks.metadata.book.base import Metadata
+    cache = open_cache(library_path)
+    book_ids = sorted(cache.all_book_ids())[:num_books]
+    tags = cache.all_field_for('tags', book_ids)
+
+    def metadata(suffix):
+        ans = {}
+        for i, book_id in enumerate(book_ids):
+            mi = ans[book_id] = Metadata(None)
+            mi.tags = list(tags[book_id]) + [f'Bulk edit {suffix}']
+            mi.series, mi.series_index = f'Bulk series {suffix} {i % 100}', float(i % 10 + 1)
+        return ans
+
+    def one_at_a_time():
+        for book_id, mi in metadata('one').items():
+            cache.set_metadata(book_id, mi, set_title=False, set_authors=False)
+
+    rows = [
+        ('set_metadata() per book', ms(timed(one_at_a_time, repeat=1))),
+        ('set_metadata_for_books()', ms(timed(lambda: cache.set_metadata_for_books(
+            metadata('bulk'), set_title=False, set_authors=False), repeat=1))),
+    ]
+    cache.close()
+    print(f'\nSetting tags and series for {len(book_ids)} books\n')
+    print_table(rows, ('', 'time'))
+# }}}
+
+
+def benchmark_vl_search(library_path):  # {{{
+    ''' Time a search inside a large Virtual library followed by sorting the
+    results, as done for every book list request by the server, and compare
+    the cost of intersecting and storing sets of book ids as python sets and
+    as bitmaps '''
+    from calibre.db.bitmap import BookIdSet
+    cache = open_cache(library_path)
+    num_books = len(cache.all_book_ids())
+    cache.set_pref('virtual_libraries', {'big': 'languages:eng or languages:deu or languages:fra'})
+    vl_books = cache.books_in_virtual_library('big')
+    query = 'rating:>2 or tags:a'
+    matches = cache.search(query)
+
+    def search_in_vl():
+        # As done by the server, results are not cached as they are restricted
+        return cache.search(query, book_ids=cache.books_in_virtual_library('big'))
+
+    def uncached_search_in_vl():
+        cache.clear_search_caches()
+        return search_in_vl()
+
+    vl_set, matches_set = set(vl_books), set(matches)
+    vl_bitmap, matches_bitmap = BookIdSet(vl_books), BookIdSet(matches)
+    rows = [
+        ('VL + search, nothing cached', ms(timed(uncached_search_in_vl))),
+        ('VL + search, VL cached', ms(timed(search_in_vl))),
+        ('VL + search + sort by title', ms(timed(lambda: cache.multisort([('title', True)], ids_to_sort=search_in_vl())))),
+        ('intersect VL with results, sets', ms(timed(lambda: vl_set & matches_set))),
+        ('intersect VL with results, bitmaps', ms(timed(lambda: vl_bitmap & matches_bitmap))),
+        ('memory for VL, set', mb(traced_memory(lambda: set(vl_books))[1])),
+        ('memory for VL, bitmap', mb(traced_memory(lambda: BookIdSet(vl_books))[1])),
+    ]
+    cache.close()
+    print(f'\nSearching a Virtual library of {len(vl_books)} books, in {num_books} books, for {len(matches)} books\n')
+    print_table(rows, ('', 'time'))
+# }}}
+
+
+def benchmark_templates(library_path, num_books=20000):  # {{{
+    ''' Compare evaluating templates for num_books books with the interpreter
+    and compiled, as done for composite columns, and time the rendering of
+    composite columns as in db/tests/profiling.py '''
+    import string
+
+    from calibre.ebooks.metadata.book.formatter import SafeFormat
+    from calibre.utils.formatter import CompiledProgram
+    cache = open_cache(library_path)
+    book_ids = sorted(cache.all_book_ids())[:num_books]
+    books = [cache.get_proxy_metadata(book_id) for book_id in book_ids]
+    formatter = SafeFormat()
+    funcs = cache.backend.get_template_functions()
+    rows = []
+    for name, template in (
+        ('field lookups', 'program: strcat($title, " - ", $authors)'),
+        ('conditions', 'program: if $series == "" && $rating ># 2 then "good" elif $tags then "tagged" else "" fi'),
+        ('functions', 'program: first_non_empty(select($identifiers, "isbn"), uppercase(sublist($tags, 0, 2, ",")))'),
+        ('arithmetic', 'program: x = 2 * 3 + 1; y = $$rating; if y then y * x / 2 else x fi'),
+    ):
+        tree = formatter.gpm_parser.program(formatter, funcs, formatter.lex_scanner.scan(template[len('program:'):]))
+
+        def render(tree):
+            # A template cache with a parsed tree, as created by the formatter, is interpreted
+            template_cache = {'bench': tree}
+            for mi in books:
+                formatter.safe_format(template, mi, 'ERROR', mi, column_name='bench', template_cache=template_cache, template_functions=funcs)
+        interpreted, compiled = timed(lambda: render(tree)), timed(lambda: render(CompiledProgram(tree)))
+        rows.append((name, ms(interpreted), ms(compiled), f'{interpreted / compiled:.1f}x'))
+
+    sfm = '{identifiers:select(isbn)} {formats}'
+    formatter.book = formatter.kwargs = books[0]
+
+    def sfm_render(vformat):
+        for mi in books:
+            formatter.book = mi
+            vformat(sfm, [], mi)
+    interpreted, compiled = timed(lambda: sfm_render(partial(string.Formatter.vformat, formatter))), timed(lambda: sfm_render(formatter.vformat))
+    rows.append(('single function mode', ms(interpreted), ms(compiled), f'{interpreted / compiled:.1f}x'))
+
+    cache.create_custom_column('bench_isbn', 'ISBN', 'composite', False, display={'composite_template': '{identifiers:select(isbn)}'})
+    cache.create_custom_column('bench_gpm', 'GPM', 'composite', False, display={
+        'composite_template': 'program: if $#bench_isbn then strcat("ISBN: ", $#bench_isbn) else $title fi'})
+    cache.close()
+    cache = open_cache(library_path)
+
+    def composites():
+        cache.clear_composite_caches()
+        for book_id in book_ids:
+            cache.composite_for('#bench_isbn', book_id)
+            cache.composite_for('#bench_gpm', book_id)
+    rows.append(('composite columns', '', ms(timed(composites)), ''))
+    for label in ('bench_isbn', 'bench_gpm'):
+        cache.delete_custom_column(label)
+    cache.close()
+    print(f'\nEvaluating templates for {len(books)} books\n')
+    print_table(rows, ('', 'interpreted', 'compiled', 'speedup'))
+# }}}
+
+
+def benchmark_composites(library_path):  # {{{
+    ''' Time the first sort and search on a composite column, rendering the
+    column one book at a time and for all books at once, and after opening
+    the library with the saved values of the column '''
+    cache = open_cache(library_path)
+    cache.create_custom_column('bench_comp', 'Composite', 'composite', False, display={
+        'composite_template': '{series:|| - }{title}', 'composite_sort': 'text'})
+    cache.close()
+    cache = open_cache(library_path, save_composite_column_values=True)
+    f = cache.fields['#bench_comp']
+    book_ids = cache.all_book_ids()
+
+    def one_at_a_time():
+        f.clear_caches()
+        for book_id in book_ids:
+            cache.composite_for('#bench_comp', book_id)
+
+    def all_at_once():
+        f.clear_caches()
+        f.render_books(book_ids)
+
+    def first_sort():
+        cache.clear_composite_caches()
+        cache.multisort([('#bench_comp', True)])
+
+    def first_search():
+        cache.clear_composite_caches()
+        cache.clear_search_caches()
+        cache.search('#bench_comp:"=leyo"')
+
+    rows = [
+        ('render one book at a time', ms(timed(one_at_a_time))),
+        ('render all books at once', ms(timed(all_at_once))),
+        ('first sort', ms(timed(first_sort))),
+        ('first search', ms(timed(first_search))),
+    ]
+    cache.close()
+    st = monotonic()
+    cache = open_cache(library_path, save_composite_column_values=True)
+    rows.append(('open library, restoring saved values', ms(monotonic() - st)))
+    rows.append(('first sort with saved values', ms(timed(lambda: cache.multisort([('#bench_comp', True)]), repeat=1))))
+    cache.delete_custom_column('bench_comp')
+    cache.close()
+    print(f'\nComposite column for {len(book_ids)} books\n')
+    print_table(rows, ('', 'time'))
+# }}}
+
+
+BENCHMARKS = {
+    'tables': benchmark_tables,
+    'startup': benchmark_startup,
+    'sort': benchmark_sort,
+    'search': benchmark_search,
+    'fts': benchmark_fts,
+    'set_metadata': benchmark_set_metadata,
+    'vl_search': benchmark_vl_search,
+    'templates': benchmark_templates,
+    'composites': benchmark_composites,
+}
+
+
+def main(args=sys.argv):
+    from calibre.utils.config import OptionParser
+    parser = OptionParser(usage='%prog [options] [{}]\n\nRun benchmarks on a synthetic library'.format('|'.join(BENCHMARKS)))
+    parser.add_option('--books', type=int, default=100000, help='Number of synthetic books to create')
+    parser.add_option('--library', default=None, help='Use the library at the specified path instead of creating a new one')
+    parser.add_option('--seed', type=int, default=1234, help='Seed for the random number generator used to create the library')
+    opts, args = parser.parse_args(args)
+    names = args[1:] or list(BENCHMARKS)
+    tdir = None
+    library_path = opts.library
+    if library_path is None:
+        tdir = library_path = tempfile.mkdtemp(prefix='db_benchmark_')
+        create_synthetic_library(library_path, opts.books, opts.seed)
+    try:
+        for name in names:
+            BENCHMARKS[name](library_path)
+    finally:
+        if tdir is not None:
+            shutil.rmtree(tdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
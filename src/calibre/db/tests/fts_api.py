@@ -103,6 +103,20 @@ def check(**kw):
         cache.add_format(1, 'TXT', BytesIO(b'a test text2'))
         self.wait_for_fts_to_finish(fts)
         check(id=2, book=1, format='TXT', searchable_text='a test text2')
+        # check worker processes are re-used
+        pids = {w.process.pid for w in fts.pool.workers if w.process is not None}
+        self.assertTrue(pids)
+        cache.add_format(1, 'TXT', BytesIO(b'a test text3'))
+        self.wait_for_fts_to_finish(fts)
+        check(id=3, book=1, format='TXT', searchable_text='a test text3')
+        self.ae(pids, {w.process.pid for w in fts.pool.workers if w.process is not None})
+        # check worker processes are restarted after max_jobs_per_process jobs
+        for w in fts.pool.workers:
+            w.max_jobs_per_process = 1
+        cache.add_format(1, 'TXT', BytesIO(b'a test text4'))
+        self.wait_for_fts_to_finish(fts)
+        check(id=4, book=1, format='TXT', searchable_text='a test text4')
+        self.ae({w.process for w in fts.pool.workers}, {None})
         # check closing shuts down all workers
         cache.close()
         self.assertFalse(fts.pool.initialized.is_set())
@@ -161,9 +175,39 @@ def test_fts_search(self):
         self.wait_for_fts_to_finish(fts)
         self.assertFalse(fts.all_currently_dirty())
         self.ae({x['id'] for x in cache.fts_search('help')}, {1, 2})
+        # bulk reindexing defers building the index until all formats are indexed
+        fts = cache.reindex_fts(bulk=True)
+        self.assertTrue(fts.pool.bulk_indexing)
+        self.wait_for_fts_to_finish(fts)
+        self.assertFalse(fts.all_currently_dirty())
+        # searching waits for the index to be built as that holds the write lock
+        self.ae({x['id'] for x in cache.fts_search('help')}, {1, 2})
+        self.assertFalse(fts.pool.bulk_indexing)
+        triggers = {r[0] for r in cache.backend.execute("SELECT name FROM fts_db.sqlite_master WHERE type='trigger'")}
+        self.assertIn('books_fts_insert_trg', triggers)
+        self.assertNotIn('books_fts_bulk_insert_trg', triggers)
+        counters = cache.fts_indexing_progress(with_counters=True)[-1]
+        self.ae(counters['indexed'], 2)
+        self.assertGreater(counters['text_length'], 0)
         cache.remove_books((1,))
         self.ae({x['id'] for x in cache.fts_search('help')}, {2})
         cache.close()
+        # bulk indexing ends even when the last dirtied format cannot be indexed
+        cache = self.new_library()
+        fts = cache.enable_fts()
+        cache.add_format(1, 'XYZ', BytesIO(b'not a format that can be indexed'))
+        self.wait_for_fts_to_finish(fts)
+        fts = cache.reindex_fts(bulk=True)
+        self.assertTrue(fts.pool.bulk_indexing)
+        self.wait_for_fts_to_finish(fts)
+        st = time.monotonic()
+        while fts.pool.bulk_indexing and time.monotonic() - st < 30:
+            time.sleep(0.01)
+        self.assertFalse(fts.pool.bulk_indexing)
+        triggers = {r[0] for r in cache.backend.execute("SELECT name FROM fts_db.sqlite_master WHERE type='trigger'")}
+        self.assertIn('books_fts_insert_trg', triggers)
+        self.assertNotIn('books_fts_bulk_insert_trg', triggers)
+        cache.close()
 
     def test_fts_triggers(self):
         cache = self.init_cache()
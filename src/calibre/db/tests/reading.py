@@ -218,6 +218,33 @@ def test_sorting(self):  # {{{
         ae(list(range(1, 11)), cache.multisort([('#one', True), ('#two', True)], ids_to_sort=sorted(cache.all_book_ids())))
         ae([4, 5, 1, 2, 3, 7, 8, 9, 10, 6], cache.multisort([('#one', True), ('#two', False)], ids_to_sort=sorted(cache.all_book_ids())))
         ae([5, 4, 3, 2, 1, 10, 9, 8, 7, 6], cache.multisort([('#one', True), ('#two', False), ('#three', False)], ids_to_sort=sorted(cache.all_book_ids())))
+        ae([6, 7, 8, 9, 10, 1, 2, 3, 4, 5], cache.multisort([('#one', False), ('#two', True), ('#three', True)], ids_to_sort=sorted(cache.all_book_ids())))
+    # }}}
+
+    def test_sort_key_cache(self):  # {{{
+        'Test that cached sort keys are updated when values change'
+        cache = self.init_cache(self.cloned_library)
+        ae = self.assertEqual
+
+        def check(*fields):
+            fresh = self.init_cache(cache.backend.library_path)
+            for field in fields:
+                for order in (True, False):
+                    ae(fresh.multisort([(field, order), ('id', True)]), cache.multisort([(field, order), ('id', True)]), field)
+            fresh.close()
+
+        fields = ('title', 'authors', 'series', 'tags', 'publisher', 'languages', '#tags', '#series', '#enum')
+        check(*fields)
+        cache.set_field('title', {1: 'aaa', 2: 'zzz'})
+        cache.set_field('series', {1: 'The Zebra', 2: 'An Ant', 3: 'Middle'})
+        cache.set_field('#tags', {3: ('aaa',)})
+        cache.set_field('languages', {1: ('fra',), 3: ('eng', 'deu')})
+        cache.rename_items('tags', {cache.get_item_id('tags', 'Tag One'): 'zzz'})
+        cache.rename_items('publisher', {cache.get_item_id('publisher', 'Publisher One'): 'Publisher Two'})
+        cache.set_field('#enum', {1: 'One'})
+        check(*fields)
+        cache.rename_items('authors', {cache.get_item_id('authors', 'Author One'): 'Zed Author'})
+        check(*fields)
     # }}}
 
     def test_get_metadata(self):  # {{{
@@ -385,6 +412,110 @@ def test_searching(self):  # {{{
 
     # }}}
 
+    def test_search_index(self):  # {{{
+        'Test that searching with the text field index gives the same results as without it'
+        from calibre.utils.config_base import Tweak
+        normal = self.init_cache(self.cloned_library)
+        with Tweak('index_text_fields_for_search', True):
+            indexed = self.init_cache(self.cloned_library)
+        self.assertIsNotNone(indexed.fields['tags'].search_index)
+        self.assertIsNone(indexed.fields['title'].search_index)
+        queries = (
+            'tags:one', 'tags:"tag one"', 'tags:=News', 'tags:="tag one"', 'tags:=tag', 'tags:"=.tag"', 'tags:^tag',
+            'tags:"tag-one"', 'tags:ws', 'authors:"author one"', 'authors:"=author one"', 'authors:uthor', 'authors:^rsm',
+            'series:"series one"', 'series:=series', '#tags:"my tag"', '#enum:one', '#enum:=one', 'publisher:lisher',
+            'one', 'series', '"tag two"', '"=tag two"', 'tags:parent', 'tags:"=.parent"', 'tags:"=.parent.child"',
+            'tags:"=parent.child"', 'tags:"..child"', 'tags:ckü', 'tags:"Crème brûlée"', 'tags:"creme brulee"', 'tags:cre',
+            'tags:~^tag', 'tags:false', 'tags:true', 'tags:ags', 'authors:"and"',
+        )
+
+        def compare():
+            for c in (normal, indexed):
+                c.clear_search_caches()
+            for q in queries:
+                self.assertEqual(normal.search(q), indexed.search(q), q)
+
+        for c in (normal, indexed):
+            c.set_field('tags', {1: ('Parent.Child', 'Crème Brûlée', 'tag-one'), 3: ('parent', 'Tschüß', 'Tagging')})
+        compare()
+        for c in (normal, indexed):
+            c.set_field('tags', {2: ('ws', 'Creme', 'NEWS')})
+            c.set_field('authors', {3: ('Rasmus Andersson', 'Bob')})
+            c.rename_items('tags', {c.get_item_id('tags', 'Tag One'): 'Renamed Tag', c.get_item_id('tags', 'parent'): 'Parent.Child'})
+            c.rename_items('#tags', {c.get_item_id('#tags', 'My Tag One'): 'Other'})
+            c.remove_items('series', (c.get_item_id('series', 'A Series One'),))
+            c.set_field('series', {2: 'New series'})
+        compare()
+        for c in (normal, indexed):
+            c.remove_books((1,))
+        compare()
+
+        # The index is rebuilt when the tables are re-read from the database
+        tag_id = indexed.get_item_id('tags', 'News')
+        expected = indexed.search('tags:=News')
+        self.assertTrue(expected)
+        self.assertFalse(indexed.search('tags:zebra'))
+        indexed.backend.conn.execute('UPDATE tags SET name="Zebra Stripes" WHERE id=?', (tag_id,))
+        indexed.reload_from_db(clear_caches=False)
+        self.assertEqual(indexed.search('tags:zebra'), expected)
+        self.assertEqual(indexed.search('tags:"=Zebra Stripes"'), expected)
+        self.assertFalse(indexed.search('tags:=News'))
+    # }}}
+
+    def test_search_plans(self):  # {{{
+        'Test compiled query plans and searching from multiple threads'
+        from threading import Thread
+
+        from calibre.utils.search_query_parser import ParseException
+        cache = self.init_cache()
+        api, ae = cache._search_api, self.assertEqual
+        q = 'title:title tags:one and #yesno:true id:>1'
+        plan = api.plan_for(cache, q)
+        self.assertIs(plan, api.plan_for(cache, q))
+        # Cheap terms are evaluated first, then terms on many-one fields and then one-one fields
+        ae([n[1] for n in plan.root[1]], ['id', '#yesno', 'tags', 'title'])
+        ae(plan.queried_fields, (('title', 'title'), ('tags', 'one'), ('#yesno', 'true'), ('id', '>1')))
+        # Template searches are never moved relative to other terms
+        plan = api.plan_for(cache, 'title:title template:"{series}#@#:b:true" id:>1 tags:one')
+        ae([n[1] for n in plan.root[1]], ['title', 'template', 'id', 'tags'])
+        for terms in (
+            ('title:title', 'tags:one', '#yesno:true', 'id:>1'), ('title:title', 'template:"{series}#@#:b:true"', 'id:>1', 'tags:one'),
+            ('not tags:one', '(series:one or id:1)', 'rating:>2'), ('#float:>11', 'authors:one', 'not formats:fmt2'),
+        ):
+            # Reordering terms does not change the result
+            ae(cache.search(' and '.join(terms)), set.intersection(*(cache.search(t) for t in terms)), terms)
+        # Saved searches are expanded into the plan
+        cache.saved_search_set_all({'s1': 'id:1 or id:2', 's2': 'search:s1 not id:1', 'r': 'search:r'})
+        ae(api.plan_for(cache, 'search:s2').queried_fields, (('id', '1'), ('id', '2'), ('id', '1')))
+        ae(cache.search('search:s2'), {2})
+        self.assertRaises(ParseException, cache.search, 'search:r')
+        # Invalid terms raise even when earlier terms match nothing
+        for q in ('id:0 and #float:>abc', 'id:0 and (tags:one or pubdate:>nodate)', 'id:0 and not vl:nosuchvl'):
+            self.assertRaises(ParseException, cache.search, q)
+        cache.saved_search_add('s1', 'id:3')
+        cache.clear_search_caches()
+        ae(cache.search('search:s2'), {3})
+
+        queries = ('tags:one', 'not tags:one', 'authors:one or series:one', 'id:<3 and title:title', 'search:s2', 'formats:fmt1')
+        expected = {q: cache.search(q) for q in queries}
+        errors = []
+
+        def run():
+            try:
+                for i in range(50):
+                    for q in queries:
+                        cache.clear_search_caches()
+                        ae(cache.search(q), expected[q])
+            except Exception as e:
+                errors.append(e)
+
+        threads = [Thread(target=run) for i in range(4)]
+        api.plan_cache.clear()
+        [t.start() for t in threads]
+        [t.join() for t in threads]
+        ae(errors, [])
+    # }}}
+
     def test_get_categories(self):  # {{{
         'Check that get_categories() returns the same data for both backends'
         from calibre.library.database2 import LibraryDatabase2
@@ -423,6 +554,50 @@ def compare_category(category, old, new):
 
     # }}}
 
+    def test_category_caching(self):  # {{{
+        'Test that cached categories are updated when fields change'
+        cache = self.init_cache()
+        ae = self.assertEqual
+
+        def counts(category, book_ids=None):
+            return {t.name:t.count for t in cache.get_categories(book_ids=book_ids)[category]}
+
+        ae(counts('tags'), {'Tag One':2, 'Tag Two':1, 'News':1})
+        ae(counts('tags', {1}), {'Tag One':1, 'News':1})
+        cached_publishers = cache.category_cache.item_map['publisher']
+        cache.get_categories()['tags'][0].count = 100  # returned items must be copies
+        ae(counts('tags'), {'Tag One':2, 'Tag Two':1, 'News':1})
+        cache.set_field('tags', {3:('Tag Two', 'New')})
+        ae(counts('tags'), {'Tag One':2, 'Tag Two':2, 'News':1, 'New':1})
+        ae(counts('tags', {1, 3}), {'Tag One':1, 'Tag Two':1, 'News':1, 'New':1})
+        self.assertIs(cache.category_cache.item_map['publisher'], cached_publishers)
+        cache.set_field('rating', {3:4})
+        self.assertNotIn('publisher', cache.category_cache.item_map)
+        ae({t.name:t.avg_rating for t in cache.get_categories()['tags']}['New'], 2)
+        cache.remove_books((3,))
+        ae(counts('tags'), {'Tag One':2, 'Tag Two':1, 'News':1})
+
+        # Items are cached by many reading threads at once
+        from threading import Thread
+
+        from calibre.db.categories import CategoryCache
+        cc, errors = CategoryCache(), []
+
+        def run(n):
+            try:
+                for i in range(2000):
+                    cc.get('tags', {n, i % 7}, list)
+            except Exception as e:
+                errors.append(e)
+        threads = [Thread(target=run, args=(n,)) for n in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        ae(errors, [])
+        self.assertLessEqual(len(cc.item_map['tags']), cc.LIMIT)
+    # }}}
+
     def test_get_formats(self):  # {{{
         'Test reading ebook formats using the format() method'
         from calibre.db.cache import NoSuchFormat
@@ -528,6 +703,138 @@ def test_datetime(self):  # {{{
             self.assertEqual(UNDEFINED_DATE, c_parse(x))
     # }}}
 
+    def test_compact_tables(self):  # {{{
+        ' Test that the compact array backed tables behave the same as the dict based ones '
+        from calibre.db.columnar import DenseMap, SetMap, TupleMap
+        from calibre.utils.config_base import Tweak
+        normal = self.init_cache(self.cloned_library)
+        with Tweak('compact_in_memory_tables', True):
+            compact = self.init_cache(self.cloned_library)
+        t = compact.fields['tags'].table
+        self.assertIsInstance(t.book_col_map, TupleMap)
+        self.assertIsInstance(t.col_book_map, SetMap)
+        self.assertIsInstance(t.id_map, DenseMap)
+        self.assertIsInstance(compact.fields['timestamp'].table.book_col_map, DenseMap)
+        self.assertIsInstance(compact.fields['series'].table.book_col_map, DenseMap)
+        queries = ('tags:one', 'tags:=News', 'authors:"=Author One"', 'series:one', 'rating:>2',
+                   'date:>9/6/2011', '#yesno:true', '#tags:true', 'languages:eng', 'one')
+        sort_fields = ('title', 'authors', 'series', 'tags', 'rating', 'pubdate', 'languages', '#tags', '#series', '#yesno')
+
+        def compare():
+            ids = sorted(normal.all_book_ids())
+            self.assertEqual(ids, sorted(compact.all_book_ids()))
+            for book_id in ids:
+                self.compare_metadata(normal.get_metadata(book_id), compact.get_metadata(book_id))
+            for q in queries:
+                self.assertEqual(normal.search(q), compact.search(q), q)
+            for field in sort_fields:
+                self.assertEqual(normal.multisort([(field, True), ('id', True)]), compact.multisort([(field, True), ('id', True)]), field)
+            for field in ('tags', 'authors', 'series', 'publisher', '#tags'):
+                self.assertEqual(normal.get_id_map(field), compact.get_id_map(field))
+                self.assertEqual(normal.get_usage_count_by_id(field), compact.get_usage_count_by_id(field))
+                for item_id in normal.get_id_map(field):
+                    self.assertEqual(normal.books_for_field(field, item_id), compact.books_for_field(field, item_id))
+            nc, cc = normal.get_categories(), compact.get_categories()
+            self.assertEqual(set(nc), set(cc))
+            for category in nc:
+                self.assertEqual([(x.name, x.count, x.id_set) for x in nc[category]], [(x.name, x.count, x.id_set) for x in cc[category]])
+
+        compare()
+        for c in (normal, compact):
+            c.set_field('tags', {1: ('a', 'b', 'c'), 2: ('c', 'News'), 3: ()})
+            c.set_field('series', {1: 'new series', 2: None})
+            c.set_field('pubdate', {1: p('2001-02-06')})
+            c.set_field('#yesno', {1: None, 2: True})
+            c.rename_items('tags', {c.get_item_id('tags', 'a'): 'b'})
+            c.remove_items('publisher', (c.get_item_id('publisher', 'Publisher One'),))
+        compare()
+        compact.compact_tables()
+        compare()
+        for c in (normal, compact):
+            c.remove_books((1,))
+        compare()
+        with Tweak('compact_in_memory_tables', True):
+            compact.reload_from_db()
+        normal.reload_from_db()
+        self.assertIsInstance(compact.fields['tags'].table.book_col_map, TupleMap)
+        self.assertIsInstance(compact.fields['series'].table.book_col_map, DenseMap)
+        self.assertNotIsInstance(normal.fields['tags'].table.book_col_map, TupleMap)
+        compare()
+
+        # Values for keys too large for the array are kept when it is resized
+        from calibre.db.columnar import IntStore, StringStore
+        for store, val in ((IntStore, int), (StringStore, str)):
+            m = DenseMap(store(), {i: val(i) for i in range(1600)})
+            m[20000] = val(20000)
+            for i in range(1600, 4000):
+                m[i] = val(i)
+            m[20001] = val(20001)
+            self.assertGreater(len(m.state), 20001)
+            self.assertEqual(m.get(20000), val(20000))
+            self.assertEqual(len(m), 4002)
+            self.assertEqual(len(m), len(list(m)))
+            self.assertEqual(dict(m.items()), {i: val(i) for i in [*range(4000), 20000, 20001]})
+    # }}}
+
+    def test_table_snapshot(self):  # {{{
+        ' Test loading the in-memory tables from the startup snapshot '
+        from calibre.db.snapshot import snapshot_path
+        from calibre.utils.config_base import Tweak
+        library_path = self.cloned_library
+
+        def check(cache, from_snapshot):
+            self.assertEqual(cache.backend.tables_loaded_from_snapshot, from_snapshot)
+            with Tweak('save_table_snapshot', False):
+                normal = self.init_cache(library_path)
+            ids = sorted(normal.all_book_ids())
+            self.assertEqual(ids, sorted(cache.all_book_ids()))
+            for book_id in ids:
+                self.compare_metadata(normal.get_metadata(book_id), cache.get_metadata(book_id))
+            for field in ('tags', 'authors', 'series', 'formats', 'identifiers', '#tags'):
+                self.assertEqual(normal.get_usage_count_by_id(field), cache.get_usage_count_by_id(field))
+            self.assertEqual(normal.multisort([('timestamp', True)]), cache.multisort([('timestamp', True)]))
+            self.assertEqual(normal.search('tags:=News'), cache.search('tags:=News'))
+            normal.close()
+
+        with Tweak('save_table_snapshot', True):
+            cache = self.init_cache(library_path)
+            self.assertFalse(cache.backend.tables_loaded_from_snapshot)
+            self.assertTrue(os.path.exists(snapshot_path(cache.backend.dbpath)))
+            cache.close()
+            cache = self.init_cache(library_path)
+            check(cache, True)
+            # Changes made by this process are saved in the snapshot on close
+            cache.set_field('tags', {1: ('a', 'b'), 2: ()})
+            cache.set_field('pubdate', {1: p('2001-02-06')})
+            cache.set_field('#yesno', {2: True})
+            cache.remove_books((3,))
+            cache.close()
+            cache = self.init_cache(library_path)
+            check(cache, True)
+            cache.close()
+        # Changes made without the snapshot enabled invalidate it
+        cache = self.init_cache(library_path)
+        cache.set_field('title', {1: 'changed'})
+        cache.close()
+        with Tweak('save_table_snapshot', True):
+            cache = self.init_cache(library_path)
+            check(cache, False)
+            self.assertEqual(cache.field_for('title', 1), 'changed')
+            cache.close()
+            cache = self.init_cache(library_path)
+            check(cache, True)
+            # Changes made by another connection are not saved on close
+            with Tweak('save_table_snapshot', False):
+                other = self.init_cache(library_path)
+            other.set_field('title', {1: 'changed again'})
+            other.close()
+            cache.close()
+            cache = self.init_cache(library_path)
+            check(cache, False)
+            self.assertEqual(cache.field_for('title', 1), 'changed again')
+            cache.close()
+    # }}}
+
     def test_restrictions(self):  # {{{
         ' Test searching with and without restrictions '
         cache = self.init_cache()
@@ -602,6 +909,25 @@ def test(hit, result, *args, **kw):
         cache.set_field('publisher', {3:'ppppp', 2:'other'})
         # Test cache update worked
         test(True, {2, 3}, 'title:=xxx or title:"=Title One"')
+
+        # Changing a field only affects searches that depend on it
+        cache._search_api.MAX_CACHE_UPDATE = 0
+        test(False, {3}, 'publisher:=ppppp')
+        cache.set_field('tags', {3:'one', 2:'two'})
+        test(True, {3}, 'publisher:=ppppp')
+        test(True, {2, 3}, 'title:=xxx or title:"=Title One"')
+        cache.set_field('publisher', {2:'ppppp'})
+        test(False, {2, 3}, 'publisher:=ppppp')
+        test(True, {2, 3}, 'title:=xxx or title:"=Title One"')
+
+        # Searches on dates are cached until midnight
+        sapi = cache._search_api
+        test(False, {1, 2, 3}, 'date:>1900')
+        test(True, {1, 2, 3}, 'date:>1900')
+        self.assertIn('date:>1900', sapi.cache_expiry)
+        sapi.cache_expiry['date:>1900'] = 0
+        test(False, {1, 2, 3}, 'date:>1900')
+        self.assertGreater(sapi.cache_expiry['date:>1900'], 0)
     # }}}
 
     def test_proxy_metadata(self):  # {{{
@@ -770,6 +1096,40 @@ def test_composites(self):  # {{{
         self.assertEqual('FMT2', cache.field_for('#ccf', 1))
     # }}}
 
+    def test_saved_composite_values(self):  # {{{
+        ' Test rendering composites for many books at once and saving the rendered values '
+        from calibre.db.composite_values import values_path
+        from calibre.utils.config_base import Tweak
+        library_path = self.cloned_library
+        cache = self.init_cache(library_path)
+        cache.create_custom_column('cct', 'CCT', 'composite', False, display={'composite_template': '{title}:{tags}'})
+        cache.close()
+        with Tweak('save_composite_column_values', True):
+            cache = self.init_cache(library_path)
+            book_ids = cache.all_book_ids()
+            expected = {book_id: cache.composite_for('#cct', book_id) for book_id in book_ids}
+            f = cache.fields['#cct']
+            f.clear_caches()
+            f.render_books(book_ids)
+            self.assertEqual(f.rendered_values(), expected)
+            cache.close()
+            self.assertTrue(os.path.exists(values_path(cache.backend.dbpath)))
+            cache = self.init_cache(library_path)
+            self.assertEqual(cache.fields['#cct'].rendered_values(), expected)
+            cache.close()
+        # Values of books changed while the values are not saved are not restored
+        cache = self.init_cache(library_path)
+        cache.set_field('title', {1: 'changed'})
+        cache.close()
+        with Tweak('save_composite_column_values', True):
+            cache = self.init_cache(library_path)
+            values = cache.fields['#cct'].rendered_values()
+            self.assertNotIn(1, values)
+            self.assertEqual(values[2], expected[2])
+            self.assertTrue(cache.composite_for('#cct', 1).startswith('changed:'))
+            cache.close()
+    # }}}
+
     def test_find_identical_books(self):  # {{{
         ' Test find_identical_books '
         from calibre.db.utils import find_identical_books
@@ -955,3 +1315,43 @@ def evaluate(book, ctx):
         unload_user_template_functions('aaaaa')
         self.assertEqual(set(v.split(',')), {'Tag One', 'News', 'Tag Two', 'one argument'})
     # }}}
+
+    def test_compiled_templates(self):  # {{{
+        from calibre.ebooks.metadata.book.formatter import SafeFormat
+        from calibre.utils.formatter import CompiledProgram
+        formatter = SafeFormat()
+        db = self.init_legacy(self.library_path)
+        mi = db.get_metadata(1)
+        templates = (
+            'program: field("title")', 'program: uppercase($authors)', 'program: $$tags',
+            'program: x = 3; y = x + 4 * 2; y', 'program: 1 / 0', 'program: "a" + 1', 'program: "x" ==# 4',
+            'program: if $title == "title one" then "yes" elif $tags then "t" else "no" fi',
+            'program: test($#yesno, "a", "b")', 'program: first_non_empty($series, $title)',
+            'program: switch($title, "^one", "A", "one", "B", "C")', 'program: switch($title, "[", "A", "C")',
+            'program: switch_if($series, "a", $tags, "b", "c")', 'program: contains($tags, "One", "yes", "no")',
+            'program: strcat($title, " - ", $authors)', 'program: "one" in $title', 'program: "One" inlist $tags',
+            'program: "One" inlist_field "tags"', 'program: $rating <# 4 && $title || ""', 'program: !$series',
+            'program: unknown_var', 'program: field("nonexistent")', 'program: if 1 then return "r" fi; "no"',
+            'program: for t in $tags: if t == "News" then break fi; t rof', 'program: break',
+            'program: def f(a): a + 1 fed; f(3)', 'program: -5 + 2.5 * 3', 'program: "a" & "b"',
+        )
+        for template in templates:
+            # A template cache and a column name cause the template to be compiled
+            template_cache = {}
+            expected = formatter.safe_format(template, {}, 'TEMPLATE ERROR', mi)
+            for i in range(2):
+                self.assertEqual(expected, formatter.safe_format(
+                    template, {}, 'TEMPLATE ERROR', mi, column_name='test', template_cache=template_cache), template)
+            self.assertIsInstance(template_cache['test'], CompiledProgram)
+        # The interpreter is used when there is a break reporter
+        reported = []
+        template_cache = {}
+        formatter.safe_format('program: x = 1; x + 1', {}, 'TEMPLATE ERROR', mi, column_name='test',
+                              template_cache=template_cache, break_reporter=lambda *a: reported.append(a[0]))
+        self.assertIn('assign to x', reported)
+        # Single function mode templates are parsed once
+        import string
+        formatter.book = formatter.kwargs = mi
+        for template in ('{title}', '{title:uppercase()}', '{series:|[|]}', '{{literal}} {tags}', '{title!r}', '{title[0]}', '{title:{tags}}'):
+            self.assertEqual(formatter.vformat(template, [], mi), string.Formatter.vformat(formatter, template, [], mi), template)
+    # }}}
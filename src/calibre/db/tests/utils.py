@@ -81,3 +81,49 @@ def test_thumbnail_cache(self):  # {{{
         self.assertEqual(len(c), 0)
         self.assertEqual(tuple(walk(c.location)), (os.path.join(c.location, 'version'),))
     # }}}
+
+    def test_book_id_bitmaps(self):  # {{{
+        import pickle
+
+        from calibre.db.bitmap import BookIdSet, FrozenBookIdSet, as_frozenset
+        ae = self.assertEqual
+        a, b = BookIdSet({1, 5, 9, 200, 3000}), FrozenBookIdSet(range(3, 10))
+        ae(a, {1, 5, 9, 200, 3000})
+        ae(list(a), [1, 5, 9, 200, 3000])
+        ae(len(a), 5)
+        ae(a & b, {5, 9}), ae(a | b, {1, 3, 4, 5, 6, 7, 8, 9, 200, 3000})
+        ae(a - b, {1, 200, 3000}), ae(b - a, {3, 4, 6, 7, 8}), ae(a ^ {1, 2}, {2, 5, 9, 200, 3000})
+        ae({1, 2, 3} & a, {1}), ae({1, 2} - a, {2})
+        self.assertIsInstance({1, 2} & a, BookIdSet)
+        self.assertIsInstance(b.union({1}), FrozenBookIdSet)
+        self.assertTrue({1, 5} <= a), self.assertTrue(a.issuperset((1, 5))), self.assertFalse(a.isdisjoint(b))
+        ae(hash(b), hash(frozenset(range(3, 10))))
+        ae({b: 1}[frozenset(range(3, 10))], 1)
+        ae(as_frozenset(a), frozenset(a))
+        ae(pickle.loads(pickle.dumps(a)), a)
+        for i in range(100):  # exercise both bitmap and set based membership tests
+            self.assertIn(200, a), self.assertNotIn(2, a), self.assertNotIn('x', a)
+        c = a.copy()
+        c.add(2), c.discard(1), c.remove(5)
+        self.assertRaises(KeyError, c.remove, 5)
+        ae(c, {2, 9, 200, 3000}), ae(a, {1, 5, 9, 200, 3000})
+        c -= {9}
+        c |= {7}
+        c &= {2, 7, 3000, 11}
+        ae(c, {2, 7, 3000})
+        ae(c.pop(), 2)
+        c.clear()
+        ae(c, set()), self.assertFalse(c)
+        self.assertRaises(ValueError, BookIdSet, (-1,))
+        self.assertRaises(TypeError, hash, a)
+        # Single book ids are added and discarded without rebuilding the bitmap every time
+        c, expected = BookIdSet(range(0, 200000, 2)), set(range(0, 200000, 2))
+        for i in range(100000, 110000):
+            c.add(i), expected.add(i)
+            if i % 3 == 0:
+                c.discard(i - 7), expected.discard(i - 7)
+            self.assertIn(i, c), self.assertNotIn(i - 7 if i % 3 == 0 else -1, c)
+        c.discard(100000), expected.discard(100000)
+        c.add(100000), expected.add(100000)
+        ae(c, expected), ae(len(c), len(expected)), ae(c.bits, BookIdSet(expected).bits)
+    # }}}
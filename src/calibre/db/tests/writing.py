@@ -9,6 +9,7 @@
 from collections import namedtuple
 from functools import partial
 from io import BytesIO
+from unittest.mock import patch
 
 from calibre.db.backend import FTSQueryError
 from calibre.db.constants import RESOURCE_URL_SCHEME
@@ -424,6 +425,67 @@ def read_all_extra_files(book_id=1):
         ae(notes_before, notes_after)
     # }}}
 
+    def test_backup_batches(self):  # {{{
+        'Test the backup of changed metadata in batches'
+        from calibre.db.backup import MetadataBackup
+        from calibre.ebooks.metadata.opf2 import OPF
+        cache = self.init_cache(self.cloned_library)
+        cache.dump_metadata()
+        self.assertFalse(cache.dirtied_cache)
+        cache.set_field('title', {1: 'title1', 2: 'title2', 3: 'title3'})
+        self.assertEqual(len(cache.get_dirtied_books(2)), 2)
+        self.assertEqual(set(cache.get_dirtied_books(5, exclude={2: cache.dirtied_cache[2]})), {1, 3})
+        self.assertEqual(set(cache.get_dirtied_books(5, exclude={2: cache.dirtied_cache[2] - 1})), {1, 2, 3})
+        # Books dirtied again after their sequence numbers were read are not cleared
+        sequences = {book_id: cache.dirtied_cache[book_id] for book_id in (1, 2)}
+        cache.set_field('title', {1: 'changed'})
+        cache.clear_dirtied_books(sequences)
+        self.assertEqual(set(cache.dirtied_cache), {1, 3})
+        self.assertEqual(set(cache.backend.dirtied_books()), {1, 3})
+        mb = MetadataBackup(cache, interval=0.01, scheduling_interval=0, batch_size=2, num_workers=2)
+        mb.start()
+        try:
+            count = 50
+            while cache.dirty_queue_length() and count > 0:
+                mb.join(0.1)
+                count -= 1
+            self.assertFalse(cache.dirty_queue_length())
+        finally:
+            mb.stop()
+        mb.join(2)
+        self.assertFalse(mb.is_alive())
+        self.assertFalse(mb.failed_in_batch)
+        for book_id, title in ((1, 'changed'), (3, 'title3')):
+            self.assertEqual(OPF(BytesIO(cache.read_backup(book_id))).title, title)
+
+        # Books that fail in a batch are retried once dirtied again and
+        # forgotten once backed up
+        mb = MetadataBackup(cache, interval=0.01, scheduling_interval=0, batch_size=2, num_workers=2)
+        render_and_write = mb.render_and_write
+
+        def fail_for_book_2(book_id, mi):
+            if book_id == 2:
+                raise Exception('Testing backup failure')
+            render_and_write(book_id, mi)
+        mb.render_and_write = fail_for_book_2
+        cache.set_field('title', {1: 'again1', 2: 'again2'})
+        with patch('calibre.db.backup.prints'), patch('traceback.print_exc'):
+            mb.do_batch()
+        self.assertEqual(set(mb.failed_in_batch), {2})
+        self.assertEqual(set(cache.dirtied_cache), {2})
+        self.assertFalse(mb.do_batch())
+        cache.set_field('title', {2: 'again3'})
+        mb.render_and_write = render_and_write
+        self.assertFalse(mb.do_batch())
+        self.assertFalse(mb.failed_in_batch)
+        self.assertFalse(cache.dirtied_cache)
+        self.assertEqual(OPF(BytesIO(cache.read_backup(2))).title, 'again3')
+        cache.set_field('title', {2: 'again4'})
+        mb.failed_in_batch[2] = cache.dirtied_cache[2]
+        mb.do_one()
+        self.assertFalse(mb.failed_in_batch)
+    # }}}
+
     def test_set_cover(self):  # {{{
         ' Test setting of cover '
         cache = self.init_cache()
@@ -507,6 +569,41 @@ def test_set_metadata(self):  # {{{
 
     # }}}
 
+    def test_set_metadata_for_books(self):  # {{{
+        ' Test setting metadata for many books at once '
+        cache = self.init_cache()
+        mi_map = {book_id: cache.get_metadata(book_id, get_cover=True, cover_as_data=True) for book_id in (1, 2, 3)}
+        # Rotate the metadata between the books
+        mi_map = {1: mi_map[3], 2: mi_map[1], 3: mi_map[2]}
+        mi_map[1].tags = ['one', 'two']
+        mi_map[2].series, mi_map[2].series_index = 'A Series [3]', 7
+        mi_map[3].authors, mi_map[3].author_sort = ['New Author'], None
+        one_at_a_time, bulk = self.init_cache(self.cloned_library), self.init_cache(self.cloned_library)
+        for book_id, mi in mi_map.items():
+            one_at_a_time.set_metadata(book_id, mi.deepcopy_metadata(), force_changes=True)
+        changed = bulk.set_metadata_for_books({k: v.deepcopy_metadata() for k, v in mi_map.items()}, force_changes=True)
+        self.assertEqual(changed, {1, 2, 3})
+        for book_id in mi_map:
+            self.compare_metadata(
+                bulk.get_metadata(book_id, get_cover=True, cover_as_data=True),
+                one_at_a_time.get_metadata(book_id, get_cover=True, cover_as_data=True),
+                exclude={'last_modified', 'format_metadata', 'formats'})
+            self.assertEqual(bulk.field_for('path', book_id), one_at_a_time.field_for('path', book_id))
+        self.assertEqual(bulk.field_for('series_index', 2), 3)
+        self.assertEqual(bulk.field_for('author_sort', 3), 'Author, New')
+        # Setting the same metadata again changes nothing
+        self.assertEqual(bulk.set_metadata_for_books(
+            {book_id: bulk.get_metadata(book_id) for book_id in mi_map}), set())
+        # Errors are ignored per book when requested
+        mi = Metadata('bad')
+        mi.rating = 'not a number'
+        good = Metadata('good')
+        good.rating = 4
+        self.assertRaises(Exception, bulk.set_metadata_for_books, {1: mi, 2: good})
+        bulk.set_metadata_for_books({1: mi, 2: good}, ignore_errors=True)
+        self.assertEqual(bulk.field_for('rating', 2), 4)
+    # }}}
+
     def test_conversion_options(self):  # {{{
         ' Test saving of conversion options '
         cache = self.init_cache()
@@ -768,6 +865,23 @@ def test_set_author_data(self):  # {{{
                          'Setting the author sort to the same value as before, incorrectly marked some books as dirty')
     # }}}
 
+    def test_reload_from_db(self):  # {{{
+        ' Test that changes made to the library by another process are seen after reloading '
+        cache, other = self.init_cache(), self.init_cache()
+        self.assertFalse(cache.custom_columns_changed())
+
+        def extra_files():
+            return [e.relpath for e in cache.list_extra_files(1, use_cache=True)]
+        before = extra_files()
+        other.add_extra_files(1, {'data/x.txt': BytesIO(b'x')})
+        self.assertEqual(extra_files(), before)
+        cache.reload_from_db()
+        self.assertIn('data/x.txt', extra_files())
+        other.create_custom_column('newcol', 'New column', 'text', False)
+        self.assertTrue(cache.custom_columns_changed())
+        self.assertFalse(self.init_cache().custom_columns_changed())
+    # }}}
+
     def test_fix_case_duplicates(self):  # {{{
         ' Test fixing of databases that have items in is_many fields that differ only by case '
         ae = self.assertEqual
@@ -1057,3 +1171,46 @@ def test_link_maps(self):
         self.assertEqual({}, cache.get_link_map('publisher'), 'links on publisher were not deleted')
         self.assertEqual({}, cache.get_all_link_maps_for_book(1), 'Not all links for book were deleted')
     # }}}
+
+    def test_wal_mode(self):  # {{{
+        ' Test using WAL mode with per-thread read-only connections '
+        from threading import Thread
+
+        from calibre.utils.config_base import Tweak
+        with Tweak('use_wal_for_databases', True):
+            cache = self.init_cache()
+        backend = cache.backend
+        if not backend.use_wal:
+            cache.close()
+            self.skipTest('The test library is not on a local filesystem')
+        self.assertEqual(backend.conn.get('PRAGMA journal_mode', all=False), 'wal')
+        self.assertEqual(backend.conn.get('PRAGMA notes_db.journal_mode', all=False), 'wal')
+        reader = backend.reader
+        self.assertIsNot(reader, backend.conn)
+        self.assertIs(reader, backend.reader)
+        other = []
+        t = Thread(target=lambda: other.append(backend.reader))
+        t.start(), t.join()
+        self.assertIsNot(other[0], reader)
+        # Committed changes are seen by the readers
+        cache.add_custom_book_data('wal', {1: 'one', 2: 'two'})
+        self.assertEqual(cache.get_custom_book_data('wal'), {1: 'one', 2: 'two'})
+        author_id = cache.get_item_id('authors', 'Author One')
+        cache.set_notes_for('authors', author_id, 'a note')
+        self.assertEqual(cache.notes_for('authors', author_id), 'a note')
+        # Uncommitted changes are seen by the thread making them
+        with backend.conn:
+            backend.add_custom_data('wal', {3: 'three'}, False)
+            self.assertIs(backend.reader, backend.conn)
+            self.assertEqual(backend.get_custom_book_data('wal', (3,)), {3: 'three'})
+        dbpath = backend.dbpath
+        cache.close()
+        self.assertFalse(os.path.exists(dbpath + '-wal'))
+        # Without the tweak the library goes back to using a rollback journal
+        cache = self.init_cache()
+        self.assertFalse(cache.backend.use_wal)
+        self.assertEqual(cache.backend.conn.get('PRAGMA journal_mode', all=False), 'delete')
+        self.assertIs(cache.backend.reader, cache.backend.conn)
+        self.assertEqual(cache.get_custom_book_data('wal'), {1: 'one', 2: 'two', 3: 'three'})
+        cache.close()
+    # }}}
@@ -74,13 +74,14 @@ def check_command_line_options(parser, args, log):
     if input.endswith('.recipe') and not os.access(input, os.R_OK):
         input = args[1]
 
-    output = args[2]
+    return input, output_path(input, args[2])
+
+
+def output_path(input, output):
     if (output.startswith('.') and output[:2] not in {'..', '.'} and '/' not in
             output and '\\' not in output):
         output = os.path.splitext(os.path.basename(input))[0]+output
-    output = os.path.abspath(output)
-
-    return input, output
+    return os.path.abspath(output)
 
 
 def option_recommendation_to_cli_option(add_option, rec):
@@ -201,6 +202,7 @@ def add_pipeline_options(parser, plumber):
                     [
                      'input_profile',
                      'output_profile',
+                     'max_workers',
                      ]
                     )),
               (_('LOOK AND FEEL'), (
@@ -290,6 +292,13 @@ def option_parser():
             help=_('List builtin recipe names. You can create an e-book from '
                 'a builtin recipe like this: ebook-convert "Recipe Name.recipe" '
                 'output.epub'))
+    parser.add_option('--also-output', default=[], action='append',
+            help=_('Also convert the input to this output file, in the same '
+                'way as output_file. Can be specified more than once. The input '
+                'is read only once for all output files when possible, which is faster '
+                'than converting it separately for each of them. Options specific to '
+                'the output format of output_file are used only for the output files '
+                'that have them.'))
     return parser
 
 
@@ -423,9 +432,27 @@ def main(args=sys.argv):
                                         for n in parser.options_iter()
                                         if n.dest]
     plumber.merge_ui_recommendations(recommendations)
+    plumbers = [plumber]
+    if opts.also_output:
+        from calibre.ebooks.conversion.plumber import Plumber
+        # The defaults of the options are the values recommended for the
+        # format of output_file, so use only the options that were specified
+        changed = [(name, val, level) for name, val, level in recommendations if val != parser.defaults.get(name)]
+        for output in opts.also_output:
+            output = output_path(plumber.input, output)
+            if patheq(plumber.input, output):
+                log.error('Input file is the same as the output file:', output)
+                return 1
+            p = Plumber(plumber.original_input_arg, output, log, ProgressBar(log))
+            p.merge_ui_recommendations(changed)
+            plumbers.append(p)
 
     try:
-        plumber.run()
+        if len(plumbers) > 1:
+            from calibre.ebooks.conversion.plumber import run_pipelines
+            run_pipelines(plumbers)
+        else:
+            plumber.run()
     except ConversionUserFeedBack as e:
         ll = {'info': log.info, 'warn': log.warn,
                 'error':log.error}.get(e.level, log.info)
@@ -435,7 +462,8 @@ def main(args=sys.argv):
         ll(e.msg)
         raise SystemExit(1)
 
-    log(_('Output saved to'), ' ', plumber.output)
+    for plumber in plumbers:
+        log(_('Output saved to'), ' ', plumber.output)
 
     return 0
 
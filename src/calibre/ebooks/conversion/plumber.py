@@ -10,7 +10,7 @@
 from functools import partial
 
 from calibre import filesystem_encoding, get_types_map, isbytestring
-from calibre.constants import __version__
+from calibre.constants import __version__, ismacos
 from calibre.customize.conversion import DummyReporter, OptionRecommendation
 from calibre.customize.ui import (
     available_input_formats,
@@ -62,6 +62,11 @@ class OptionValues:
     pass
 
 
+# Options that do not change the book created by the input plugin, so pipelines
+# that differ only in these can share it
+OPTIONS_NOT_AFFECTING_INPUT = frozenset(('verbose', 'pretty_print', 'max_workers'))
+
+
 class CompositeProgressReporter:
 
     def __init__(self, global_min, global_max, global_reporter):
@@ -152,6 +157,15 @@ def __init__(self, input, output, log, report_progress=DummyReporter(),
                        x.short_name for x in output_profiles()])
         ),
 
+OptionRecommendation(name='max_workers',
+            recommended_value=1, level=OptionRecommendation.LOW,
+            help=_('The maximum number of worker processes used to flatten the CSS of '
+                   'the HTML files in the book. Using more than one makes converting '
+                   'books with many HTML files faster, the output is the same. Zero '
+                   'means one worker per CPU core. Worker processes are not available '
+                   'on Windows and macOS.')
+        ),
+
 OptionRecommendation(name='base_font_size',
             recommended_value=0, level=OptionRecommendation.LOW,
             help=_('The base font size in pts. All font sizes in the produced book '
@@ -1024,6 +1038,10 @@ def run(self):
         '''
         Run the conversion pipeline
         '''
+        self.setup_pipeline()
+        self.run_after_setup()
+
+    def setup_pipeline(self, start_font_scanner=True):
         # Setup baseline option values
         self.setup_options()
         if self.opts.verbose:
@@ -1031,7 +1049,7 @@ def run(self):
         if self.for_regex_wizard and hasattr(self.opts, 'no_process'):
             self.opts.no_process = True
         self.flush()
-        if self.opts.embed_all_fonts or self.opts.embed_font_family:
+        if start_font_scanner and (self.opts.embed_all_fonts or self.opts.embed_font_family):
             # Start the threaded font scanner now, for performance
             from calibre.utils.fonts.scanner import font_scanner  # noqa: F401
         import logging
@@ -1054,37 +1072,47 @@ def run(self):
 
         # Run any preprocess plugins
         from calibre.customize.ui import run_plugins_on_preprocess
+        self.unprocessed_input = self.input
         self.input = run_plugins_on_preprocess(self.input)
 
         self.flush()
-        # Create an OEBBook from the input file. The input plugin does all the
-        # heavy lifting.
-        accelerators = {}
-
-        tdir = PersistentTemporaryDirectory('_plumber')
-        stream = self.input if self.input_fmt == 'recipe' else \
-                open(self.input, 'rb')
         if self.input_fmt == 'recipe':
             self.opts.original_recipe_input_arg = self.original_input_arg
 
         if hasattr(self.opts, 'lrf') and self.output_plugin.file_type == 'lrf':
             self.opts.lrf = True
+
+    def run_after_setup(self):
         if self.input_fmt == 'azw4' and self.output_plugin.file_type == 'pdf':
             self.ui_reporter(0.01, 'AZW4 files are simply wrappers around PDF files.'
                              ' Skipping the conversion and unwrapping the embedded PDF instead')
             from calibre.ebooks.azw4.reader import unwrap
-            unwrap(stream, self.output)
+            with open(self.input, 'rb') as stream:
+                unwrap(stream, self.output)
             self.ui_reporter(1.)
             self.log(self.output_fmt.upper(), 'output written to', self.output)
             self.flush()
             return
+        self.output_plugin.specialize_options(self.log, self.opts, self.input_fmt)
+        if self.read_input():
+            self.convert_parsed_input()
+
+    def read_input(self):
+        '''
+        Create an OEBBook from the input file. The input plugin does all the
+        heavy lifting. Returns False if the pipeline must stop after this.
+        '''
+        accelerators = {}
+        opts_before_input = dict(vars(self.opts))
 
+        tdir = PersistentTemporaryDirectory('_plumber')
+        stream = self.input if self.input_fmt == 'recipe' else \
+                open(self.input, 'rb')
         self.ui_reporter(0.01, _('Converting input to HTML...'))
         ir = CompositeProgressReporter(0.01, 0.34, self.ui_reporter)
         self.input_plugin.report_progress = ir
         if self.for_regex_wizard:
             self.input_plugin.for_viewer = True
-        self.output_plugin.specialize_options(self.log, self.opts, self.input_fmt)
         with self.input_plugin:
             self.oeb = self.input_plugin(stream, self.opts,
                                         self.input_fmt, self.log,
@@ -1092,7 +1120,7 @@ def run(self):
             if self.opts.debug_pipeline is not None:
                 self.dump_input(self.oeb, tdir)
                 if self.abort_after_input_dump:
-                    return
+                    return False
             if self.input_fmt in ('recipe', 'downloaded_recipe'):
                 self.opts_to_mi(self.user_metadata)
             if not hasattr(self.oeb, 'manifest'):
@@ -1101,15 +1129,49 @@ def run(self):
                     encoding=self.input_plugin.output_encoding,
                     for_regex_wizard=self.for_regex_wizard, removed_items=getattr(self.input_plugin, 'removed_items_to_ignore', ()))
             if self.for_regex_wizard:
-                return
+                return False
             self.input_plugin.postprocess_book(self.oeb, self.opts, self.log)
             self.opts.is_image_collection = self.input_plugin.is_image_collection
-            pr = CompositeProgressReporter(0.34, 0.67, self.ui_reporter)
             self.flush()
             if self.opts.debug_pipeline is not None:
                 out_dir = os.path.join(self.opts.debug_pipeline, 'parsed')
                 self.dump_oeb(self.oeb, out_dir)
                 self.log('Parsed HTML written to:', out_dir)
+        # Input plugins can pass information to the rest of the pipeline in opts
+        self.opts_set_by_input = {k: v for k, v in vars(self.opts).items() if opts_before_input.get(k, self) is not v}
+        return True
+
+    def input_key(self):
+        '''
+        Pipelines with equal keys produce the same book from read_input(), so
+        they can share it, see :func:`run_pipelines`. None if the book cannot
+        be shared. Must be called after setup_pipeline().
+        '''
+        if (self.input_fmt in ('recipe', 'downloaded_recipe') or self.for_regex_wizard or self.opts.debug_pipeline is not None or
+                # PDF output initializes Qt, which is not fork safe
+                self.output_plugin.file_type == 'pdf'):
+            return None
+        names = {rec.option.name for rec in self.input_options}.union(rec.option.name for rec in self.pipeline_options)
+        vals = []
+        for name in sorted(names - OPTIONS_NOT_AFFECTING_INPUT):
+            val = getattr(self.opts, name, None)
+            vals.append((name, getattr(val, 'short_name', val)))
+        # Preprocess plugins create a new file for every pipeline
+        return repr((self.unprocessed_input, self.input_fmt, vals))
+
+    def use_parsed_input(self, other):
+        '''
+        Use the book created by read_input() of other, a pipeline with the
+        same :meth:`input_key`, instead of calling read_input().
+        '''
+        self.oeb = other.oeb
+        self.oeb.pretty_print = self.opts.pretty_print
+        for k, v in other.opts_set_by_input.items():
+            setattr(self.opts, k, v)
+
+    def convert_parsed_input(self):
+        pr = CompositeProgressReporter(0.34, 0.67, self.ui_reporter)
+        with self.input_plugin:
             self.input_plugin.specialize(self.oeb, self.opts, self.log,
                     self.output_fmt)
 
@@ -1222,7 +1284,8 @@ def run(self):
                     'lit'),
                 transform_css_rules=transform_css_rules,
                 specializer=partial(self.output_plugin.specialize_css_for_output,
-                    self.log, self.opts))
+                    self.log, self.opts),
+                max_workers=self.opts.max_workers)
         flattener(self.oeb, self.opts)
         self.opts._final_base_font_size = fbase
 
@@ -1310,6 +1373,52 @@ def create_oebbook(log, path_or_stream, opts, reader=None,
     return oeb
 
 
+def run_pipelines(plumbers, max_workers=1):
+    '''
+    Run the conversion pipelines of several Plumbers, typically converting one
+    input file to several output formats. The input plugin is run and the book
+    is parsed only once for all pipelines with the same :meth:`Plumber.input_key`.
+    The rest of each of these pipelines runs in a forked worker process on its
+    own copy of the parsed book, at most max_workers at a time. Where forking is
+    not supported or not safe, every pipeline is run completely, one after
+    another.
+    '''
+    from calibre.utils.forked_map import forked_map, forked_map_is_supported
+    if not forked_map_is_supported or ismacos:
+        for plumber in plumbers:
+            plumber.run()
+        return
+    groups = {}
+    for plumber in plumbers:
+        # Threads do not survive being forked
+        plumber.setup_pipeline(start_font_scanner=False)
+        key = plumber.input_key()
+        groups.setdefault(id(plumber) if key is None else key, []).append(plumber)
+    unshared = []
+    for group in groups.values():
+        if len(group) < 2:
+            unshared.extend(group)
+            continue
+        parsed = group[0]
+        if not parsed.read_input():
+            continue
+
+        def convert(plumber):
+            if plumber is not parsed:
+                plumber.use_parsed_input(parsed)
+            plumber.output_plugin.specialize_options(plumber.log, plumber.opts, plumber.input_fmt)
+            plumber.convert_parsed_input()
+
+        for i in range(0, len(group), max(1, max_workers)):
+            batch = group[i:i + max(1, max_workers)]
+            # One worker per pipeline, as each one changes the book
+            list(forked_map(convert, batch, num_workers=len(batch)))
+    # Run these last, as PDF output initializes Qt in specialize_options(),
+    # which is not fork safe
+    for plumber in unshared:
+        plumber.run_after_setup()
+
+
 def create_dummy_plumber(input_format, output_format):
     from calibre.utils.logging import Log
     input_format = input_format.lower()
@@ -14,7 +14,7 @@
 from calibre.ebooks.oeb.polish.container import get_container as _gc
 from calibre.ebooks.oeb.polish.replace import rationalize_folders, rename_files
 from calibre.ebooks.oeb.polish.split import merge, split
-from calibre.ebooks.oeb.polish.tests.base import BaseTest, get_simple_book, get_split_book
+from calibre.ebooks.oeb.polish.tests.base import BaseTest, build_book, get_simple_book, get_split_book
 from calibre.ptempfile import TemporaryDirectory, TemporaryFile
 from calibre.utils.filenames import nlinks_file
 from calibre.utils.resources import get_path as P
@@ -285,3 +285,34 @@ def test_folder_type_map_case(self):
         self.assertTrue(c.has_name('Image/testcase.png'))
         self.assertTrue(c.exists('Image/testcase.png'))
         self.assertFalse(c.has_name('image/testcase.png'))
+
+    def test_convert_to_several_formats(self):
+        ' Test that converting to several formats at once gives the same output as converting separately '
+        from unittest.mock import patch
+
+        from calibre.constants import ismacos
+        from calibre.ebooks.conversion.plumber import Plumber
+        from calibre.utils.forked_map import forked_map_is_supported
+        book = get_simple_book()
+
+        def contents(path):
+            if path.endswith('.txt'):
+                with open(path, 'rb') as f:
+                    return f.read()
+            # The OPF and NCX contain the time of conversion
+            with ZipFile(path) as zf:
+                return {n: zf.read(n) for n in zf.namelist() if n.rpartition('.')[-1] in ('html', 'xhtml', 'css')}
+
+        separate = [os.path.join(self.tdir, 'separate.' + fmt) for fmt in ('txt', 'epub')]
+        for output in separate:
+            build_book(book, output)
+        read_input, outputs_read = Plumber.read_input, []
+
+        def counting_read_input(self):
+            outputs_read.append(self.output)
+            return read_input(self)
+        with patch.object(Plumber, 'read_input', counting_read_input):
+            build_book(book, os.path.join(self.tdir, 'shared.txt'), args=['--also-output', os.path.join(self.tdir, 'shared.epub')])
+        self.assertEqual(len(outputs_read), 1 if forked_map_is_supported and not ismacos else 2)
+        for output in separate:
+            self.assertEqual(contents(output), contents(output.replace('separate', 'shared')))
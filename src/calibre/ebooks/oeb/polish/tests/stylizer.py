@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+Tests that the conversion Stylizer, which matches CSS rules to tags by walking
+the tree once, computes the same styles as matching every rule with select().
+Also tests that flattening the CSS of a book in worker processes produces
+exactly the same output as flattening it in one process. And a benchmark comparing the two on a synthetic book, run as:
+
+    calibre-debug src/calibre/ebooks/oeb/polish/tests/stylizer.py -- --blocks 5000 --rules 1000
+'''
+
+import random
+import sys
+from time import monotonic
+from types import SimpleNamespace
+
+from calibre.customize.profiles import InputProfile, OutputProfile
+from calibre.ebooks.oeb.base import CSS_MIME, XHTML_MIME, XHTML_NS, OEBBook
+from calibre.ebooks.oeb.polish.tests.base import BaseTest
+from calibre.ebooks.oeb.stylizer import Stylizer
+from calibre.ebooks.oeb.transforms.flatcss import CSSFlattener
+from calibre.utils.forked_map import forked_map_is_supported
+from calibre.utils.logging import DevNull
+from calibre.utils.xml_parse import safe_xml_fromstring
+
+
+class SelectStylizer(Stylizer):
+    index_rules = False
+
+
+TAGS = ('div', 'p', 'span', 'a', 'em', 'b', 'blockquote', 'h2', 'ul', 'li')
+CLASSES = tuple(f'c{i}' for i in range(40))
+COLORS = ('red', 'green', 'blue', 'black', 'gray', 'white')
+
+SELECTORS = (
+    '{tag}', '.{cls}', '#{id}', '{tag}.{cls}', '.{cls}.{cls2}', '{tag}#{id}', '*', '{tag} {tag2}', '.{cls} {tag}',
+    '{tag} .{cls}', '{tag} > {tag2}', '.{cls} > .{cls2}', '{tag} + {tag2}', '{tag} ~ .{cls}', '{tag}:first-child',
+    '{tag}:last-child', '.{cls}:nth-child(2n+1)', '{tag}:nth-of-type(2)', ':not(.{cls})', '{tag}:not({tag2})',
+    '{tag}[title]', '[title^=t{n}]', '{tag}[data-x~=v{n}]', '[lang|=fr]', ':lang(fr) {tag}', '{tag}:empty',
+    ':root', 'body :first-child', '#{id} {tag}', '{tag} {tag2} {tag}', '{tag}:hover', 'a:visited', '{tag}::first-letter',
+    '.{CLS}', '{TAG}', 'div.{cls} p.{cls2} span', '.{cls} + .{cls2}', '[class]', '{tag}[class$={n}]',
+)
+# Mostly class selectors, as in the stylesheets of typical books
+BOOK_SELECTORS = ('.{cls}',) * 8 + ('{tag}.{cls}',) * 4 + (
+    '{tag}', '.{cls} {tag}', '{tag} .{cls}', '.{cls} > {tag}', '{tag} + {tag2}', '{tag}:first-child', '#{id}', '.{cls}::first-letter')
+
+
+def random_tree(rng, num_blocks):
+    ans = []
+    ids = []
+
+    def block(depth):
+        tag = rng.choice(TAGS)
+        attrs = []
+        if rng.random() < 0.6:
+            attrs.append('class="{}"'.format(' '.join(rng.sample(CLASSES, rng.randint(1, 3)))))
+        if rng.random() < 0.1:
+            ids.append(f'i{len(ids)}')
+            attrs.append(f'id="{ids[-1]}"')
+        if rng.random() < 0.1:
+            attrs.append(f'title="t{rng.randint(0, 9)}"')
+        if rng.random() < 0.1:
+            attrs.append(f'data-x="v{rng.randint(0, 9)} v{rng.randint(0, 9)}"')
+        if rng.random() < 0.05:
+            attrs.append('lang="{}"'.format(rng.choice(('fr', 'fr-CA', 'en'))))
+        if rng.random() < 0.05:
+            attrs.append(f'style="color: {rng.choice(COLORS)}"')
+        ans.append('<{} {}>'.format(tag, ' '.join(attrs)))
+        if rng.random() < 0.9:
+            ans.append('Some text')
+        if depth < 6:
+            for i in range(rng.choice((0, 0, 1, 2, 3))):
+                block(depth + 1)
+        ans.append(f'</{tag}>')
+
+    count = 0
+    while count < num_blocks:
+        before = len(ans)
+        block(0)
+        count += (len(ans) - before) // 2
+    return '<html xmlns="{}"><head><link rel="stylesheet" href="style.css"/></head><body>{}</body></html>'.format(
+        XHTML_NS, '\n'.join(ans)), ids or ['none']
+
+
+def random_css(rng, num_rules, ids, selectors=SELECTORS):
+    ans = []
+    for i in range(num_rules):
+        tag, tag2 = rng.choice(TAGS), rng.choice(TAGS)
+        cls, cls2 = rng.choice(CLASSES), rng.choice(CLASSES)
+        selector = rng.choice(selectors).format(
+            tag=tag, tag2=tag2, cls=cls, cls2=cls2, id=rng.choice(ids), n=rng.randint(0, 9), CLS=cls.upper(), TAG=tag.upper())
+        important = ' !important' if rng.random() < 0.05 else ''
+        ans.append(f'{selector} {{ color: {rng.choice(COLORS)}{important}; margin-left: {i}px }}')
+    return '\n'.join(ans)
+
+
+def stylizers(html, css, classes=(Stylizer, SelectStylizer), **kw):
+    ans = []
+    for cls in classes:
+        oeb = OEBBook(DevNull(), None)
+        for k, v in kw.items():
+            setattr(oeb, k, v)
+        oeb.manifest.add('css', 'style.css', CSS_MIME, data=css)
+        item = oeb.manifest.add('html', 'index.html', XHTML_MIME, data=safe_xml_fromstring(html))
+        opts = SimpleNamespace(output_profile=OutputProfile(None), change_justification='original')
+        ans.append(cls(item.data, item.href, oeb, opts, InputProfile(None)))
+    return ans
+
+
+def computed_styles(stylizer):
+    tags = {elem: i for i, elem in enumerate(stylizer.oeb.manifest.hrefs['index.html'].data.iter('*'))}
+    return [(tags[elem], dict(style._style), sorted(getattr(style._style, 'important_properties', ())), style._pseudo_classes)
+            for elem, style in stylizer._styles.items()]
+
+
+def flattened_book(seed, max_workers, fbase):
+    rng = random.Random(seed)
+    oeb = OEBBook(DevNull(), None)
+    for i in range(9):
+        html, ids = random_tree(rng, 100)
+        html = html.replace('href="style.css"', 'href="../style.css"').replace('<body>', '<body style="font-size: 1.1em"><a href="#x">link</a>')
+        oeb.spine.add(oeb.manifest.add(f'h{i}', f'text/h{i}.html', XHTML_MIME, data=safe_xml_fromstring(html)))
+    css = random_css(rng, 200, ids, BOOK_SELECTORS) + (
+        ' a:hover { color: red } @page { margin-left: 3pt } @font-face { font-family: X; src: url(x.ttf) } .c1 { font-size: 1.3rem }')
+    oeb.manifest.add('css', 'style.css', CSS_MIME, data=css)
+    opts = SimpleNamespace(
+        output_profile=OutputProfile(None), dest=OutputProfile(None), source=InputProfile(None), change_justification='original',
+        disable_font_rescaling=False, extra_css=None, insert_blank_line=False, insert_blank_line_size=0.5, margin_top=5, margin_bottom=5,
+        margin_left=5, margin_right=5, minimum_line_height=120, remove_paragraph_spacing=False, remove_paragraph_spacing_indent_size=1.5,
+        embed_font_family=None, filter_css=None)
+    CSSFlattener(fbase=fbase, lineh=1.2, max_workers=max_workers)(oeb, opts)
+    return sorted((item.href, item.bytes_representation) for item in oeb.manifest.values()), opts._stored_page_margins
+
+
+class StylizerTest(BaseTest):
+
+    def test_parallel_css_flattening(self):
+        if not forked_map_is_supported:
+            self.skipTest('Worker processes are not supported')
+        for fbase in (0, 12):
+            self.assertEqual(flattened_book(3, 1, fbase), flattened_book(3, 2, fbase))
+
+    def test_stylizer_rule_matching(self):
+        def t(html, css, **kw):
+            html = f'<html xmlns="{XHTML_NS}"><head><link rel="stylesheet" href="style.css"/></head><body>{html}</body></html>'
+            a, b = stylizers(html, css, **kw)
+            self.assertEqual(computed_styles(a), computed_styles(b))
+            return a
+
+        s = t('<div class="A b" id="X"><p>1</p><p title="t">2</p><span lang="fr">3<em>4</em></span></div><p class="a">5</p>',
+              '.a { color: red } #x p { color: green } p + p { margin: 1px } p ~ span em:first-child { color: blue }'
+              ' div > :not(p) { color: gray } :lang(fr) { font-style: italic } [title] { color: white !important }'
+              ' p:first-letter { color: red } p:hover { color: blue } p, .b { margin-left: 1px } p:unknown { color: red }')
+        self.assertEqual(s.style(s.oeb.manifest.hrefs['index.html'].data.find(f'.//{{{XHTML_NS}}}em'))._style['color'], 'blue')
+        t('<div><p>first letter</p></div>', 'p::first-letter { color: red } p { color: blue }', plumber_output_format='mobi')
+        rng = random.Random(7)
+        for i in range(20):
+            html, ids = random_tree(rng, 200)
+            t(html.partition('<body>')[2].rpartition('</body>')[0], random_css(rng, 150, ids))
+
+
+def main(args=sys.argv):
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmark matching CSS rules in the Stylizer')
+    parser.add_argument('--blocks', type=int, default=5000, help='Number of tags in the document')
+    parser.add_argument('--rules', type=int, default=1000, help='Number of CSS rules')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of times to style the document')
+    opts = parser.parse_args(args[1:])
+    rng = random.Random(7)
+    html, ids = random_tree(rng, opts.blocks)
+    css = random_css(rng, opts.rules, ids, BOOK_SELECTORS)
+    a, b = stylizers(html, css)
+    if computed_styles(a) != computed_styles(b):
+        raise SystemExit('The computed styles are different')
+    for name, s in (('walk tree once', a), ('select() per rule', b)):
+        item = s.oeb.manifest.hrefs['index.html']
+        st = monotonic()
+        for i in range(opts.repeat):
+            type(s)(item.data, item.href, s.oeb, s.opts, s.profile)
+        print(f'{name}: {(monotonic() - st) * 1000 / opts.repeat:.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -11,6 +11,7 @@
 import os
 import re
 import unicodedata
+from collections import defaultdict
 from operator import itemgetter
 from weakref import WeakKeyDictionary
 from xml.dom import SyntaxErr as CSSSyntaxError
@@ -20,6 +21,8 @@
 from css_parser import profile as cssprofiles
 from css_parser.css import CSSFontFaceRule, CSSPageRule, CSSStyleRule, cssproperties
 from css_selectors import INAPPROPRIATE_PSEUDO_CLASSES, Select, SelectorError
+from css_selectors.parser import ascii_lower
+from css_selectors.select import get_parsed_selector, rightmost_key
 from tinycss.media3 import CSSMedia3Parser
 
 from calibre import as_unicode, force_unicode
@@ -157,6 +160,15 @@ def __init__(self, opts, profile, stylesheets):
                     self.rules.extend(self.flatten_rule(rule, href, index, is_user_agent_sheet=sheet_index==0))
                     index = index + 1
         self.rules.sort(key=itemgetter(0))  # sort by specificity
+        # The parsed selector of every rule and the key used to index it, see
+        # Stylizer.match_rules()
+        self.rule_selectors = []
+        for _, _, _, text, _ in self.rules:
+            try:
+                parsed = get_parsed_selector(text)
+            except SelectorError:
+                parsed = ()
+            self.rule_selectors.append((parsed[0], rightmost_key(parsed[0])) if len(parsed) == 1 else (None, None))
 
     def flatten_rule(self, rule, href, index, is_user_agent_sheet=False):
         results = []
@@ -230,6 +242,8 @@ def same_rules(self, opts, profile, stylesheets):
 
 class Stylizer:
     STYLESHEETS = WeakKeyDictionary()
+    # Match the rules by walking the tree once, see match_rules()
+    index_rules = True
 
     def __init__(self, tree, path, oeb, opts, profile=None,
             extra_css='', user_css='', base_css=''):
@@ -336,6 +350,7 @@ def __init__(self, tree, path, oeb, opts, profile=None,
             or not self.oeb.stylizer_rules.same_rules(self.opts, self.profile, stylesheets):
             self.oeb.stylizer_rules = StylizerRules(self.opts, self.profile, stylesheets)
         self.rules = self.oeb.stylizer_rules.rules
+        self.rule_selectors = self.oeb.stylizer_rules.rule_selectors
         self.page_rule = self.oeb.stylizer_rules.page_rule
         self.font_face_rules = self.oeb.stylizer_rules.font_face_rules
         self.flatten_style = self.oeb.stylizer_rules.flatten_style
@@ -343,19 +358,26 @@ def __init__(self, tree, path, oeb, opts, profile=None,
         self._styles = {}
         pseudo_pat = re.compile(':{{1,2}}({})'.format('|'.join(INAPPROPRIATE_PSEUDO_CLASSES)), re.I)
         select = Select(tree, ignore_inappropriate_pseudo_classes=True)
-
-        for _, _, cssdict, text, _ in self.rules:
+        fake_first_letter = getattr(self.oeb, 'plumber_output_format', '').lower() in {'mobi', 'docx'}
+        rule_matches = None
+        # Faking first-letter changes the tree while the rules are applied
+        if self.index_rules and not (fake_first_letter and any(
+                (m := pseudo_pat.search(x[3])) is not None and m.group(1) == 'first-letter' for x in self.rules)):
+            rule_matches = self.match_rules(select)
+
+        for i, (_, _, cssdict, text, _) in enumerate(self.rules):
             fl = pseudo_pat.search(text)
-            try:
-                matches = tuple(select(text))
-            except SelectorError as err:
-                self.logger.error(f'Ignoring CSS rule with invalid selector: {text!r} ({as_unicode(err)})')
-                continue
+            matches = None if rule_matches is None else rule_matches[i]
+            if matches is None:
+                try:
+                    matches = tuple(select(text))
+                except SelectorError as err:
+                    self.logger.error(f'Ignoring CSS rule with invalid selector: {text!r} ({as_unicode(err)})')
+                    continue
 
             if fl is not None:
                 fl = fl.group(1)
-                if fl == 'first-letter' and getattr(self.oeb,
-                        'plumber_output_format', '').lower() in {'mobi', 'docx'}:
+                if fl == 'first-letter' and fake_first_letter:
                     # Fake first-letter
                     for elem in matches:
                         for x in elem.iter('*'):
@@ -409,6 +431,55 @@ def __init__(self, tree, path, oeb, opts, profile=None,
                 if upd:
                     style._update_cssdict(upd)
 
+    def match_rules(self, select):
+        ''' Return the tags matched by every rule, in document order, the same
+        as select() would. Rather than calling select() once per rule, the
+        rules are indexed by the id, class or tag name of their rightmost
+        compound selector and the tree is walked once, testing each tag only
+        against the rules that can match it. The entry for a rule is None if
+        it has to be matched with select(). '''
+        ans = [None] * len(self.rule_selectors)
+        matchers = list(ans)
+        universal, by_id, by_class, by_tag = [], defaultdict(list), defaultdict(list), defaultdict(list)
+        buckets = {'id': by_id, 'class': by_class, 'tag': by_tag}
+        for i, (parsed, key) in enumerate(self.rule_selectors):
+            if parsed is None:
+                continue
+            try:
+                matchers[i] = select.matcher(parsed)
+            except SelectorError:
+                continue  # select() will report the error
+            ans[i] = []
+            if key is None:
+                universal.append(i)
+            else:
+                buckets[key[0]][key[1]].append(i)
+        if not (universal or by_id or by_class or by_tag):
+            return ans
+        # The candidate rules for every tag name and class attribute value
+        universal, tag_candidates, class_candidates = tuple(universal), {}, {}
+        map_tag_name = select.map_tag_name
+        for elem in select.itertag():
+            tag = elem.tag
+            candidates = tag_candidates.get(tag)
+            if candidates is None:
+                candidates = tag_candidates[tag] = universal + tuple(by_tag.get(map_tag_name(tag), ()))
+            if by_id:
+                q = elem.get('id')
+                if q is not None:
+                    candidates += tuple(by_id.get(ascii_lower(q), ()))
+            if by_class:
+                q = elem.get('class')
+                if q:
+                    c = class_candidates.get(q)
+                    if c is None:
+                        c = class_candidates[q] = tuple(i for x in set(ascii_lower(q).split()) for i in by_class.get(x, ()))
+                    candidates += c
+            for i in candidates:
+                if matchers[i](elem):
+                    ans[i].append(elem)
+        return ans
+
     def _fetch_css_file(self, path):
         hrefs = self.oeb.manifest.hrefs
         if path not in hrefs:
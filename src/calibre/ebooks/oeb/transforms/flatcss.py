@@ -11,6 +11,7 @@
 import operator
 import re
 from collections import defaultdict
+from uuid import uuid4
 from xml.dom import SyntaxErr
 
 import css_parser
@@ -21,6 +22,7 @@
 from calibre.ebooks import unit_convert
 from calibre.ebooks.oeb.base import CSS_MIME, OEB_STYLES, SVG, SVG_NS, XHTML, XHTML_NS, XPath, barename, css_text, namespace
 from calibre.ebooks.oeb.stylizer import Stylizer
+from calibre.ebooks.oeb.transforms.parallel import map_items, number_of_workers, parse_html, serialize_html
 from calibre.utils.filenames import ascii_filename, ascii_text
 from calibre.utils.icu import numeric_sort_key
 from polyglot.builtins import iteritems, string_or_bytes
@@ -137,8 +139,10 @@ class CSSFlattener:
 
     def __init__(self, fbase=None, fkey=None, lineh=None, unfloat=False,
                  untable=False, page_break_on_body=False, specializer=None,
-                 transform_css_rules=()):
+                 transform_css_rules=(), max_workers=1):
         self.fbase = fbase
+        # Items are flattened in this many worker processes, zero means one per CPU
+        self.max_workers = max_workers
         self.transform_css_rules = transform_css_rules
         if self.transform_css_rules:
             from calibre.ebooks.css_transform_rules import compile_rules
@@ -199,10 +203,14 @@ def __call__(self, oeb, context):
         # like the AZW3 output inline ToC.
         self.oeb.store_embed_font_rules = EmbedFontsCSSRules(self.body_font_family,
                 self.embed_font_rules)
-        self.stylize_spine()
-        self.sbase = self.baseline_spine() if self.fbase else None
-        self.fmap = FontMapper(self.sbase, self.fbase, self.fkey)
-        self.flatten_spine()
+        self.page_styles = {}
+        if number_of_workers(self.items, self.max_workers) > 1:
+            self.flatten_spine_in_workers()
+        else:
+            self.stylize_spine()
+            self.sbase = self.baseline_spine() if self.fbase else None
+            self.fmap = FontMapper(self.sbase, self.fbase, self.fkey)
+            self.flatten_spine()
         if epub3_nav is not None:
             self.opts.epub3_nav_parsed = epub3_nav.data
 
@@ -210,14 +218,8 @@ def __call__(self, oeb, context):
 
     def store_page_margins(self):
         self.opts._stored_page_margins = {}
-        for item, stylizer in iteritems(self.stylizers):
-            margins = self.opts._stored_page_margins[item.href] = {}
-            for prop, val in stylizer.page_rule.items():
-                p, w = prop.partition('-')[::2]
-                if p == 'margin':
-                    margins[w] = unit_convert(
-                            val, stylizer.profile.width_pts, stylizer.body_font_size,
-                            stylizer.profile.dpi, body_font_size=stylizer.body_font_size)
+        for item in self.items:
+            self.opts._stored_page_margins[item.href] = self.page_styles[item][1]
 
     def get_embed_font_info(self, family, failure_critical=True):
         efi = []
@@ -282,34 +284,36 @@ def get_embed_font_info(self, family, failure_critical=True):
 
     def stylize_spine(self):
         self.stylizers = {}
-        profile = self.context.source
-        css = ''
         for item in self.items:
-            html = item.data
-            body = html.find(XHTML('body'))
-            if 'style' in html.attrib:
-                b = body.attrib.get('style', '')
-                body.set('style', html.get('style') + ';' + b)
-                del html.attrib['style']
-            bs = body.get('style', '').split(';')
-            bs.append('margin-top: 0pt')
-            bs.append('margin-bottom: 0pt')
-            if float(self.context.margin_left) >= 0:
-                bs.append(f'margin-left : {float(self.context.margin_left):g}pt')
-            if float(self.context.margin_right) >= 0:
-                bs.append(f'margin-right : {float(self.context.margin_right):g}pt')
-            bs.extend(['padding-left: 0pt', 'padding-right: 0pt'])
-            if self.page_break_on_body:
-                bs.extend(['page-break-before: always'])
-            if self.context.change_justification != 'original':
-                bs.append('text-align: '+ self.context.change_justification)
-            if self.body_font_family:
-                bs.append('font-family: '+self.body_font_family)
-            body.set('style', '; '.join(bs))
-            stylizer = Stylizer(html, item.href, self.oeb, self.context, profile,
-                    user_css=self.context.extra_css,
-                    extra_css=css)
-            self.stylizers[item] = stylizer
+            self.prepare_body(item)
+            self.stylizers[item] = self.stylizer_for(item)
+
+    def prepare_body(self, item):
+        html = item.data
+        body = html.find(XHTML('body'))
+        if 'style' in html.attrib:
+            b = body.attrib.get('style', '')
+            body.set('style', html.get('style') + ';' + b)
+            del html.attrib['style']
+        bs = body.get('style', '').split(';')
+        bs.append('margin-top: 0pt')
+        bs.append('margin-bottom: 0pt')
+        if float(self.context.margin_left) >= 0:
+            bs.append(f'margin-left : {float(self.context.margin_left):g}pt')
+        if float(self.context.margin_right) >= 0:
+            bs.append(f'margin-right : {float(self.context.margin_right):g}pt')
+        bs.extend(['padding-left: 0pt', 'padding-right: 0pt'])
+        if self.page_break_on_body:
+            bs.extend(['page-break-before: always'])
+        if self.context.change_justification != 'original':
+            bs.append('text-align: '+ self.context.change_justification)
+        if self.body_font_family:
+            bs.append('font-family: '+self.body_font_family)
+        body.set('style', '; '.join(bs))
+
+    def stylizer_for(self, item):
+        return Stylizer(item.data, item.href, self.oeb, self.context, self.context.source,
+                user_css=self.context.extra_css, extra_css='')
 
     def baseline_node(self, node, stylizer, sizes, csize):
         csize = stylizer.style(node)['font-size']
@@ -320,14 +324,19 @@ def baseline_node(self, node, stylizer, sizes, csize):
             if child.tail:
                 sizes[csize] += len(COLLAPSE.sub(' ', child.tail))
 
-    def baseline_spine(self):
+    def baseline_item(self, item, stylizer, sizes):
+        self.baseline_node(item.data.find(XHTML('body')), stylizer, sizes, self.context.source.fbase)
+
+    def baseline_spine(self, item_sizes=None):
         sizes = defaultdict(float)
-        for item in self.items:
-            html = item.data
-            stylizer = self.stylizers[item]
-            body = html.find(XHTML('body'))
-            fsize = self.context.source.fbase
-            self.baseline_node(body, stylizer, sizes, fsize)
+        if item_sizes is None:
+            for item in self.items:
+                self.baseline_item(item, self.stylizers[item], sizes)
+        else:
+            # The sizes are counts of characters, so summing them per item first is exact
+            for isizes in item_sizes:
+                for size, count in isizes.items():
+                    sizes[size] += count
         try:
             sbase = max(list(sizes.items()), key=operator.itemgetter(1))[0]
         except Exception:
@@ -532,8 +541,7 @@ def force_int(raw):
 
         pseudo_classes = style.pseudo_classes(self.filter_css)
         if cssdict or pseudo_classes:
-            keep_classes = set()
-
+            klass = css = None
             if cssdict:
                 items = sorted(iteritems(cssdict))
                 css = ';\n'.join(f'{key}: {val}' for key, val in items)
@@ -543,34 +551,15 @@ def force_int(raw):
                 # name with different case, both cases will apply, leading
                 # to incorrect results.
                 klass = ascii_text(STRIPNUM.sub('', classes_list[0])).lower().strip().replace(' ', '_')
-                if css in styles:
-                    match = styles[css]
-                else:
-                    match = klass + str(names[klass] or '')
-                    styles[css] = match
-                    names[klass] += 1
-                node.attrib['class'] = match
-                keep_classes.add(match)
-
-            for psel, cssdict in iteritems(pseudo_classes):
-                items = sorted(iteritems(cssdict))
-                css = ';\n'.join(f'{key}: {val}' for key, val in items)
-                pstyles = pseudo_styles[psel]
-                if css in pstyles:
-                    match = pstyles[css]
-                else:
-                    # We have to use a different class for each psel as
-                    # otherwise you can have incorrect styles for a situation
-                    # like: a:hover { color: red } a:link { color: blue } a.x:hover { color: green }
-                    # If the pcalibre class for a:hover and a:link is the same,
-                    # then the class attribute for a.x tags will contain both
-                    # that class and the class for a.x:hover, which is wrong.
-                    klass = 'pcalibre'
-                    match = klass + str(names[klass] or '')
-                    pstyles[css] = match
-                    names[klass] += 1
-                keep_classes.add(match)
-                node.attrib['class'] = ' '.join(keep_classes)
+            pseudo_css = [(psel, ';\n'.join(f'{key}: {val}' for key, val in sorted(iteritems(pcssdict))))
+                          for psel, pcssdict in iteritems(pseudo_classes)]
+            if names is None:
+                # Flattening in a worker process, the classes are named when
+                # the results are merged, in the same order as here
+                node.attrib['class'] = self.deferred_class_prefix + str(len(self.deferred_classes))
+                self.deferred_classes.append((klass, css, pseudo_css))
+            else:
+                self.set_classes(node, klass, css, pseudo_css, names, styles, pseudo_styles)
 
         elif 'class' in node.attrib:
             del node.attrib['class']
@@ -580,6 +569,36 @@ def force_int(raw):
             for child in node:
                 self.flatten_node(child, stylizer, names, styles, pseudo_styles, psize, item_id)
 
+    def set_classes(self, node, klass, css, pseudo_css, names, styles, pseudo_styles):
+        keep_classes = set()
+        if css is not None:
+            if css in styles:
+                match = styles[css]
+            else:
+                match = klass + str(names[klass] or '')
+                styles[css] = match
+                names[klass] += 1
+            node.attrib['class'] = match
+            keep_classes.add(match)
+
+        for psel, css in pseudo_css:
+            pstyles = pseudo_styles[psel]
+            if css in pstyles:
+                match = pstyles[css]
+            else:
+                # We have to use a different class for each psel as
+                # otherwise you can have incorrect styles for a situation
+                # like: a:hover { color: red } a:link { color: blue } a.x:hover { color: green }
+                # If the pcalibre class for a:hover and a:link is the same,
+                # then the class attribute for a.x tags will contain both
+                # that class and the class for a.x:hover, which is wrong.
+                klass = 'pcalibre'
+                match = klass + str(names[klass] or '')
+                pstyles[css] = match
+                names[klass] += 1
+            keep_classes.add(match)
+            node.attrib['class'] = ' '.join(keep_classes)
+
     def flatten_head(self, item, href, global_href):
         html = item.data
         head = html.find(XHTML('head'))
@@ -623,7 +642,8 @@ def replace_css(self, css):
         self.oeb.manifest.main_stylesheet = item
         return href
 
-    def collect_global_css(self):
+    def item_page_styles(self, stylizer):
+        ' Return the @page and @font-face CSS and the page margins of a flattened item '
         def rules_in(sheets):
             for s in sheets:
                 yield from s.cssRules
@@ -643,20 +663,30 @@ def unique_font_face_rules(*rules):
                         seen.add(key)
                         yield rule
 
+        if float(self.context.margin_top) >= 0:
+            stylizer.page_rule['margin-top'] = f'{float(self.context.margin_top):g}pt'
+        if float(self.context.margin_bottom) >= 0:
+            stylizer.page_rule['margin-bottom'] = f'{float(self.context.margin_bottom):g}pt'
+        items = sorted(stylizer.page_rule.items())
+        css = ';\n'.join(f'{key}: {val}' for key, val in items)
+        css = (f'@page {{\n{css}\n}}\n') if items else ''
+        rules = [css_text(r) for r in unique_font_face_rules(*stylizer.font_face_rules, *rules_in(self.embed_font_rules))]
+        raw = '\n\n'.join(rules)
+        css += '\n\n' + raw
+
+        margins = {}
+        for prop, val in stylizer.page_rule.items():
+            p, w = prop.partition('-')[::2]
+            if p == 'margin':
+                margins[w] = unit_convert(
+                        val, stylizer.profile.width_pts, stylizer.body_font_size,
+                        stylizer.profile.dpi, body_font_size=stylizer.body_font_size)
+        return css, margins
+
+    def collect_global_css(self):
         global_css = defaultdict(list)
         for item in self.items:
-            stylizer = self.stylizers[item]
-            if float(self.context.margin_top) >= 0:
-                stylizer.page_rule['margin-top'] = f'{float(self.context.margin_top):g}pt'
-            if float(self.context.margin_bottom) >= 0:
-                stylizer.page_rule['margin-bottom'] = f'{float(self.context.margin_bottom):g}pt'
-            items = sorted(stylizer.page_rule.items())
-            css = ';\n'.join(f'{key}: {val}' for key, val in items)
-            css = (f'@page {{\n{css}\n}}\n') if items else ''
-            rules = [css_text(r) for r in unique_font_face_rules(*stylizer.font_face_rules, *rules_in(self.embed_font_rules))]
-            raw = '\n\n'.join(rules)
-            css += '\n\n' + raw
-            global_css[css].append(item)
+            global_css[self.page_styles[item][0]].append(item)
 
         gc_map = {}
         manifest = self.oeb.manifest
@@ -677,17 +707,68 @@ def unique_font_face_rules(*rules):
                 ans[item] = gc_map[css]
         return ans
 
+    def flatten_item(self, item, stylizer, names, styles, pseudo_styles):
+        html = item.data
+        if self.specializer is not None:
+            self.specializer(item, stylizer)
+        fsize = self.context.dest.fbase
+        self.flatten_node(html, stylizer, names, styles, pseudo_styles, fsize, item.id, recurse=False)
+        self.flatten_node(html.find(XHTML('body')), stylizer, names, styles, pseudo_styles, fsize, item.id)
+        self.page_styles[item] = self.item_page_styles(stylizer)
+
     def flatten_spine(self):
         names = defaultdict(int)
         styles, pseudo_styles = {}, defaultdict(dict)
         for item in self.items:
-            html = item.data
-            stylizer = self.stylizers[item]
-            if self.specializer is not None:
-                self.specializer(item, stylizer)
-            fsize = self.context.dest.fbase
-            self.flatten_node(html, stylizer, names, styles, pseudo_styles, fsize, item.id, recurse=False)
-            self.flatten_node(html.find(XHTML('body')), stylizer, names, styles, pseudo_styles, fsize, item.id)
+            self.flatten_item(item, self.stylizers[item], names, styles, pseudo_styles)
+        self.write_css(styles, pseudo_styles)
+
+    def item_font_sizes(self, item):
+        # Runs in a worker process
+        sizes = defaultdict(float)
+        self.baseline_item(item, self.stylizer_for(item), sizes)
+        return dict(sizes)
+
+    def flatten_item_in_worker(self, item):
+        # Runs in a worker process. The Stylizer caches computed font sizes,
+        # so compute them as baseline_spine() does in the conversion process,
+        # before flattening changes the body font size.
+        stylizer = self.stylizer_for(item)
+        if self.fbase:
+            self.baseline_item(item, stylizer, defaultdict(float))
+        self.deferred_classes = []
+        self.flatten_item(item, stylizer, None, None, None)
+        return serialize_html(item.data), self.deferred_classes, self.page_styles[item]
+
+    def flatten_spine_in_workers(self):
+        ''' Produces exactly the same output as stylize_spine() followed by
+        flatten_spine(), with the Stylizer for each item created and the item
+        flattened in a worker process. Class names depend on all items, so the
+        workers record the styles of each tag and the classes are named here. '''
+        self.stylizers = {}
+        for item in self.items:
+            self.prepare_body(item)
+        self.sbase = None
+        if self.fbase:
+            self.sbase = self.baseline_spine(map_items(self.item_font_sizes, self.items, self.max_workers))
+        self.fmap = FontMapper(self.sbase, self.fbase, self.fkey)
+        self.deferred_class_prefix = f'calibre-deferred-{uuid4().hex}-'
+        names = defaultdict(int)
+        styles, pseudo_styles = {}, defaultdict(dict)
+        results = map_items(self.flatten_item_in_worker, self.items, self.max_workers)
+        for item, (raw, deferred_classes, page_styles) in zip(self.items, results):
+            item.data = html = parse_html(raw, item.data.getroottree().docinfo.URL)
+            nodes = {}
+            for node in html.iter('*'):
+                q = node.get('class')
+                if q and q.startswith(self.deferred_class_prefix):
+                    nodes[int(q[len(self.deferred_class_prefix):])] = node
+            for i, (klass, css, pseudo_css) in enumerate(deferred_classes):
+                self.set_classes(nodes[i], klass, css, pseudo_css, names, styles, pseudo_styles)
+            self.page_styles[item] = page_styles
+        self.write_css(styles, pseudo_styles)
+
+    def write_css(self, styles, pseudo_styles):
         items = sorted(((key, val) for (val, key) in iteritems(styles)), key=lambda x: numeric_sort_key(x[0]))
         # :hover must come after link and :active must come after :hover
         psels = sorted(pseudo_styles, key=lambda x:
@@ -704,5 +785,4 @@ def flatten_spine(self):
         href = self.replace_css(css)
         global_css = self.collect_global_css()
         for item in self.items:
-            stylizer = self.stylizers[item]
             self.flatten_head(item, href, global_css[item])
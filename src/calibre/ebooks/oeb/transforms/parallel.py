@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+Run the per item work of a transform in forked worker processes. The workers
+inherit a copy of the book and of the transform from the conversion process,
+so nothing has to be sent to them. Only the results are sent back, HTML trees
+modified by a worker must be serialized with :func:`serialize_html` and
+restored with :func:`parse_html`.
+'''
+
+from lxml import etree
+
+from calibre import detect_ncpus
+from calibre.constants import ismacos
+from calibre.utils.forked_map import forked_map, forked_map_is_supported
+from calibre.utils.xml_parse import create_parser
+
+# Books with fewer items than this are processed in the conversion process
+MIN_ITEMS_PER_WORKER = 4
+
+
+def number_of_workers(items, max_workers=1):
+    ''' The number of worker processes to use for items. max_workers of zero
+    means one per CPU. The conversion process on macOS uses libraries that
+    are not fork safe, so it never forks. '''
+    if not forked_map_is_supported or ismacos:
+        return 1
+    num = detect_ncpus() if max_workers < 1 else max_workers
+    return max(1, min(num, len(items) // MIN_ITEMS_PER_WORKER))
+
+
+def map_items(func, items, max_workers=1):
+    ''' Return the list of func(item) for items, in order, calling func in
+    worker processes if max_workers allows it. func must not change anything
+    other than the item, as changes made in a worker are lost, and must
+    return picklable results. '''
+    num_workers = number_of_workers(items, max_workers)
+    if num_workers < 2:
+        return list(map(func, items))
+    return list(forked_map(func, items, num_workers=num_workers))
+
+
+def serialize_html(root):
+    return etree.tostring(root.getroottree(), encoding='utf-8')
+
+
+def parse_html(raw, base_url=None):
+    ' Restore the tree serialized by :func:`serialize_html` returning its root element '
+    return etree.fromstring(raw, parser=create_parser(False), base_url=base_url)
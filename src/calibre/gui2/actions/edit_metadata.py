@@ -216,14 +216,8 @@ def do_paste(self, ignore_excluded_fields=False):
             mi.set_null(field)
         db = self.gui.current_db
         book_ids = {db.id(r.row()) for r in rows}
-        title_excluded = 'title' in exclude
-        authors_excluded = 'authors' in exclude
-        for book_id in book_ids:
-            if title_excluded:
-                mi.title = db.new_api.field_for('title', book_id)
-            if authors_excluded:
-                mi.authors = db.new_api.field_for('authors', book_id)
-            db.new_api.set_metadata(book_id, mi, ignore_errors=True)
+        db.new_api.set_metadata_for_books(
+            dict.fromkeys(book_ids, mi), ignore_errors=True, set_title='title' not in exclude, set_authors='authors' not in exclude)
         if cover:
             db.new_api.set_cover({book_id: cover for book_id in book_ids})
         self.refresh_books_after_metadata_edit(book_ids)
@@ -178,7 +178,7 @@ def reindex(self):
             return
         from calibre.gui2.widgets import BusyCursor
         with BusyCursor():
-            self.db.reindex_fts()
+            self.db.reindex_fts(bulk=True)
 
     @property
     def indexing_enabled(self):
@@ -9,17 +9,20 @@
 import time
 from functools import partial
 from hashlib import sha256
-from threading import Lock, RLock
+from queue import Queue
+from threading import Lock, RLock, Thread
 
 from calibre.constants import cache_dir, iswindows
 from calibre.customize.ui import plugin_for_input_format
 from calibre.ebooks.metadata import authors_to_string
-from calibre.srv.errors import BookNotFound, HTTPNotFound
+from calibre.srv.errors import BookNotFound, HTTPBadRequest, HTTPNotFound
 from calibre.srv.last_read import last_read_cache
 from calibre.srv.metadata import book_as_json
-from calibre.srv.render_book import RENDER_VERSION
+from calibre.srv.render_book import PARTIAL_MANIFEST_NAME, PRIORITY_NAMES_FILE, RENDER_VERSION, read_priority_names
+from calibre.srv.render_cache import MANIFEST_NAME, RenderedBooks
 from calibre.srv.routes import endpoint, json
 from calibre.srv.utils import get_db, get_library_data
+from calibre.utils.config import prefs
 from calibre.utils.filenames import rmtree
 from calibre.utils.localization import _
 from calibre.utils.resources import get_path as P
@@ -29,6 +32,15 @@
 cache_lock = RLock()
 queued_jobs = {}
 failed_jobs = {}
+# The folders in which queued books are being rendered
+rendering_dirs = {}
+partial_manifest_cache = {}
+# Number of spine items rendered before the first partial manifest is available
+PROGRESSIVE_FIRST_ITEMS = 3
+# The index of rendered books, see calibre.srv.render_cache
+rendered_books = None
+# The order in which the browser viewer chooses the format to open
+VIEWER_FORMAT_PRIORITIES = ('EPUB', 'AZW3', 'DOCX', 'LIT', 'MOBI', 'ODT', 'RTF', 'MD', 'MARKDOWN', 'TXT', 'PDF')
 
 
 def abspath(x):
@@ -61,6 +73,21 @@ def book_hash(library_uuid, book_id, fmt, size, mtime):
     return as_unicode(sha256(raw).hexdigest())
 
 
+def rendered_books_cache(ctx):
+    global rendered_books
+    with cache_lock:
+        if rendered_books is None:
+            rendered_books = RenderedBooks(os.path.join(books_cache_dir(), 'f'), max_size=ctx.opts.render_cache_size, log=ctx.log)
+        else:
+            rendered_books.max_size = int(ctx.opts.render_cache_size * 1024**2)
+    return rendered_books
+
+
+def save_rendered_books_index():
+    if rendered_books is not None:
+        rendered_books.save_index()
+
+
 staging_cleaned = False
 
 
@@ -73,9 +100,14 @@ def safe_remove(x, is_file=None):
         pass
 
 
-def queue_job(ctx, copy_format_to, bhash, fmt, book_id, size, mtime):
+def queue_job(ctx, copy_format_to, bhash, fmt, book_id, size, mtime, progressive=False, prerender=False):
     global staging_cleaned
     tdir = os.path.join(books_cache_dir(), 's')
+    if ctx.change_relay is not None:
+        # Every server process has its own staging folder, so that it does not
+        # clean up the books being rendered by the others
+        tdir = os.path.join(tdir, str(ctx.change_relay.index))
+        os.makedirs(tdir, exist_ok=True)
     if not staging_cleaned:
         staging_cleaned = True
         for x in os.listdir(tdir):
@@ -86,29 +118,41 @@ def queue_job(ctx, copy_format_to, bhash, fmt, book_id, size, mtime):
     tdir = tempfile.mkdtemp('', '', tdir)
     job_id = ctx.start_job(f'Render book {book_id} ({fmt})', 'calibre.srv.render_book', 'render', args=(
         pathtoebook, tdir, {'size':size, 'mtime':mtime, 'hash':bhash}),
-        job_done_callback=job_done, job_data=(bhash, pathtoebook, tdir))
+        kwargs={'progressive': PROGRESSIVE_FIRST_ITEMS if progressive else 0},
+        job_done_callback=job_done, job_data=(bhash, pathtoebook, tdir, prerender))
     queued_jobs[bhash] = job_id
+    rendering_dirs[bhash] = tdir
     return job_id
 
 
-last_final_clean_time = 0
+def partial_manifest(tdir):
+    ' The partial manifest of a book being rendered progressively, or None '
+    path = os.path.join(tdir, PARTIAL_MANIFEST_NAME)
+    try:
+        mtime = os.stat(path).st_mtime_ns
+        cached = partial_manifest_cache.get(tdir)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        with open(path, 'rb') as f:
+            ans = jsonlib.load(f)
+    except OSError:
+        return None
+    partial_manifest_cache[tdir] = mtime, ans
+    return ans
 
 
-def clean_final(interval=24 * 60 * 60):
-    global last_final_clean_time
-    now = time.time()
-    if now - last_final_clean_time < interval:
-        return
-    last_final_clean_time = now
-    fdir = os.path.join(books_cache_dir(), 'f')
-    for x in os.listdir(fdir):
-        try:
-            tm = os.path.getmtime(os.path.join(fdir, x, 'calibre-book-manifest.json'))
-        except OSError:
-            continue
-        if now - tm >= interval:
-            # This book has not been accessed for a long time, delete it
-            safe_remove(x)
+def staged_book_file(rd, bhash, tdir, name):
+    ''' Serve a file of a book that is being rendered progressively, if it is
+    ready, otherwise ask for it to be rendered next. '''
+    manifest = partial_manifest(tdir)
+    if manifest is None or name not in manifest['files']:
+        # Only spine items are rendered on request, each is listed once, so
+        # that the list cannot grow without bound
+        if manifest is not None and name in manifest['spine'] and name not in read_priority_names(tdir):
+            with open(os.path.join(tdir, PRIORITY_NAMES_FILE), 'ab') as f:
+                f.write(name.encode('utf-8') + b'\n')
+        return None
+    return rd.filesystem_file_with_custom_etag(open(os.path.join(tdir, name), 'rb'), bhash, name)
 
 
 def rename_with_retry(a, b, sleep_time=1):
@@ -124,37 +168,69 @@ def rename_with_retry(a, b, sleep_time=1):
 
 def job_done(job):
     with cache_lock:
-        bhash, pathtoebook, tdir = job.data
+        bhash, pathtoebook, tdir, prerender = job.data
         queued_jobs.pop(bhash, None)
+        rendering_dirs.pop(bhash, None)
+        partial_manifest_cache.pop(tdir, None)
         safe_remove(pathtoebook)
         if job.failed:
             failed_jobs[bhash] = (job.was_aborted, job.traceback)
             safe_remove(tdir, False)
         else:
             try:
-                clean_final()
                 dest = os.path.join(books_cache_dir(), 'f', bhash)
-                safe_remove(dest, False)
-                rename_with_retry(tdir, dest)
+                if os.path.exists(os.path.join(dest, MANIFEST_NAME)):
+                    # Rendered by another server process meanwhile, and possibly being read
+                    safe_remove(tdir, False)
+                else:
+                    safe_remove(dest, False)
+                    rename_with_retry(tdir, dest)
             except Exception:
                 import traceback
                 failed_jobs[bhash] = (False, traceback.format_exc())
+            else:
+                if rendered_books is not None:
+                    rendered_books.added(bhash, prerendered=prerender)
+                    rendered_books.prune(keep=(bhash,))
+                    rendered_books.save_index()
+
+
+def format_hash(db, book_id, fmt, fm):
+    ' Return the size, mtime and hash of the rendered book for the format with format metadata fm '
+    size, mtime = map(int, (fm['size'], time.mktime(fm['mtime'].utctimetuple())*10))
+    return size, mtime, book_hash(db.library_id, book_id, fmt, size, mtime)
+
+
+def add_user_data(ans, db, rd, book_id, fmt):
+    ans['metadata'] = book_as_json(db, book_id)
+    user = rd.username or None
+    ans['last_read_positions'] = db.get_last_read_positions(book_id, fmt, user) if user else []
+    ans['annotations_map'] = db.annotations_map_for_book(book_id, fmt, user_type='web', user=user or '*')
+    return ans
 
 
 @endpoint('/book-manifest/{book_id}/{fmt}', postprocess=json, types={'book_id':int})
 def book_manifest(ctx, rd, book_id, fmt):
+    '''
+    Get the manifest of the rendered book, or the status of the job rendering
+    it. With progressive=1 the book is rendered in spine order and, while the
+    job is running, a manifest with is_partial set and only the files that are
+    ready is returned, once the first few spine items are ready. Requesting a
+    file that is not ready with /book-file causes it to be rendered next.
+    '''
     db, library_id = get_library_data(ctx, rd)[:2]
     force_reload = rd.query.get('force_reload') == '1'
+    progressive = rd.query.get('progressive') == '1'
     if plugin_for_input_format(fmt) is None:
         raise HTTPNotFound(f'The format {fmt.upper()} cannot be viewed')
     if not ctx.has_id(rd, db, book_id):
         raise BookNotFound(book_id, db)
+    cache = rendered_books_cache(ctx)
     with db.safe_read_lock:
         fm = db.format_metadata(book_id, fmt, allow_cache=False)
         if not fm:
             raise HTTPNotFound(f'No {fmt} format for the book (id:{book_id}) in the library: {library_id}')
-        size, mtime = map(int, (fm['size'], time.mktime(fm['mtime'].utctimetuple())*10))
-        bhash = book_hash(db.library_id, book_id, fmt, size, mtime)
+        size, mtime, bhash = format_hash(db, book_id, fmt, fm)
         with cache_lock:
             mpath = abspath(os.path.join(books_cache_dir(), 'f', bhash, 'calibre-book-manifest.json'))
             if force_reload:
@@ -163,11 +239,8 @@ def book_manifest(ctx, rd, book_id, fmt):
                 os.utime(mpath, None)
                 with open(mpath, 'rb') as f:
                     ans = jsonlib.load(f)
-                ans['metadata'] = book_as_json(db, book_id)
-                user = rd.username or None
-                ans['last_read_positions'] = db.get_last_read_positions(book_id, fmt, user) if user else []
-                ans['annotations_map'] = db.annotations_map_for_book(book_id, fmt, user_type='web', user=user or '*')
-                return ans
+                cache.used(bhash)
+                return add_user_data(ans, db, rd, book_id, fmt)
             except OSError as e:
                 if e.errno != errno.ENOENT:
                     raise
@@ -176,11 +249,105 @@ def book_manifest(ctx, rd, book_id, fmt):
                 return {'aborted':x[0], 'traceback':x[1], 'job_status':'finished'}
             job_id = queued_jobs.get(bhash)
             if job_id is None:
-                job_id = queue_job(ctx, partial(db.copy_format_to, book_id, fmt), bhash, fmt, book_id, size, mtime)
+                cache.missed()
+                job_id = queue_job(ctx, partial(db.copy_format_to, book_id, fmt), bhash, fmt, book_id, size, mtime, progressive=progressive)
+            ans = partial_manifest(rendering_dirs[bhash]) if progressive else None
     status, result, tb, aborted = ctx.job_status(job_id)
+    if ans is not None:
+        ans = add_user_data(dict(ans), db, rd, book_id, fmt)
+        ans.update({'job_status':status, 'job_id':job_id})
+        return ans
     return {'aborted': aborted, 'traceback':tb, 'job_status':status, 'job_id':job_id}
 
 
+class Prerenderer(Thread):
+
+    ''' Render books for the viewer in the background, one at a time, so that
+    the worker processes remain available for books being opened. '''
+
+    daemon = True
+
+    def __init__(self, log):
+        Thread.__init__(self, name='PrerenderBooks')
+        self.log = log
+        self.queue = Queue()
+
+    def run(self):
+        while True:
+            ctx, db, book_id, formats = self.queue.get()
+            try:
+                self.render(ctx, db, book_id, formats)
+            except Exception:
+                self.log.exception(f'Failed to pre-render the book: {book_id}')
+            finally:
+                self.queue.task_done()
+
+    def render(self, ctx, db, book_id, formats):
+        cache = rendered_books_cache(ctx)
+        with db.safe_read_lock:
+            available = {f.upper() for f in (db.formats(book_id) or ())}
+            fmt = next((f for f in formats if f in available), None)
+            if fmt is None:
+                return
+            fm = db.format_metadata(book_id, fmt, allow_cache=False)
+            if not fm:
+                return
+            size, mtime, bhash = format_hash(db, book_id, fmt, fm)
+            with cache_lock:
+                if bhash in cache or bhash in queued_jobs:
+                    return
+                job_id = queue_job(ctx, partial(db.copy_format_to, book_id, fmt), bhash, fmt, book_id, size, mtime, prerender=True)
+        while ctx.job_status(job_id)[0] in ('waiting', 'running'):
+            time.sleep(0.1)
+
+
+prerenderer = None
+
+
+def prerender_formats(requested=None):
+    ' The formats to pre-render, in order of preference, as the browser viewer chooses them '
+    if requested:
+        ans = [f.upper() for f in requested]
+    else:
+        fmt = prefs['output_format'].upper()
+        ans = ['EPUB' if fmt == 'PDF' else fmt] + list(VIEWER_FORMAT_PRIORITIES)
+    return tuple(f for f in dict.fromkeys(ans) if plugin_for_input_format(f) is not None)
+
+
+@endpoint('/book-prerender', postprocess=json, methods=('POST',))
+def book_prerender(ctx, rd):
+    '''
+    Render books for the viewer in the background, so that they open
+    instantly. The request body is a JSON object with the optional keys
+    book_ids, search and vl, selecting books in the library specified by the
+    library_id query parameter, and formats, the formats to render in order of
+    preference. Returns the number of books queued. For example, to pre-render
+    the books added in the last day::
+
+        curl --data '{"search": "date:>1daysago"}' http://localhost:8080/book-prerender
+    '''
+    global prerenderer
+    db = get_library_data(ctx, rd)[0]
+    ctx.check_for_write_access(rd)
+    try:
+        data = jsonlib.load(rd.request_body_file)
+        book_ids = ctx.get_effective_book_ids(db, rd, data.get('vl') or '')
+        if data.get('search'):
+            book_ids = db.search(data['search'], book_ids=book_ids)
+        if data.get('book_ids') is not None:
+            book_ids = set(book_ids) & set(map(int, data['book_ids']))
+        formats = prerender_formats(data.get('formats'))
+    except Exception as err:
+        raise HTTPBadRequest(f'Invalid request: {err}')
+    with cache_lock:
+        if prerenderer is None:
+            prerenderer = Prerenderer(ctx.log)
+            prerenderer.start()
+    for book_id in sorted(book_ids):
+        prerenderer.queue.put((ctx, db, book_id, formats))
+    return len(book_ids)
+
+
 @endpoint('/book-file/{book_id}/{fmt}/{size}/{mtime}/{+name}', types={'book_id':int, 'size':int, 'mtime':int})
 def book_file(ctx, rd, book_id, fmt, size, mtime, name):
     db, library_id = get_library_data(ctx, rd)[:2]
@@ -192,11 +359,24 @@ def book_file(ctx, rd, book_id, fmt, size, mtime, name):
     if not mpath.startswith(base):
         raise HTTPNotFound(f'No book file with hash: {bhash} and name: {name}')
     try:
-        return rd.filesystem_file_with_custom_etag(open(mpath, 'rb'), bhash, name)
+        ans = rd.filesystem_file_with_custom_etag(open(mpath, 'rb'), bhash, name)
     except OSError as e:
         if e.errno != errno.ENOENT:
             raise
-        raise HTTPNotFound(f'No book file with hash: {bhash} and name: {name}')
+    else:
+        # Keep the book while it is being read
+        rendered_books_cache(ctx).reading(bhash)
+        return ans
+    with cache_lock:
+        tdir = rendering_dirs.get(bhash)
+        if tdir is not None and abspath(os.path.join(tdir, name)).startswith(os.path.join(abspath(tdir), '')):
+            try:
+                ans = staged_book_file(rd, bhash, tdir, name)
+            except FileNotFoundError:
+                ans = None  # rendering finished and the folder was moved
+            if ans is not None:
+                return ans
+    raise HTTPNotFound(f'No book file with hash: {bhash} and name: {name}')
 
 
 @endpoint('/book-get-last-read-position/{library_id}/{+which}', postprocess=json)
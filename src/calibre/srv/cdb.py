@@ -5,6 +5,7 @@
 import os
 import shutil
 import time
+from contextlib import nullcontext
 from functools import partial
 from io import BytesIO
 
@@ -56,7 +57,8 @@ def cdb_run(ctx, rd, which, version):
     if getattr(m, 'needs_srv_ctx', False):
         args = [ctx] + list(args)
     try:
-        result = m.implementation(db, partial(ctx.notify_changes, db.backend.library_path), *args)
+        with nullcontext() if getattr(m, 'readonly', False) else ctx.writing(db.backend.library_path):
+            result = m.implementation(db, partial(ctx.notify_changes, db.backend.library_path), *args)
     except Exception as err:
         tb = ''
         if not getattr(err, 'suppress_traceback', False):
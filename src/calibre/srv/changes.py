@@ -67,9 +67,21 @@ def __repr__(self):
         return f'{self.__class__.__name__}(added={sorted(map(str, self.added))}, removed={sorted(map(str, self.removed))})'
 
 
+class LibraryChanged(ChangeEvent):
+
+    ''' A change that is not described by a more specific event, for example,
+    to notes or data files '''
+
+    book_ids = frozenset()
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}()'
+
+
 books_added = BooksAdded
 formats_added = FormatsAdded
 formats_removed = FormatsRemoved
 books_deleted = BooksDeleted
 metadata = MetadataChanged
 saved_searches = SavedSearchesChanged
+library_changed = LibraryChanged
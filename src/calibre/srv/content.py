@@ -8,14 +8,18 @@
 import errno
 import os
 import re
+import shutil
+import weakref
 from contextlib import suppress
 from functools import partial
 from io import BytesIO
 from json import load as load_json_file
-from threading import Lock
+from queue import Queue
+from threading import Lock, Thread
+from uuid import uuid4
 
 from calibre import fit_image, guess_type, sanitize_file_name
-from calibre.constants import config_dir, iswindows
+from calibre.constants import config_dir
 from calibre.db.constants import DATA_DIR_NAME, DATA_FILE_PATTERN, RESOURCE_URL_SCHEME
 from calibre.db.errors import NoSuchFormat
 from calibre.ebooks.covers import cprefs, generate_cover, override_prefs, scale_cover, set_use_roman
@@ -23,13 +27,15 @@
 from calibre.ebooks.metadata.meta import set_metadata
 from calibre.ebooks.metadata.opf2 import metadata_to_opf
 from calibre.library.save_to_disk import find_plugboard
+from calibre.srv.books import rendered_books_cache
 from calibre.srv.errors import BookNotFound, HTTPBadRequest, HTTPNotFound
+from calibre.srv.fcache import path_in_cache
 from calibre.srv.metadata import encode_stat_result
 from calibre.srv.routes import endpoint, json
 from calibre.srv.utils import get_db, get_use_roman, http_date
 from calibre.utils.config_base import tweaks
 from calibre.utils.date import timestampfromdt
-from calibre.utils.filenames import ascii_filename, atomic_rename, make_long_path_useable
+from calibre.utils.filenames import ascii_filename, make_long_path_useable
 from calibre.utils.img import image_from_data, scale_image
 from calibre.utils.localization import _
 from calibre.utils.resources import get_image_path as I
@@ -46,8 +52,6 @@
 
 # Get book formats/cover as a cached filesystem file {{{
 
-rename_counter = 0
-
 
 def reset_caches():
     pass
@@ -64,49 +68,72 @@ def open_for_write(fname):
     return share_open(fname, 'w+b')
 
 
-def create_file_copy(ctx, rd, prefix, library_id, book_id, ext, mtime, copy_func, extra_etag_data=''):
-    ''' We cannot copy files directly from the library folder to the output
-    socket, as this can potentially lock the library for an extended period. So
-    instead we copy out the data from the library folder into a temp folder. We
-    make sure to only do this copy once, using the previous copy, if there have
-    been no changes to the data for the file since the last copy. '''
-    global rename_counter
+def file_cache_for(ctx, rd):
+    ' The cache for files copied out of libraries, see calibre.srv.fcache '
+    location = ctx.opts.file_cache_location
+    if location:
+        location = os.path.abspath(os.path.expanduser(location))
+        if ctx.change_relay is not None:
+            # Every server process has its own cache
+            location = os.path.join(location, str(ctx.change_relay.index))
+    else:
+        location = os.path.join(rd.tdir, 'fcache')
+    with lock:
+        ans = ctx.file_cache
+        if ans is None or ans.location != location:
+            from calibre.srv.fcache import FileCache
+            if ans is not None:
+                ans.save_index()
+            ans = ctx.file_cache = FileCache(location, max_size=ctx.opts.file_cache_size, log=ctx.log)
+    return ans
 
-    # Avoid too many items in a single directory for performance
-    base = os.path.join(rd.tdir, 'fcache', ((f'{book_id:x}')[-3:]))
-    if iswindows:
-        base = '\\\\?\\' + os.path.abspath(base)  # Ensure fname is not too long for windows' API
 
+def cache_file_name(prefix, library_id, book_id, ext):
     bname = f'{prefix}-{library_id}-{book_id:x}.{ext}'
     if '\\' in bname or '/' in bname:
         raise ValueError('File components must not contain path separators')
-    fname = os.path.join(base, bname)
-    used_cache = 'no'
+    return bname
+
+
+def cached_file_copy(file_cache, prefix, library_id, book_id, ext, mt, copy_func):
+    ''' Return (open file, whether the cached copy was used, path of the file)
+    for the copy of the data in file_cache, creating it with copy_func if it
+    does not exist or is older than mt. Only one thread creates a particular
+    file, other threads needing it wait and then use the created file. '''
+    name, fname = file_cache.path_for(book_id, cache_file_name(prefix, library_id, book_id, ext))
 
     def safe_mtime():
         with suppress(OSError):
             return os.path.getmtime(fname)
 
-    mt = mtime if isinstance(mtime, (int, float)) else timestampfromdt(mtime)
-    with lock:
+    def create():
+        # Write to a temporary file and rename it, so that interrupted or
+        # failed copies are never used
+        tname = os.path.join(os.path.dirname(fname), f'_{uuid4().hex}')
+        ans = open_for_write(tname)
+        try:
+            copy_func(ans)
+            size = ans.tell()
+            os.replace(tname, fname)
+        except BaseException:
+            ans.close()
+            with suppress(OSError):
+                os.remove(tname)
+            raise
+        file_cache.added(name, size)
+        ans.seek(0)
+        return ans
+
+    used_cache = 'no'
+    with file_cache.file_lock(name):
         previous_mtime = safe_mtime()
         if previous_mtime is None or previous_mtime < mt:
             if previous_mtime is not None:
                 # File exists and may be open, so we cannot change its
                 # contents, as that would lead to corrupted downloads in any
                 # clients that are currently downloading the file.
-                if iswindows:
-                    # On windows in order to re-use bname, we have to rename it
-                    # before deleting it
-                    rename_counter += 1
-                    dname = os.path.join(base, f'_{rename_counter:x}')
-                    atomic_rename(fname, dname)
-                    os.remove(dname)
-                else:
-                    os.remove(fname)
-            ans = open_for_write(fname)
-            copy_func(ans)
-            ans.seek(0)
+                file_cache.remove(name, fname)
+            ans = create()
         else:
             try:
                 ans = share_open(fname, 'rb')
@@ -114,13 +141,25 @@ def safe_mtime():
             except OSError as err:
                 if err.errno != errno.ENOENT:
                     raise
-                ans = open_for_write(fname)
-                copy_func(ans)
-                ans.seek(0)
-        if ctx.testing:
-            rd.outheaders['Used-Cache'] = used_cache
-            rd.outheaders['Tempfile'] = as_hex_unicode(fname)
-        return rd.filesystem_file_with_custom_etag(ans, prefix, library_id, book_id, mt, extra_etag_data)
+                ans = create()
+            else:
+                file_cache.used(name, os.fstat(ans.fileno()).st_size)
+    file_cache.prune()
+    return ans, used_cache, fname
+
+
+def create_file_copy(ctx, rd, prefix, library_id, book_id, ext, mtime, copy_func, extra_etag_data=''):
+    ''' We cannot copy files directly from the library folder to the output
+    socket, as this can potentially lock the library for an extended period. So
+    instead we copy out the data from the library folder into a cache folder. We
+    make sure to only do this copy once, using the previous copy, if there have
+    been no changes to the data for the file since the last copy. '''
+    mt = mtime if isinstance(mtime, (int, float)) else timestampfromdt(mtime)
+    ans, used_cache, fname = cached_file_copy(file_cache_for(ctx, rd), prefix, library_id, book_id, ext, mt, copy_func)
+    if ctx.testing:
+        rd.outheaders['Used-Cache'] = used_cache
+        rd.outheaders['Tempfile'] = as_hex_unicode(fname)
+    return rd.filesystem_file_with_custom_etag(ans, prefix, library_id, book_id, mt, extra_etag_data)
 
 
 def write_generated_cover(db, book_id, width, height, destf):
@@ -155,16 +194,160 @@ def copy_func(dest):
             db.copy_cover_to(book_id, dest)
     else:
         prefix += f'-{width}x{height}'
-
-        def copy_func(dest):
-            buf = BytesIO()
-            db.copy_cover_to(book_id, buf)
-            quality = min(99, max(50, tweaks['content_server_thumbnail_compression_quality']))
-            data = scale_image(buf.getvalue(), width=width, height=height, compression_quality=quality)[-1]
-            dest.write(data)
+        copy_func = partial(write_thumbnail, db, book_id, width, height)
+        location = pregenerated_thumbnails_location(ctx)
+        if location:
+            path = path_in_cache(location, book_id, cache_file_name(prefix, library_id, book_id, 'jpg'))[1]
+            copy_func = partial(copy_pregenerated_thumbnail, path, timestampfromdt(mtime), copy_func)
     return create_file_copy(ctx, rd, prefix, library_id, book_id, 'jpg', mtime, copy_func)
 
 
+def write_thumbnail(db, book_id, width, height, dest):
+    buf = BytesIO()
+    db.copy_cover_to(book_id, buf)
+    quality = min(99, max(50, tweaks['content_server_thumbnail_compression_quality']))
+    data = scale_image(buf.getvalue(), width=width, height=height, compression_quality=quality)[-1]
+    dest.write(data)
+
+
+def copy_pregenerated_thumbnail(path, mt, fallback, dest):
+    ' Copy the thumbnail generated by another server process, if it is up to date '
+    try:
+        f = share_open(path, 'rb')
+    except OSError:
+        return fallback(dest)
+    with f:
+        if os.fstat(f.fileno()).st_mtime >= mt:
+            shutil.copyfileobj(f, dest)
+        else:
+            fallback(dest)
+
+
+def parse_thumbnail_sizes(raw):
+    ans = []
+    for x in (raw or '').split(','):
+        try:
+            w, h = map(int, x.strip().partition('x')[::2])
+        except Exception:
+            continue
+        if w > 0 and h > 0:
+            ans.append((w, h))
+    return tuple(ans)
+
+
+# Only one server process generates thumbnails in advance, the others copy
+# them from its cache
+THUMBNAIL_GENERATOR_PROCESS = 0
+STOP_GENERATING = object()
+
+
+class ThumbnailGenerator(Thread):
+
+    ''' Fill the cache with thumbnails of the specified sizes for all books in
+    a library that have covers, and again for books whose covers are changed.
+    Registered as a cover cache with the library so that it is notified of
+    changed covers and of the library being closed. Only a weak reference to
+    the library is kept, so that this thread does not keep it alive. '''
+
+    def __init__(self, file_cache, db, sizes, log=None):
+        Thread.__init__(self, name='ThumbnailGenerator', daemon=True)
+        self.file_cache, self.dbref, self.sizes, self.log = file_cache, weakref.ref(db), sizes, log
+        self.library_id = db.server_library_id
+        self.queue = Queue()
+        self.queue.put(None)
+
+    @property
+    def db(self):
+        return self.dbref()
+
+    def invalidate(self, book_ids):
+        # Called by set_cover() with the write lock held, the thumbnails
+        # are generated after the new cover has been saved
+        self.queue.put(tuple(book_ids))
+
+    def library_closed(self):
+        self.queue.put(STOP_GENERATING)
+
+    def run(self):
+        try:
+            while True:
+                book_ids = self.queue.get()
+                try:
+                    if book_ids is STOP_GENERATING or not self.generate_for(book_ids):
+                        break
+                finally:
+                    self.queue.task_done()
+        finally:
+            key = self.file_cache.location, self.library_id
+            with lock:
+                if thumbnail_generators.get(key) is self:
+                    del thumbnail_generators[key]
+
+    def open_db(self):
+        db = self.db
+        return None if db is None or db.is_closed else db
+
+    def generate_for(self, book_ids):
+        ' Return False if the library has been closed '
+        if book_ids is None:
+            db = self.open_db()
+            if db is None:
+                return False
+            book_ids = db.all_book_ids()
+        for book_id in book_ids:
+            for width, height in self.sizes:
+                db = self.open_db()
+                if db is None:
+                    return False
+                try:
+                    self.generate(db, book_id, width, height)
+                except Exception:
+                    if self.log is not None:
+                        self.log.exception(f'Failed to generate thumbnail of size {width}x{height} for book: {book_id}')
+        return True
+
+    def generate(self, db, book_id, width, height):
+        mtime = db.cover_last_modified(book_id)
+        if mtime is None:
+            return
+        f = cached_file_copy(
+            self.file_cache, f'cover-{width}x{height}', self.library_id, book_id, 'jpg', timestampfromdt(mtime),
+            partial(write_thumbnail, db, book_id, width, height))[0]
+        f.close()
+
+
+thumbnail_generators = {}
+
+
+def generates_thumbnails(ctx):
+    return ctx.change_relay is None or ctx.change_relay.index == THUMBNAIL_GENERATOR_PROCESS
+
+
+def pregenerated_thumbnails_location(ctx):
+    ''' The location of the cache of the server process that generates
+    thumbnails in advance, if that is some other process and the caches are
+    in a known location '''
+    location = ctx.opts.file_cache_location
+    if location and ctx.opts.pregenerate_thumbnails and not generates_thumbnails(ctx):
+        return os.path.join(os.path.abspath(os.path.expanduser(location)), str(THUMBNAIL_GENERATOR_PROCESS))
+
+
+def pregenerate_thumbnails(ctx, rd, db):
+    ' Start generating thumbnails for a library in the background, if enabled. Called when the server first uses the library. '
+    sizes = parse_thumbnail_sizes(ctx.opts.pregenerate_thumbnails)
+    if not sizes or not generates_thumbnails(ctx):
+        return
+    file_cache = file_cache_for(ctx, rd)
+    key = file_cache.location, db.server_library_id
+    with lock:
+        g = thumbnail_generators.get(key)
+        if g is not None and g.db is db and g.file_cache is file_cache:
+            return
+        thumbnail_generators[key] = g = ThumbnailGenerator(file_cache, db, sizes, ctx.log)
+    db.add_cover_cache(g)
+    g.start()
+
+
 def fname_for_content_disposition(fname, as_encoded_unicode=False):
     if as_encoded_unicode:
         # See https://tools.ietf.org/html/rfc6266
@@ -343,6 +526,15 @@ def save_reader_profile(ctx, rd):
     return True
 
 
+@endpoint('/cache-stats', postprocess=json)
+def cache_stats(ctx, rd):
+    ' Statistics for the caches of files, rendered books, searches and categories '
+    ans = ctx.cache_statistics()
+    ans['files'] = file_cache_for(ctx, rd).statistics()
+    ans['rendered_books'] = rendered_books_cache(ctx).statistics()
+    return ans
+
+
 @endpoint('/get/{what}/{book_id}/{library_id=None}', android_workaround=True)
 def get(ctx, rd, what, book_id, library_id):
     book_id, rest = book_id.partition('_')[::2]
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+A size bounded, optionally persistent, cache of files copied out of libraries
+by the server (book formats, covers and thumbnails). Least recently used files
+are deleted when the cache is too large. Files are only ever deleted, never
+modified in place, so downloads of a deleted file that are in progress, for
+example via sendfile, continue to work, as they use the already open file.
+'''
+
+import os
+from collections import OrderedDict
+from contextlib import contextmanager, suppress
+from threading import Lock
+
+from calibre.constants import iswindows
+
+INDEX_NAME = 'index'
+
+
+def path_in_cache(root, book_id, bname):
+    ' Return the name of the file in the index of the cache at root and its path '
+    # Avoid too many items in a single directory for performance
+    subdir = (f'{book_id:x}')[-3:]
+    return subdir + '/' + bname, os.path.join(root, subdir, bname)
+
+
+class FileCache:
+
+    def __init__(
+        self,
+        location,  # The folder for the cache, it is created if it does not exist
+        max_size=1024,  # The maximum disk space in MB, zero means unlimited
+        log=None,
+    ):
+        # The location as specified, used to identify the cache
+        self.location = location
+        if iswindows:
+            location = '\\\\?\\' + os.path.abspath(location)  # Ensure file names are not too long for windows' API
+        # The folder used for file system operations
+        self.root = location
+        self.max_size = int(max_size * 1024**2)
+        self.log = log
+        self.lock = Lock()
+        # Path of file in the cache -> [lock for the file, number of threads using the lock]
+        self.file_locks = {}
+        self.rename_counter = 0
+        self.stats = dict.fromkeys(('hits', 'misses', 'bytes_served', 'bytes_written', 'evictions'), 0)
+        self._load_index()
+
+    def _log_error(self, *args):
+        if self.log is not None:
+            self.log.error(*args)
+
+    def _load_index(self):
+        ''' Load the index, adding files that are missing from it, such as
+        files created after the index was last saved, as the most recently
+        used files. '''
+        order = {}
+        with suppress(FileNotFoundError), open(os.path.join(self.root, INDEX_NAME), 'rb') as f:
+            for line in f.read().decode('utf-8').splitlines():
+                order[line] = len(order)
+        items = []
+        with suppress(FileNotFoundError):
+            for subdir in os.scandir(self.root):
+                if not subdir.is_dir():
+                    continue
+                for entry in os.scandir(subdir.path):
+                    name = subdir.name + '/' + entry.name
+                    if entry.name.startswith('_'):
+                        # A replaced file that could not be deleted earlier
+                        with suppress(OSError):
+                            os.remove(entry.path)
+                    elif entry.is_file():
+                        items.append((name, entry.stat().st_size))
+        items.sort(key=lambda x: order.get(x[0], len(order)))
+        self.items = OrderedDict(items)
+        self.total_size = sum(self.items.values())
+
+    def save_index(self):
+        with self.lock:
+            data = '\n'.join(self.items).encode('utf-8')
+        try:
+            with open(os.path.join(self.root, INDEX_NAME), 'wb') as f:
+                f.write(data)
+        except FileNotFoundError:
+            pass  # The cache folder was deleted, for example, a temporary folder at shutdown
+        except OSError as err:
+            self._log_error('Failed to save the file cache index:', err)
+
+    def path_for(self, book_id, bname):
+        ' Return the name of the file in the index and its path '
+        return path_in_cache(self.root, book_id, bname)
+
+    @contextmanager
+    def file_lock(self, name):
+        ' Serialise access to a single file in the cache, other files are not blocked '
+        with self.lock:
+            entry = self.file_locks.get(name)
+            if entry is None:
+                entry = self.file_locks[name] = [Lock(), 0]
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self.lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self.file_locks[name]
+
+    def remove(self, name, path):
+        ' Remove a file, must be called with the lock for the file held '
+        with self.lock:
+            self.total_size -= self.items.pop(name, 0)
+            self.rename_counter += 1
+            counter = self.rename_counter
+        if iswindows:
+            # On windows in order to re-use the file name, we have to rename
+            # the file before deleting it
+            dname = os.path.join(os.path.dirname(path), f'_{counter:x}')
+            try:
+                os.replace(path, dname)
+            except FileNotFoundError:
+                return
+            path = dname
+        with suppress(FileNotFoundError):
+            os.remove(path)
+
+    def used(self, name, size):
+        ' A file was served from the cache '
+        with self.lock:
+            self.stats['hits'] += 1
+            self.stats['bytes_served'] += size
+            if name in self.items:
+                self.items.move_to_end(name)
+            else:
+                self.items[name] = size
+                self.total_size += size
+
+    def added(self, name, size):
+        ' A file was created in the cache '
+        with self.lock:
+            self.stats['misses'] += 1
+            self.stats['bytes_written'] += size
+            self.total_size += size - self.items.pop(name, 0)
+            self.items[name] = size
+
+    def prune(self):
+        ''' Delete least recently used files until the cache is small enough.
+        The most recently used file is always kept. Must not be called with
+        the lock for any file held. '''
+        if not self.max_size:
+            return
+        while True:
+            with self.lock:
+                if self.total_size <= self.max_size or len(self.items) < 2:
+                    return
+                name = next(iter(self.items))
+            subdir, bname = name.split('/')
+            with self.file_lock(name):
+                with self.lock:
+                    if next(iter(self.items), None) != name:
+                        # The file was used by another thread meanwhile
+                        continue
+                    self.stats['evictions'] += 1
+                self.remove(name, os.path.join(self.root, subdir, bname))
+
+    def statistics(self):
+        with self.lock:
+            ans = self.stats.copy()
+            ans['size'], ans['max_size'], ans['count'] = self.total_size, self.max_size, len(self.items)
+        lookups = ans['hits'] + ans['misses']
+        ans['hit_ratio'] = ans['hits'] / lookups if lookups else 0
+        return ans
@@ -3,11 +3,16 @@
 
 
 import json
+from contextlib import contextmanager, nullcontext
 from functools import partial
 from importlib import import_module
-from threading import Lock
+from threading import Event, Lock, local
+from weakref import WeakSet
 
+from calibre.db.bitmap import FrozenBookIdSet
 from calibre.srv.auth import AuthController
+from calibre.srv.books import save_rendered_books_index
+from calibre.srv.changes import library_changed
 from calibre.srv.errors import HTTPForbidden
 from calibre.srv.library_broker import LibraryBroker, path_for_db
 from calibre.srv.routes import Router
@@ -17,11 +22,34 @@
 from polyglot.builtins import itervalues
 
 
+class Flight:
+
+    ''' A computation of a cached value that other threads needing the same
+    value can wait for, instead of repeating it. '''
+
+    def __init__(self):
+        self.done = Event()
+        self.result = self.exception = None
+
+    def finish(self, result=None, exception=None):
+        self.result, self.exception = result, exception
+        self.done.set()
+
+    def wait(self):
+        self.done.wait()
+        if self.exception is not None:
+            raise self.exception
+        return self.result
+
+
 class Context:
 
     log = None
     url_for = None
     jobs_manager = None
+    change_relay = None
+    # The cache of files copied out of libraries, see calibre.srv.fcache
+    file_cache = None
     CATEGORY_CACHE_SIZE = 25
     SEARCH_CACHE_SIZE = 100
 
@@ -29,16 +57,75 @@ def __init__(self, libraries, opts, testing=False, notify_changes=None):
         self.opts = opts
         self.library_broker = libraries if isinstance(libraries, LibraryBroker) else LibraryBroker(libraries)
         self.testing = testing
+        # Protects only the cache bookkeeping, cached values are computed without it
         self.lock = Lock()
+        self.in_flight = {}
+        self.cache_stats = {name: dict.fromkeys(('hits', 'misses', 'waits'), 0) for name in ('categories', 'tag_browser', 'search')}
         self.user_manager = UserManager(opts.userdb)
         self.ignored_fields = frozenset(filter(None, (x.strip() for x in (opts.ignored_fields or '').split(','))))
         self.displayed_fields = frozenset(filter(None, (x.strip() for x in (opts.displayed_fields or '').split(','))))
         self._notify_changes = notify_changes
+        # Libraries that have been used by the server, held weakly so that closed libraries are forgotten
+        self.libraries_in_use = WeakSet()
+        # The libraries used and notified of changes by the writes in progress in each thread
+        self.writes = local()
 
     def notify_changes(self, library_path, change_event):
+        if self.change_relay is not None:
+            self.change_relay.broadcast(library_path, change_event)
+            notified = getattr(self.writes, 'notified', None)
+            if notified is not None:
+                notified.add(library_path)
         if self._notify_changes is not None:
             self._notify_changes(library_path, change_event)
 
+    def use_change_relay(self, change_relay):
+        ' Share changes to libraries with other server processes, see calibre.srv.processes '
+        self.change_relay = change_relay
+        change_relay.start(self.apply_changes)
+
+    def writing(self, library_path=None):
+        ''' Serialises changes to libraries with other server processes, if
+        any. When done, library_path and the libraries used meanwhile, which
+        may have been changed, are sent to the other processes as changed,
+        unless notify_changes() was called for them. '''
+        return nullcontext() if self.change_relay is None else self._writing(library_path)
+
+    @contextmanager
+    def _writing(self, library_path):
+        writes = self.writes
+        outermost = getattr(writes, 'used', None) is None
+        if outermost:
+            writes.used, writes.notified = set(), set()
+        if library_path is not None:
+            writes.used.add(library_path)
+        with self.change_relay.writing():
+            try:
+                yield
+            finally:
+                if outermost:
+                    changed = writes.used - writes.notified
+                    writes.used = writes.notified = None
+                    for path in changed:
+                        self.change_relay.broadcast(path, library_changed())
+
+    def apply_changes(self, library_path, change_events):
+        ''' Called for changes made to a library by other server processes, the
+        library is reloaded once for all of them. Libraries whose custom columns
+        were changed are closed instead, to be opened again when next used, as
+        reloading does not re-read the custom column definitions. '''
+        with self.library_broker:
+            dbs = tuple((library_id, db) for library_id, db in self.library_broker.loaded_dbs.items()
+                        if db is not None and db.backend.library_path == library_path)
+        for library_id, db in dbs:
+            try:
+                if db.custom_columns_changed():
+                    self.library_broker.close_library(library_id)
+                else:
+                    db.reload_from_db()
+            except Exception:
+                self.log.exception(f'Failed to reload library at: {library_path} after changes: {change_events!r}')
+
     def start_job(self, name, module, func, args=(), kwargs=None, job_done_callback=None, job_data=None):
         return self.jobs_manager.start_job(name, module, func, args, kwargs, job_done_callback, job_data)
 
@@ -60,6 +147,16 @@ def finalize_session(self, endpoint, data, output):
         pass
 
     def get_library(self, request_data, library_id=None):
+        db = self._get_library(request_data, library_id)
+        if db is not None:
+            if db not in self.libraries_in_use:
+                self.library_first_used(request_data, db)
+            used = getattr(self.writes, 'used', None)
+            if used is not None:
+                used.add(db.backend.library_path)
+        return db
+
+    def _get_library(self, request_data, library_id=None):
         if not request_data.username:
             return self.library_broker.get(library_id)
         lf = partial(self.user_manager.allowed_library_names, request_data.username)
@@ -71,6 +168,18 @@ def get_library(self, request_data, library_id=None):
             return self.library_broker.get(library_id)
         raise HTTPForbidden(f'The user {request_data.username} is not allowed to access the library {library_id}')
 
+    def library_first_used(self, request_data, db):
+        ' Called the first time a library is used after it has been loaded '
+        with self.lock:
+            if db in self.libraries_in_use:
+                return
+            self.libraries_in_use.add(db)
+        from calibre.srv.content import pregenerate_thumbnails
+        try:
+            pregenerate_thumbnails(self, request_data, db)
+        except Exception:
+            self.log.exception('Failed to start generating thumbnails for the library at:', db.backend.library_path)
+
     def library_info(self, request_data):
         if not request_data.username:
             return self.library_broker.library_map, self.library_broker.default_library
@@ -101,7 +210,7 @@ def newest_book_ids(self, request_data, db, count=5):
 
     def get_allowed_book_ids_from_restriction(self, request_data, db):
         restriction = self.restriction_for(request_data, db)
-        return frozenset(db.search('', restriction=restriction)) if restriction else None
+        return FrozenBookIdSet(db.search('', restriction=restriction)) if restriction else None
 
     def allowed_book_ids(self, request_data, db):
         try:
@@ -128,40 +237,79 @@ def get_effective_book_ids(self, db, request_data, vl, report_parse_errors=False
                 raise
             return frozenset()
 
+    def cached(self, name, caches, db, key, is_valid, compute, limit):
+        ''' Return the value for key from the per-library LRU cache in caches,
+        calling compute() to create it if it is missing or is_valid(stamp)
+        is False. compute() must return (stamp, value). Only one thread
+        computes the value for a key, other threads wait for it, values for
+        other keys and libraries are computed in parallel. '''
+        library_id = db.server_library_id
+        stats, fkey = self.cache_stats[name], (name, library_id, key)
+        with self.lock:
+            old = caches[library_id].get(key)
+        # is_valid() usually reads from the library, which must not block
+        # lookups in other libraries, so it is called without the lock
+        valid = old is not None and is_valid(old[0])
+        with self.lock:
+            cache = caches[library_id]
+            if valid and cache.get(key) is old:
+                cache.move_to_end(key)
+                stats['hits'] += 1
+                return old[1]
+            flight = self.in_flight.get(fkey)
+            computing = flight is None
+            if computing:
+                flight = self.in_flight[fkey] = Flight()
+            stats['misses' if computing else 'waits'] += 1
+        if not computing:
+            return flight.wait()
+        try:
+            stamp, value = compute()
+        except BaseException as e:
+            with self.lock:
+                del self.in_flight[fkey]
+            flight.finish(exception=e)
+            raise
+        with self.lock:
+            del self.in_flight[fkey]
+            cache[key] = stamp, value
+            cache.move_to_end(key)
+            if len(cache) > limit:
+                cache.popitem(last=False)
+        flight.finish(value)
+        return value
+
+    def cache_statistics(self):
+        ' The number of hits, misses and waits for a computation by another thread, for the search and category caches '
+        with self.lock:
+            return {name: stats.copy() for name, stats in self.cache_stats.items()}
+
     def get_categories(self, request_data, db, sort='name', first_letter_sort=True,
                        vl='', report_parse_errors=False):
         restrict_to_ids = self.get_effective_book_ids(db, request_data, vl,
                                           report_parse_errors=report_parse_errors)
-        key = restrict_to_ids, sort, first_letter_sort
-        with self.lock:
-            cache = self.library_broker.category_caches[db.server_library_id]
-            old = cache.pop(key, None)
-            if old is None or old[0] <= db.last_modified():
-                categories = db.get_categories(book_ids=restrict_to_ids, sort=sort, first_letter_sort=first_letter_sort)
-                cache[key] = old = (utcnow(), categories)
-                if len(cache) > self.CATEGORY_CACHE_SIZE:
-                    cache.popitem(last=False)
-            else:
-                cache[key] = old
-            return old[1]
+
+        def compute():
+            # Taken before computing, so changes made while computing invalidate the result
+            stamp = utcnow()
+            return stamp, db.get_categories(book_ids=restrict_to_ids, sort=sort, first_letter_sort=first_letter_sort)
+        return self.cached(
+            'categories', self.library_broker.category_caches, db, (restrict_to_ids, sort, first_letter_sort),
+            lambda stamp: stamp > db.last_modified(), compute, self.CATEGORY_CACHE_SIZE)
 
     def get_tag_browser(self, request_data, db, opts, render, vl=''):
         restrict_to_ids = self.get_effective_book_ids(db, request_data, vl)
-        key = restrict_to_ids, opts
-        with self.lock:
-            cache = self.library_broker.category_caches[db.server_library_id]
-            old = cache.pop(key, None)
-            if old is None or old[0] <= db.last_modified():
-                categories = db.get_categories(book_ids=restrict_to_ids, sort=opts.sort_by, first_letter_sort=opts.collapse_model == 'first letter')
-                data = json.dumps(render(db, categories), ensure_ascii=False)
-                if isinstance(data, str):
-                    data = data.encode('utf-8')
-                cache[key] = old = (utcnow(), data)
-                if len(cache) > self.CATEGORY_CACHE_SIZE:
-                    cache.popitem(last=False)
-            else:
-                cache[key] = old
-            return old[1]
+
+        def compute():
+            stamp = utcnow()
+            categories = db.get_categories(book_ids=restrict_to_ids, sort=opts.sort_by, first_letter_sort=opts.collapse_model == 'first letter')
+            data = json.dumps(render(db, categories), ensure_ascii=False)
+            if isinstance(data, str):
+                data = data.encode('utf-8')
+            return stamp, data
+        return self.cached(
+            'tag_browser', self.library_broker.category_caches, db, (restrict_to_ids, opts),
+            lambda stamp: stamp > db.last_modified(), compute, self.CATEGORY_CACHE_SIZE)
 
     def search(self, request_data, db, query, vl='', report_restriction_errors=False):
         try:
@@ -173,20 +321,16 @@ def search(self, request_data, db, query, vl='', report_restriction_errors=False
                 return frozenset(), e
             return frozenset(), None
         query = query or ''
-        key = query, restrict_to_ids
-        with self.lock:
-            cache = self.library_broker.search_caches[db.server_library_id]
-            old = cache.pop(key, None)
-            if old is None or old[0] < db.clear_search_cache_count:
-                matches = db.search(query, book_ids=restrict_to_ids)
-                cache[key] = old = (db.clear_search_cache_count, matches)
-                if len(cache) > self.SEARCH_CACHE_SIZE:
-                    cache.popitem(last=False)
-            else:
-                cache[key] = old
-            if report_restriction_errors:
-                return old[1], None
-            return old[1]
+
+        def compute():
+            stamp = db.clear_search_cache_count
+            return stamp, db.search(query, book_ids=restrict_to_ids)
+        matches = self.cached(
+            'search', self.library_broker.search_caches, db, (query, restrict_to_ids),
+            lambda stamp: stamp >= db.clear_search_cache_count, compute, self.SEARCH_CACHE_SIZE)
+        if report_restriction_errors:
+            return matches, None
+        return matches
 
 
 SRV_MODULES = ('ajax', 'books', 'cdb', 'code', 'content', 'legacy', 'opds', 'users_api', 'convert', 'fts')
@@ -219,6 +363,9 @@ def set_jobs_manager(self, jobs_manager):
         self.router.ctx.jobs_manager = jobs_manager
 
     def close(self):
+        if self.router.ctx.file_cache is not None:
+            self.router.ctx.file_cache.save_index()
+        save_rendered_books_index()
         self.router.ctx.library_broker.close()
 
     @property
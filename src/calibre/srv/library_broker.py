@@ -143,6 +143,14 @@ def init_library(self, library_path, is_default_library):
         library_path = self.original_path_map.get(library_path, library_path)
         return init_library(library_path, is_default_library)
 
+    def close_library(self, library_id):
+        ' Close a loaded library, it is opened again when it is next needed '
+        with self:
+            db = self.loaded_dbs.pop(library_id, None)
+            for caches in (self.category_caches, self.search_caches, self.tag_browser_caches):
+                caches.pop(library_id, None)
+        getattr(db, 'close', lambda: None)()
+
     def close(self):
         with self:
             for db in itervalues(self.loaded_dbs):
@@ -4,15 +4,19 @@
 __license__ = 'GPL v3'
 __copyright__ = '2015, Kovid Goyal <kovid at kovidgoyal.net>'
 
+import heapq
 import ipaddress
 import os
 import select
+import selectors
 import socket
 import ssl
 import traceback
+from collections import deque
 from contextlib import suppress
 from functools import lru_cache, partial
 from io import BytesIO
+from itertools import count
 
 from calibre import as_unicode
 from calibre.constants import iswindows
@@ -171,6 +175,10 @@ def is_local_address(addr: ipaddress.IPv4Address | ipaddress.IPv6Address | None)
 
 class Connection:  # {{{
 
+    # Called with the connection whenever wait_for is changed, used by event
+    # loops that track the interest of connections incrementally
+    interest_changed = None
+
     def __init__(self, socket, opts, ssl_context, tdir, addr, pool, log, access_log, wakeup):
         self.opts, self.pool, self.log, self.wakeup, self.access_log = opts, pool, log, wakeup, access_log
         try:
@@ -218,6 +226,16 @@ def end_send_optimization(self):
         if self.send_bufsize != self.orig_send_bufsize:
             self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.orig_send_bufsize)
 
+    @property
+    def wait_for(self):
+        return self._wait_for
+
+    @wait_for.setter
+    def wait_for(self, val):
+        self._wait_for = val
+        if self.interest_changed is not None:
+            self.interest_changed(self)
+
     def set_state(self, wait_for, func, *args, **kwargs):
         self.wait_for = wait_for
         if args or kwargs:
@@ -435,6 +453,18 @@ def __init__(
                 set_socket_inherit(self.pre_activated_socket, False)
                 self.bind_address = self.pre_activated_socket.getsockname()
 
+        self.selector = None
+        if self.opts.event_loop == 'selectors':
+            self.selector = selectors.DefaultSelector()
+            # fd -> events that the fd is registered for in the selector
+            self.registered = {}
+            # Connections whose interest has to be updated in the selector,
+            # appended to from any thread
+            self.changed_connections = deque()
+            # A heap of (deadline, seq, fd, conn) with one entry per
+            # connection, for checking for idle connections
+            self.timeouts, self.timeout_seq = [], count()
+
         self.create_control_connection()
         self.pool = ThreadPool(self.log, self.job_completed, count=self.opts.worker_count)
         self.plugin_pool = PluginPool(self, plugins)
@@ -526,6 +556,9 @@ def serve(self):
         from calibre.utils.network import format_addr_for_url
 
         self.connection_map = {}
+        if self.selector is not None:
+            self.selector.register(self.socket.fileno(), selectors.EVENT_READ)
+            self.selector.register(self.control_out.fileno(), selectors.EVENT_READ)
         if not self.socket_was_preactivated:
             self.socket.listen(min(socket.SOMAXCONN, 128))
         self.bound_address = ba = self.socket.getsockname()
@@ -561,6 +594,10 @@ def serve_forever(self):
     def setup_socket(self):
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.opts.server_processes > 1 and hasattr(socket, 'SO_REUSEPORT'):
+            # Every server process binds its own socket to the same port and
+            # the kernel distributes incoming connections between them
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
 
         # If listening on the IPV6 any address ('::' = IN6ADDR_ANY),
         # activate dual-stack.
@@ -582,6 +619,14 @@ def bind(self, family, atype, proto=0):
         self.socket.bind(self.bind_address)
 
     def tick(self):
+        if self.selector is None:
+            self.select_tick()
+        else:
+            self.selectors_tick()
+
+    def select_tick(self):
+        # Scans all connections and calls select() on every tick, simple
+        # but O(n) in the number of connections and limited to FD_SETSIZE
         now = monotonic()
         read_needed, write_needed, readable, remove, close_needed = [], [], [], [], []
         has_ssl = self.ssl_context is not None
@@ -640,15 +685,110 @@ def tick(self):
 
         if not self.ready:
             return
+        self.dispatch_events(self.get_actions(readable, writable))
+
+    def selectors_tick(self):
+        # Only connections whose interest has changed are updated in the
+        # selector and idle connections are found using a heap of deadlines,
+        # so the cost of a tick does not depend on the number of idle
+        # connections.
+        now = monotonic()
+        timeout = self.opts.timeout
+        while self.timeouts and self.timeouts[0][0] <= now:
+            deadline, seq, s, conn = heapq.heappop(self.timeouts)
+            if self.connection_map.get(s) is not conn:
+                continue  # closed
+            if now - conn.last_activity > timeout:
+                if conn.handle_timeout():
+                    conn.last_activity = now
+                else:
+                    self.log(f'Closing connection because of extended inactivity: {conn.state_description}')
+                    self.close(s, conn)
+                    continue
+            heapq.heappush(self.timeouts, (conn.last_activity + timeout, next(self.timeout_seq), s, conn))
 
+        readable = self.update_interest()
+        if readable:
+            poll_timeout = 0
+        else:
+            poll_timeout = min(timeout, max(0, self.timeouts[0][0] - now)) if self.timeouts else timeout
+        try:
+            ready = self.selector.select(poll_timeout)
+        except OSError as e:
+            if getattr(e, 'errno', e.args[0]) in socket_errors_eintr:
+                return
+            raise
+        if not self.ready:
+            return
+        writable = []
+        for key, events in ready:
+            if events & selectors.EVENT_READ:
+                readable[key.fd] = None
+            if events & selectors.EVENT_WRITE:
+                writable.append(key.fd)
+        self.dispatch_events(self.get_actions(readable, writable))
+
+    def update_interest(self):
+        ''' Update the selector registrations of connections whose interest
+        has changed. Returns a dict whose keys are the connections that have
+        buffered data and so are readable without waiting. '''
+        readable = {}
+        has_ssl = self.ssl_context is not None
+        q = self.changed_connections
+        while q:
+            conn = q.popleft()
+            s = conn.socket.fileno()
+            if self.connection_map.get(s) is not conn:
+                continue  # closed
+            wf = conn.wait_for
+            events = 0
+            if wf is READ or wf is RDWR:
+                if wf is RDWR:
+                    events |= selectors.EVENT_WRITE
+                if not conn.read_buffer.has_data and has_ssl:
+                    conn.drain_ssl_buffer()
+                    if not conn.ready:
+                        self.close(s, conn)
+                        continue
+                if conn.read_buffer.has_data:
+                    readable[s] = None
+                else:
+                    events |= selectors.EVENT_READ
+            elif wf is WRITE:
+                events |= selectors.EVENT_WRITE
+            current = self.registered.get(s, 0)
+            if events != current:
+                if not events:
+                    self.selector.unregister(s)
+                    del self.registered[s]
+                elif current:
+                    self.selector.modify(s, events)
+                else:
+                    self.selector.register(s, events)
+                if events:
+                    self.registered[s] = events
+        return readable
+
+    def add_connection(self, s, conn):
+        self.connection_map[s] = conn
+        if self.selector is not None:
+            conn.interest_changed = self.changed_connections.append
+            self.changed_connections.append(conn)
+            heapq.heappush(self.timeouts, (conn.last_activity + self.opts.timeout, next(self.timeout_seq), s, conn))
+
+    def dispatch_events(self, actions):
         ignore = set()
-        for s, conn, event in self.get_actions(readable, writable):
+        for s, conn, event in actions:
             if s in ignore:
                 continue
             try:
                 conn.handle_event(event)
                 if not conn.ready:
                     self.close(s, conn)
+                elif self.selector is not None:
+                    # There may be more buffered data to read even if the
+                    # interest of the connection has not changed
+                    self.changed_connections.append(conn)
             except JobQueueFull:
                 self.log.exception(f'Server busy handling request: {conn.state_description}')
                 if conn.ready:
@@ -704,6 +844,8 @@ def dispatch_job_results(self):
 
     def close(self, s, conn):
         self.connection_map.pop(s, None)
+        if self.selector is not None and self.registered.pop(s, None):
+            self.selector.unregister(s)
         conn.close()
 
     def get_actions(self, readable, writable):
@@ -715,8 +857,9 @@ def get_actions(self, readable, writable):
                 if sock is not None:
                     s = sock.fileno()
                     if s > -1:
-                        self.connection_map[s] = conn = self.handler(
+                        conn = self.handler(
                             sock, self.opts, self.ssl_context, self.tdir, addr, self.pool, self.log, self.access_log, self.wakeup)
+                        self.add_connection(s, conn)
                         if self.ssl_context is not None:
                             yield s, conn, RDWR
             elif s == control:
@@ -767,6 +910,8 @@ def shutdown(self):
                 self.socket = None
         for s, conn in tuple(iteritems(self.connection_map)):
             self.close(s, conn)
+        if self.selector is not None:
+            self.selector.close()
         wait_till = monotonic() + self.opts.shutdown_timeout
         for pool in (self.plugin_pool, self.pool):
             pool.stop(wait_till)
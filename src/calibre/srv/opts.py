@@ -42,6 +42,15 @@ def __new__(cls, *args):
     'timeout', 120.0,
     None,
 
+    _('Method used to wait for activity on network connections'),
+    'event_loop', Choices('select', 'selectors'),
+    _('The default, "select", checks every open connection each time the server waits'
+      ' for activity, which is slow when there are hundreds of connections and is limited'
+      ' to about a thousand connections. "selectors" uses the most efficient mechanism'
+      ' available on the operating system, such as epoll on Linux, which scales to many'
+      ' thousands of idle connections, for example, from OPDS readers and browsers that'
+      ' keep connections alive.'),
+
     _('Time (in seconds) to wait for a response from the server when making queries'),
     'ajax_timeout', 60.0,
     None,
@@ -70,6 +79,15 @@ def __new__(cls, *args):
     'worker_count', 10,
     None,
 
+    _('Number of server processes'),
+    'server_processes', 1,
+    _('Run this many server processes, each with its own worker threads, that share the'
+      ' listening port. This allows the server to use more than one CPU core for processing'
+      ' requests. Changes to libraries are made by one process at a time and the other'
+      ' processes are notified of them. Conversion jobs are tracked per process, so do not'
+      ' use this if you convert books in the browser. Only works on Linux with the'
+      ' standalone calibre-server.'),
+
     _('Maximum number of worker processes'),
     'max_jobs', 0,
     _('Worker processes are launched as needed and used for large jobs such as preparing'
@@ -90,6 +108,35 @@ def __new__(cls, *args):
     'url_prefix', None,
     _('Useful if you wish to run this server behind a reverse proxy. For example use, /calibre as the URL prefix.'),
 
+    _('Folder for cached copies of books and covers'),
+    'file_cache_location', None,
+    _('Books, covers and thumbnails are copied out of libraries into a cache before'
+      ' being sent, so that libraries are not locked during slow downloads. By default,'
+      ' the cache is in a temporary folder that is deleted when the server stops. Set'
+      ' this to a folder to keep the cache between restarts of the server, so that it'
+      ' does not have to be filled again.'),
+
+    _('Maximum size of the cache of books and covers (in MB)'),
+    'file_cache_size', 1024,
+    _('When the cache of copies of books, covers and thumbnails becomes larger than'
+      ' this, the least recently used files are deleted from it. Set to zero for no limit.'),
+
+    _('Maximum size of the cache of books prepared for the viewer (in MB)'),
+    'render_cache_size', 2048,
+    _('Books opened in the viewer in the browser are first prepared for viewing and'
+      ' kept in a cache. When the cache becomes larger than this, books are deleted'
+      ' from it, books that have been opened more than once are kept for longer than'
+      ' books opened only once. Set to zero for no limit.'),
+
+    _('Generate thumbnails of these sizes in advance'),
+    'pregenerate_thumbnails', None,
+    _('Comma separated list of thumbnail sizes, such as 300x400,600x800, that are'
+      ' generated for all books in the background when a library is first browsed'
+      ' and whenever a cover is changed, so that the cover grid is displayed quickly.'
+      ' The sizes are the sz values in the /get/thumb URLs used by the browser, which'
+      ' depend on the screen resolution. By default, thumbnails are generated only'
+      ' when they are requested.'),
+
     _('Number of books to show in a single page'),
     'num_per_page', 50,
     _('The number of books to show in a single page in the browser.'),
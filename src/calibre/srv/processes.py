@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+Run the server in several processes that share the listening port via
+SO_REUSEPORT, so that request processing is not limited to a single CPU core.
+Every process opens the libraries itself. Changes to libraries are serialised
+by a lock shared by all the processes and the process that makes a change
+sends the change event (see :mod:`calibre.srv.changes`) to all the other
+processes, which then reload the library, so that their caches are not stale.
+Libraries used while making changes, for which no specific event was sent,
+are sent as changed, with a generic event. Libraries whose custom columns
+were changed are closed and opened again instead of being reloaded.
+Change events that arrive while earlier ones are being applied are applied
+together, so a burst of changes causes only a couple of reloads.
+Linux only.
+'''
+
+import fcntl
+import multiprocessing
+import os
+import signal
+import sys
+import tempfile
+import traceback
+from contextlib import contextmanager, suppress
+from threading import Condition, RLock, Thread
+
+from calibre.utils.monotonic import monotonic
+
+# A process that dies sooner than this after being started is not restarted,
+# as it most likely failed to bind to the port or open the libraries
+STARTUP_TIME = 5  # seconds
+
+
+class ChangeRelay:
+
+    ''' Shares changes to libraries between server processes. Must be created
+    before the server processes are forked. '''
+
+    SYNC_TIMEOUT = 60  # seconds
+
+    def __init__(self, num_processes):
+        ctx = multiprocessing.get_context('fork')
+        self.queues = tuple(ctx.SimpleQueue() for i in range(num_processes))
+        # The number of changes made so far, only modified with the lock held
+        self.generation = ctx.Value('Q', 0, lock=False)
+        # POSIX record locks are released automatically if the process
+        # holding them dies, unlike multiprocessing locks
+        self.lock_file = tempfile.TemporaryFile(prefix='calibre-server-lock-')
+        self.thread_lock = RLock()
+        self.lock_depth = 0
+        self.index = 0
+        self.applied = 0
+        self.applied_changed = Condition()
+
+    def start(self, apply_change):
+        ''' Start receiving changes made by other processes. Must be called in
+        the server process, apply_change(library_path, change_events) will be
+        called in a separate thread with the list of changes to a library
+        received since it was last called. '''
+        self.apply_change = apply_change
+        with self.locked():
+            # Libraries are opened after this, so they already contain all
+            # changes made so far
+            self.applied = self.generation.value
+        Thread(name='ChangeRelay', target=self.receive_changes, daemon=True).start()
+
+    def receive_changes(self):
+        q = self.queues[self.index]
+        while True:
+            changes, latest = {}, 0
+            item = q.get()
+            while True:
+                generation, library_path, change_event = item
+                if generation > self.applied:
+                    changes.setdefault(library_path, []).append(change_event)
+                    latest = max(latest, generation)
+                if q.empty():
+                    break
+                item = q.get()
+            for library_path, change_events in changes.items():
+                self.apply_change(library_path, change_events)
+            if latest:
+                with self.applied_changed:
+                    self.applied = latest
+                    self.applied_changed.notify_all()
+
+    @contextmanager
+    def locked(self):
+        with self.thread_lock:
+            self.lock_depth += 1
+            try:
+                if self.lock_depth == 1:
+                    fcntl.lockf(self.lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    if self.lock_depth == 1:
+                        fcntl.lockf(self.lock_file, fcntl.LOCK_UN)
+            finally:
+                self.lock_depth -= 1
+
+    @contextmanager
+    def writing(self):
+        ''' Serialise changes to libraries with the other processes. Waits for
+        all changes made by other processes to be applied in this process
+        first, so that changes are never made to stale data. '''
+        with self.locked():
+            generation = self.generation.value
+            with self.applied_changed:
+                self.applied_changed.wait_for(lambda: self.applied >= generation, timeout=self.SYNC_TIMEOUT)
+            yield
+
+    def broadcast(self, library_path, change_event):
+        with self.writing():
+            self.generation.value = generation = self.generation.value + 1
+            for i, q in enumerate(self.queues):
+                if i != self.index:
+                    q.put((generation, library_path, change_event))
+            with self.applied_changed:
+                self.applied = generation
+
+
+def run_server_processes(num_processes, run_server, log):
+    ''' Fork num_processes processes, calling run_server(change_relay) in
+    each, restarting them if they die, until the server is stopped by a
+    signal. Returns the exit code. '''
+    change_relay = ChangeRelay(num_processes)
+    processes = {}
+    stopping = False
+
+    def start(index):
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+                    signal.signal(sig, signal.SIG_DFL)
+                change_relay.index = index
+                code = run_server(change_relay) or 0
+            except SystemExit as e:
+                if isinstance(e.code, int):
+                    code = e.code
+                else:
+                    print(e.code, file=sys.stderr)
+            except BaseException:
+                traceback.print_exc()
+            finally:
+                with suppress(Exception):
+                    sys.stdout.flush(), sys.stderr.flush()
+                os._exit(code)
+        processes[pid] = index, monotonic()
+
+    def stop(*a):
+        nonlocal stopping
+        stopping = True
+        for pid in processes:
+            with suppress(OSError):
+                os.kill(pid, signal.SIGTERM)
+
+    for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+        signal.signal(sig, stop)
+    for index in range(num_processes):
+        start(index)
+    ans = 0
+    while processes:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        index, started_at = processes.pop(pid)
+        if stopping:
+            continue
+        code = os.waitstatus_to_exitcode(status)
+        if monotonic() - started_at < STARTUP_TIME:
+            log.error(f'Server process {index} failed to start with exit code: {code}, shutting down')
+            ans = code or 1
+            stop()
+        else:
+            log.warn(f'Server process {index} died with exit code: {code}, restarting it')
+            start(index)
+    return ans
@@ -7,9 +7,11 @@
 import sys
 from collections import defaultdict
 from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
 from datetime import datetime
 from functools import partial
 from itertools import count
+from time import monotonic
 
 from lxml.etree import Comment
 
@@ -24,6 +26,7 @@
 from calibre.ebooks.oeb.polish.utils import guess_type
 from calibre.srv.metadata import encode_datetime
 from calibre.utils.date import EPOCH
+from calibre.utils.filenames import atomic_rename
 from calibre.utils.forked_map import forked_map, forked_map_is_supported
 from calibre.utils.logging import default_log
 from calibre.utils.serialize import json_dumps, json_loads, msgpack_loads
@@ -41,6 +44,10 @@
     def get_num_of_significant_chars(elem):
         return len(getattr(elem, 'text', '') or '') + len(getattr(elem, 'tail', '') or '')
 RENDER_VERSION = 1
+# Written while a book is rendered progressively, listing the files that are ready
+PARTIAL_MANIFEST_NAME = 'calibre-book-manifest-partial.json'
+# Names of files, one per line, that should be rendered next
+PRIORITY_NAMES_FILE = 'calibre-book-priority-names.txt'
 
 BLANK_JPEG = b'\xff\xd8\xff\xdb\x00C\x00\x03\x02\x02\x02\x02\x02\x03\x02\x02\x02\x03\x03\x03\x03\x04\x06\x04\x04\x04\x04\x04\x08\x06\x06\x05\x06\t\x08\n\n\t\x08\t\t\n\x0c\x0f\x0c\n\x0b\x0e\x0b\t\t\r\x11\r\x0e\x0f\x10\x10\x11\x10\n\x0c\x12\x13\x12\x10\x13\x0f\x10\x10\x10\xff\xc9\x00\x0b\x08\x00\x01\x00\x01\x01\x01\x11\x00\xff\xcc\x00\x06\x00\x10\x10\x05\xff\xda\x00\x08\x01\x01\x00\x00?\x00\xd2\xcf \xff\xd9'  # noqa: E501
 
@@ -578,7 +585,7 @@ def calculate_number_of_workers(names, in_process_container, max_workers):
 
 def process_exploded_book(
     book_fmt, opfpath, input_fmt, tdir, log=None, book_hash=None, save_bookmark_data=False,
-    book_metadata=None, virtualize_resources=True, max_workers=1
+    book_metadata=None, virtualize_resources=True, max_workers=1, progressive=0
 ):
     log = log or default_log
     container = SimpleContainer(tdir, opfpath, log)
@@ -650,35 +657,101 @@ def needs_work(mt):
     }
 
     names_that_need_work = tuple(n for n, mt in container.mime_map.items() if needs_work(mt))
-    num_workers = calculate_number_of_workers(names_that_need_work, container, max_workers)
-    results = []
     f = partial(process_book_file, virtualize_resources, book_render_data['link_uid'], container, present_names)
-    if num_workers < 2:
-        results.extend(map(f, names_that_need_work))
-    elif forked_map_is_supported:
-        results.extend(forked_map(f, names_that_need_work, num_workers=num_workers))
+    if progressive > 0:
+        def publish(results):
+            data, smil_names = manifest_for(book_render_data, container, results, set(container.name_path_map) - excluded_names, is_partial=True)
+            write_manifest(container.root, data, PARTIAL_MANIFEST_NAME)
+        results = process_names_progressively(f, names_that_need_work, spine, progressive, container, max_workers, publish)
     else:
-        with ThreadPoolExecutor(max_workers=num_workers) as executor:
-            results.extend(executor.map(f, names_that_need_work))
+        results = process_names(f, names_that_need_work, container, max_workers)
+
+    data, smil_names = manifest_for(book_render_data, container, results, set(container.name_path_map) - excluded_names)
+    excluded_names |= smil_names
+    container.commit()
+
+    for name in excluded_names:
+        os.remove(container.name_path_map[name])
+
+    write_manifest(container.root, data)
+    if progressive > 0:
+        for x in (PARTIAL_MANIFEST_NAME, PRIORITY_NAMES_FILE):
+            with suppress(FileNotFoundError):
+                os.remove(os.path.join(container.root, x))
+
+    return container, bookmark_data
+
 
-    ltm = book_render_data['link_to_map']
+def process_names(f, names, container, max_workers):
+    num_workers = calculate_number_of_workers(names, container, max_workers)
+    if num_workers < 2:
+        return list(map(f, names))
+    if forked_map_is_supported:
+        return list(forked_map(f, names, num_workers=num_workers))
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        return list(executor.map(f, names))
+
+
+def read_priority_names(root):
+    try:
+        with open(os.path.join(root, PRIORITY_NAMES_FILE), 'rb') as f:
+            raw = f.read().decode('utf-8', 'replace')
+    except FileNotFoundError:
+        return ()
+    return tuple(filter(None, raw.splitlines()))
+
+
+def process_names_progressively(f, names, spine, first_items, container, max_workers, publish, publish_interval=1):
+    ''' Process the stylesheets and other small files and the first first_items
+    spine items, then publish a partial manifest. Process the rest in spine
+    order, in small batches, publishing a partial manifest every
+    publish_interval seconds. Names listed in :data:`PRIORITY_NAMES_FILE` are
+    processed in the next batch. '''
+    spine_index = {name: i for i, name in enumerate(spine)}
+    html_names = sorted((n for n in names if container.mime_map[n].lower() in OEB_DOCS),
+                        key=lambda n: spine_index.get(n, len(spine_index)))
+    pending = html_names[first_items:]
+    first = set(names) - set(pending)
+    results = process_names(f, [n for n in names if n in first], container, max_workers)
+    publish(results)
+    last_published = monotonic()
+    batch_size = 2 * max(1, max_workers or detect_ncpus())
+    while pending:
+        wanted = set(read_priority_names(container.root)).intersection(pending)
+        if wanted:
+            pending = [n for n in pending if n in wanted] + [n for n in pending if n not in wanted]
+        batch, pending = pending[:batch_size], pending[batch_size:]
+        results.extend(process_names(f, batch, container, max_workers))
+        if pending and monotonic() - last_published >= publish_interval:
+            publish(results)
+            last_published = monotonic()
+    return results
+
+
+def manifest_for(book_render_data, container, results, names, is_partial=False):
+    ''' Return the manifest for the files in names, from the results of
+    process_book_file() and the names of the SMIL files, which are not sent to
+    the viewer. A partial manifest lists only the files that have been
+    processed. '''
+    book_render_data = book_render_data.copy()
+    ltm = book_render_data['link_to_map'] = {}
     html_data = {}
     virtualized_names = set()
+    smil_names = set()
 
     def merge_ltm(dest, src):
         for k, v in src.items():
             if k in dest:
                 dest[k] |= v
             else:
-                dest[k] = v
+                dest[k] = set(v)
 
     final_smil_map = {}
 
     def merge_smil_map(smil_map):
-        for n in smil_map.pop(__smil_file_names__):
-            excluded_names.add(n)
+        smil_names.update(smil_map[__smil_file_names__])
         for n, d in smil_map.items():
-            if d:
+            if d and n != __smil_file_names__:
                 # This assumes all smil data for a spine item is in a single
                 # smil file, which is required per the spec
                 final_smil_map[n] = d
@@ -691,7 +764,7 @@ def merge_smil_map(smil_map):
             if k in ltm:
                 merge_ltm(ltm[k], v)
             else:
-                ltm[k] = v
+                ltm[k] = {fk: set(fv) for fk, fv in v.items()}
     book_render_data['has_smil'] = bool(final_smil_map)
 
     def manifest_data(name):
@@ -717,22 +790,26 @@ def manifest_data(name):
                 ans['smil_map'] = smil_map
         return ans
 
-    book_render_data['files'] = {name:manifest_data(name) for name in set(container.name_path_map) - excluded_names}
-    container.commit()
-
-    for name in excluded_names:
-        os.remove(container.name_path_map[name])
+    names = names - smil_names
+    if is_partial:
+        mime_map = container.mime_map
+        names = {n for n in names if n in html_data or (mime_map.get(n) or '').lower() not in OEB_DOCS}
+        book_render_data['is_partial'] = True
+    book_render_data['files'] = {name:manifest_data(name) for name in names}
 
-    ltm = book_render_data['link_to_map']
     for name, amap in ltm.items():
         for k, v in tuple(amap.items()):
             amap[k] = tuple(v)  # needed for JSON serialization
+    return book_render_data, smil_names
 
-    data = as_bytes(json.dumps(book_render_data, ensure_ascii=False))
-    with open(os.path.join(container.root, 'calibre-book-manifest.json'), 'wb') as f:
-        f.write(data)
 
-    return container, bookmark_data
+def write_manifest(root, data, name='calibre-book-manifest.json'):
+    raw = as_bytes(json.dumps(data, ensure_ascii=False))
+    path = os.path.join(root, name)
+    with open(path + '.tmp', 'wb') as f:
+        f.write(raw)
+    # Readers of partial manifests must never see a partially written file
+    atomic_rename(path + '.tmp', path)
 
 
 def split_name(name):
@@ -808,7 +885,10 @@ def get_stored_annotations(container, bookmark_data):
                 yield {'type': 'last-read', 'pos': epubcfi, 'pos_type': 'epubcfi', 'timestamp': EPOCH}
 
 
-def render(pathtoebook, output_dir, book_hash=None, serialize_metadata=False, extract_annotations=False, virtualize_resources=True, max_workers=0):
+def render(
+    pathtoebook, output_dir, book_hash=None, serialize_metadata=False, extract_annotations=False, virtualize_resources=True, max_workers=0,
+    progressive=0
+):
     pathtoebook = os.path.abspath(pathtoebook)
     mi = None
     if serialize_metadata:
@@ -820,7 +900,7 @@ def render(pathtoebook, output_dir, book_hash=None, serialize_metadata=False, ex
     container, bookmark_data = process_exploded_book(
         book_fmt, opfpath, input_fmt, output_dir, max_workers=max_workers,
         book_hash=book_hash, save_bookmark_data=extract_annotations,
-        book_metadata=mi, virtualize_resources=virtualize_resources
+        book_metadata=mi, virtualize_resources=virtualize_resources, progressive=progressive
     )
     if serialize_metadata:
         from calibre.ebooks.metadata.book.serialize import metadata_as_dict
@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+A size bounded index of the books rendered for the in browser viewer, which
+are stored in a folder per book, named by the hash of the book. When the
+books are too large, books are deleted in order of their second most recent
+use, so that books opened repeatedly are kept over books opened only once,
+for example, by someone browsing through many books, or pre-rendered and not
+opened since. Books used only once are ordered by their single use, moved
+back by ONE_OFF_PENALTY. Books being read, that is, opened or with files sent
+to the viewer in the last IN_USE_PERIOD, are never deleted, as the viewer
+loads the files of a book as they are needed.
+
+The folder is shared by all server processes. The index is saved in it and
+is merged with the books in the folder and the uses recorded by other
+processes, under a file lock, before it is saved and before books are
+deleted. Books not in it, for example, ones just rendered by another process,
+are added as used once, when they were last opened. Reading a book is recorded
+by touching a file in its folder, so that other processes do not delete it.
+'''
+
+import json
+import os
+import time
+from contextlib import suppress
+from threading import Lock
+
+from calibre.utils.filenames import atomic_rename, rmtree
+from calibre.utils.lock import ExclusiveFile
+
+INDEX_NAME = 'index.json'
+LOCK_NAME = 'index.lock'
+MANIFEST_NAME = 'calibre-book-manifest.json'
+READING_NAME = 'calibre-book-reading'
+ONE_OFF_PENALTY = 7 * 24 * 60 * 60
+IN_USE_PERIOD = 2 * 60 * 60
+# How often the file recording that a book is being read is touched
+MARK_READ_INTERVAL = 60
+
+
+def folder_size(path):
+    ans = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for x in filenames:
+            with suppress(OSError):
+                ans += os.lstat(os.path.join(dirpath, x)).st_size
+    return ans
+
+
+class RenderedBooks:
+
+    def __init__(
+        self,
+        location,  # The folder containing the folders of the rendered books
+        max_size=2048,  # The maximum disk space in MB, zero means unlimited
+        log=None,
+    ):
+        self.location = location
+        self.max_size = int(max_size * 1024**2)
+        self.log = log
+        self.lock = Lock()
+        self.stats = dict.fromkeys(('hits', 'misses', 'evictions', 'prerendered'), 0)
+        # hash -> time a file of the book was last sent to the viewer, not saved
+        # as books are not being read by anyone after a restart
+        self.last_read = {}
+        self._load_index()
+
+    def _read_index(self):
+        try:
+            with open(os.path.join(self.location, INDEX_NAME), 'rb') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _load_index(self):
+        index = self._read_index()
+        # hash -> [size, time of last use, time of previous use or zero]
+        self.items = {}
+        with suppress(FileNotFoundError):
+            for entry in os.scandir(self.location):
+                if not entry.is_dir():
+                    continue
+                item = index.get(entry.name)
+                if item is None:
+                    try:
+                        last_used = os.path.getmtime(os.path.join(entry.path, MANIFEST_NAME))
+                    except OSError:
+                        continue  # Not a completely rendered book
+                    item = [folder_size(entry.path), last_used, 0]
+                self.items[entry.name] = item
+        self.total_size = sum(x[0] for x in self.items.values())
+
+    def _log_error(self, *args):
+        if self.log is not None:
+            self.log.error(*args)
+
+    def index_lock(self):
+        ' Serialise changes to the index and deleting books with other server processes '
+        return ExclusiveFile(os.path.join(self.location, LOCK_NAME))
+
+    def _refresh(self):
+        ''' Merge the changes made by other server processes into the index:
+        books they rendered or deleted and the uses they saved in the index
+        file. Must be called with the index lock held. '''
+        index = self._read_index()
+        on_disk = {}
+        with suppress(FileNotFoundError):
+            for entry in os.scandir(self.location):
+                if entry.is_dir():
+                    with suppress(OSError):
+                        on_disk[entry.name] = os.path.getmtime(os.path.join(entry.path, MANIFEST_NAME))
+        with self.lock:
+            unknown = tuple(h for h in on_disk if h not in self.items and h not in index)
+        sizes = {h: folder_size(os.path.join(self.location, h)) for h in unknown}
+        with self.lock:
+            items = {}
+            for bhash, mtime in on_disk.items():
+                item, other = self.items.get(bhash), index.get(bhash)
+                if item is None:
+                    item = other or [sizes.get(bhash, 0), mtime, 0]
+                elif other:
+                    times = sorted({item[1], item[2], other[1], other[2]}, reverse=True)
+                    item[1:] = times[0], (times[1] if len(times) > 1 else 0)
+                items[bhash] = item
+            self.items = items
+            self.total_size = sum(x[0] for x in items.values())
+            for bhash in tuple(self.last_read):
+                if bhash not in on_disk:
+                    del self.last_read[bhash]
+
+    def _save_index(self):
+        with self.lock:
+            data = json.dumps(self.items).encode('utf-8')
+        path = os.path.join(self.location, INDEX_NAME)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+        atomic_rename(path + '.tmp', path)
+
+    def save_index(self):
+        try:
+            with self.index_lock():
+                self._refresh()
+                self._save_index()
+        except OSError as err:
+            self._log_error('Failed to save the index of rendered books:', err)
+
+    def __contains__(self, bhash):
+        with self.lock:
+            return bhash in self.items
+
+    def mark_read(self, bhash, now):
+        ''' Record that a book is being read in its folder, for other server
+        processes. Returns False if the book is not in the folder. '''
+        path = os.path.join(self.location, bhash, READING_NAME)
+        try:
+            with open(path, 'ab'):
+                pass
+            os.utime(path, (now, now))
+        except OSError:
+            return False
+        return True
+
+    def read_since(self, bhash):
+        ' The time the book was last read by any server process '
+        with self.lock:
+            ans = self.last_read.get(bhash, 0)
+        with suppress(OSError):
+            ans = max(ans, os.path.getmtime(os.path.join(self.location, bhash, READING_NAME)))
+        return ans
+
+    def used(self, bhash):
+        ' A rendered book was opened '
+        now = time.time()
+        self.mark_read(bhash, now)
+        with self.lock:
+            self.stats['hits'] += 1
+            item = self.items.get(bhash)
+            if item is None:
+                self.items[bhash] = item = [folder_size(os.path.join(self.location, bhash)), now, 0]
+                self.total_size += item[0]
+            else:
+                item[1:] = now, item[1]
+            self.last_read[bhash] = now
+
+    def reading(self, bhash):
+        ''' A file of a rendered book was sent to the viewer, the book may have
+        been rendered by another server process '''
+        now = time.time()
+        with self.lock:
+            if now - self.last_read.get(bhash, 0) < MARK_READ_INTERVAL:
+                self.last_read[bhash] = now
+                return
+        if self.mark_read(bhash, now):
+            with self.lock:
+                self.last_read[bhash] = now
+
+    def missed(self):
+        ' A book that has not been rendered was opened '
+        with self.lock:
+            self.stats['misses'] += 1
+
+    def added(self, bhash, prerendered=False):
+        ''' A book was rendered, a pre-rendered book counts as used once, now,
+        other books count as opened once, when rendering them was started. '''
+        size = folder_size(os.path.join(self.location, bhash))
+        now = time.time()
+        if not prerendered:
+            self.mark_read(bhash, now)
+        with self.lock:
+            if prerendered:
+                self.stats['prerendered'] += 1
+            else:
+                self.last_read[bhash] = now
+            old = self.items.pop(bhash, None)
+            self.total_size += size - (0 if old is None else old[0])
+            self.items[bhash] = [size, now, 0]
+
+    def eviction_key(self, bhash):
+        size, last_used, previously_used = self.items[bhash]
+        return previously_used or (last_used - ONE_OFF_PENALTY)
+
+    def prune(self, keep=()):
+        ''' Delete books until the cache is small enough, except the books in
+        keep, such as a book that has just been rendered, and the books being
+        read by any server process. '''
+        if not self.max_size:
+            return
+        with self.lock:
+            if self.total_size <= self.max_size:
+                return
+        try:
+            with self.index_lock():
+                self._refresh()
+                self._prune(keep)
+        except OSError as err:
+            self._log_error('Failed to delete rendered books:', err)
+
+    def _prune(self, keep):
+        in_use_since = time.time() - IN_USE_PERIOD
+        with self.lock:
+            candidates = sorted((h for h in self.items if h not in keep), key=self.eviction_key)
+        for bhash in candidates:
+            with self.lock:
+                if self.total_size <= self.max_size:
+                    break
+            if self.read_since(bhash) >= in_use_since:
+                continue
+            with self.lock:
+                item = self.items.pop(bhash, None)
+                if item is None:
+                    continue
+                self.total_size -= item[0]
+                self.last_read.pop(bhash, None)
+                self.stats['evictions'] += 1
+            rmtree(os.path.join(self.location, bhash), ignore_errors=True)
+
+    def statistics(self):
+        with self.lock:
+            ans = self.stats.copy()
+            ans['size'], ans['max_size'], ans['count'] = self.total_size, self.max_size, len(self.items)
+        lookups = ans['hits'] + ans['misses']
+        ans['hit_ratio'] = ans['hits'] / lookups if lookups else 0
+        return ans
@@ -314,7 +314,10 @@ def dispatch(self, data):
         self.init_session(endpoint_, data)
         if endpoint_.needs_db_write:
             self.ctx.check_for_write_access(data)
-        ans = endpoint_(self.ctx, data, *args)
+            with self.ctx.writing():
+                ans = endpoint_(self.ctx, data, *args)
+        else:
+            ans = endpoint_(self.ctx, data, *args)
         self.finalize_session(endpoint_, data, ans)
         outheaders = data.outheaders
 
@@ -6,11 +6,13 @@
 import os
 import signal
 import sys
+from functools import partial
 
 from calibre import as_unicode
-from calibre.constants import is_running_from_develop, ismacos, iswindows
+from calibre.constants import is_running_from_develop, islinux, ismacos, iswindows
 from calibre.db.legacy import LibraryDatabase
 from calibre.srv.bonjour import BonJour
+from calibre.srv.books import save_rendered_books_index
 from calibre.srv.handler import Handler
 from calibre.srv.http_response import create_http_handler
 from calibre.srv.library_broker import load_gui_libraries
@@ -56,7 +58,7 @@ def daemonize():  # {{{
 
 class Server:
 
-    def __init__(self, libraries, opts):
+    def __init__(self, libraries, opts, change_relay=None):
         log = access_log = None
         log_size = opts.max_log_size * 1024 * 1024
         if opts.log:
@@ -64,6 +66,8 @@ def __init__(self, libraries, opts):
         if opts.access_log:
             access_log = RotatingLog(opts.access_log, max_size=log_size)
         self.handler = Handler(libraries, opts)
+        if change_relay is not None:
+            self.handler.router.ctx.use_change_relay(change_relay)
         if opts.custom_list_template:
             with open(os.path.expanduser(opts.custom_list_template), 'rb') as f:
                 self.handler.router.ctx.custom_list_template = json.load(f)
@@ -81,12 +85,20 @@ def __init__(self, libraries, opts):
             plugins=plugins)
         self.handler.set_log(self.loop.log)
         self.handler.set_jobs_manager(self.loop.jobs_manager)
-        self.serve_forever = self.loop.serve_forever
         self.stop = self.loop.stop
         if is_running_from_develop:
             from calibre.utils.rapydscript import compile_srv
             compile_srv()
 
+    def serve_forever(self):
+        try:
+            self.loop.serve_forever()
+        finally:
+            file_cache = self.handler.router.ctx.file_cache
+            if file_cache is not None:
+                file_cache.save_index()
+            save_rendered_books_index()
+
 
 def create_option_parser():
     parser = opts_to_parser(
@@ -226,10 +238,27 @@ def main(args=sys.argv):
         raise SystemExit('The --log option must point to a file, not a directory')
     if opts.access_log and os.path.isdir(opts.access_log):
         raise SystemExit('The --access-log option must point to a file, not a directory')
+    if opts.server_processes > 1:
+        if not islinux:
+            raise SystemExit(_('Running more than one server process is only supported on Linux'))
+        from calibre.srv.processes import run_server_processes
+        from calibre.utils.logging import default_log
+        daemonize_if_needed(opts)
+        log = RotatingLog(opts.log, max_size=opts.max_log_size * 1024 * 1024) if opts.log else default_log
+        raise SystemExit(run_server_processes(opts.server_processes, partial(run_server_process, libraries, opts), log))
+    server = create_server(libraries, opts)
+    daemonize_if_needed(opts)
+    serve(server, opts)
+
+
+def create_server(libraries, opts, change_relay=None):
     try:
-        server = Server(libraries, opts)
+        return Server(libraries, opts, change_relay)
     except BadIPSpec as e:
         raise SystemExit(f'{e}')
+
+
+def daemonize_if_needed(opts):
     if getattr(opts, 'daemonize', False):
         if not opts.log and not iswindows:
             raise SystemExit(
@@ -239,6 +268,16 @@ def main(args=sys.argv):
     if opts.pidfile:
         with open(opts.pidfile, 'wb') as f:
             f.write(str(os.getpid()).encode('ascii'))
+
+
+def run_server_process(libraries, opts, change_relay):
+    if change_relay.index > 0:
+        # Only advertise the server once
+        opts.use_bonjour = False
+    serve(create_server(libraries, opts, change_relay), opts)
+
+
+def serve(server, opts):
     signal.signal(signal.SIGTERM, lambda s, f: server.stop())
     if not getattr(opts, 'daemonize', False) and not iswindows:
         signal.signal(signal.SIGHUP, lambda s, f: server.stop())
@@ -6,6 +6,7 @@
 
 import json
 import os
+import time
 import zlib
 from functools import partial
 from io import BytesIO
@@ -85,6 +86,57 @@ def test_ajax_categories(self):  # {{{
             self.ae(set(data['book_ids']), {2})
     # }}}
 
+    def test_srv_search_cache(self):  # {{{
+        'Test that concurrent requests for a cached value compute it only once'
+        from threading import Event, Thread
+        from types import SimpleNamespace
+        with self.create_server() as server:
+            ctx = server.handler.ctx
+            db = ctx.library_broker.get(None)
+            rd = SimpleNamespace(username=None)
+            ae = self.assertEqual
+            ae(ctx.search(rd, db, 'id:1'), {1})
+            ae(ctx.search(rd, db, 'id:1'), {1})
+            ae(ctx.cache_statistics()['search'], {'hits': 1, 'misses': 1, 'waits': 0})
+            db.set_field('title', {1: 'changed'})
+            ae(ctx.search(rd, db, 'title:changed'), {1})
+            ae(ctx.search(rd, db, 'id:1'), {1})
+            ae(ctx.cache_statistics()['search'], {'hits': 1, 'misses': 3, 'waits': 0})
+
+            release, calls, results = Event(), [], []
+
+            def compute(key):
+                calls.append(key)
+                release.wait()
+                return 1, key
+
+            def get(key):
+                results.append(ctx.cached('search', ctx.library_broker.search_caches, db, key, bool, partial(compute, key), 10))
+
+            threads = [Thread(target=get, args=(key,)) for key in 'aaab']
+            [t.start() for t in threads]
+            while sum(ctx.cache_statistics()['search'].values()) < 8 or len(calls) < 2:
+                time.sleep(0.01)
+            ae(sorted(calls), ['a', 'b'])
+            release.set()
+            [t.join() for t in threads]
+            ae(sorted(results), ['a', 'a', 'a', 'b'])
+            ae(ctx.cache_statistics()['search'], {'hits': 1, 'misses': 5, 'waits': 2})
+            get('a')
+            ae(results[-1], 'a')
+            ae(ctx.cache_statistics()['search']['hits'], 2)
+            ae(ctx.in_flight, {})
+
+            # The validity of cached values is checked without the lock
+            locked_during_check = []
+
+            def is_valid(stamp):
+                locked_during_check.append(ctx.lock.locked())
+                return True
+            ae(ctx.cached('search', ctx.library_broker.search_caches, db, 'a', is_valid, partial(compute, 'a'), 10), 'a')
+            ae(locked_during_check, [False])
+    # }}}
+
     def test_srv_restrictions(self):  # {{{
         ' Test that virtual lib. + search restriction works on all end points'
         with self.create_server(auth=True, auth_mode='basic') as server:
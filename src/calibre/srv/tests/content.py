@@ -230,6 +230,264 @@ def change_cover(count, book_id=2):
 
     # }}}
 
+    def test_pregenerate_thumbnails(self):  # {{{
+        'Test generating thumbnails in the background'
+        from calibre.srv.content import thumbnail_generators
+        with self.create_server(pregenerate_thumbnails='100x100, 60x90,junk') as server:
+            db = server.handler.router.ctx.library_broker.get(None)
+            conn = server.connect()
+
+            def get(book_id, q):
+                conn.request('GET', f'/get/thumb/{book_id}?{q}')
+                r = conn.getresponse()
+                return r, r.read()
+
+            def wait_for_generator():
+                g, = (g for g in thumbnail_generators.values() if g.db is db)
+                self.ae(g.sizes, ((100, 100), (60, 90)))
+                g.queue.join()
+                return g
+
+            r, data = get(1, 'sz=100')
+            self.ae(r.status, http_client.OK)
+            wait_for_generator()
+            r, data = get(2, 'sz=100x100')
+            self.ae(r.status, http_client.OK)
+            self.ae(r.getheader('Used-Cache'), 'yes')
+            r, data = get(2, 'sz=60x90')
+            self.ae(r.getheader('Used-Cache'), 'yes')
+            r, data = get(2, 'sz=120x120')
+            self.ae(r.getheader('Used-Cache'), 'no')
+
+            time.sleep(0.01)
+            db.set_cover({2:I('lt.png', data=True)})
+            g = wait_for_generator()
+            r, data = get(2, 'sz=100x100')
+            self.ae(r.getheader('Used-Cache'), 'yes')
+        # The generator stops when the library is closed
+        db.close()
+        g.join(10)
+        self.assertFalse(g.is_alive())
+        self.assertNotIn(g, thumbnail_generators.values())
+    # }}}
+
+    def test_file_cache(self):  # {{{
+        'Test the size bounded, persistent cache of files'
+        from calibre.ptempfile import TemporaryDirectory
+        from calibre.srv.fcache import FileCache
+        with TemporaryDirectory() as tdir:
+            with self.create_server(file_cache_location=tdir, file_cache_size=0.001) as server:
+                db = server.handler.router.ctx.library_broker.get(None)
+                conn = server.connect()
+
+                def get(url):
+                    conn.request('GET', url)
+                    r = conn.getresponse()
+                    return r, r.read()
+
+                r, data = get('/get/cover/1')
+                self.ae(r.getheader('Used-Cache'), 'no')
+                path = from_hex_unicode(r.getheader('Tempfile'))
+                self.assertTrue(path.startswith(tdir))
+                f = share_open(path, 'rb')
+                r, data = get('/get/cover/1')
+                self.ae(r.getheader('Used-Cache'), 'yes')
+                self.ae(data, db.cover(1))
+                # The same cache is used for every request
+                file_cache = server.handler.router.ctx.file_cache
+                self.ae(file_cache.location, tdir)
+                # The limit is smaller than two covers, so the next file evicts it
+                r, data = get('/get/cover/2')
+                self.ae(r.getheader('Used-Cache'), 'no')
+                self.assertFalse(os.path.exists(path))
+                self.ae(f.read(), db.cover(1))
+                f.close()
+                self.assertIs(server.handler.router.ctx.file_cache, file_cache)
+                cover = db.cover(2)
+                r, data = get('/cache-stats')
+                stats = json.loads(data)['files']
+                self.ae((stats['hits'], stats['misses'], stats['evictions'], stats['count']), (1, 2, 1, 1))
+                self.ae(stats['bytes_served'], len(db.cover(1)))
+            # The cache is preserved across restarts
+            fc = FileCache(tdir, max_size=0)
+            self.ae(len(fc.items), 1)
+            self.ae(fc.total_size, len(cover))
+            with self.create_server(file_cache_location=tdir) as server:
+                conn = server.connect()
+                r, data = get('/get/cover/2')
+                self.ae(r.getheader('Used-Cache'), 'yes')
+    # }}}
+
+    def test_rendered_books_cache(self):  # {{{
+        'Test the size bounded index of books rendered for the viewer'
+        from calibre.ptempfile import TemporaryDirectory
+        from calibre.srv.render_cache import READING_NAME, RenderedBooks
+        with TemporaryDirectory() as tdir:
+            def render(bhash, size=400, prerendered=False):
+                os.mkdir(os.path.join(cache.location, bhash))
+                with open(os.path.join(cache.location, bhash, 'calibre-book-manifest.json'), 'wb') as f:
+                    f.write(b'x' * size)
+                cache.added(bhash, prerendered=prerendered)
+
+            def books_in(location):
+                return sorted(x for x in os.listdir(location) if os.path.isdir(os.path.join(location, x)))
+
+            cache = RenderedBooks(tdir, max_size=0.001)
+            for bhash in 'abc':
+                render(bhash)
+            cache.used('a'), cache.used('a'), cache.missed()
+            # Books opened repeatedly are kept over more recently added books
+            render('d')
+            # No one is reading them
+            cache.last_read.clear()
+            for bhash in 'abcd':
+                os.remove(os.path.join(tdir, bhash, READING_NAME))
+            cache.prune(keep=('d',))
+            self.ae(books_in(tdir), ['a', 'd'])
+            stats = cache.statistics()
+            self.ae((stats['hits'], stats['misses'], stats['evictions'], stats['count'], stats['size']), (2, 1, 2, 2, 800))
+            cache.save_index()
+            # Books not in the index are added to it
+            os.mkdir(os.path.join(tdir, 'e'))
+            with open(os.path.join(tdir, 'e', 'calibre-book-manifest.json'), 'wb') as f:
+                f.write(b'x')
+            c2 = RenderedBooks(tdir)
+            self.ae(sorted(c2.items), ['a', 'd', 'e'])
+            self.ae(c2.items['a'], cache.items['a'])
+            self.ae(c2.total_size, 801)
+            # Books being read are not deleted, even if they are the first to go
+            location = os.path.join(tdir, 'reading')
+            os.mkdir(location)
+            cache = RenderedBooks(location, max_size=0.001)
+            for bhash in 'abc':
+                render(bhash, prerendered=True)
+            cache.reading('a')
+            render('d')
+            cache.prune(keep=('d',))
+            self.ae(books_in(location), ['a', 'd'])
+            self.ae(cache.statistics()['prerendered'], 3)
+            # Books being rendered are not in the index
+            cache.reading('e')
+            self.assertNotIn('e', cache.last_read)
+            # Server processes share the folder, books read by any of them are
+            # not deleted and the index has the books rendered and deleted by all
+            location = os.path.join(tdir, 'shared')
+            os.mkdir(location)
+            cache, other = RenderedBooks(location, max_size=0.001), RenderedBooks(location, max_size=0.001)
+            for bhash in 'abc':
+                render(bhash, prerendered=True)
+            other.reading('b')
+            self.assertIn('b', other.last_read)
+            render('d')
+            cache.prune(keep=('d',))
+            self.ae(books_in(location), ['b', 'd'])
+            cache.used('b')
+            cache.save_index()
+            other.save_index()
+            self.ae(sorted(other.items), ['b', 'd'])
+            self.ae(other.total_size, 800)
+            self.ae(RenderedBooks(location).items['b'], cache.items['b'])
+    # }}}
+
+    def test_prerender(self):  # {{{
+        'Test rendering books for the viewer in the background'
+        from types import SimpleNamespace
+
+        from calibre.ptempfile import TemporaryDirectory
+        from calibre.srv import books
+        with TemporaryDirectory() as tdir, self.create_server(local_write=True) as server:
+            for x in 'sf':
+                os.mkdir(os.path.join(tdir, x))
+            orig = books._books_cache_dir, books.rendered_books
+            books._books_cache_dir, books.rendered_books = tdir, None
+            try:
+                ctx = server.handler.router.ctx
+                db = ctx.library_broker.get(None)
+                db.add_format(1, 'TXT', BytesIO(b'some text'))
+                jobs = []
+
+                def start_job(name, module, func, args=(), kwargs=None, job_done_callback=None, job_data=None):
+                    # Rendering is tested elsewhere, the job renders an empty book
+                    with open(os.path.join(args[1], 'calibre-book-manifest.json'), 'wb') as f:
+                        f.write(b'{}')
+                    jobs.append([job_done_callback, SimpleNamespace(data=job_data, failed=False)])
+                    return len(jobs) - 1
+
+                def job_status(job_id):
+                    job = jobs[job_id]
+                    if job[0] is not None:
+                        job_done_callback, job[0] = job[0], None
+                        job_done_callback(job[1])
+                    return 'finished', None, None, False
+                ctx.start_job, ctx.job_status = start_job, job_status
+                conn = server.connect()
+
+                def prerender(body):
+                    conn.request('POST', '/book-prerender', body=body)
+                    r = conn.getresponse()
+                    return r.status, r.read()
+
+                self.ae(prerender(json.dumps({'book_ids': [1, 2], 'formats': ['txt']})), (http_client.OK, b'2'))
+                books.prerenderer.queue.join()
+                # Book 2 has no TXT format
+                self.ae(len(jobs), 1)
+                bhash = jobs[0][1].data[0]
+                self.assertIn(bhash, books.rendered_books)
+                self.assertTrue(os.path.exists(os.path.join(tdir, 'f', bhash, 'calibre-book-manifest.json')))
+                self.assertNotIn(bhash, books.queued_jobs)
+                self.ae(books.rendered_books.statistics()['prerendered'], 1)
+                # Rendered books are not rendered again
+                self.ae(prerender(json.dumps({'search': 'formats:TXT', 'formats': ['TXT']})), (http_client.OK, b'1'))
+                books.prerenderer.queue.join()
+                self.ae(len(jobs), 1)
+                self.ae(prerender(b'not json')[0], http_client.BAD_REQUEST)
+            finally:
+                books._books_cache_dir, books.rendered_books = orig
+    # }}}
+
+    def test_progressive_rendering(self):  # {{{
+        'Test rendering the spine of a book in order, with requested items first'
+        from types import SimpleNamespace
+
+        from calibre.ptempfile import TemporaryDirectory
+        from calibre.srv.books import staged_book_file
+        from calibre.srv.render_book import PARTIAL_MANIFEST_NAME, PRIORITY_NAMES_FILE, process_names_progressively, read_priority_names
+        with TemporaryDirectory() as tdir:
+            spine = [f'{i}.html' for i in range(10)]
+            names = ['style.css'] + spine[::-1]
+            mime_map = dict.fromkeys(spine, 'application/xhtml+xml')
+            mime_map['style.css'] = 'text/css'
+            container = SimpleNamespace(root=tdir, mime_map=mime_map)
+            processed, published = [], []
+
+            def f(name):
+                processed.append(name)
+                if name == '3.html':
+                    with open(os.path.join(tdir, PRIORITY_NAMES_FILE), 'ab') as pf:
+                        pf.write(b'8.html\n7.html\n')
+                return name
+
+            results = process_names_progressively(f, names, spine, 2, container, 1, lambda r: published.append(list(r)), publish_interval=0)
+            self.ae(read_priority_names(tdir), ('8.html', '7.html'))
+            self.ae(published[0], ['style.css', '1.html', '0.html'])
+            self.ae(processed, ['style.css', '1.html', '0.html', '2.html', '3.html', '7.html', '8.html', '4.html', '5.html', '6.html', '9.html'])
+            self.ae(results, processed)
+
+        with TemporaryDirectory() as tdir:
+            rd = SimpleNamespace(filesystem_file_with_custom_etag=lambda f, etag, name: (f.read(), f.close())[0])
+            self.assertIsNone(staged_book_file(rd, 'h', tdir, '0.html'))
+            self.ae(read_priority_names(tdir), ())
+            with open(os.path.join(tdir, PARTIAL_MANIFEST_NAME), 'w') as f:
+                json.dump({'files': {'0.html': {}}, 'spine': ['0.html', '1.html']}, f)
+            with open(os.path.join(tdir, '0.html'), 'wb') as f:
+                f.write(b'ready')
+            self.ae(staged_book_file(rd, 'h', tdir, '0.html'), b'ready')
+            # Files that are not ready are asked for once and only if they are in the spine
+            for name in ('1.html', '1.html', 'x.css', 'not-in-book.html'):
+                self.assertIsNone(staged_book_file(rd, 'h', tdir, name))
+            self.ae(read_priority_names(tdir), ('1.html',))
+    # }}}
+
     def test_char_count(self):  # {{{
         from calibre.ebooks.oeb.parse_utils import html5_parse
         from calibre.srv.render_book import get_length
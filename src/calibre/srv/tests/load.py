@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+A load test for the server event loop, that opens many idle keep-alive
+connections and measures the latency of requests made while they are open.
+Run as:
+
+    calibre-debug src/calibre/srv/tests/load.py -- --connections 5000
+'''
+
+import socket
+import sys
+from contextlib import contextmanager
+
+from calibre.constants import iswindows
+from calibre.srv.tests.base import BaseTest, TestServer
+from calibre.utils.monotonic import monotonic
+
+REQUEST = b'GET /test HTTP/1.1\r\nHost: localhost\r\nConnection: keep-alive\r\n\r\n'
+
+
+@contextmanager
+def max_connections(wanted):
+    ''' Raise the soft limit on open files, if needed and possible, so that
+    wanted connections can be opened, restoring it on exit. Yields the number
+    of connections that can be opened, at most wanted. '''
+    if iswindows:
+        yield wanted
+        return
+    import resource
+    # Both ends of every connection are in this process
+    needed = 2 * wanted + 100
+    original = soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != resource.RLIM_INFINITY and soft < needed:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (needed if hard == resource.RLIM_INFINITY else min(needed, hard), hard))
+        except (OSError, ValueError):
+            pass
+    try:
+        soft = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+        yield wanted if soft == resource.RLIM_INFINITY else max(0, min(wanted, (soft - 100) // 2))
+    finally:
+        if resource.getrlimit(resource.RLIMIT_NOFILE) != original:
+            resource.setrlimit(resource.RLIMIT_NOFILE, original)
+
+
+def read_response(sock):
+    ' Read a complete response, assuming it has a Content-Length header '
+    data = b''
+    while b'\r\n\r\n' not in data:
+        chunk = sock.recv(4096)
+        if not chunk:
+            raise ConnectionError('Connection closed by server')
+        data += chunk
+    headers, body = data.split(b'\r\n\r\n', 1)
+    length = 0
+    for line in headers.split(b'\r\n')[1:]:
+        k, v = line.split(b':', 1)
+        if k.strip().lower() == b'content-length':
+            length = int(v)
+    while len(body) < length:
+        chunk = sock.recv(4096)
+        if not chunk:
+            raise ConnectionError('Connection closed by server')
+        body += chunk
+    return headers.split(b'\r\n', 1)[0], body
+
+
+def request(sock):
+    sock.sendall(REQUEST)
+    return read_response(sock)
+
+
+def open_idle_connections(address, num):
+    ' Open num keep-alive connections, making one request on each so that the server has fully set them up '
+    ans = []
+    try:
+        for i in range(num):
+            s = socket.create_connection(address, timeout=30)
+            ans.append(s)
+            status, body = request(s)
+            if b' 200 ' not in status:
+                raise ValueError(f'Unexpected response: {status}')
+    except BaseException:
+        close_connections(ans)
+        raise
+    return ans
+
+
+def close_connections(conns):
+    for s in conns:
+        try:
+            s.close()
+        except OSError:
+            pass
+
+
+def run_load_test(event_loop='selectors', connections=1000, requests=200, report=print):
+    ''' Open the specified number of idle connections and then measure the
+    latency of requests made on a new connection while the idle connections
+    are open. Finally, check that all the idle connections are still usable.
+    Returns a dict of timings in seconds. '''
+    with TestServer(lambda data: b'ok', event_loop=event_loop, timeout=600) as server:
+        st = monotonic()
+        idle = open_idle_connections(server.address, connections)
+        ans = {'open': monotonic() - st}
+        try:
+            active = socket.create_connection(server.address, timeout=30)
+            try:
+                times = []
+                for i in range(requests):
+                    st = monotonic()
+                    request(active)
+                    times.append(monotonic() - st)
+                st = monotonic()
+                for s in idle:
+                    request(s)
+                ans['reuse'] = monotonic() - st
+                ans['open_connections'] = server.loop.num_active_connections
+            finally:
+                active.close()
+            times.sort()
+            ans['median'], ans['p99'] = times[len(times) // 2], times[int(len(times) * 0.99)]
+        finally:
+            close_connections(idle)
+    report(f'{event_loop}: {connections} idle connections: opened in {ans["open"]:.2f}s, request latency median:'
+           f' {ans["median"] * 1000:.2f}ms p99: {ans["p99"] * 1000:.2f}ms, reused all in {ans["reuse"]:.2f}s')
+    return ans
+
+
+class LoadTest(BaseTest):
+
+    def test_many_idle_connections(self):
+        'Test that the selectors event loop can handle connections with descriptors that are too large for select()'
+        # Both ends of the connections are in this process, so this uses
+        # file descriptors larger than the 1024 that select() can handle
+        wanted = 550
+        with max_connections(wanted) as num:
+            if num < wanted:
+                self.skipTest('Not enough file descriptors available')
+            ans = run_load_test('selectors', connections=wanted, requests=20, report=lambda *a: None)
+        self.ae(ans['open_connections'], wanted + 1)
+
+    def test_event_loops(self):
+        'Test that both event loops serve requests while other connections are idle'
+        for event_loop in ('select', 'selectors'):
+            ans = run_load_test(event_loop, connections=100, requests=20, report=lambda *a: None)
+            self.ae(ans['open_connections'], 101)
+
+
+def main(args=sys.argv):
+    from calibre.utils.config import OptionParser
+    parser = OptionParser(usage='%prog [options]\n\nLoad test the server event loop with many idle keep-alive connections')
+    parser.add_option('--connections', type=int, default=5000, help='Number of idle connections to open')
+    parser.add_option('--requests', type=int, default=500, help='Number of requests to time while the idle connections are open')
+    parser.add_option('--event-loop', default=None, choices=('select', 'selectors'), help='Only test the specified event loop')
+    opts, args = parser.parse_args(args)
+    with max_connections(opts.connections) as num:
+        if num < opts.connections:
+            print(f'Only {num} connections can be opened because of the limit on open files')
+        for event_loop in ((opts.event_loop,) if opts.event_loop else ('select', 'selectors')):
+            if event_loop == 'select' and num > 500:
+                print(f'select: skipped, as select() cannot handle {num} connections')
+                continue
+            run_load_test(event_loop, num, opts.requests)
+
+
+if __name__ == '__main__':
+    main()
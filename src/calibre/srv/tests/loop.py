@@ -9,10 +9,12 @@
 import ssl
 import time
 from collections import namedtuple
+from contextlib import nullcontext
 from glob import glob
 from threading import Event
-from unittest import skipIf
+from unittest import skipIf, skipUnless
 
+from calibre.constants import islinux
 from calibre.ptempfile import TemporaryDirectory
 from calibre.srv.pre_activated import has_preactivated_support
 from calibre.srv.tests.base import BaseTest, TestServer
@@ -136,6 +138,82 @@ def test_dual_stack(self):
             self.ae(r.status, http_client.OK)
             self.ae(r.read(), b'testbody')
 
+    @skipUnless(islinux, 'Multiple server processes are only supported on Linux')
+    def test_server_processes(self):
+        'Test sharing the port and changes between server processes'
+        from queue import Queue
+
+        from calibre.srv.changes import BooksAdded, books_added, metadata
+        from calibre.srv.processes import ChangeRelay
+        def handler(data):
+            return b'ok'
+        with TestServer(handler, server_processes=2) as s1, TestServer(handler, server_processes=2, port=s1.address[1]) as s2:
+            self.ae(s1.address, s2.address)
+            for s in (s1, s2):
+                self.ae(s.loop.socket.getsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT), 1)
+
+        relay = ChangeRelay(2)
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                relay.index = 1
+                received = Queue()
+                relay.start(lambda library_path, change_events: received.put((library_path, change_events)))
+                library_path, (change_event,) = received.get(timeout=10)
+                relay.broadcast(library_path, books_added(change_event.book_ids | {3}))
+                code = 0
+            finally:
+                os._exit(code)
+        received = []
+
+        def apply_change(library_path, change_events):
+            time.sleep(0.1)
+            for change_event in change_events:
+                received.append((library_path, type(change_event), change_event.book_ids))
+
+        relay.start(apply_change)
+        relay.broadcast('/library', metadata((1, 2)))
+        self.ae(os.waitstatus_to_exitcode(os.waitpid(pid, 0)[1]), 0)
+        # Must wait for the change made by the other process to be applied
+        with relay.writing():
+            self.ae(received, [('/library', BooksAdded, {1, 2, 3})])
+        self.ae(relay.generation.value, 2)
+
+        # Changes that arrive together are applied together
+        relay, calls = ChangeRelay(2), []
+        for generation in range(1, 4):
+            relay.queues[0].put((generation, '/library', metadata((generation,))))
+        relay.queues[0].put((4, '/other', metadata((4,))))
+        relay.start(lambda library_path, change_events: calls.append((library_path, [tuple(e.book_ids) for e in change_events])))
+        with relay.applied_changed:
+            relay.applied_changed.wait_for(lambda: relay.applied >= 4, timeout=10)
+        self.ae(calls, [('/library', [(1,), (2,), (3,)]), ('/other', [(4,)])])
+
+        # Libraries that may have been changed while writing are sent as
+        # changed, unless a change event was sent for them already
+        from calibre.srv.changes import LibraryChanged, MetadataChanged
+        from calibre.srv.handler import Context
+        from calibre.srv.opts import Options
+
+        class Relay:
+            broadcasts = []
+
+            def writing(self):
+                return nullcontext()
+
+            def broadcast(self, library_path, change_event):
+                self.broadcasts.append((library_path, type(change_event)))
+
+        ctx = Context((), Options(userdb=':memory:'))
+        ctx.change_relay = relay = Relay()
+        with ctx.writing('/library'):
+            ctx.notify_changes('/other', metadata((1,)))
+            with ctx.writing('/other'):
+                pass
+            self.ae(relay.broadcasts, [('/other', MetadataChanged)])
+        self.ae(relay.broadcasts, [('/other', MetadataChanged), ('/library', LibraryChanged)])
+
     def test_ring_buffer(self):
         'Test the ring buffer used for reads'
         class FakeSocket:
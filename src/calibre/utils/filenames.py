@@ -668,6 +668,20 @@ def is_fat_filesystem(path):
         # Values I have seen: FAT32, exFAT, NTFS
         return tn.upper().startswith('FAT')
 
+    def is_network_filesystem(path):
+        if not path:
+            return False
+        path = os.path.abspath(path)
+        if path.startswith(long_path_prefix):
+            path = path[len(long_path_prefix):]
+            if path.upper().startswith('UNC\\'):
+                return True
+        elif path.startswith('\\\\'):
+            return True  # UNC path
+        import ctypes
+        DRIVE_REMOTE = 4
+        return ctypes.windll.kernel32.GetDriveTypeW(f'{path[0].upper()}:\\') == DRIVE_REMOTE
+
     def get_long_path_name(path):
         from calibre_extensions.winutil import get_long_path_name
         lpath = path
@@ -692,3 +706,66 @@ def get_long_path_name(path):
     def is_fat_filesystem(path):
         # TODO: Implement for Linux and macOS
         return False
+
+    NETWORK_FILESYSTEMS = frozenset((
+        'nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', '9p', 'afs', 'ceph', 'glusterfs', 'lustre', 'davfs',
+        'fuse.sshfs', 'fuse.rclone', 'fuse.glusterfs', 'fuse.davfs2', 'fuse.s3fs',
+        # macOS
+        'afpfs', 'webdav', 'ftp',
+    ))
+
+    def macos_filesystem_type(path):
+        ''' Return the type name of the filesystem containing path and whether
+        it is local, using statfs(). '''
+        import ctypes
+        import ctypes.util
+
+        class statfs(ctypes.Structure):
+            _fields_ = [
+                ('f_bsize', ctypes.c_uint32), ('f_iosize', ctypes.c_int32), ('f_blocks', ctypes.c_uint64),
+                ('f_bfree', ctypes.c_uint64), ('f_bavail', ctypes.c_uint64), ('f_files', ctypes.c_uint64),
+                ('f_ffree', ctypes.c_uint64), ('f_fsid', ctypes.c_int32 * 2), ('f_owner', ctypes.c_uint32),
+                ('f_type', ctypes.c_uint32), ('f_flags', ctypes.c_uint32), ('f_fssubtype', ctypes.c_uint32),
+                ('f_fstypename', ctypes.c_char * 16), ('f_mntonname', ctypes.c_char * 1024),
+                ('f_mntfromname', ctypes.c_char * 1024), ('f_flags_ext', ctypes.c_uint32), ('f_reserved', ctypes.c_uint32 * 7),
+            ]
+        MNT_LOCAL = 0x1000
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        try:
+            func = libc['statfs$INODE64']  # Intel, where the 64-bit inode version has its own name
+        except AttributeError:
+            func = libc.statfs
+        func.argtypes = ctypes.c_char_p, ctypes.POINTER(statfs)
+        buf = statfs()
+        if func(os.fsencode(path), ctypes.byref(buf)) != 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return buf.f_fstypename.decode('utf-8', 'replace'), bool(buf.f_flags & MNT_LOCAL)
+
+    def is_network_filesystem(path):
+        ''' True if path is on a network filesystem, or if the type of its
+        filesystem cannot be determined. '''
+        if not path:
+            return False
+        if ismacos:
+            try:
+                fstype, is_local = macos_filesystem_type(os.path.dirname(os.path.abspath(path)))
+            except Exception:
+                return True
+            return not is_local or fstype in NETWORK_FILESYSTEMS
+        try:
+            with open('/proc/self/mounts', 'rb') as f:
+                raw = f.read().decode('utf-8', 'replace')
+        except OSError:
+            return True
+        path = os.path.realpath(path)
+        mount_point, fstype = '', ''
+        for line in raw.splitlines():
+            parts = line.split()
+            if len(parts) < 3:
+                continue
+            # Spaces and other special characters are octal escaped in mounts
+            mp = parts[1].replace('\\040', ' ').replace('\\011', '\t').replace('\\134', '\\')
+            if (path == mp or path.startswith(mp.rstrip('/') + '/')) and len(mp) >= len(mount_point):
+                mount_point, fstype = mp, parts[2]
+        return not mount_point or fstype in NETWORK_FILESYSTEMS
@@ -11,8 +11,9 @@
 import re
 import string
 import traceback
+from _string import formatter_field_name_split, formatter_parser
 from collections import OrderedDict
-from functools import partial
+from functools import lru_cache, partial
 from math import modf
 from sys import exc_info
 
@@ -1005,6 +1006,12 @@ def __dir__(self):
                         [f+'_' for f in self.__formatter__.funcs.keys()]))
 
 
+def float_deal_with_none(v):
+    # Undefined values and the string 'None' are assumed to be zero.
+    # The reason for string 'None': raw_field returns it for undefined values
+    return float(v if v and v != 'None' else 0)
+
+
 class _Interpreter:
     def error(self, message, line_number):
         m = _('Interpreter: {0} - line number {1}').format(message, line_number)
@@ -1030,6 +1037,8 @@ def program(self, funcs, parent, prog, val, is_call=False, args=None,
             if is_call:
                 # prog is an instance of the function definition class
                 ret = self.do_node_stored_template_call(StoredTemplateCallNode(1, prog.name, prog, None), args=args)
+            elif isinstance(prog, CompiledProgram):
+                ret = self.expression_list(prog.tree) if self.break_reporter else prog.run(self)
             else:
                 ret = self.expression_list(prog)
         except ReturnExecuted as e:
@@ -1505,10 +1514,7 @@ def do_node_string_infix(self, prog):
         '>=#': lambda x, y: x >= y,
         }
 
-    def float_deal_with_none(self, v):
-        # Undefined values and the string 'None' are assumed to be zero.
-        # The reason for string 'None': raw_field returns it for undefined values
-        return float(v if v and v != 'None' else 0)
+    float_deal_with_none = staticmethod(float_deal_with_none)
 
     def do_node_numeric_infix(self, prog):
         try:
@@ -1689,6 +1695,403 @@ def expr(self, prog):
                        prog.line_number)
 
 
+def internal_error(ip, e, line_number):
+    if DEBUG:
+        traceback.print_exc()
+    ip.error(_("Internal error evaluating an expression: '{0}'").format(str(e)), line_number)
+
+
+class CompiledProgram:
+    '''
+    A parsed General Program Mode template together with its compiled form,
+    see :class:`_Compiler`. The tree is used when a break reporter is active.
+    '''
+
+    __slots__ = ('run', 'tree')
+
+    def __init__(self, tree):
+        self.tree = tree
+        self.run = _Compiler().compile_list(tree)
+
+
+class _Compiler:
+    '''
+    Compiles the tree of nodes created by the parser into nested closures,
+    each called with the interpreter as its only argument. This avoids the
+    dispatch through NODE_OPS and the break reporter checks done for every node
+    by the interpreter. The closures raise exactly the same errors as the
+    interpreter. Operators whose operands are all constants are evaluated once,
+    here. Nodes that are not compiled, such as loops, function definitions and
+    calls of stored templates, are evaluated by the interpreter. As a
+    consequence break and continue can only propagate through compiled code to
+    the top of the program, where they are errors, so their values are not
+    tracked.
+    '''
+
+    def constant(self, value):
+        def f(ip):
+            return value
+        f.constant_value = value
+        return f
+
+    def is_constant(self, f):
+        return hasattr(f, 'constant_value')
+
+    def fold(self, f, *operands):
+        # Evaluate f now if all its operands are constants and it does not fail
+        if all(map(self.is_constant, operands)):
+            try:
+                return self.constant(f(_constant_folding_interpreter))
+            except Exception:
+                pass
+        return f
+
+    def compile_list(self, prog):
+        funcs = tuple(map(self.compile, prog))
+        if not funcs:
+            return self.constant('')
+        if len(funcs) == 1:
+            return funcs[0]
+
+        def f(ip):
+            for func in funcs:
+                val = func(ip)
+            return val
+        return f
+
+    def compile(self, prog):
+        if isinstance(prog, list):
+            return self.compile_list(prog)
+        compiler = self.COMPILERS.get(prog.node_type)
+        if compiler is not None:
+            f = compiler(self, prog)
+            if f is not None:
+                return f
+        return lambda ip: ip.expr(prog)
+
+    def compile_constant(self, prog):
+        return self.constant(prog.value)
+
+    def compile_rvalue(self, prog):
+        name, line_number = prog.name, prog.line_number
+
+        def f(ip):
+            try:
+                return ip.locals[name]
+            except Exception:
+                ip.error(_("Unknown identifier '{0}'").format(name), line_number)
+        return f
+
+    def compile_assign(self, prog):
+        left, right = prog.left, self.compile(prog.right)
+
+        def f(ip):
+            ip.locals[left] = t = right(ip)
+            return t
+        return f
+
+    def compile_func(self, prog):
+        args = tuple(map(self.compile, prog.expression_list))
+        id_, line_number = prog.name.strip(), prog.line_number
+
+        def f(ip):
+            vals = [a(ip) for a in args]
+            try:
+                return ip.funcs[id_].eval_(ip.parent, ip.parent_kwargs, ip.parent_book, ip.locals, *vals)
+            except (ValueError, ExecutionBase, StopException):
+                raise
+            except Exception as e:
+                internal_error(ip, e, line_number)
+        return f
+
+    def compile_field(self, prog):
+        expression, line_number = self.compile(prog.expression), prog.line_number
+        if self.is_constant(expression):
+            name = expression.constant_value
+
+            def f(ip):
+                try:
+                    return ip.parent.get_value(name, [], ip.parent_kwargs)
+                except StopException:
+                    raise
+                except Exception:
+                    ip.error(_("Unknown field '{0}'").format(name), line_number)
+            return f
+
+        def f(ip):
+            try:
+                name = expression(ip)
+                try:
+                    return ip.parent.get_value(name, [], ip.parent_kwargs)
+                except StopException:
+                    raise
+                except Exception:
+                    ip.error(_("Unknown field '{0}'").format(name), line_number)
+            except (StopException, ValueError):
+                raise
+            except Exception:
+                ip.error(_("Unknown field '{0}'").format('internal parse error'), line_number)
+        return f
+
+    def compile_raw_field(self, prog):
+        expression, line_number = self.compile(prog.expression), prog.line_number
+        default = None if prog.default is None else self.compile(prog.default)
+        key = None
+        if self.is_constant(expression):
+            # The field key for a constant name is looked up only once
+            try:
+                key = field_metadata.search_term_to_field_key(expression.constant_value)
+            except Exception:
+                pass
+
+        def f(ip):
+            try:
+                name = key or field_metadata.search_term_to_field_key(expression(ip))
+                res = getattr(ip.parent_book, name, None)
+                if res is None and default is not None:
+                    return default(ip)
+                if isinstance(res, list):
+                    fm = ip.parent_book.metadata_for_field(name)
+                    return (', ' if fm is None else fm['is_multiple']['list_to_ui']).join(res)
+                return str(res)
+            except (StopException, ValueError):
+                raise
+            except Exception:
+                ip.error(_("Unknown field '{0}'").format('internal parse error'), line_number)
+        return f
+
+    def compile_if(self, prog):
+        condition, then_part = self.compile(prog.condition), self.compile_list(prog.then_part)
+        else_part = self.compile_list(prog.else_part) if prog.else_part else self.constant('')
+        if self.is_constant(condition):
+            return then_part if condition.constant_value else else_part
+
+        def f(ip):
+            return then_part(ip) if condition(ip) else else_part(ip)
+        return f
+
+    def compile_first_non_empty(self, prog):
+        exprs = tuple(map(self.compile, prog.expression_list))
+
+        def f(ip):
+            for expr in exprs:
+                v = expr(ip)
+                if v:
+                    return v
+            return ''
+        return self.fold(f, *exprs)
+
+    def compile_switch(self, prog):
+        exprs = tuple(map(self.compile, prog.expression_list))
+        value, cases, default = exprs[0], tuple(zip(exprs[1:-1:2], exprs[2:-1:2])), exprs[-1]
+        line_number = prog.line_number
+
+        def f(ip):
+            val = value(ip)
+            for pat, res in cases:
+                v = pat(ip)
+                try:
+                    matches = re.search(v, val, flags=re.I)
+                except (ValueError, ExecutionBase, StopException):
+                    raise
+                except Exception as e:
+                    internal_error(ip, e, line_number)
+                if matches:
+                    return res(ip)
+            return default(ip)
+        return self.fold(f, *exprs)
+
+    def compile_switch_if(self, prog):
+        exprs = tuple(map(self.compile, prog.expression_list))
+        cases, default = tuple(zip(exprs[0:-1:2], exprs[1:-1:2])), exprs[-1]
+
+        def f(ip):
+            for test, res in cases:
+                if test(ip):
+                    return res(ip)
+            return default(ip)
+        return self.fold(f, *exprs)
+
+    def compile_contains(self, prog):
+        value, test, match, not_match = map(self.compile, (
+            prog.value_expression, prog.test_expression, prog.match_expression, prog.not_match_expression))
+        line_number = prog.line_number
+
+        def f(ip):
+            v, t = value(ip), test(ip)
+            try:
+                matches = re.search(t, v, flags=re.I)
+            except (ValueError, ExecutionBase, StopException):
+                raise
+            except Exception as e:
+                internal_error(ip, e, line_number)
+            return match(ip) if matches else not_match(ip)
+        return self.fold(f, value, test, match, not_match)
+
+    def compile_strcat(self, prog):
+        exprs = tuple(map(self.compile, prog.expression_list))
+        line_number = prog.line_number
+
+        def f(ip):
+            vals = [expr(ip) for expr in exprs]
+            try:
+                return ''.join(vals)
+            except (ValueError, ExecutionBase, StopException):
+                raise
+            except Exception as e:
+                internal_error(ip, e, line_number)
+        return self.fold(f, *exprs)
+
+    def compile_string_infix(self, prog):
+        left, right, operator, line_number = self.compile(prog.left), self.compile(prog.right), prog.operator, prog.line_number
+        if operator == 'inlist_field':
+            def compare(x, y, ip):
+                return ip.do_inlist_field(x, y, prog)
+        else:
+            op = _Interpreter.INFIX_STRING_COMPARE_OPS.get(operator)
+            if op is None:
+                return None
+
+            def compare(x, y, ip):
+                return op(x, y)
+
+        def f(ip):
+            try:
+                return '1' if compare(left(ip), right(ip), ip) else ''
+            except (StopException, ValueError):
+                raise
+            except Exception:
+                ip.error(_("Error during string comparison: "
+                           "operator '{0}'").format(operator), line_number)
+        return f if operator == 'inlist_field' else self.fold(f, left, right)
+
+    def compile_numeric_infix(self, prog):
+        left, right, operator, line_number = self.compile(prog.left), self.compile(prog.right), prog.operator, prog.line_number
+        op = _Interpreter.INFIX_NUMERIC_COMPARE_OPS.get(operator)
+        if op is None:
+            return None
+
+        def f(ip):
+            try:
+                return '1' if op(float_deal_with_none(left(ip)), float_deal_with_none(right(ip))) else ''
+            except (StopException, ValueError):
+                raise
+            except Exception:
+                ip.error(_("Value used in comparison is not a number: "
+                           "operator '{0}'").format(operator), line_number)
+        return self.fold(f, left, right)
+
+    def compile_logop(self, prog):
+        left, right, operator, line_number = self.compile(prog.left), self.compile(prog.right), prog.operator, prog.line_number
+        if operator not in ('and', 'or'):
+            return None
+        is_and = operator == 'and'
+
+        def f(ip):
+            try:
+                return '1' if ((left(ip) and right(ip)) if is_and else (left(ip) or right(ip))) else ''
+            except (StopException, ValueError):
+                raise
+            except Exception:
+                ip.error(_("Error during operator evaluation: "
+                           "operator '{0}'").format(operator), line_number)
+        return self.fold(f, left, right)
+
+    def compile_logop_unary(self, prog):
+        expr, operator, line_number = self.compile(prog.expr), prog.operator, prog.line_number
+        if operator != 'not':
+            return None
+
+        def f(ip):
+            try:
+                return '' if expr(ip) else '1'
+            except (StopException, ValueError):
+                raise
+            except Exception:
+                ip.error(_("Error during operator evaluation: "
+                           "operator '{0}'").format(operator), line_number)
+        return self.fold(f, expr)
+
+    def compile_binary_arithop(self, prog):
+        left, right, operator, line_number = self.compile(prog.left), self.compile(prog.right), prog.operator, prog.line_number
+        op = _Interpreter.ARITHMETIC_BINARY_OPS.get(operator)
+        if op is None:
+            return None
+
+        def f(ip):
+            try:
+                answer = op(float_deal_with_none(left(ip)), float_deal_with_none(right(ip)))
+                return str(answer if modf(answer)[0] != 0 else int(answer))
+            except (StopException, ValueError):
+                raise
+            except Exception:
+                ip.error(_("Error during operator evaluation: "
+                           "operator '{0}'").format(operator), line_number)
+        return self.fold(f, left, right)
+
+    def compile_stringops(self, prog):
+        left, right, operator, line_number = self.compile(prog.left), self.compile(prog.right), prog.operator, prog.line_number
+
+        def f(ip):
+            try:
+                return left(ip) + right(ip)
+            except (StopException, ValueError):
+                raise
+            except Exception:
+                ip.error(_("Error during operator evaluation: "
+                           "operator '{0}'").format(operator), line_number)
+        return self.fold(f, left, right)
+
+    COMPILERS = {
+        Node.NODE_CONSTANT:         compile_constant,
+        Node.NODE_RVALUE:           compile_rvalue,
+        Node.NODE_ASSIGN:           compile_assign,
+        Node.NODE_FUNC:             compile_func,
+        Node.NODE_FIELD:            compile_field,
+        Node.NODE_RAW_FIELD:        compile_raw_field,
+        Node.NODE_IF:               compile_if,
+        Node.NODE_FIRST_NON_EMPTY:  compile_first_non_empty,
+        Node.NODE_SWITCH:           compile_switch,
+        Node.NODE_SWITCH_IF:        compile_switch_if,
+        Node.NODE_CONTAINS:         compile_contains,
+        Node.NODE_STRCAT:           compile_strcat,
+        Node.NODE_COMPARE_STRING:   compile_string_infix,
+        Node.NODE_COMPARE_NUMERIC:  compile_numeric_infix,
+        Node.NODE_BINARY_LOGOP:     compile_logop,
+        Node.NODE_UNARY_LOGOP:      compile_logop_unary,
+        Node.NODE_BINARY_ARITHOP:   compile_binary_arithop,
+        Node.NODE_BINARY_STRINGOP:  compile_stringops,
+    }
+
+
+# Used to evaluate operators with constant operands when compiling, only its
+# error() method is ever called
+_constant_folding_interpreter = _Interpreter()
+
+
+@lru_cache(maxsize=512)
+def simple_format_parts(fmt):
+    '''
+    Return the parts of a Single Function Mode template as a tuple of (literal
+    text, field name, format spec). Returns None for templates that use
+    features of format strings that need the full implementation in
+    string.Formatter, such as conversions, nested or positional fields.
+    '''
+    ans = []
+    try:
+        for literal_text, field_name, format_spec, conversion in formatter_parser(fmt):
+            if field_name is not None:
+                if conversion is not None or '{' in format_spec or '}' in format_spec:
+                    return None
+                first, rest = formatter_field_name_split(field_name)
+                if not first or not isinstance(first, str) or next(rest, None) is not None:
+                    return None
+            ans.append((literal_text, field_name, format_spec))
+    except ValueError:
+        return None
+    return tuple(ans)
+
+
 class TemplateFormatter(string.Formatter):
     '''
     Provides a format function that substitutes '' for any missing value
@@ -1787,9 +2190,11 @@ def _explode_format_string(self, fmt):
 
     def _eval_program(self, val, prog, column_name, global_vars, break_reporter):
         if column_name is not None and self.template_cache is not None:
+            # Templates in the cache are compiled as they are likely to be
+            # evaluated for many books
             tree = self.template_cache.get(column_name, None)
             if not tree:
-                tree = self.gpm_parser.program(self, self.funcs, self.lex_scanner.scan(prog))
+                tree = CompiledProgram(self.gpm_parser.program(self, self.funcs, self.lex_scanner.scan(prog)))
                 self.template_cache[column_name] = tree
         else:
             tree = self.gpm_parser.program(self, self.funcs, self.lex_scanner.scan(prog))
@@ -1827,6 +2232,12 @@ def _run_python_template(self, compiled_template, arguments):
         try:
             db = get_database(self.book, None)
             db = db if db is not None else self.database
+            # The context and the function caller are created only when needed
+            # as most templates are not python templates
+            if self.python_context_object is None:
+                self.python_context_object = PythonTemplateContext()
+            if self._caller is None:
+                self._caller = FormatterFuncsCaller(self)
             self.python_context_object.set_values(
                          db=db,
                          globals=self.global_vars,
@@ -1877,6 +2288,20 @@ def replace_func(mo):
     def get_value(self, key, args, kwargs):
         raise Exception('get_value must be implemented in the subclass')
 
+    def vformat(self, fmt, args, kwargs):
+        # The parsed template is cached as the same few templates are used
+        # for many books
+        parts = simple_format_parts(fmt)
+        if parts is None:
+            return string.Formatter.vformat(self, fmt, args, kwargs)
+        ans = []
+        for literal_text, field_name, format_spec in parts:
+            if literal_text:
+                ans.append(literal_text)
+            if field_name is not None:
+                ans.append(self.format_field(self.get_value(field_name, args, kwargs), format_spec))
+        return ''.join(ans)
+
     def format_field(self, val, fmt):
         # ensure we are dealing with a string.
         if isinstance(val, numbers.Number):
@@ -2029,7 +2454,7 @@ def unsafe_format(self, fmt, kwargs, book, strip_results=True, global_vars=None,
                       python_context_object=None):
         state = self.save_state()
         try:
-            self._caller = FormatterFuncsCaller(self)
+            self._caller = None
             self.strip_results = strip_results
             self.column_name = self.template_cache = None
             self.kwargs = kwargs
@@ -2037,10 +2462,7 @@ def unsafe_format(self, fmt, kwargs, book, strip_results=True, global_vars=None,
             self.composite_values = {}
             self.locals = {}
             self.global_vars = global_vars if isinstance(global_vars, dict) else {}
-            if isinstance(python_context_object, PythonTemplateContext):
-                self.python_context_object = python_context_object
-            else:
-                self.python_context_object = PythonTemplateContext()
+            self.python_context_object = python_context_object if isinstance(python_context_object, PythonTemplateContext) else None
             return self.evaluate(fmt, [], kwargs, self.global_vars)
         finally:
             self.restore_state(state)
@@ -2059,17 +2481,14 @@ def safe_format(self, fmt, kwargs, error_value, book,
             self.composite_values = {}
             self.database = database
         try:
-            self._caller = FormatterFuncsCaller(self)
+            self._caller = None
             self.strip_results = strip_results
             self.column_name = column_name
             self.template_cache = template_cache
             self.kwargs = kwargs
             self.book = book
             self.global_vars = global_vars if isinstance(global_vars, dict) else {}
-            if isinstance(python_context_object, PythonTemplateContext):
-                self.python_context_object = python_context_object
-            else:
-                self.python_context_object = PythonTemplateContext()
+            self.python_context_object = python_context_object if isinstance(python_context_object, PythonTemplateContext) else None
             if template_functions:
                 self.funcs = template_functions
             else:
@@ -15,7 +15,7 @@
 
 from css_selectors.errors import ExpressionError
 from css_selectors.ordered_set import OrderedSet
-from css_selectors.parser import Element, FunctionalPseudoElement, ascii_lower, parse
+from css_selectors.parser import Class, CombinedSelector, Element, FunctionalPseudoElement, Hash, Pseudo, ascii_lower, parse
 from polyglot.builtins import iteritems, itervalues
 
 PARSE_CACHE_SIZE = 200
@@ -193,6 +193,18 @@ def has_matches(self, selector, root=None):
         for elem in self(selector, root=root):
             return True
         return False
+
+    def matcher(self, selector):
+        ''' Return a function that takes a tag from the tree and returns True
+        iff it matches selector, which can be a string or a parsed selector.
+        Use this to test many tags against a selector, instead of finding all
+        tags matching it. Raises :class:`ExpressionError` if the selector is
+        not supported. '''
+        parsed_selectors = get_parsed_selector(selector) if isinstance(selector, str) else (selector,)
+        matchers = tuple(compile_matcher(self, s) for s in parsed_selectors)
+        if len(matchers) == 1:
+            return matchers[0]
+        return lambda elem: any(m(elem) for m in matchers)
     # }}}
 
     def iterparsedselector(self, parsed_selector):
@@ -683,7 +695,236 @@ def select_empty(cache, elem):
 
 # }}}
 
+# Matching single tags {{{
+# These compile parsed selectors into functions that test a single tag, right
+# to left, with the same semantics as the select_* functions above
+
+
+def rightmost_key(parsed_selector):
+    ''' Return one of ('id', val), ('class', val) or ('tag', val) that every
+    tag matching parsed_selector must have, preferring the most selective, or
+    None if there is none. Ids, classes and tag names are lower cased. Used to
+    index selectors so that tags need only be tested against selectors that
+    can match them. '''
+    node = getattr(parsed_selector, 'parsed_tree', parsed_selector)
+    if isinstance(node, CombinedSelector):
+        node = node.subselector
+    id_ = class_name = tag = None
+    while node is not None:
+        if isinstance(node, Hash):
+            id_ = id_ or ascii_lower(node.id)
+        elif isinstance(node, Class):
+            class_name = class_name or ascii_lower(node.class_name)
+        elif isinstance(node, Element):
+            if node.element and node.element != '*':
+                tag = ascii_lower(node.element)
+            break
+        elif isinstance(node, Pseudo) and node.ident == 'root':
+            break  # :root ignores the rest of the compound selector
+        node = getattr(node, 'selector', None)
+    if id_ is not None:
+        return 'id', id_
+    if class_name is not None:
+        return 'class', class_name
+    if tag is not None:
+        return 'tag', tag
+
+
+def compile_matcher(cache, parsed_selector):
+    type_name = type(parsed_selector).__name__
+    try:
+        func = matcher_map[ascii_lower(type_name)]
+    except KeyError:
+        raise ExpressionError(f'{type_name} is not supported')
+    return func(cache, parsed_selector)
+
+
+def match_any(elem):
+    return True
+
+
+def match_selector(cache, selector):
+    match = compile_matcher(cache, selector.parsed_tree)
+    if selector.pseudo_element is None:
+        return match
+    if isinstance(selector.pseudo_element, FunctionalPseudoElement):
+        raise ExpressionError(
+            f'The pseudo-element ::{selector.pseudo_element.name} is not supported')
+    func = get_func_for_pseudo(cache, selector.pseudo_element)
+    return lambda elem: match(elem) and func(cache, elem)
+
+
+def match_combinedselector(cache, combined):
+    combinator = cache.combinator_mapping[combined.combinator]
+    left, right = compile_matcher(cache, combined.selector), compile_matcher(cache, combined.subselector)
+    return combinator_matchers[combinator](cache.root, left, right)
+
+
+def match_descendant(root, left, right):
+    def match(elem):
+        if elem is root or not right(elem):
+            return False
+        ancestor = elem.getparent()
+        while ancestor is not None:
+            if left(ancestor):
+                return True
+            if ancestor is root:
+                break
+            ancestor = ancestor.getparent()
+        return False
+    return match
+
+
+def match_child(root, left, right):
+    def match(elem):
+        if elem is root or not right(elem):
+            return False
+        parent = elem.getparent()
+        return parent is not None and left(parent)
+    return match
+
+
+def match_direct_adjacent(root, left, right):
+    def match(elem):
+        if elem is root or not right(elem):
+            return False
+        for sibling in elem.itersiblings('*', preceding=True):
+            return left(sibling)
+        return False
+    return match
+
+
+def match_indirect_adjacent(root, left, right):
+    def match(elem):
+        if elem is root or not right(elem):
+            return False
+        for sibling in elem.itersiblings('*', preceding=True):
+            if left(sibling):
+                return True
+        return False
+    return match
+
+
+combinator_matchers = {
+    'descendant': match_descendant, 'child': match_child,
+    'direct_adjacent': match_direct_adjacent, 'indirect_adjacent': match_indirect_adjacent,
+}
+
+
+def match_element(cache, selector):
+    element = selector.element
+    if not element or element == '*':
+        return match_any
+    element = ascii_lower(element)
+    map_tag_name = cache.map_tag_name
+    tag_matches = {}
+
+    def match_tag_name(elem):
+        tag = elem.tag
+        ans = tag_matches.get(tag)
+        if ans is None:
+            ans = tag_matches[tag] = map_tag_name(tag) == element
+        return ans
+    return match_tag_name
+
+
+def match_hash(cache, selector):
+    match, val = compile_matcher(cache, selector.selector), ascii_lower(selector.id)
+
+    def match_id(elem):
+        q = elem.get('id')
+        return q is not None and ascii_lower(q) == val and match(elem)
+    return match_id
+
+
+def match_class(cache, selector):
+    match, val = compile_matcher(cache, selector.selector), ascii_lower(selector.class_name)
+    class_matches = {}
+
+    def match_class_name(elem):
+        q = elem.get('class')
+        if q is None:
+            return False
+        ans = class_matches.get(q)
+        if ans is None:
+            ans = class_matches[q] = val in ascii_lower(q).split()
+        return ans and match(elem)
+    return match_class_name
+
+
+def match_negation(cache, selector):
+    match, exclude = compile_matcher(cache, selector.selector), compile_matcher(cache, selector.subselector)
+    return lambda elem: match(elem) and not exclude(elem)
+
+
+attrib_value_tests = {
+    'exists': lambda val, value: True,
+    'equals': lambda val, value: val == value,
+    'includes': lambda val, value: value in val.split(),
+    'dashmatch': lambda val, value: val == value or val.startswith(value + '-'),
+    'prefixmatch': lambda val, value: val.startswith(value),
+    'suffixmatch': lambda val, value: val.endswith(value),
+    'substringmatch': lambda val, value: value in val,
+}
+
+
+def match_attrib(cache, selector):
+    operator = cache.attribute_operator_mapping[selector.operator]
+    value = selector.value
+    if operator != 'exists' and (not value or (operator == 'includes' and not is_non_whitespace(value))):
+        return lambda elem: False
+    match, name, test = compile_matcher(cache, selector.selector), ascii_lower(selector.attrib), attrib_value_tests[operator]
+    map_attrib_name = ascii_lower
+    if '{' in cache.root.tag:
+        def map_attrib_name(x):
+            return ascii_lower(x.rpartition('}')[2])
+    name_matches = {}
+
+    def match_attrib_value(elem):
+        for attr, val in iteritems(elem.attrib):
+            q = name_matches.get(attr)
+            if q is None:
+                q = name_matches[attr] = map_attrib_name(attr) == name
+            if q and test(val, value):
+                return match(elem)
+        return False
+    return match_attrib_value
+
+
+def match_function(cache, function):
+    fname = function.name.replace('-', '_')
+    try:
+        func = cache.dispatch_map[fname]
+    except KeyError:
+        raise ExpressionError(
+            f'The pseudo-class :{function.name}() is unknown')
+    match = compile_matcher(cache, function.selector)
+    if fname == 'lang':
+        items = frozenset(func(cache, function))
+        return lambda elem: elem in items and match(elem)
+    if fname not in ('nth_child', 'nth_last_child', 'nth_of_type', 'nth_last_of_type'):
+        raise ExpressionError(
+            f'The pseudo-class :{function.name}() is not supported')
+    function.parsed_arguments  # Raise ExpressionError for invalid arguments now
+    return lambda elem: match(elem) and func(cache, function, elem)
+
+
+def match_pseudo(cache, pseudo):
+    func = get_func_for_pseudo(cache, pseudo.ident)
+    if func is select_root:
+        root = cache.root
+        return lambda elem: elem is root
+    match = compile_matcher(cache, pseudo.selector)
+    return lambda elem: match(elem) and func(cache, elem)
+
+# }}}
+
+
 default_dispatch_map = {name.partition('_')[2]:obj for name, obj in globals().items() if name.startswith('select_') and callable(obj)}
+matcher_map = {
+    'selector': match_selector, 'combinedselector': match_combinedselector, 'element': match_element, 'hash': match_hash,
+    'class': match_class, 'negation': match_negation, 'attrib': match_attrib, 'function': match_function, 'pseudo': match_pseudo,
+}
 
 if __name__ == '__main__':
     from pprint import pprint
@@ -13,7 +13,7 @@
 
 from css_selectors.errors import ExpressionError, SelectorSyntaxError
 from css_selectors.parser import parse, tokenize
-from css_selectors.select import Select
+from css_selectors.select import Select, rightmost_key
 
 
 class TestCSSSelectors(unittest.TestCase):
@@ -659,6 +659,9 @@ def pcss(main, *selectors, **kwargs):
             result = list(select_ids(main))
             for selector in selectors:
                 self.ae(list(select_ids(selector)), result)
+            for selector in (main,) + selectors:
+                match = select.matcher(selector)
+                self.ae([elem.get('id') for elem in select.itertag() if match(elem)], result, selector)
             return result
         all_ids = pcss('*')
         self.ae(all_ids[:6], [
@@ -740,15 +743,30 @@ def pcss(main, *selectors, **kwargs):
         self.ae(pcss(r'[h\a0 ref]', r'[h\]ref]'), [])
 
         self.assertRaises(ExpressionError, lambda : tuple(select('body:nth-child')))
+        self.assertRaises(ExpressionError, select.matcher, 'body:nth-child')
 
         select = Select(document, ignore_inappropriate_pseudo_classes=True)
         self.assertGreater(len(tuple(select('p:hover'))), 0)
 
+    def test_rightmost_key(self):
+        def key(css):
+            return rightmost_key(parse(css)[0])
+        self.ae(key('div p.C#X'), ('id', 'x'))
+        self.ae(key('#x p.c'), ('class', 'c'))
+        self.ae(key('div > P[title]:first-child'), ('tag', 'p'))
+        self.ae(key('div :not(p)'), None)
+        self.ae(key('*'), None)
+        self.ae(key('p:root'), None)
+        self.ae(key('p:root.c'), ('class', 'c'))
+
     def test_select_shakespeare(self):
         document = html.document_fromstring(self.HTML_SHAKESPEARE)
         select = Select(document)
         def count(s):
-            return sum(1 for r in select(s))
+            ans = sum(1 for r in select(s))
+            match = select.matcher(s)
+            self.ae(sum(1 for elem in select.itertag() if match(elem)), ans, s)
+            return ans
 
         # Data borrowed from http://mootools.net/slickspeed/
 